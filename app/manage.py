@@ -1,6 +1,6 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
-from flask_script import Command
+from flask_script import Command, Option
 import sys
 import os
 
@@ -30,6 +30,52 @@ class UpdateData(Command):
             create_float_transfer_account(app)
 
 
+class ReconcileTransferAccountLedgers(Command):
+    """
+    Recomputes transfer account running totals from their credit transfers and reports any drift
+    """
+
+    option_list = (
+        Option('--fix', dest='fix', action='store_true', default=False,
+               help='Correct the totals and balances of drifted accounts'),
+    )
+
+    def run(self, fix):
+        from server.utils.transfer_account import reconcile_transfer_account_ledgers
+        with app.app_context():
+            drift = reconcile_transfer_account_ledgers(fix=fix)
+            for item in drift:
+                print(f"Transfer account {item['transfer_account_id']}: "
+                      f"stored {item['stored']}, expected {item['expected']}")
+            print(f'{len(drift)} transfer account(s) drifted{" and were corrected" if fix and drift else ""}')
+
+
+class RebuildMetricsRollups(Command):
+    """
+    Rebuilds the daily metrics rollups of every organisation (or just one) from their transfers and users
+    """
+
+    option_list = (
+        Option('--organisation', dest='organisation_id', type=int, default=None,
+               help='Only rebuild this organisation'),
+    )
+
+    def run(self, organisation_id):
+        from server.models.organisation import Organisation
+        from server.utils.metrics.rollups import rebuild_metrics_rollups
+        with app.app_context():
+            organisations = Organisation.query
+            if organisation_id:
+                organisations = organisations.filter(Organisation.id == organisation_id)
+            for organisation in organisations.all():
+                if organisation.token_id is None:
+                    print(f'Organisation {organisation.id} has no token, skipping')
+                    continue
+                rows = rebuild_metrics_rollups(organisation)
+                db.session.commit()
+                print(f'Organisation {organisation.id}: {rows} rollup rows')
+
+
 app = create_app()
 manager = Manager(app)
 
@@ -39,6 +85,10 @@ manager.add_command('db', MigrateCommand)
 
 manager.add_command('update_data', UpdateData())
 
+manager.add_command('reconcile_ledgers', ReconcileTransferAccountLedgers())
+
+manager.add_command('rebuild_metrics_rollups', RebuildMetricsRollups())
+
 
 if __name__ == '__main__':
     manager.run()
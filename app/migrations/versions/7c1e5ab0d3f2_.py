@@ -0,0 +1,45 @@
+"""Add running transfer totals to transfer_account
+
+Revision ID: 7c1e5ab0d3f2
+Revises: 50fa8260cee7
+Create Date: 2026-10-18 09:12:44.210391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5ab0d3f2'
+down_revision = '50fa8260cee7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transfer_account', sa.Column('_total_received_complete_wei', sa.Numeric(precision=27), nullable=True))
+    op.add_column('transfer_account', sa.Column('_total_sent_complete_wei', sa.Numeric(precision=27), nullable=True))
+    op.add_column('transfer_account', sa.Column('_total_sent_pending_wei', sa.Numeric(precision=27), nullable=True))
+
+    # Backfill the running totals from existing transfers
+    op.execute('''
+        UPDATE transfer_account SET
+            _total_received_complete_wei = COALESCE((
+                SELECT SUM(_transfer_amount_wei) FROM credit_transfer
+                WHERE recipient_transfer_account_id = transfer_account.id AND transfer_status = 'COMPLETE'
+            ), 0),
+            _total_sent_complete_wei = COALESCE((
+                SELECT SUM(_transfer_amount_wei) FROM credit_transfer
+                WHERE sender_transfer_account_id = transfer_account.id AND transfer_status = 'COMPLETE'
+            ), 0),
+            _total_sent_pending_wei = COALESCE((
+                SELECT SUM(_transfer_amount_wei) FROM credit_transfer
+                WHERE sender_transfer_account_id = transfer_account.id AND transfer_status IN ('PENDING', 'PARTIAL')
+            ), 0)
+    ''')
+
+
+def downgrade():
+    op.drop_column('transfer_account', '_total_sent_pending_wei')
+    op.drop_column('transfer_account', '_total_sent_complete_wei')
+    op.drop_column('transfer_account', '_total_received_complete_wei')
@@ -0,0 +1,40 @@
+"""Add a completed receive count to user, to rank the business directory by
+
+Revision ID: 7d4b9e2a6c15
+Revises: e4a1c7b9d2f6
+Create Date: 2026-10-18 21:42:07.318526
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4b9e2a6c15'
+down_revision = 'e4a1c7b9d2f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('completed_receive_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill from the transfers users have already received. Afterwards it's kept up to date as transfers complete
+    op.execute('''
+        UPDATE "user" SET completed_receive_count = receives.count
+        FROM (
+            SELECT recipient_user_id, count(*) AS count FROM credit_transfer
+            WHERE transfer_status = 'COMPLETE' AND recipient_user_id IS NOT NULL
+            GROUP BY recipient_user_id
+        ) AS receives
+        WHERE "user".id = receives.recipient_user_id
+    ''')
+    op.create_index(
+        'ix_user_directory_ranking', 'user', ['business_usage_id', 'completed_receive_count'],
+        postgresql_where=sa.text('is_market_enabled = true')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_user_directory_ranking', table_name='user')
+    op.drop_column('user', 'completed_receive_count')
@@ -0,0 +1,43 @@
+"""Add prior task frontier for credit transfers
+
+Revision ID: 9b3f5d1e7a20
+Revises: 7c1e5ab0d3f2
+Create Date: 2026-10-18 13:05:51.774210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3f5d1e7a20'
+down_revision = '7c1e5ab0d3f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transfer_account', sa.Column('_last_completed_send_id', sa.Integer(), nullable=True))
+
+    op.execute('''
+        UPDATE transfer_account SET _last_completed_send_id = last_send.id
+        FROM (
+            SELECT sender_transfer_account_id, MAX(id) AS id FROM credit_transfer
+            WHERE transfer_status = 'COMPLETE'
+            GROUP BY sender_transfer_account_id
+        ) AS last_send
+        WHERE last_send.sender_transfer_account_id = transfer_account.id
+    ''')
+
+    op.create_index(
+        'ix_credit_transfer_unconfirmed_receives',
+        'credit_transfer',
+        ['recipient_transfer_account_id', 'id'],
+        unique=False,
+        postgresql_where=sa.text("transfer_status = 'COMPLETE' AND blockchain_status IS DISTINCT FROM 'SUCCESS'")
+    )
+
+
+def downgrade():
+    op.drop_index('ix_credit_transfer_unconfirmed_receives', table_name='credit_transfer')
+    op.drop_column('transfer_account', '_last_completed_send_id')
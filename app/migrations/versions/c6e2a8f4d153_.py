@@ -0,0 +1,50 @@
+"""Add daily metrics rollups
+
+Revision ID: c6e2a8f4d153
+Revises: 9b3f5d1e7a20
+Create Date: 2026-10-18 15:42:10.318452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6e2a8f4d153'
+down_revision = '9b3f5d1e7a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('metrics_daily_rollup',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('authorising_user_id', sa.Integer(), nullable=True),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.Column('organisation_id', sa.Integer(), nullable=False),
+    sa.Column('token_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('object_type', sa.String(), nullable=False),
+    sa.Column('transfer_type', sa.String(), nullable=False),
+    sa.Column('transfer_subtype', sa.String(), nullable=False),
+    sa.Column('dimension', sa.String(), nullable=False),
+    sa.Column('group_value', sa.String(), nullable=False),
+    sa.Column('total_amount_wei', sa.Numeric(precision=36), nullable=False),
+    sa.Column('item_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['organisation_id'], ['organisation.id'], ),
+    sa.ForeignKeyConstraint(['token_id'], ['token.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('organisation_id', 'day', 'object_type', 'dimension', 'group_value',
+                        'token_id', 'transfer_type', 'transfer_subtype', name='uq_metrics_daily_rollup_key')
+    )
+    op.create_index(op.f('ix_metrics_daily_rollup_id'), 'metrics_daily_rollup', ['id'], unique=False)
+    # Rollups are built per organisation with `python manage.py rebuild_metrics_rollups`. Until then, metrics
+    # keep using the raw queries
+    op.add_column('organisation', sa.Column('metrics_rollup_offset_hours', sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('organisation', 'metrics_rollup_offset_hours')
+    op.drop_index(op.f('ix_metrics_daily_rollup_id'), table_name='metrics_daily_rollup')
+    op.drop_table('metrics_daily_rollup')
@@ -0,0 +1,34 @@
+"""Add a trigram indexed search document to user
+
+Revision ID: e4a1c7b9d2f6
+Revises: c6e2a8f4d153
+Create Date: 2026-10-18 19:05:21.482113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a1c7b9d2f6'
+down_revision = 'c6e2a8f4d153'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('search_document', sa.String(), nullable=True))
+
+    # Backfill from the columns search ranks on. Afterwards it's kept up to date by the User model
+    op.execute('''
+        UPDATE "user" SET search_document = concat_ws(
+            ' ', first_name, last_name, _phone, _public_serial_number, _location, primary_blockchain_address
+        )
+    ''')
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX trgm_search_document ON "user" USING gin (search_document gin_trgm_ops)')
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS trgm_search_document')
+    op.drop_column('user', 'search_document')
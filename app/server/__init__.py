@@ -24,6 +24,7 @@ import i18n
 from eth_utils import to_checksum_address
 import sys
 import os
+import math
 import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -243,6 +244,20 @@ def register_blueprints(app):
     def page_not_found(e):
         return render_template('index.html'), 404
 
+    from server.exceptions import PaginationCursorError
+
+    @app.errorhandler(PaginationCursorError)
+    def invalid_pagination_cursor(e):
+        return make_response(jsonify({'message': str(e)})), 400
+
+    from server.exceptions import HashingBusyError
+
+    @app.errorhandler(HashingBusyError)
+    def hashing_busy(e):
+        response = make_response(jsonify({'message': str(e)}), 503)
+        response.headers['Retry-After'] = str(math.ceil(config.HASHING_QUEUE_TIMEOUT_SECONDS) or 1)
+        return response
+
 
 def none_if_exception(f: Callable) -> Union[object, None]:
     """
@@ -25,9 +25,9 @@ from server.utils.search import generate_search_query, CREDIT_TRANSFER
 from server.utils.credit_transfer import (
     make_payment_transfer,
     make_target_balance_transfer,
-    make_blockchain_transfer)
+    make_blockchain_transfer,
+    ingest_third_party_transfers)
 
-from server.utils.user import create_transfer_account_if_required
 from server.utils.auth import multi_org
 
 from server.exceptions import NoTransferAccountError, UserNotFoundError, InsufficientBalanceError, AccountNotApprovedError, \
@@ -479,93 +479,72 @@ class InternalCreditTransferAPI(MethodView):
     def post(self):
         post_data = request.get_json()
 
-        transfer_amount = post_data.get('transfer_amount')
-        sender_blockchain_address = post_data.get('sender_blockchain_address')
-        recipient_blockchain_address = post_data.get('recipient_blockchain_address')
-        blockchain_transaction_hash = post_data.get('blockchain_transaction_hash')
-        contract_address = post_data.get('contract_address')
-
-        transfer = CreditTransfer.query.execution_options(show_all=True).filter_by(blockchain_hash=blockchain_transaction_hash).first()
-        # Case 1: Transfer exists in the database already. Mark received_third_party_sync as true, fetch it, and return it in that case
-        if transfer:
-            transfer.received_third_party_sync = True
-            credit_transfer = credit_transfer_schema.dump(transfer).data
-            response_object = {
-                'message': 'Transfer Successful',
-                'data': {
-                    'credit_transfer': credit_transfer,
-                }
+        result = ingest_third_party_transfers([post_data])[0]
+
+        transfer = result['credit_transfer']
+        response_object = {
+            'message': result['message'],
+            'data': {
+                'credit_transfer': credit_transfer_schema.dump(transfer).data,
+            } if transfer else {}
+        }
+
+        return make_response(jsonify(response_object)), 201
+
+
+class InternalCreditTransferBatchAPI(MethodView):
+    @requires_auth(allowed_basic_auth_types=('internal',))
+    def post(self):
+        """
+        Batch variant of InternalCreditTransferAPI, used by the worker's third party sync.
+        The whole batch is ingested together; if that fails, each transfer is retried inside its own savepoint
+        so that a single bad transfer only fails itself.
+        Returns a list with a result per transfer, in the order they were sent, each carrying the transfer's
+        blockchain_transaction_hash
+        """
+        post_data = request.get_json()
+
+        transfers = post_data.get('transfers') or []
+
+        def _to_result(ingested, ok=True):
+            transfer = ingested['credit_transfer']
+            return {
+                'blockchain_transaction_hash': ingested['blockchain_transaction_hash'],
+                'ok': ok,
+                'message': ingested['message'],
+                'credit_transfer_id': transfer.id if transfer else None
             }
 
-        else:
-            token = Token.query.filter_by(address=contract_address).first()
-            maybe_sender_transfer_account = TransferAccount.query.execution_options(show_all=True).filter_by(blockchain_address=sender_blockchain_address).first()
-            maybe_sender_user = maybe_sender_transfer_account.users[0] if maybe_sender_transfer_account and len(maybe_sender_transfer_account.users) == 1 else None
+        savepoint = db.session.begin_nested()
+        try:
+            results = [_to_result(r) for r in ingest_third_party_transfers(transfers)]
+            savepoint.commit()
+        except Exception:
+            savepoint.rollback()
+            results = []
+            for transfer_data in transfers:
+                savepoint = db.session.begin_nested()
+                try:
+                    results.append(_to_result(ingest_third_party_transfers([transfer_data])[0]))
+                    savepoint.commit()
+                except Exception as e:
+                    savepoint.rollback()
+                    results.append(_to_result({
+                        'blockchain_transaction_hash': transfer_data.get('blockchain_transaction_hash'),
+                        'message': str(e),
+                        'credit_transfer': None
+                    }, ok=False))
 
-            maybe_recipient_transfer_account = TransferAccount.query.execution_options(show_all=True).filter_by(blockchain_address=recipient_blockchain_address).first()
-            maybe_recipient_user = maybe_recipient_transfer_account.users[0] if maybe_recipient_transfer_account and len(maybe_recipient_transfer_account.users) == 1 else None
+        response_object = {
+            'message': f'Processed {len(results)} transfers',
+            'data': {
+                'results': results
+            }
+        }
 
-            # Case 2: Two non-sempo users making a trade on our token. We don't have to track this!
-            if not maybe_recipient_transfer_account and not maybe_sender_transfer_account:
-                response_object = {
-                    'message': 'No existing users involved in this transfer',
-                    'data': {}
-                }
-            # Case 3: Two non-Sempo users, at least one of whom has interacted with Sempo users before transacting with one another
-            # We don't have to track this either!
-            elif (
-                    # The recipient is either an external transfer account we've seen before
-                    # OR we haven't seen them before and so can infer they're external
-                    (
-                            (
-                             maybe_recipient_transfer_account
-                             and maybe_recipient_transfer_account.account_type == TransferAccountType.EXTERNAL
-                            ) or not maybe_recipient_transfer_account)
-                    and
-                    #
-                    # And the sender is either an external transfer account we've seen before
-                    # OR we haven't seen them before and so can infer they're external
-                    ((
-                             maybe_sender_transfer_account
-                             and maybe_sender_transfer_account.account_type == TransferAccountType.EXTERNAL
-                     ) or not maybe_sender_transfer_account)
-            ):
-                    response_object = {
-                        'message': 'Only external users involved in this transfer',
-                        'data': {}
-                    }
-            # Case 4: One or both of the transfer accounts are affiliated with Sempo accounts.
-            # This is the only case where we want to generate a new CreditTransfer object.
-            else:
-                send_transfer_account = create_transfer_account_if_required(sender_blockchain_address, token, TransferAccountType.EXTERNAL)
-                receive_transfer_account = create_transfer_account_if_required(recipient_blockchain_address, token, TransferAccountType.EXTERNAL)
-                transfer = CreditTransfer(
-                    transfer_amount,
-                    token=token,
-                    sender_transfer_account=send_transfer_account,
-                    recipient_transfer_account=receive_transfer_account,
-                    transfer_type=TransferTypeEnum.PAYMENT,
-                    sender_user=maybe_sender_user,
-                    recipient_user=maybe_recipient_user,
-                    require_sufficient_balance=False,
-                    received_third_party_sync=True
-                )
-
-                transfer.resolve_as_complete_with_existing_blockchain_transaction(
-                    blockchain_transaction_hash
-                )
-
-                db.session.flush()
-
-                credit_transfer = credit_transfer_schema.dump(transfer).data
-                response_object = {
-                    'message': 'Transfer Successful',
-                    'data': {
-                        'credit_transfer': credit_transfer,
-                    }
-                }
         return make_response(jsonify(response_object)), 201
 
+
 # add Rules for API Endpoints
 credit_transfer_blueprint.add_url_rule(
     '/credit_transfer/',
@@ -585,3 +564,9 @@ credit_transfer_blueprint.add_url_rule(
     view_func=InternalCreditTransferAPI.as_view('internal_credit_transfer_view'),
     methods=['POST']
 )
+
+credit_transfer_blueprint.add_url_rule(
+    '/credit_transfer/internal/batch/',
+    view_func=InternalCreditTransferBatchAPI.as_view('internal_credit_transfer_batch_view'),
+    methods=['POST']
+)
@@ -1,5 +1,4 @@
 from decimal import Decimal
-import math
 import datetime 
 
 from sqlalchemy.orm import joinedload, load_only
@@ -15,12 +14,11 @@ from server.models.credit_transfer import CreditTransfer
 from server.utils.auth import requires_auth
 from server.utils.transfer_filter import process_transfer_filters
 from server.utils.search import generate_search_query
-from server.utils.credit_transfer import make_payment_transfer, make_target_balance_transfer
-from server.utils.transfer_enums import TransferSubTypeEnum, TransferModeEnum
+from server.utils.disbursement import make_disbursement_transfers
 from server.models.utils import paginate_query
 from server.utils.executor import status_checkable_executor_job, add_after_request_checkable_executor_job
 from server.utils.access_control import AccessControl
-from server.utils.metrics.metrics_cache import clear_metrics_cache, rebuild_metrics_cache
+from server.utils.metrics.metrics_cache import rebuild_metrics_cache
 
 disbursement_blueprint = Blueprint('disbursement', __name__)
 
@@ -32,62 +30,15 @@ def make_transfers(disbursement_id, auto_resolve=False):
     }
 
     send_transfer_account = g.user.default_organisation.queried_org_level_transfer_account
-    from server.models.user import User
-    from server.models.transfer_account import TransferAccount
     from server.models.disbursement import Disbursement
     disbursement = db.session.query(Disbursement).filter(Disbursement.id == disbursement_id)\
         .first()
     disbursement.mark_processing()
     db.session.commit()
-    for idx, ta in enumerate(disbursement.transfer_accounts):
-        try:
-            user = ta.primary_user
-            if disbursement.transfer_type == 'DISBURSEMENT':
-                transfer = make_payment_transfer(
-                    disbursement.disbursement_amount,
-                    send_user=g.user,
-                    receive_user=db.session.query(User).filter(User.id == user.id).first(),
-                    send_transfer_account=send_transfer_account,
-                    receive_transfer_account=db.session.query(TransferAccount).filter(TransferAccount.id == ta.id).first(),
-                    transfer_subtype=TransferSubTypeEnum.DISBURSEMENT,
-                    transfer_mode=TransferModeEnum.WEB,
-                    automatically_resolve_complete=False,
-                )
-            if disbursement.transfer_type == 'RECLAMATION':
-                transfer = make_payment_transfer(
-                    disbursement.disbursement_amount,
-                    send_user=db.session.query(User).filter(User.id == user.id).first(),
-                    send_transfer_account=db.session.query(TransferAccount).filter(TransferAccount.id == ta.id).first(),
-                    transfer_subtype=TransferSubTypeEnum.RECLAMATION,
-                    transfer_mode=TransferModeEnum.WEB,
-                    require_recipient_approved=False,
-                    automatically_resolve_complete=False,
-                )
-            if disbursement.transfer_type == 'BALANCE':
-                transfer = make_target_balance_transfer(
-                        disbursement.disbursement_amount,
-                        db.session.query(User).filter(User.id == user.id).first(),
-                        automatically_resolve_complete=False,
-                        transfer_mode=TransferModeEnum.WEB,
-                    )
-
-            disbursement.credit_transfers.append(transfer)
-            if auto_resolve and disbursement.state == 'APPROVED':
-                transfer.approvers = disbursement.approvers
-                transfer.add_approver_and_resolve_as_completed()
-        except Exception as e:
-            disbursement.errors = disbursement.errors + [str(ta) +': ' + str(e)]
-
-        db.session.commit()
-        percent_complete = ((idx + 1) / disbursement.recipient_count) * 100
-        message = f'Creating transfer {idx+1} of {disbursement.recipient_count}'
-        yield {
-            'message': 'Success' if percent_complete == 100 else message,
-            'percent_complete': math.floor(percent_complete),
-        }
+    for progress in make_disbursement_transfers(disbursement, send_transfer_account, auto_resolve=auto_resolve):
+        yield progress
     disbursement.mark_complete()
     db.session.commit()
-    clear_metrics_cache()
     rebuild_metrics_cache()
 
 class MakeDisbursementAPI(MethodView):
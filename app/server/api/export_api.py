@@ -2,95 +2,73 @@ from flask import Blueprint, request, make_response, jsonify, g, current_app
 from flask.views import MethodView
 from pyexcelerate import Workbook
 from datetime import datetime, timedelta
+import math
 import random, string
-from sqlalchemy import and_, or_, desc
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, or_, desc, func
+from sqlalchemy.orm import lazyload, selectinload
 
 from server import db
 from server.models.credit_transfer import CreditTransfer
+from server.models.custom_attribute import CustomAttribute
+from server.models.custom_attribute_user_storage import CustomAttributeUserStorage
 from server.models.transfer_account import TransferAccount
 from server.models.transfer_usage import TransferUsage
 from server.models.user import User
+from server.models.utils import user_transfer_account_association_table
 from server.utils.auth import requires_auth
-from server.utils.export import generate_pdf_export, export_workbook_via_s3, partition_query
-from server.utils.executor import standard_executor_job, add_after_request_executor_job
+from server.utils.export import (
+    generate_pdf_export, export_workbook_via_s3, partition_query, send_export_emails,
+    XlsxExportWriter, CsvExportWriter
+)
+from server.utils.executor import status_checkable_executor_job, add_after_request_checkable_executor_job
 from server.utils.transfer_filter import process_transfer_filters
 from server.utils.search import generate_search_query
 
 export_blueprint = Blueprint('export', __name__)
 
-@standard_executor_job
-def generate_export(post_data):
-    from server.models.credit_transfer import CreditTransfer
-    from server.models.transfer_account import TransferAccount
-    from server.models.user import User
-
-    export_type = post_data.get('export_type')
-    include_transfers = post_data.get('include_transfers')  # True or False
-    include_sent_and_received = post_data.get('include_sent_and_received')  # True or False
-    include_custom_attributes = post_data.get('include_custom_attributes')  # True or False
+# Rows are fetched from a server-side cursor this many at a time, with their related objects loaded in one query
+# per batch, so an export's memory use doesn't grow with its size
+EXPORT_BATCH_SIZE = 500
+
+transfer_account_columns = [
+    {'header': 'Account ID',            'query_type': 'db',     'query': 'id'},
+    {'header': 'User ID',               'query_type': 'custom', 'query': 'user_id'},
+    {'header': 'First Name',            'query_type': 'custom', 'query': 'first_name'},
+    {'header': 'Last Name',             'query_type': 'custom', 'query': 'last_name'},
+    {'header': 'Public Serial Number',  'query_type': 'custom', 'query': 'public_serial_number'},
+    {'header': 'Phone',                 'query_type': 'custom', 'query': 'phone'},
+    {'header': 'Created (UTC)',         'query_type': 'db',     'query': 'created'},
+    {'header': 'Approved',              'query_type': 'db',     'query': 'is_approved'},
+    {'header': 'Beneficiary',           'query_type': 'custom', 'query': 'has_beneficiary_role'},
+    {'header': 'Vendor',                'query_type': 'custom', 'query': 'has_vendor_role'},
+    {'header': 'Location',              'query_type': 'custom', 'query': 'location'},
+    {'header': 'Current Balance',       'query_type': 'custom', 'query': 'balance'},
+    {'header': 'Amount Received',       'query_type': 'custom', 'query': 'received'},
+    {'header': 'Amount Sent',           'query_type': 'custom', 'query': 'sent'}
+]
+
+credit_transfer_columns = [
+    {'header': 'ID',                'query_type': 'db',     'query': 'id'},
+    {'header': 'Transfer Amount',   'query_type': 'custom', 'query': 'transfer_amount'},
+    {'header': 'Created',           'query_type': 'db',     'query': 'created'},
+    {'header': 'Resolved Date',     'query_type': 'db',     'query': 'resolved_date'},
+    {'header': 'Transfer Type',     'query_type': 'enum',   'query': 'transfer_type'},
+    {'header': 'Transfer Type',     'query_type': 'enum', 'query': 'transfer_subtype'},
+    {'header': 'Transfer Status',   'query_type': 'enum',   'query': 'transfer_status'},
+    {'header': 'Sender ID',         'query_type': 'db',     'query': 'sender_transfer_account_id'},
+    {'header': 'Recipient ID',      'query_type': 'db',     'query': 'recipient_transfer_account_id'},
+    {'header': 'Transfer Uses',     'query_type': 'custom', 'query': 'transfer_usages'},
+]
+
+
+def _transfer_account_ids_query(post_data):
+    """
+    :return: query of the ids of the transfer accounts to export, or None if there aren't any
+    """
     user_type = post_data.get('user_type')  # Beneficiaries, Vendors, All
 
-    transfer_account_columns = [
-        {'header': 'Account ID',            'query_type': 'db',     'query': 'id'},
-        {'header': 'User ID',               'query_type': 'custom', 'query': 'user_id'},
-        {'header': 'First Name',            'query_type': 'custom', 'query': 'first_name'},
-        {'header': 'Last Name',             'query_type': 'custom', 'query': 'last_name'},
-        {'header': 'Public Serial Number',  'query_type': 'custom', 'query': 'public_serial_number'},
-        {'header': 'Phone',                 'query_type': 'custom', 'query': 'phone'},
-        {'header': 'Created (UTC)',         'query_type': 'db',     'query': 'created'},
-        {'header': 'Approved',              'query_type': 'db',     'query': 'is_approved'},
-        {'header': 'Beneficiary',           'query_type': 'custom', 'query': 'has_beneficiary_role'},
-        {'header': 'Vendor',                'query_type': 'custom', 'query': 'has_vendor_role'},
-        {'header': 'Location',              'query_type': 'custom', 'query': 'location'},
-        {'header': 'Current Balance',       'query_type': 'custom', 'query': 'balance'},
-        {'header': 'Amount Received',       'query_type': 'custom', 'query': 'received'},
-        {'header': 'Amount Sent',           'query_type': 'custom', 'query': 'sent'}
-    ]
-
-    credit_transfer_columns = [
-        {'header': 'ID',                'query_type': 'db',     'query': 'id'},
-        {'header': 'Transfer Amount',   'query_type': 'custom', 'query': 'transfer_amount'},
-        {'header': 'Created',           'query_type': 'db',     'query': 'created'},
-        {'header': 'Resolved Date',     'query_type': 'db',     'query': 'resolved_date'},
-        {'header': 'Transfer Type',     'query_type': 'enum',   'query': 'transfer_type'},
-        {'header': 'Transfer Type',     'query_type': 'enum', 'query': 'transfer_subtype'},
-        {'header': 'Transfer Status',   'query_type': 'enum',   'query': 'transfer_status'},
-        {'header': 'Sender ID',         'query_type': 'db',     'query': 'sender_transfer_account_id'},
-        {'header': 'Recipient ID',      'query_type': 'db',     'query': 'recipient_transfer_account_id'},
-        {'header': 'Transfer Uses',     'query_type': 'custom', 'query': 'transfer_usages'},
-    ]
-
-    # need to add Balance (Payable)
-
-    random_string = ''.join(random.choices(string.ascii_letters, k=5))
-    # TODO MAKE THIS API AUTHED
-    time = str(datetime.utcnow())
-
-    base_filename = current_app.config['DEPLOYMENT_NAME'] + '-id' + str(g.user.id) + '-' + str(time[0:10]) + '-' + random_string
-    workbook_filename = base_filename + '.xlsx'
-    # e.g. dev-id1-2018-09-19-asfi.xlsx
-    pdf_filename = base_filename + '.pdf'
-
-    wb = Workbook()
-    ws = wb.new_sheet("transfer_accounts")
-
-    # ws1 = wb.create_sheet(title='transfer_accounts')
-
-    user_filter = None
-
-    for index, column in enumerate(transfer_account_columns):
-        ws[1][index+1] = column['header']
-
-
-    # Create transfer_accounts workbook headers
-    for index, column in enumerate(transfer_account_columns):
-        ws[1][index+1] = column['header']
-
-    user_accounts = []
-    credit_transfer_list = []
-
     # filter user accounts
+    user_filter = None
     if user_type == 'beneficiary':
         user_filter = User.has_beneficiary_role
 
@@ -98,13 +76,9 @@ def generate_export(post_data):
         user_filter = User.has_vendor_role
 
     if user_filter is not None:
-        user_accounts = User.query.filter(
-            user_filter==True
-        ).options(
-            joinedload(User.transfer_accounts)
-        )
+        return db.session.query(User.default_transfer_account_id).filter(user_filter == True)
 
-    elif user_type == 'selected' or user_type == 'all':
+    if user_type == 'selected' or user_type == 'all':
         # HANDLE PARAM : search_string - Any search string. An empty string (or None) will just return everything!
         search_string = post_data.get('search_string') or ''
         # HANDLE PARAM : params - Standard filter object. Exact same as the ones Metrics uses!
@@ -116,127 +90,209 @@ def generate_export(post_data):
         exclude_accounts = post_data.get('exclude_accounts', [])
 
         if include_accounts:
-            transfer_accounts = db.session.query(TransferAccount).options().filter(TransferAccount.id.in_(include_accounts))
+            return db.session.query(TransferAccount.id).filter(TransferAccount.id.in_(include_accounts))
+
+        search_query = generate_search_query(search_string, filters, order=desc, sort_by_arg='rank')
+        return search_query.filter(TransferAccount.id.notin_(exclude_accounts))\
+            .with_entities(TransferAccount.id)\
+            .order_by(None)
+
+    return None
+
+
+def _custom_attribute_names(transfer_account_ids):
+    # Custom attribute columns have to be known before any rows are written
+    user_ids = db.session.query(user_transfer_account_association_table.c.user_id)\
+        .filter(user_transfer_account_association_table.c.transfer_account_id.in_(transfer_account_ids))
+    names = db.session.query(func.coalesce(CustomAttribute.name, ' '))\
+        .select_from(CustomAttributeUserStorage)\
+        .outerjoin(CustomAttribute, CustomAttributeUserStorage.custom_attribute_id == CustomAttribute.id)\
+        .filter(CustomAttributeUserStorage.user_id.in_(user_ids))\
+        .distinct()
+    return sorted(name for name, in names)
+
+
+def _transfer_account_row(transfer_account, include_sent_and_received, custom_attribute_names):
+    user = transfer_account.primary_user
+    row = []
+    for column in transfer_account_columns:
+        if column['query_type'] == 'db': cell_contents = "{0}".format(getattr(transfer_account, column['query']))
+        elif column['query'] == 'user_id': cell_contents = "{0}".format(user.id)
+        elif column['query'] == 'first_name': cell_contents = "{0}".format(user.first_name)
+        elif column['query'] == 'last_name': cell_contents = "{0}".format(user.last_name)
+        elif column['query'] == 'phone': cell_contents = "{0}".format(user.phone or '')
+        elif column['query'] == 'public_serial_number': cell_contents = "{0}".format(user.public_serial_number or '')
+        elif column['query'] == 'location': cell_contents = "{0}".format(user._location)
+        elif column['query'] == 'balance': cell_contents = getattr(transfer_account, column['query'])/100
+        elif column['query'] == 'has_beneficiary_role': cell_contents = "{0}".format(user.has_beneficiary_role)
+        elif column['query'] == 'has_vendor_role': cell_contents = "{0}".format(user.has_vendor_role)
+        elif include_sent_and_received and column['query'] == 'received':
+            cell_contents = transfer_account.total_received / 100
+        elif include_sent_and_received and column['query'] == 'sent':
+            cell_contents = transfer_account.total_sent / 100
         else:
-            search_query = generate_search_query(search_string, filters, order=desc, sort_by_arg='rank', include_user=True).options(
-                joinedload(User.transfer_accounts)
-            )
+            cell_contents = ""
+        row.append(cell_contents)
+
+    if custom_attribute_names:
+        # Add custom attributes as columns at the end
+        values = {}
+        for attribute in user.custom_attributes:
+            name = (attribute.custom_attribute and attribute.custom_attribute.name) or ' '
+            values[name] = attribute.value
+        row.extend(values.get(name, '') for name in custom_attribute_names)
+    return row
+
+
+def _credit_transfer_row(credit_transfer):
+    row = []
+    for column in credit_transfer_columns:
+        if column['query_type'] == 'db':
+            cell_contents = "{0}".format(getattr(credit_transfer, column['query']))
+        elif column['query_type'] == 'enum':
+            enum = getattr(credit_transfer, column['query'])
+            cell_contents = "{0}".format(enum and enum.value)
+        elif column['query'] == 'transfer_amount':
+            cell_contents = "{0}".format(getattr(credit_transfer, column['query'])/100)
+        elif column['query'] == 'transfer_usages':
+            cell_contents = ', '.join([usage._name for usage in credit_transfer.transfer_usages])
+        else:
+            cell_contents = ""
+        row.append(cell_contents)
+    return row
 
-            search_query = search_query.filter(TransferAccount.id.notin_(exclude_accounts))
-            transfer_accounts = [r[0] for r in search_query] # Get TransferAccount (TransferAccount, searchRank, User)
-        user_accounts = [ta.primary_user for ta in transfer_accounts]
+
+@status_checkable_executor_job
+def generate_export(post_data):
+    yield {
+        'message': 'Generating export',
+        'percent_complete': 0,
+    }
+
+    export_type = post_data.get('export_type')  # xlsx (default), csv or pdf
+    include_transfers = post_data.get('include_transfers')  # True or False
+    include_sent_and_received = post_data.get('include_sent_and_received')  # True or False
+    include_custom_attributes = post_data.get('include_custom_attributes')  # True or False
+    user_type = post_data.get('user_type')  # Beneficiaries, Vendors, All
+
+    random_string = ''.join(random.choices(string.ascii_letters, k=5))
+    # TODO MAKE THIS API AUTHED
+    time = str(datetime.utcnow())
+
+    base_filename = current_app.config['DEPLOYMENT_NAME'] + '-id' + str(g.user.id) + '-' + str(time[0:10]) + '-' + random_string
+    # e.g. dev-id1-2018-09-19-asfi.xlsx
+    pdf_filename = base_filename + '.pdf'
+
+    transfer_account_ids = _transfer_account_ids_query(post_data)
 
     if export_type == 'pdf':
+        user_accounts = []
+        if transfer_account_ids is not None:
+            transfer_accounts = TransferAccount.query.filter(TransferAccount.id.in_(transfer_account_ids))
+            user_accounts = [ta.primary_user for ta in transfer_accounts]
         file_url = generate_pdf_export(user_accounts, pdf_filename)
-        response_object = {
+        yield {
             'message': 'Export file created.',
+            'percent_complete': 100,
             'data': {
                 'file_url': file_url,
             }
         }
-
-        return make_response(jsonify(response_object)), 201
-
-    if user_accounts is not None:
-        custom_attribute_columns = []
-
-        for index, user_account in enumerate(user_accounts):
-            transfer_account = user_account.transfer_account
-            if transfer_account:
-                for jindix, column in enumerate(transfer_account_columns):
-                    if column['query_type'] == 'db': cell_contents = "{0}".format(getattr(transfer_account, column['query']))
-                    elif column['query'] == 'user_id': cell_contents = "{0}".format(transfer_account.primary_user.id)
-                    elif column['query'] == 'first_name': cell_contents = "{0}".format(transfer_account.primary_user.first_name)
-                    elif column['query'] == 'last_name': cell_contents = "{0}".format(transfer_account.primary_user.last_name)
-                    elif column['query'] == 'phone': cell_contents = "{0}".format(transfer_account.primary_user.phone or '')
-                    elif column['query'] == 'public_serial_number': cell_contents = "{0}".format(transfer_account.primary_user.public_serial_number or '')
-                    elif column['query'] == 'location': cell_contents = "{0}".format(transfer_account.primary_user._location)
-                    elif column['query'] == 'balance': cell_contents = getattr(transfer_account, column['query'])/100
-                    elif column['query'] == 'has_beneficiary_role': cell_contents = "{0}".format(transfer_account.primary_user.has_beneficiary_role)
-                    elif column['query'] == 'has_vendor_role': cell_contents = "{0}".format(transfer_account.primary_user.has_vendor_role)
-                    elif include_sent_and_received:
-                        if column['query'] == 'received':
-                            received_amount = transfer_account.total_received
-                            cell_contents = received_amount / 100
-                        elif column['query'] == 'sent':
-                            sent_amount = transfer_account.total_sent
-                            cell_contents = sent_amount / 100
-                    else:
-                        cell_contents = ""
-                    ws[index+2][jindix+1] = cell_contents
-                if include_custom_attributes:
-                    # Add custom attributes as columns at the end
-                    for attribute in transfer_account.primary_user.custom_attributes:
-                        name = (attribute.custom_attribute and attribute.custom_attribute.name) or ' '
-
-                        try:
-                            col_num = custom_attribute_columns.index(name) + 1 + len(transfer_account_columns)
-                        except ValueError:
-                            custom_attribute_columns.append(name)
-                            col_num = len(custom_attribute_columns) + len(transfer_account_columns)
-                        ws[index + 2][col_num] = attribute.value
-            else:
-                print('No Transfer Account for user account id: ', user_account.id)
-
-        # Add custom attribute headers:
-        if include_custom_attributes:
-            for index, column_name in enumerate(custom_attribute_columns):
-                ws[1][index + 1 + len(transfer_account_columns)] = column_name
-    if include_transfers and user_accounts is not None:
-        transfer_sheet = wb.new_sheet("credit_transfers")
-
-        if user_type == 'all':
-            transfers = CreditTransfer.query.enable_eagerloads(False).options(
-                joinedload(CreditTransfer.transfer_usages).load_only(TransferUsage._name),
+        return
+
+    if transfer_account_ids is not None:
+        # Stream the accounts in id order. Mapper level joined loads are swapped for one IN query per batch,
+        # since joined collections can't be streamed
+        transfer_accounts = TransferAccount.query\
+            .filter(TransferAccount.id.in_(transfer_account_ids))\
+            .order_by(TransferAccount.id)\
+            .options(
+                lazyload('*'),
+                selectinload(TransferAccount.users)
+                    .selectinload(User.custom_attributes)
+                    .joinedload(CustomAttributeUserStorage.custom_attribute)
             )
-        else:
-            def _get_transfers_from_accounts(user_accounts):
-                for u in user_accounts:
-                    for transfer in u.transfer_account.credit_receives:
-                        yield transfer
-                    for transfer in u.transfer_account.credit_sends:
-                        yield transfer
-            transfers = _get_transfers_from_accounts(user_accounts)
+    else:
+        transfer_accounts = None
+
+    transfers = None
+    if include_transfers and transfer_accounts is not None:
+        transfers = CreditTransfer.query.order_by(CreditTransfer.id).options(
+            lazyload('*'),
+            selectinload(CreditTransfer.transfer_usages).load_only(TransferUsage._name),
+        )
+        if user_type != 'all':
+            transfers = transfers.filter(or_(
+                CreditTransfer.sender_transfer_account_id.in_(transfer_account_ids),
+                CreditTransfer.recipient_transfer_account_id.in_(transfer_account_ids)
+            ))
 
-        # Create credit_transfers workbook headers
-        for index, column in enumerate(credit_transfer_columns):
-            transfer_sheet[1][index+1] = column['header']
+    total_rows = (transfer_accounts.count() if transfer_accounts is not None else 0)\
+        + (transfers.count() if transfers is not None else 0)
+    rows_written = 0
 
-        used_transfers = set()
-        for index, credit_transfer in enumerate(transfers):
-            if credit_transfer.id not in used_transfers:
-                used_transfers.add(credit_transfer.id)
-                for jindix, column in enumerate(credit_transfer_columns):
-                    if column['query_type'] == 'db':
-                        cell_contents = "{0}".format(getattr(credit_transfer, column['query']))
-                    elif column['query_type'] == 'enum':
-                        enum = getattr(credit_transfer, column['query'])
-                        cell_contents = "{0}".format(enum and enum.value)
-                    elif column['query'] == 'transfer_amount':
-                        cell_contents = "{0}".format(getattr(credit_transfer, column['query'])/100)
-                    elif column['query'] == 'transfer_usages':
-                        cell_contents = ', '.join([usage._name for usage in credit_transfer.transfer_usages])
-                    else:
-                        cell_contents = ""
-                    transfer_sheet[index + 2][jindix + 1] = cell_contents
-   
-    file_url = export_workbook_via_s3(wb, workbook_filename)
-    response_object = {
+    def progress():
+        return {
+            'message': f'Exported {rows_written} of {total_rows} rows',
+            'percent_complete': math.floor(100 * rows_written / total_rows) if total_rows else 0,
+        }
+
+    writer = CsvExportWriter(base_filename) if export_type == 'csv' else XlsxExportWriter(base_filename)
+    try:
+        custom_attribute_names = []
+        if include_custom_attributes and transfer_account_ids is not None:
+            custom_attribute_names = _custom_attribute_names(transfer_account_ids)
+
+        # Create transfer_accounts workbook headers
+        writer.add_sheet(
+            'transfer_accounts', [column['header'] for column in transfer_account_columns] + custom_attribute_names
+        )
+        if transfer_accounts is not None:
+            for transfer_account in transfer_accounts.yield_per(EXPORT_BATCH_SIZE):
+                # Transfer accounts without a user are left out of the export
+                if transfer_account.primary_user:
+                    writer.write_row(
+                        _transfer_account_row(transfer_account, include_sent_and_received, custom_attribute_names)
+                    )
+                rows_written += 1
+                if rows_written % EXPORT_BATCH_SIZE == 0:
+                    yield progress()
+
+        if transfers is not None:
+            # Create credit_transfers workbook headers
+            writer.add_sheet('credit_transfers', [column['header'] for column in credit_transfer_columns])
+            for credit_transfer in transfers.yield_per(EXPORT_BATCH_SIZE):
+                writer.write_row(_credit_transfer_row(credit_transfer))
+                rows_written += 1
+                if rows_written % EXPORT_BATCH_SIZE == 0:
+                    yield progress()
+
+        file_urls = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    if not current_app.config['IS_TEST']:
+        send_export_emails(file_urls)
+
+    yield {
         'message': 'Export file created.',
+        'percent_complete': 100,
         'data': {
-            'file_url': file_url,
+            'file_url': file_urls[0],
+            'file_urls': file_urls,
         }
     }
-    return make_response(jsonify(response_object)), 201
 
 
 class ExportAPI(MethodView):
     @requires_auth(allowed_roles={'ADMIN': 'admin'})
     def post(self):
         post_data = request.get_json()
-        add_after_request_executor_job(generate_export, [post_data])
+        task_uuid = add_after_request_checkable_executor_job(generate_export, [post_data])
         return {
             'status': 'success',
+            'task_uuid': task_uuid,
             'data': {
                 'message': 'Generating export. Please check your email shortly.',
             }
@@ -127,19 +127,33 @@ class FiltersApi(MethodView):
         return make_response(jsonify(response_object)), 200
 
 class CacheApi(MethodView):
+    @requires_auth(allowed_roles={'ADMIN': 'sempoadmin'})
+    def get(self):
+        """
+        This endpoint returns the cache hits and misses of each metric for the current org, over the last week
+        """
+        response_object = {
+            'status': 'success',
+            'message': 'Successfully Loaded.',
+            'data': {
+                'cache_stats': metrics_cache.get_metrics_cache_stats(),
+            }
+        }
+        return make_response(jsonify(response_object)), 200
+
     @requires_auth(allowed_roles={'ADMIN': 'sempoadmin'})
     def post(self):
         """
         This endpoint erases the cache for the current org. 
         Use this after you alter the past so the cache can rebuild itself 
         """
-        count = metrics_cache.clear_metrics_cache()
+        version = metrics_cache.clear_metrics_cache()
         metrics_cache.rebuild_metrics_cache()
         response_object = {
             'status' : 'success',
             'message': 'Cache erased',
             'data': {
-                'removed_entries': count,
+                'cache_version': version,
             }
         }
         return make_response(jsonify(response_object)), 200
@@ -161,3 +175,9 @@ metrics_blueprint.add_url_rule(
     view_func=CacheApi.as_view('metrics_cache_view'),
     methods=['POST']
 )
+
+metrics_blueprint.add_url_rule(
+    '/metrics/cache_stats/',
+    view_func=CacheApi.as_view('metrics_cache_stats_view'),
+    methods=['GET']
+)
@@ -6,7 +6,8 @@ from server.utils.auth import show_all, requires_auth
 from server.models.ussd import UssdMenu
 from server.utils.user import get_user_by_phone
 from server.utils.ussd.ussd_processor import UssdProcessor
-from server.utils.ussd.ussd import menu_display_text_in_lang, create_or_update_session
+from server.utils.ussd.ussd import menu_display_text_in_lang
+from server.utils.ussd.session_store import create_or_update_cached_session, save_ussd_session
 
 ussd_blueprint = Blueprint('ussd', __name__)
 
@@ -43,15 +44,18 @@ class ProcessUssd(MethodView):
                 text = menu_display_text_in_lang(current_menu, user)
             else:
                 current_menu = UssdProcessor.process_request(session_id, latest_input, user)
-                ussd_session = create_or_update_session(session_id, user, current_menu, user_input, service_code)
+                ussd_session = create_or_update_cached_session(
+                    session_id, user, current_menu, user_input, service_code
+                )
                 text = UssdProcessor.custom_display_text(current_menu, ussd_session)
 
                 if "CON" not in text and "END" not in text:
-                    raise Exception("no menu found. text={}, user={}, menu={}, session={}".format(text, user.id, current_menu.name, ussd_session.id))
+                    raise Exception("no menu found. text={}, user={}, menu={}, session={}".format(text, user.id, current_menu.name, ussd_session.session_id))
 
                 if len(text) > 164:
                     print(f"Warning, text has length {len(text)}, display may be truncated")
 
+                save_ussd_session(ussd_session, is_ended=text.startswith('END'))
                 db.session.commit()
         else:
             current_menu = UssdMenu.find_by_name('exit_invalid_request')
@@ -175,4 +175,16 @@ class PhoneVerificationError(Exception):
 
 
 class TransferAccountNotFoundError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class PaginationCursorError(Exception):
+    """
+    Raise if a keyset pagination cursor can't be decoded
+    """
+    pass
+
+class HashingBusyError(Exception):
+    """
+    Raise if a password or PIN can't be hashed or checked because the hashing pool is busy
+    """
+    pass
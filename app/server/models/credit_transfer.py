@@ -5,19 +5,20 @@ from decimal import Decimal
 from sqlalchemy.dialects.postgresql import JSON, JSONB
 from flask import current_app, g
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import Index
+from sqlalchemy import Index, event, inspect, text
 from sqlalchemy.sql import func
 from sqlalchemy import or_
 from uuid import uuid4
 
 from server import db, bt
 from server.models.utils import BlockchainTaskableBase, ManyOrgBase, credit_transfer_transfer_usage_association_table,\
-    disbursement_credit_transfer_association_table, credit_transfer_approver_user_association_table
+    disbursement_credit_transfer_association_table, credit_transfer_approver_user_association_table, call_after_commit
 from server.models.token import Token
 from server.models.user import User
 from server.models.transfer_account import TransferAccount
 from server.utils.access_control import AccessControl
-from server.utils.metrics.metrics_cache import clear_metrics_cache, rebuild_metrics_cache
+from server.utils.metrics.rollups import record_transfer_rollup_change
+from server.utils.transfer_usage import invalidate_transfer_usage_ranking
 
 from server.exceptions import (
     TransferLimitError,
@@ -94,7 +95,18 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
 
     fiat_ramp = db.relationship('FiatRamp', backref='credit_transfer', lazy=True, uselist=False)
 
-    __table_args__ = (Index('updated_index', "updated"), )
+    __table_args__ = (
+        Index('updated_index', "updated"),
+        # Complete receives that aren't confirmed on chain yet, which are the ones a later send from the
+        # recipient may have to wait on. Postgres keeps this up to date as transfers complete and are confirmed
+        Index(
+            'ix_credit_transfer_unconfirmed_receives',
+            'recipient_transfer_account_id', 'id',
+            postgresql_where=text(
+                "transfer_status = 'COMPLETE' AND blockchain_status IS DISTINCT FROM 'SUCCESS'"
+            )
+        ),
+    )
 
     from_exchange = db.relationship('Exchange', backref='from_transfer', lazy='joined', uselist=False,
                                      foreign_keys='Exchange.from_transfer_id')
@@ -119,6 +131,15 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
     def add_message(self, message):
         self.resolution_message = message
 
+    @classmethod
+    def metrics_unsettled_filter(cls):
+        # Transfers only change in ways that matter to metrics when they're resolved, so the metrics cache
+        # holds unresolved ones back until they are
+        return or_(
+            cls.transfer_status == None,
+            cls.transfer_status.in_([TransferStatusEnum.PENDING, TransferStatusEnum.PARTIAL])
+        )
+
     # TODO: Apply this to all transfer amounts/balances, work out the correct denominator size
     @hybrid_property
     def transfer_amount(self):
@@ -153,6 +174,19 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
         )
 
     def send_blockchain_payload_to_worker(self, is_retry=False, queue='high-priority'):
+        return bt.make_token_transfer(**self._blockchain_payload(), queue=queue)
+
+    @staticmethod
+    def send_blockchain_payloads_to_worker(transfers, queue='high-priority'):
+        """
+        Sends several transfers to the worker at once. Transfers from the same account in the same batch share the
+        same prior tasks, so those are only worked out once per account and batch.
+        :return: task uuids for the transfers, in the same order
+        """
+        prior_tasks_cache = {}
+        return bt.make_token_transfers([t._blockchain_payload(prior_tasks_cache) for t in transfers], queue=queue)
+
+    def _blockchain_payload(self, prior_tasks_cache=None):
         sender_approval = self.sender_transfer_account.get_or_create_system_transfer_approval()
         recipient_approval = self.recipient_transfer_account.get_or_create_system_transfer_approval()
 
@@ -167,18 +201,21 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
 
         # Forces an order on transactions so that if there's an outage somewhere, transactions don't get confirmed
         # On chain in an order that leads to a unrecoverable state
-        other_priors = [t.blockchain_task_uuid for t in self._get_required_prior_tasks()]
-
-        all_priors = approval_priors + other_priors
+        if prior_tasks_cache is not None and self.batch_uuid is not None:
+            cache_key = (self.sender_transfer_account_id, self.batch_uuid)
+            if cache_key not in prior_tasks_cache:
+                prior_tasks_cache[cache_key] = [t.blockchain_task_uuid for t in self._get_required_prior_tasks()]
+            other_priors = prior_tasks_cache[cache_key]
+        else:
+            other_priors = [t.blockchain_task_uuid for t in self._get_required_prior_tasks()]
 
-        return bt.make_token_transfer(
+        return dict(
             signing_address=self.sender_transfer_account.organisation.system_blockchain_address,
             token=self.token,
             from_address=self.sender_transfer_account.blockchain_address,
             to_address=self.recipient_transfer_account.blockchain_address,
             amount=self.transfer_amount,
-            prior_tasks=all_priors,
-            queue=queue,
+            prior_tasks=approval_priors + other_priors,
             task_uuid=self.blockchain_task_uuid
         )
 
@@ -195,34 +232,61 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
         Required priors are all transfers in "more_recent_receives" and "most_recent_out_of_batch_send".
         For why this works, see https://github.com/teamsempo/SempoBlockchain/pull/262
 
+        Rather than searching Alice's history, this starts from her account's frontier: her last completed send
+        (TransferAccount._last_completed_send_id) and her unconfirmed receives (ix_credit_transfer_unconfirmed_receives).
+        Only if the last send doesn't qualify (it's this transfer, or in the same batch) do we search for an older one.
         """
+        # Flush so that the frontier includes any transfers completed in this session
+        db.session.flush()
+
+        sender_transfer_account = self.sender_transfer_account
+
         # We're constantly querying complete transfers here. Lazy and DRY
         complete_transfer_base_query = (
             CreditTransfer.query.filter(CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE)
         ).execution_options(show_all=True)
 
-        # Query for finding the most recent transfer sent by the sending account that isn't from the same batch uuid
-        # that of the transfer in question
-        most_recent_out_of_batch_send = (
-            complete_transfer_base_query
-                .order_by(CreditTransfer.id.desc())
-                .filter(CreditTransfer.sender_transfer_account == self.sender_transfer_account)
-                .filter(CreditTransfer.id != self.id)
-                .filter(or_(CreditTransfer.batch_uuid != self.batch_uuid,
-                            CreditTransfer.batch_uuid == None  # Only exclude matching batch_uuids if they're not null
-                            )
-                ).execution_options(show_all=True).first()
-        )
+        def is_out_of_batch_send(transfer):
+            return (
+                transfer is not None
+                and transfer.id != self.id
+                and transfer.transfer_status == TransferStatusEnum.COMPLETE
+                # Only exclude matching batch_uuids if they're not null
+                and (self.batch_uuid is None or transfer.batch_uuid != self.batch_uuid)
+            )
 
-        # Base query for finding more_recent_receives
-        base_receives_query = (
+        most_recent_out_of_batch_send = None
+        if sender_transfer_account._last_completed_send_id:
+            last_completed_send = CreditTransfer.query.execution_options(show_all=True)\
+                .get(sender_transfer_account._last_completed_send_id)
+
+            if is_out_of_batch_send(last_completed_send):
+                most_recent_out_of_batch_send = last_completed_send
+            else:
+                # Query for finding the most recent transfer sent by the sending account that isn't from the same
+                # batch uuid that of the transfer in question
+                most_recent_out_of_batch_send = (
+                    complete_transfer_base_query
+                        .order_by(CreditTransfer.id.desc())
+                        .filter(CreditTransfer.sender_transfer_account == sender_transfer_account)
+                        .filter(CreditTransfer.id != self.id)
+                        .filter(or_(CreditTransfer.batch_uuid != self.batch_uuid,
+                                    CreditTransfer.batch_uuid == None  # Only exclude matching batch_uuids if they're not null
+                                    )
+                        ).execution_options(show_all=True).first()
+                )
+
+        # Receives that are already confirmed on chain can't be required priors, so we only look at unconfirmed ones
+        unconfirmed_receives_query = (
             complete_transfer_base_query
-                .filter(CreditTransfer.recipient_transfer_account == self.sender_transfer_account)
+                .filter(CreditTransfer.recipient_transfer_account == sender_transfer_account)
+                .filter(CreditTransfer.blockchain_status.is_distinct_from(BlockchainStatus.SUCCESS))
         ).execution_options(show_all=True)
 
         if most_recent_out_of_batch_send:
             # If most_recent_out_of_batch_send exists, find all receive transfers since it.
-            more_recent_receives = base_receives_query.filter(CreditTransfer.id > most_recent_out_of_batch_send.id).all()
+            more_recent_receives = unconfirmed_receives_query\
+                .filter(CreditTransfer.id > most_recent_out_of_batch_send.id).all()
 
             # Required priors are then the out of batch send plus these receive transfers
             required_priors = more_recent_receives + [most_recent_out_of_batch_send]
@@ -237,16 +301,15 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
 
         else:
             # Otherwise, return all receives, which are all our required priors
-            required_priors = base_receives_query.all()
+            required_priors = unconfirmed_receives_query.all()
 
         # Filter out any transfers that we already know are complete - there's no reason to create an extra dep
-        # We don't do this inside the Alchemy queries because we need the completed priors to calculate other priors
         required_priors = [prior for prior in required_priors if prior.blockchain_status != BlockchainStatus.SUCCESS]
 
         # Remove any possible duplicates
         return set(required_priors)
 
-    def add_approver_and_resolve_as_completed(self, user=None):
+    def add_approver_and_resolve_as_completed(self, user=None, batch_uuid=None, check_limits=True):
         # Adds approver to transfer, resolves as complete if it can!
         if not user:
             user = db.session.query(User).filter(User.id == g.user.id).first()
@@ -256,7 +319,7 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
             if current_app.config['REQUIRE_MULTIPLE_APPROVALS']:
                 self.transfer_status = TransferStatusEnum.PARTIAL
         if self.check_if_fully_approved():
-            self.resolve_as_complete_and_trigger_blockchain()
+            self.resolve_as_complete_and_trigger_blockchain(batch_uuid=batch_uuid, check_limits=check_limits)
 
     def check_if_fully_approved(self):
         # Checks if the credit transfer is approved and ready to be resolved as complete
@@ -287,20 +350,26 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
             self,
             existing_blockchain_txn=None,
             queue='high-priority',
-            batch_uuid: str=None
+            batch_uuid: str=None,
+            check_limits=True
     ):
 
-        self.resolve_as_complete(batch_uuid)
+        self.resolve_as_complete(batch_uuid, check_limits=check_limits)
 
         if not existing_blockchain_txn:
             self.blockchain_task_uuid = str(uuid4())
             g.pending_transactions.append((self, queue))
 
-    def resolve_as_complete(self, batch_uuid=None):
+    def resolve_as_complete(self, batch_uuid=None, check_limits=True):
+        """
+        :param batch_uuid: the batch the transfer goes to chain with
+        :param check_limits: False if the caller has already checked the sender's transfer limits for this transfer
+        """
         if self.transfer_status not in [None, TransferStatusEnum.PENDING, TransferStatusEnum.PARTIAL]:
             raise Exception(f'Resolve called multiple times for transfer {self.id}')
         try:
-            self.check_sender_transfer_limits()
+            if check_limits:
+                self.check_sender_transfer_limits()
         except TransferLimitError as e:
             # Sempo admins can always bypass limits, allowing for things like emergency moving of funds etc
             if hasattr(g, 'user') and AccessControl.has_suffient_role(g.user.roles, {'ADMIN': 'sempoadmin'}):
@@ -313,9 +382,6 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
         self.blockchain_status = BlockchainStatus.PENDING
         self.update_balances()
 
-        if (datetime.datetime.utcnow() - self.created).seconds > 5:
-            clear_metrics_cache()
-            rebuild_metrics_cache()
         if self.recipient_user and self.recipient_user.transfer_card:
             self.recipient_user.transfer_card.update_transfer_card()
 
@@ -344,6 +410,38 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
         self.sender_transfer_account.update_balance()
         self.recipient_transfer_account.update_balance()
 
+    @staticmethod
+    def _ledger_contribution(status, amount_wei):
+        """
+        How much a transfer in a given status counts towards the running totals of the accounts involved,
+        as (recipient received complete, sender sent complete, sender sent pending)
+        """
+        if isinstance(status, str):
+            status = TransferStatusEnum(status)
+        if status == TransferStatusEnum.COMPLETE:
+            return amount_wei, amount_wei, 0
+        if status in [TransferStatusEnum.PENDING, TransferStatusEnum.PARTIAL]:
+            return 0, 0, amount_wei
+        return 0, 0, 0
+
+    def apply_ledger_change(self, old_status, new_status):
+        """
+        Moves this transfer's amount between the sender and recipient accounts' running totals
+        when its status changes from old_status to new_status
+        """
+        amount_wei = self._transfer_amount_wei or 0
+        old = self._ledger_contribution(old_status, amount_wei)
+        new = self._ledger_contribution(new_status, amount_wei)
+        received_complete, sent_complete, sent_pending = [n - o for n, o in zip(new, old)]
+
+        if self.recipient_transfer_account:
+            self.recipient_transfer_account.apply_ledger_delta(received_complete_wei=received_complete)
+        if self.sender_transfer_account:
+            self.sender_transfer_account.apply_ledger_delta(
+                sent_complete_wei=sent_complete,
+                sent_pending_wei=sent_pending
+            )
+
 
     def get_transfer_limits(self):
         from server.utils.transfer_limits import (LIMIT_IMPLEMENTATIONS, get_applicable_transfer_limits)
@@ -475,4 +573,81 @@ class CreditTransfer(ManyOrgBase, BlockchainTaskableBase):
             self.resolve_as_rejected(message)
             raise InsufficientBalanceError(message)
 
+        # Set explicitly rather than relying on the column default, so the transfer is counted as pending straight away
+        self.transfer_status = TransferStatusEnum.PENDING
         self.update_balances()
+
+
+@event.listens_for(CreditTransfer.transfer_status, 'set', active_history=True)
+def _transfer_status_changed(target, value, oldvalue, initiator):
+    if not isinstance(oldvalue, (TransferStatusEnum, str)):
+        # Transient transfers have NO_VALUE/NEVER_SET here, and haven't contributed to any totals yet
+        oldvalue = None
+    target.apply_ledger_change(oldvalue, value)
+
+
+@event.listens_for(CreditTransfer, 'after_insert')
+@event.listens_for(CreditTransfer, 'after_update')
+def _record_completed_send(mapper, connection, target):
+    # Keeps the sender's prior task frontier up to date. This runs once the transfer has an id, which it
+    # often doesn't when it's resolved, so it can't live in the transfer_status listener above
+    if target.transfer_status != TransferStatusEnum.COMPLETE or target.sender_transfer_account is None:
+        return
+
+    if not inspect(target).attrs.transfer_status.history.added:
+        # Status wasn't changed in this flush, so the send has already been recorded
+        return
+
+    target.sender_transfer_account.record_completed_send(target.id, connection=connection)
+
+
+@event.listens_for(CreditTransfer, 'after_insert')
+@event.listens_for(CreditTransfer, 'after_update')
+def _update_metrics_rollups(mapper, connection, target):
+    record_transfer_rollup_change(connection, target)
+
+
+@event.listens_for(CreditTransfer, 'after_insert')
+@event.listens_for(CreditTransfer, 'after_update')
+def _record_completed_receive(mapper, connection, target):
+    # Keeps the recipient's completed receive count, which the business directory ranks businesses by, up to date
+    state = inspect(target)
+    history = state.attrs.transfer_status.history
+    if not history.has_changes() or target.recipient_user_id is None:
+        return
+
+    was_complete = TransferStatusEnum.COMPLETE in history.deleted
+    is_complete = target.transfer_status == TransferStatusEnum.COMPLETE
+    if was_complete != is_complete:
+        User.record_completed_receive(
+            connection, target.recipient_user_id, 1 if is_complete else -1, session=state.session
+        )
+
+
+@event.listens_for(CreditTransfer, 'after_insert')
+@event.listens_for(CreditTransfer, 'after_update')
+def _invalidate_transfer_usage_ranking(mapper, connection, target):
+    # The order a user is offered transfer usages in depends on the usages of their completed sends, so it changes
+    # when a send completes (or stops being complete), or when the usages of a completed send are edited
+    state = inspect(target)
+    if target.sender_user_id is None:
+        return
+
+    history = state.attrs.transfer_status.history
+    was_complete = TransferStatusEnum.COMPLETE in history.deleted
+    is_complete = target.transfer_status == TransferStatusEnum.COMPLETE
+    status_changed = history.has_changes() and was_complete != is_complete
+    usage_changed = is_complete and state.attrs.transfer_use.history.has_changes()
+    if not (status_changed or usage_changed):
+        return
+
+    sender_user_id = target.sender_user_id
+    invalidate_transfer_usage_ranking(sender_user_id)
+
+    # Invalidate again once the change is committed, in case another request ranked from the old transfers
+    # in the meantime
+    call_after_commit(
+        ('transfer_usage_ranking', sender_user_id),
+        lambda: invalidate_transfer_usage_ranking(sender_user_id),
+        state.session
+    )
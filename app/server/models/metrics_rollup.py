@@ -0,0 +1,40 @@
+from server import db
+from server.models.utils import ModelBase
+
+
+class MetricsDailyRollup(ModelBase):
+    """
+    Pre-aggregated daily totals used by the metrics engine in place of scanning every transfer and user.
+    There's one row per organisation, token, local day, transfer type and group (eg transfer_mode/'USSD'),
+    kept up to date as transfers complete. See server.utils.metrics.rollups
+    """
+    __tablename__ = 'metrics_daily_rollup'
+
+    organisation_id = db.Column(db.Integer, db.ForeignKey('organisation.id'), nullable=False)
+    token_id = db.Column(db.Integer, db.ForeignKey('token.id'), nullable=False)
+    # The day in the organisation's timezone, offset the same way as the metrics date filters
+    day = db.Column(db.Date, nullable=False)
+
+    # credit_transfer or user
+    object_type = db.Column(db.String, nullable=False)
+    # Empty rather than null so that they can be part of the unique key
+    transfer_type = db.Column(db.String, nullable=False, default='')
+    transfer_subtype = db.Column(db.String, nullable=False, default='')
+
+    # The group_by name from server.utils.metrics.group (eg 'transfer_usage' or 'gender,sender'), and its value
+    dimension = db.Column(db.String, nullable=False)
+    group_value = db.Column(db.String, nullable=False, default='')
+
+    total_amount_wei = db.Column(db.Numeric(36), nullable=False, default=0)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint(
+            'organisation_id', 'day', 'object_type', 'dimension', 'group_value',
+            'token_id', 'transfer_type', 'transfer_subtype',
+            name='uq_metrics_daily_rollup_key'
+        ),
+    )
+
+    def __repr__(self):
+        return f'<MetricsDailyRollup {self.organisation_id} {self.day} {self.dimension}:{self.group_value}>'
@@ -1,4 +1,5 @@
 from flask import current_app
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.dialects.postgresql import ARRAY
 import pendulum
@@ -6,7 +7,12 @@ import secrets
 from decimal import Decimal
 
 from server import db, bt
-from server.models.utils import ModelBase, organisation_association_table
+from server.models.utils import (
+    ModelBase,
+    organisation_association_table,
+    invalidate_org_topology_cache,
+    call_after_commit
+)
 import server.models.transfer_account
 from server.utils.misc import encrypt_string, decrypt_string
 from server.utils.access_control import AccessControl
@@ -38,6 +44,8 @@ class Organisation(ModelBase):
     card_shard_distance = db.Column(db.Integer, default=0) 
 
     _timezone = db.Column(db.String, default='UTC', nullable=False)
+    # UTC offset the org's metrics rollups were built with. Null until they're built with rebuild_metrics_rollups
+    metrics_rollup_offset_hours = db.Column(db.Float)
     _country_code = db.Column(db.String, nullable=False)
     _default_disbursement_wei = db.Column(db.Numeric(27), default=0)
     require_transfer_card = db.Column(db.Boolean, default=False)
@@ -215,3 +223,19 @@ class Organisation(ModelBase):
 
         if token:
             self.bind_token(token)
+
+
+@event.listens_for(Organisation, 'after_insert')
+@event.listens_for(Organisation, 'after_delete')
+def _organisation_topology_changed(mapper, connection, target):
+    invalidate_org_topology_cache()
+
+    # Invalidate again once the change is committed, since a request counting organisations in the meantime
+    # can't see it yet, and would otherwise cache that count under the new version
+    call_after_commit('org_topology', invalidate_org_topology_cache, inspect(target).session)
+
+
+@event.listens_for(Organisation.__table__, 'after_create')
+@event.listens_for(Organisation.__table__, 'after_drop')
+def _organisation_table_changed(target, connection, **kw):
+    invalidate_org_topology_cache()
@@ -5,6 +5,7 @@ from flask import g
 
 from sqlalchemy.sql import func
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy import or_
 
 from server import db, bt
@@ -52,6 +53,19 @@ class TransferAccount(OneOrgBase, ModelBase, SoftDelete):
     # mechanism to have initial funds. It's essentially an app-level analogy to minting
     # which happens on the chain.
     _balance_offset_wei    = db.Column(db.Numeric(27), default=0)
+
+    # Running totals of the account's credit transfers, maintained incrementally as transfer statuses change
+    # (see CreditTransfer.apply_ledger_change) so that updating the balance doesn't need to aggregate the whole
+    # transfer history. Use reconcile_transfer_account_ledgers to check them against the transfers themselves.
+    _total_received_complete_wei    = db.Column(db.Numeric(27), default=0)
+    _total_sent_complete_wei        = db.Column(db.Numeric(27), default=0)
+    _total_sent_pending_wei         = db.Column(db.Numeric(27), default=0)
+
+    # Id of the most recent complete transfer sent from this account, kept up to date as sends complete
+    # (see record_completed_send). Together with credit_transfer's unconfirmed receives index, this is the
+    # frontier used to work out which blockchain tasks a new send has to wait on
+    _last_completed_send_id = db.Column(db.Integer)
+
     blockchain_address = db.Column(db.String())
 
     is_approved     = db.Column(db.Boolean, default=False)
@@ -157,6 +171,98 @@ class TransferAccount(OneOrgBase, ModelBase, SoftDelete):
         self._balance_offset_wei = val * int(1e16)
         self.update_balance()
 
+    def apply_ledger_delta(self, received_complete_wei=0, sent_complete_wei=0, sent_pending_wei=0):
+        """
+        Adjusts the account's running transfer totals by the given amounts.
+        Once the account exists in the database, the totals are incremented in a single UPDATE so that concurrent
+        transfers against the same account can't overwrite each other's changes.
+        """
+        if not (received_complete_wei or sent_complete_wei or sent_pending_wei):
+            return
+
+        if self.id is None:
+            # Not flushed yet, so nothing else can be holding this row
+            self._total_received_complete_wei = (self._total_received_complete_wei or 0) + received_complete_wei
+            self._total_sent_complete_wei = (self._total_sent_complete_wei or 0) + sent_complete_wei
+            self._total_sent_pending_wei = (self._total_sent_pending_wei or 0) + sent_pending_wei
+            return
+
+        deferred_write = self._deferred_ledger_write()
+        if deferred_write is not None:
+            # Written along with every other account's changes at the end of the batch
+            deferred_write['received_complete_wei'] += received_complete_wei
+            deferred_write['sent_complete_wei'] += sent_complete_wei
+            deferred_write['sent_pending_wei'] += sent_pending_wei
+            set_committed_value(self, '_total_received_complete_wei',
+                                (self._total_received_complete_wei or 0) + received_complete_wei)
+            set_committed_value(self, '_total_sent_complete_wei',
+                                (self._total_sent_complete_wei or 0) + sent_complete_wei)
+            set_committed_value(self, '_total_sent_pending_wei',
+                                (self._total_sent_pending_wei or 0) + sent_pending_wei)
+            return
+
+        table = TransferAccount.__table__
+        totals = db.session.execute(
+            table.update()
+            .where(table.c.id == self.id)
+            .values({
+                table.c._total_received_complete_wei:
+                    func.coalesce(table.c._total_received_complete_wei, 0) + received_complete_wei,
+                table.c._total_sent_complete_wei:
+                    func.coalesce(table.c._total_sent_complete_wei, 0) + sent_complete_wei,
+                table.c._total_sent_pending_wei:
+                    func.coalesce(table.c._total_sent_pending_wei, 0) + sent_pending_wei,
+            })
+            .returning(
+                table.c._total_received_complete_wei,
+                table.c._total_sent_complete_wei,
+                table.c._total_sent_pending_wei
+            )
+        ).first()
+
+        set_committed_value(self, '_total_received_complete_wei', totals[0])
+        set_committed_value(self, '_total_sent_complete_wei', totals[1])
+        set_committed_value(self, '_total_sent_pending_wei', totals[2])
+
+    def record_completed_send(self, credit_transfer_id, connection=None):
+        """
+        Moves the account's last completed send forward to credit_transfer_id, unless a later send has already
+        completed. Done in a single UPDATE for the same reason as apply_ledger_delta.
+        :param connection: the connection to use when called part way through a flush
+        """
+        deferred_write = self._deferred_ledger_write()
+        if deferred_write is not None:
+            deferred_write['last_completed_send_id'] = max(deferred_write['last_completed_send_id'], credit_transfer_id)
+            set_committed_value(self, '_last_completed_send_id',
+                                max(self._last_completed_send_id or 0, credit_transfer_id))
+            return
+
+        table = TransferAccount.__table__
+        last_completed_send_id = (connection or db.session).execute(
+            table.update()
+            .where(table.c.id == self.id)
+            .values({
+                table.c._last_completed_send_id:
+                    func.greatest(func.coalesce(table.c._last_completed_send_id, 0), credit_transfer_id)
+            })
+            .returning(table.c._last_completed_send_id)
+        ).scalar()
+
+        set_committed_value(self, '_last_completed_send_id', last_completed_send_id)
+
+    def _deferred_ledger_write(self):
+        # Inside server.utils.transfer_account.deferred_ledger_writes, the changes to this account are collected here
+        deferred_writes = getattr(g, 'deferred_ledger_writes', None)
+        if deferred_writes is None:
+            return None
+        return deferred_writes.setdefault(self.id, {
+            'transfer_account': self,
+            'received_complete_wei': 0,
+            'sent_complete_wei': 0,
+            'sent_pending_wei': 0,
+            'last_completed_send_id': 0
+        })
+
     def update_balance(self):
         """
         Update the balance of the user by calculating the difference between inbound and outbound transfers, plus an
@@ -166,6 +272,8 @@ class TransferAccount(OneOrgBase, ModelBase, SoftDelete):
         - already spent
         or
         - from a transfer that may ultimately be rejected.
+
+        Inbound and outbound totals are read from the account's running totals rather than aggregated from transfers.
         """
         if not self._balance_offset_wei:
             self._balance_offset_wei = 0
@@ -195,52 +303,21 @@ class TransferAccount(OneOrgBase, ModelBase, SoftDelete):
         """
         The total sent by an account, counting ONLY transfers that have been resolved as complete locally
         """
-        amount = (
-            db.session.query(
-                func.sum(server.models.credit_transfer.CreditTransfer._transfer_amount_wei).label('total')
-            )
-                .execution_options(show_all=True)
-                .filter(server.models.credit_transfer.CreditTransfer.sender_transfer_account_id == self.id)
-                .filter(server.models.credit_transfer.CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE)
-                .first().total
-        )
-        return amount or 0
+        return self._total_sent_complete_wei or 0
 
     @hybrid_property
     def total_received_complete_only_wei(self):
         """
         The total received by an account, counting ONLY transfers that have been resolved as complete
         """
-        amount = (
-            db.session.query(
-                func.sum(server.models.credit_transfer.CreditTransfer._transfer_amount_wei).label('total')
-            )
-                .execution_options(show_all=True)
-                .filter(server.models.credit_transfer.CreditTransfer.recipient_transfer_account_id == self.id)
-                .filter(server.models.credit_transfer.CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE)
-                .first().total
-        )
-
-        return amount or 0
+        return self._total_received_complete_wei or 0
 
     @hybrid_property
     def total_sent_incl_pending_wei(self):
         """
         The total sent by an account, counting transfers that are either pending or complete locally
         """
-        amount = (
-                db.session.query(
-                    func.sum(server.models.credit_transfer.CreditTransfer._transfer_amount_wei).label('total')
-                )
-                .execution_options(show_all=True)
-                .filter(server.models.credit_transfer.CreditTransfer.sender_transfer_account_id == self.id)
-                .filter(or_(
-                    server.models.credit_transfer.CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE,
-                    server.models.credit_transfer.CreditTransfer.transfer_status == TransferStatusEnum.PARTIAL,
-                    server.models.credit_transfer.CreditTransfer.transfer_status == TransferStatusEnum.PENDING))
-                .first().total
-        )
-        return amount or 0
+        return (self._total_sent_complete_wei or 0) + (self._total_sent_pending_wei or 0)
 
     @hybrid_property
     def total_received_incl_pending_wei(self):
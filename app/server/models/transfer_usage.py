@@ -1,6 +1,8 @@
+import threading
+
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import func
+from sqlalchemy import func, event, inspect
 from server.exceptions import (
     IconNotSupportedException,
     TransferUsageNameDuplicateException
@@ -9,8 +11,12 @@ from server.constants import (
     MATERIAL_COMMUNITY_ICONS
 )
 
-from server import db
-from server.models.utils import ModelBase, credit_transfer_transfer_usage_association_table
+from server import db, red
+from server.models.utils import ModelBase, credit_transfer_transfer_usage_association_table, call_after_commit
+
+# Transfer usages change rarely, so each process keeps a read-only copy of them (see TransferUsageCatalogue).
+# Changes to the transfer_usage table bump this version, which tells every process to reload its copy
+TRANSFER_USAGE_VERSION_KEY = 'transfer_usage_version'
 
 class TransferUsage(ModelBase):
     __tablename__ = 'transfer_usage'
@@ -67,4 +73,66 @@ class TransferUsage(ModelBase):
         return usage
 
     def __repr__(self):
-        return f'<Transfer Usage {self.id}: {self.name}>'
\ No newline at end of file
+        return f'<Transfer Usage {self.id}: {self.name}>'
+
+class CataloguedTransferUsage(object):
+    """
+    A read-only copy of a TransferUsage, held by the TransferUsageCatalogue
+    """
+    __slots__ = ('_id', '_name', '_priority', '_translations')
+
+    def __init__(self, id, name, priority, translations):
+        self._id = id
+        self._name = name
+        self._priority = priority
+        self._translations = translations
+
+    id = property(lambda self: self._id)
+    name = property(lambda self: self._name)
+    priority = property(lambda self: self._priority)
+    translations = property(lambda self: self._translations)
+
+    def __repr__(self):
+        return f'<CataloguedTransferUsage {self.id}: {self.name}>'
+
+
+class TransferUsageCatalogue(object):
+    """
+    Every transfer usage, in id order and indexed by id. Loaded on first use in each process, and reloaded when
+    TRANSFER_USAGE_VERSION_KEY changes, so listing transfer usages costs one redis read rather than a query
+    """
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.usages = [CataloguedTransferUsage(*row) for row in rows]
+        self.by_id = {usage.id: usage for usage in self.usages}
+
+    @classmethod
+    def current(cls):
+        version = int(red.get(TRANSFER_USAGE_VERSION_KEY) or 0)
+        catalogue = cls._current
+        if catalogue is None or catalogue.version != version:
+            with cls._lock:
+                catalogue = cls._current
+                if catalogue is None or catalogue.version != version:
+                    rows = db.session.query(
+                        TransferUsage.id, TransferUsage._name, TransferUsage.priority, TransferUsage.translations
+                    ).order_by(TransferUsage.id).all()
+                    catalogue = cls._current = cls(version, rows)
+        return catalogue
+
+
+def bump_transfer_usage_version():
+    red.incr(TRANSFER_USAGE_VERSION_KEY)
+
+
+@event.listens_for(TransferUsage, 'after_insert')
+@event.listens_for(TransferUsage, 'after_update')
+@event.listens_for(TransferUsage, 'after_delete')
+def _bump_transfer_usage_version(mapper, connection, target):
+    bump_transfer_usage_version()
+
+    # Bump again once the change is committed, in case another process reloaded its catalogue in the meantime
+    call_after_commit('transfer_usage_version', bump_transfer_usage_version, inspect(target).session)
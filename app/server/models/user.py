@@ -5,18 +5,18 @@ from sqlalchemy.dialects.postgresql import JSON, JSONB
 from sqlalchemy import text, Table, cast, String
 from sqlalchemy.sql.functions import func
 from itsdangerous import TimedJSONWebSignatureSerializer, BadSignature, SignatureExpired
-from cryptography.fernet import Fernet
 import pyotp
 import config
 from flask import current_app, g
 import datetime
-import bcrypt
 import math
 import jwt
 import random
 import string
 import sentry_sdk
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 
 from server import db, celery_app, bt
 from server.utils.misc import encrypt_string, decrypt_string
@@ -24,6 +24,9 @@ from server.utils.access_control import AccessControl
 from server.utils.phone import proccess_phone_number
 from server.utils.executor import add_after_request_executor_job
 from server.utils.audit_history import track_updates
+from server.utils import hashing
+from server.utils.auth_context import record_last_seen, invalidate_auth_context, AUTH_CONTEXT_USER_ATTRIBUTES
+from server.utils.metrics.rollups import record_user_rollup_change
 from server.utils.amazon_ses import send_reset_email
 
 from server.utils.transfer_account import (
@@ -35,7 +38,9 @@ import server.models.transfer_account
 import server.models.credit_transfer
 import server.utils.transfer_enums
 
-from server.models.utils import ModelBase, ManyOrgBase, user_transfer_account_association_table, SoftDelete
+from server.models.utils import (
+    ModelBase, ManyOrgBase, user_transfer_account_association_table, SoftDelete, call_after_commit
+)
 from server.models.organisation import Organisation
 from server.models.blacklist_token import BlacklistToken
 from server.models.transfer_card import TransferCard
@@ -51,6 +56,11 @@ from server.constants import (
     ACCESS_ROLES
 )
 
+# User attributes the search document is built from, see server/utils/search.py
+SEARCH_DOCUMENT_ATTRIBUTES = [
+    'first_name', 'last_name', '_phone', '_public_serial_number', '_location', 'primary_blockchain_address'
+]
+
 # self-referencing-m2m-relationship
 referrals = Table(
     'referrals', ModelBase.metadata,
@@ -127,6 +137,10 @@ class User(ManyOrgBase, ModelBase, SoftDelete):
 
     is_activated = db.Column(db.Boolean, default=False)
     is_disabled = db.Column(db.Boolean, default=False)
+
+    # Everything search matches users on, in one column with a trigram index, so search can use the index to find
+    # candidate users before ranking them. Kept up to date by _update_search_document
+    search_document = db.Column(db.String())
     is_phone_verified = db.Column(db.Boolean, default=False)
     is_self_sign_up = db.Column(db.Boolean, default=True)
     is_market_enabled = db.Column(db.Boolean, default=False)
@@ -140,6 +154,10 @@ class User(ManyOrgBase, ModelBase, SoftDelete):
 
     business_usage_id = db.Column(db.Integer, db.ForeignKey(TransferUsage.id))
 
+    # How many complete transfers the user has received, which is what the business directory ranks businesses by.
+    # Kept up to date as transfers complete (or stop being complete) by record_completed_receive
+    completed_receive_count = db.Column(db.Integer, default=0, nullable=False)
+
     transfer_accounts = db.relationship(
         "TransferAccount",
         secondary=user_transfer_account_association_table,
@@ -197,6 +215,15 @@ class User(ManyOrgBase, ModelBase, SoftDelete):
 
     exchanges = db.relationship("Exchange", backref="user")
 
+    __table_args__ = (
+        # The business directory ranking for each business category, so top businesses can be read off the index
+        db.Index(
+            'ix_user_directory_ranking',
+            'business_usage_id', 'completed_receive_count',
+            postgresql_where=text('is_market_enabled = true')
+        ),
+    )
+
     @hybrid_property
     def coordinates(self):
         return str(self.lat) + ', ' + str(self.lng)
@@ -472,39 +499,66 @@ class User(ManyOrgBase, ModelBase, SoftDelete):
         return self.organisations[0]
 
     def update_last_seen_ts(self):
-        pass
-        # cur_time = datetime.datetime.utcnow()
-        # if self._last_seen:
-        #     # default to 1 minute intervals
-        #     if cur_time - self._last_seen >= datetime.timedelta(minutes=1):
-        #         self._last_seen = cur_time
-        # else:
-        #     self._last_seen = cur_time
+        # Coalesced with other last seen updates, and written in a batch
+        record_last_seen(self.id)
+
+    @staticmethod
+    def record_completed_receive(connection, user_id, change, session=None):
+        """
+        Adds change (1 when a transfer to a user completes, -1 when one stops being complete) to the user's
+        completed receive count, in a single UPDATE so concurrent transfers to the same user can't lose counts.
+        Works from the user's id so it's safe to call part way through a flush, and only updates the in-memory
+        count of a user already loaded into session
+        :param connection: the flush's connection
+        """
+        user = session.identity_map.get(identity_key(User, user_id)) if session else None
+        if user is not None and 'completed_receive_count' not in user.__dict__:
+            user = None
+
+        deferred_counts = getattr(g, 'deferred_receive_counts', None)
+        if deferred_counts is not None:
+            deferred_counts[user_id] = deferred_counts.get(user_id, 0) + change
+            if user is not None:
+                set_committed_value(user, 'completed_receive_count', (user.completed_receive_count or 0) + change)
+            return
+
+        table = User.__table__
+        completed_receive_count = connection.execute(
+            table.update()
+            .where(table.c.id == user_id)
+            .values({table.c.completed_receive_count: table.c.completed_receive_count + change})
+            .returning(table.c.completed_receive_count)
+        ).scalar()
+
+        if user is not None:
+            set_committed_value(user, 'completed_receive_count', completed_receive_count)
 
     @staticmethod
     def salt_hash_secret(password):
-        f = Fernet(config.PASSWORD_PEPPER)
-        return f.encrypt(bcrypt.hashpw(password.encode(), bcrypt.gensalt())).decode()
+        return hashing.hash_secret(password)
 
     @staticmethod
     def check_salt_hashed_secret(password, hashed_password):
-        if not hashed_password:
-            return False
-        f = Fernet(config.PASSWORD_PEPPER)
-        hashed_password = f.decrypt(hashed_password.encode())
-        return bcrypt.checkpw(password.encode(), hashed_password)
+        return hashing.check_secret(password, hashed_password)
 
     def hash_password(self, password):
         self.password_hash = self.salt_hash_secret(password)
 
     def verify_password(self, password):
-        return self.check_salt_hashed_secret(password, self.password_hash)
+        verified = self.check_salt_hashed_secret(password, self.password_hash)
+        # Moves the hash to the current work factor while we have the password
+        if verified and hashing.needs_rehash(self.password_hash):
+            self.hash_password(password)
+        return verified
 
     def hash_pin(self, pin):
         self.pin_hash = self.salt_hash_secret(pin)
 
     def verify_pin(self, pin):
-        return self.check_salt_hashed_secret(pin, self.pin_hash)
+        verified = self.check_salt_hashed_secret(pin, self.pin_hash)
+        if verified and hashing.needs_rehash(self.pin_hash):
+            self.hash_pin(pin)
+        return verified
 
     def encode_TFA_token(self, valid_days=1):
         """
@@ -805,3 +859,34 @@ class User(ManyOrgBase, ModelBase, SoftDelete):
             return '<User {} {}>'.format(self.id, self.phone)
             
 track_updates(User)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _update_metrics_rollups(mapper, connection, target):
+    record_user_rollup_change(connection, target)
+
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def _update_search_document(mapper, connection, target):
+    target.search_document = build_search_document(target)
+
+
+def build_search_document(user):
+    return ' '.join(
+        str(value) for value in [getattr(user, attribute) for attribute in SEARCH_DOCUMENT_ATTRIBUTES] if value
+    )
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_auth_context(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[attribute].history.has_changes() for attribute in AUTH_CONTEXT_USER_ATTRIBUTES):
+        return
+    user_id = target.id
+    invalidate_auth_context(user_id)
+
+    # Invalidate again once the change is committed, in case another request rebuilt the context from the old
+    # values in the meantime
+    call_after_commit(('auth_context', user_id), lambda: invalidate_auth_context(user_id), state.session)
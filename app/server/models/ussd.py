@@ -1,9 +1,16 @@
+import threading
+
+from sqlalchemy import event, inspect
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.orm.attributes import flag_modified
 import sentry_sdk
 
-from server import db
-from server.models.utils import ModelBase
+from server import db, red
+from server.models.utils import ModelBase, call_after_commit
+
+# USSD menus are static reference data, so each process keeps a read-only copy of them (see UssdMenuRegistry).
+# Changes to the ussd_menu table bump this version, which tells every process to reload its copy
+USSD_MENU_VERSION_KEY = 'ussd_menu_version'
 
 
 class UssdMenu(ModelBase):
@@ -26,22 +33,98 @@ class UssdMenu(ModelBase):
     display_key = db.Column(db.String, nullable=False)
 
     @staticmethod
-    def find_by_name(name: str) -> "UssdMenu":
-        menus = UssdMenu.query.filter_by(name=name)
-        if menus.count() == 0:
+    def find_by_name(name: str) -> "RegisteredUssdMenu":
+        """
+        :return: a read-only copy of the menu from the process's menu registry, or of the invalid request menu
+        if there's no menu with that name
+        """
+        registry = UssdMenuRegistry.current()
+        menu = registry.by_name.get(name)
+        if menu is None:
             sentry_sdk.capture_message("No USSD Menu with name {}".format(name))
             # should handle case if no invalid_request menu?
-            return UssdMenu.query.filter_by(name='exit_invalid_request').first()
-        else:
-            return menus.first()
+            return registry.by_name.get('exit_invalid_request')
+        return menu
 
     def parent(self):
-        return UssdMenu.query.filter_by(id=self.parent_id).first()
+        return UssdMenuRegistry.current().by_id.get(self.parent_id)
 
     def __repr__(self):
         return f"<UssdMenu {self.id}: {self.name} - {self.description}>"
 
 
+class RegisteredUssdMenu(object):
+    """
+    A read-only copy of a UssdMenu, held by the UssdMenuRegistry
+    """
+    __slots__ = ('_id', '_name', '_description', '_parent_id', '_display_key', '_parent')
+
+    def __init__(self, id, name, description, parent_id, display_key):
+        self._id = id
+        self._name = name
+        self._description = description
+        self._parent_id = parent_id
+        self._display_key = display_key
+        self._parent = None
+
+    id = property(lambda self: self._id)
+    name = property(lambda self: self._name)
+    description = property(lambda self: self._description)
+    parent_id = property(lambda self: self._parent_id)
+    display_key = property(lambda self: self._display_key)
+
+    def parent(self):
+        return self._parent
+
+    def __repr__(self):
+        return f"<RegisteredUssdMenu {self.id}: {self.name} - {self.description}>"
+
+
+class UssdMenuRegistry(object):
+    """
+    Every USSD menu, indexed by name and by id, with their parents resolved. Loaded on first use in each process,
+    and reloaded when USSD_MENU_VERSION_KEY changes, so looking up a menu costs one redis read rather than queries
+    """
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, version, rows):
+        self.version = version
+        menus = [RegisteredUssdMenu(*row) for row in rows]
+        self.by_id = {menu.id: menu for menu in menus}
+        self.by_name = {menu.name: menu for menu in menus}
+        for menu in menus:
+            menu._parent = self.by_id.get(menu.parent_id)
+
+    @classmethod
+    def current(cls):
+        version = red.get(USSD_MENU_VERSION_KEY)
+        registry = cls._current
+        if registry is None or registry.version != version:
+            with cls._lock:
+                registry = cls._current
+                if registry is None or registry.version != version:
+                    rows = db.session.query(
+                        UssdMenu.id, UssdMenu.name, UssdMenu.description, UssdMenu.parent_id, UssdMenu.display_key
+                    ).all()
+                    registry = cls._current = cls(version, rows)
+        return registry
+
+
+def bump_ussd_menu_version():
+    red.incr(USSD_MENU_VERSION_KEY)
+
+
+@event.listens_for(UssdMenu, 'after_insert')
+@event.listens_for(UssdMenu, 'after_update')
+@event.listens_for(UssdMenu, 'after_delete')
+def _bump_ussd_menu_version(mapper, connection, target):
+    bump_ussd_menu_version()
+
+    # Bump again once the change is committed, in case another process reloaded its menus in the meantime
+    call_after_commit('ussd_menu_version', bump_ussd_menu_version, inspect(target).session)
+
+
 class UssdSession(ModelBase):
     __tablename__ = 'ussd_session'
 
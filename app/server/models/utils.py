@@ -1,17 +1,24 @@
 from contextlib import contextmanager
 from flask import g, request
+import base64
 import datetime
+import json
+import math
 from dateutil import parser
 
 from sqlalchemy import event, inspect
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import Query
-from sqlalchemy import or_
+from sqlalchemy import and_, or_, tuple_, nullslast
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+import config
 
 import server
-from server import db, bt, AppQuery
-from server.exceptions import OrganisationNotProvidedException, ResourceAlreadyDeletedError
+from server import db, bt, red, AppQuery
+from server.exceptions import OrganisationNotProvidedException, ResourceAlreadyDeletedError, PaginationCursorError
 from server.utils.transfer_enums import BlockchainStatus
 
 
@@ -48,6 +55,77 @@ def no_expire():
     yield
     s.expire_on_commit = True
 
+# Work to do once a session's transaction commits, such as invalidating caches of what it changed. It's kept in
+# the session's info, so it only runs when the session (and so thread) that scheduled it commits, and is dropped
+# if that session rolls back instead
+AFTER_COMMIT_CALLBACKS_KEY = 'after_commit_callbacks'
+
+
+def call_after_commit(key, callback, session=None):
+    """
+    Calls callback once the session's current transaction commits, or not at all if it's rolled back
+    :param key: identifies the callback, so scheduling the same key more than once in a transaction only calls it once
+    :param session: the session to wait on, defaulting to the current scoped session
+    """
+    session = session or db.session()
+    session.info.setdefault(AFTER_COMMIT_CALLBACKS_KEY, {})[key] = callback
+
+
+@event.listens_for(db.session, 'after_commit')
+def _call_after_commit_callbacks(session):
+    callbacks = session.info.pop(AFTER_COMMIT_CALLBACKS_KEY, None)
+    for callback in (callbacks or {}).values():
+        callback()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_after_commit_callbacks(session):
+    session.info.pop(AFTER_COMMIT_CALLBACKS_KEY, None)
+
+
+# Process-wide cache of whether more than one organisation exists. The redis version lets other processes know
+# when an organisation has been inserted or deleted, so they can refresh their own copy of the topology
+ORG_TOPOLOGY_VERSION_KEY = 'ORG_TOPOLOGY_VERSION'
+_org_topology_cache = {'version': None, 'has_many_orgs': None}
+
+# Counts how often filter_by_org resolved the org topology without running the organisation count query
+org_filter_stats = {'compiles': 0, 'org_count_skipped': 0, 'org_count_queries': 0}
+
+
+def invalidate_org_topology_cache():
+    """
+    Clears the cached organisation topology for this process, and bumps the shared version so that
+    every other process recounts organisations on its next request
+    """
+    _org_topology_cache['has_many_orgs'] = None
+    red.incr(ORG_TOPOLOGY_VERSION_KEY)
+    if g:
+        g.pop('has_many_orgs', None)
+
+
+def has_many_orgs():
+    """
+    Whether more than one organisation exists, resolved at most once per request (memoised on g).
+    Only counts organisations if the process-wide cache is empty or was invalidated by another process.
+    """
+    memoised = g.get('has_many_orgs')
+    if memoised is not None:
+        org_filter_stats['org_count_skipped'] += 1
+        return memoised
+
+    version = red.get(ORG_TOPOLOGY_VERSION_KEY)
+    if _org_topology_cache['has_many_orgs'] is None or _org_topology_cache['version'] != version:
+        _org_topology_cache['has_many_orgs'] = db.session.query(server.models.organisation.Organisation.id)\
+            .execution_options(org_check=True).count() > 1
+        _org_topology_cache['version'] = version
+        org_filter_stats['org_count_queries'] += 1
+    else:
+        org_filter_stats['org_count_skipped'] += 1
+
+    g.has_many_orgs = _org_topology_cache['has_many_orgs']
+    return g.has_many_orgs
+
+
 @event.listens_for(AppQuery, "before_compile", retval=True)
 def filter_by_org(query):
     """A query compilation rule that will add limiting criteria for every
@@ -62,12 +140,16 @@ def filter_by_org(query):
         return query
     if org_check:
         return query
-    has_many_orgs = db.session.query(server.models.organisation.Organisation.id).execution_options(org_check=True).count() > 1
-    
+    org_filter_stats['compiles'] += 1
+    many_orgs = has_many_orgs()
+
+    # Columns from the same entity (eg several aggregates over one table) only need filtering once
+    filtered_entities = set()
     for ent in query.column_descriptions:
         entity = ent['entity']
-        if entity is None:
+        if entity is None or entity in filtered_entities:
             continue
+        filtered_entities.add(entity)
         insp = inspect(ent['entity'])
         mapper = getattr(insp, 'mapper', None)
 
@@ -93,7 +175,7 @@ def filter_by_org(query):
                         if not multi_org:
                             raise Exception('Multiple organizations not supported for this operation')
                         query_organisations = g.query_organisations
-                    if has_many_orgs:
+                    if many_orgs:
                         if issubclass(mapper.class_, ManyOrgBase):
                             # filters many-to-many
                             query = query.enable_assertions(False).filter(or_(
@@ -271,6 +353,13 @@ class ManyOrgBase(object):
                                lazy='joined')
 
 
+OFFSET_PAGINATION = 'offset'
+KEYSET_PAGINATION = 'keyset'
+EXACT_TOTAL = 'exact'
+ESTIMATED_TOTAL = 'estimate'
+NO_TOTAL = 'none'
+
+
 def paginate_query(query, sort_attribute=None, sort_desc=True, ignore_last_fetched=False):
     """
     Paginates an sqlalchemy query, gracefully managing missing queries.
@@ -282,12 +371,20 @@ def paginate_query(query, sort_attribute=None, sort_desc=True, ignore_last_fetch
     which can be used to return the next set of results.
     The reason we don't just return the id is because a given item's position in a list can change significantly.
 
+    With pagination=keyset, pages are fetched with a cursor instead of an offset, so deep pages cost the same as the
+    first one. The last fetched value returned is then an opaque cursor (the sort value and id of the last item),
+    to be passed back as last_fetched for the next page. Keyset pages are never larger than PAGINATION_MAX_PER_PAGE.
+
     :param query: base query
     :param sort_attribute: override option for the sort parameter.
     :param sort_desc: sort in desc order
+    :param ignore_last_fetched: don't return the last fetched item (doesn't apply to keyset pagination)
     :argument updated_after: only return items updated after a certain date
-    :argument per_page: how many results to return per request. Defaults to unlimited
+    :argument per_page: how many results to return per request. Defaults to unlimited, or the max page size for keyset
     :argument page: the page number of the results to return. Defaults to first page
+    :argument pagination: 'offset' (default) or 'keyset'
+    :argument total: how to work out the total number of items. 'exact' (default for offset pagination),
+        'estimate' (default for keyset pagination) uses the query planner's row estimate, 'none' skips it
     :returns: tuple of (
         item list,
         total number of items,
@@ -300,6 +397,8 @@ def paginate_query(query, sort_attribute=None, sort_desc=True, ignore_last_fetch
     per_page = request.args.get('per_page')
     page = request.args.get('page')
     last_fetched = request.args.get('last_fetched')
+    pagination = request.args.get('pagination', OFFSET_PAGINATION)
+    total_mode = request.args.get('total')
 
     #Unfortunately SQLAlchemy doesn't have a better way to expose the queried object
     queried_object = query._primary_entity.mapper.class_
@@ -312,6 +411,11 @@ def paginate_query(query, sort_attribute=None, sort_desc=True, ignore_last_fetch
     if not sort_attribute:
         sort_attribute = queried_object.id
 
+    if pagination == KEYSET_PAGINATION:
+        return _keyset_paginate_query(
+            query, queried_object, sort_attribute, sort_desc, per_page, last_fetched, total_mode or ESTIMATED_TOTAL
+        )
+
     if sort_attribute.expression.comparator.type.python_type == datetime.datetime and last_fetched:
         last_fetched = parser.isoparse(last_fetched)
 
@@ -342,21 +446,125 @@ def paginate_query(query, sort_attribute=None, sort_desc=True, ignore_last_fetch
 
         return items, len(items), 1, new_last_fetched
 
-    per_page = int(per_page)
+    per_page = min(int(per_page), config.PAGINATION_MAX_PER_PAGE)
 
-    if page is None:
-        paginated = query.paginate(0, per_page, error_out=False)
+    if total_mode in (ESTIMATED_TOTAL, NO_TOTAL):
+        # Skip paginate's exact count of the whole query
+        page = max(int(page or 1), 1)
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+        total_items = estimate_query_count(query) if total_mode == ESTIMATED_TOTAL else None
+        total_pages = _total_pages(total_items, per_page)
     else:
+        if page is None:
+            paginated = query.paginate(0, per_page, error_out=False)
+        else:
 
-        page = int(page)
+            page = int(page)
 
-        paginated = query.paginate(page, per_page, error_out=False)
+            paginated = query.paginate(page, per_page, error_out=False)
+        items, total_items, total_pages = paginated.items, paginated.total, paginated.pages
 
-    if len(paginated.items) > 0 and not ignore_last_fetched:
-        new_last_fetched_obj = paginated.items[-1]
+    if len(items) > 0 and not ignore_last_fetched:
+        new_last_fetched_obj = items[-1]
         new_last_fetched = getattr(new_last_fetched_obj, sort_attribute.key)
     else:
         new_last_fetched = None
 
-    return paginated.items, paginated.total, paginated.pages, new_last_fetched
+    return items, total_items, total_pages, new_last_fetched
+
+
+def _keyset_paginate_query(query, queried_object, sort_attribute, sort_desc, per_page, cursor, total_mode):
+    per_page = min(int(per_page or config.PAGINATION_MAX_PER_PAGE), config.PAGINATION_MAX_PER_PAGE)
+    total_items = None
+    if total_mode == ESTIMATED_TOTAL:
+        total_items = estimate_query_count(query)
+    elif total_mode == EXACT_TOTAL:
+        total_items = query.order_by(None).count()
+
+    # The id breaks ties between items with the same sort value, so none are skipped or repeated across pages.
+    # Any ordering the query already has is replaced, since the cursor only describes this one
+    query = query.order_by(None)
+    if sort_attribute.key == queried_object.id.key:
+        order_columns = [sort_attribute]
+    else:
+        order_columns = [sort_attribute, queried_object.id]
+
+    # Comparisons with NULL are never true, so items with no sort value are explicitly put after all the others
+    # (in either direction), and paged through by id once the cursor reaches them
+    sort_nullable = len(order_columns) > 1 and getattr(sort_attribute.expression, 'nullable', True)
+    order_by = [c.desc() if sort_desc else c.asc() for c in order_columns]
+    if sort_nullable:
+        order_by[0] = nullslast(order_by[0])
+    query = query.order_by(*order_by)
+
+    if cursor:
+        cursor_values = decode_pagination_cursor(cursor, sort_attribute)[:len(order_columns)]
+        columns = tuple_(*order_columns)
+        if sort_nullable and cursor_values[0] is None:
+            item_id = queried_object.id
+            query = query.filter(and_(
+                sort_attribute == None, item_id < cursor_values[1] if sort_desc else item_id > cursor_values[1]
+            ))
+        else:
+            after_cursor = columns < tuple_(*cursor_values) if sort_desc else columns > tuple_(*cursor_values)
+            query = query.filter(or_(after_cursor, sort_attribute == None) if sort_nullable else after_cursor)
+
+    items = query.limit(per_page).all()
+
+    if items:
+        last_item = items[-1]
+        next_cursor = encode_pagination_cursor(getattr(last_item, sort_attribute.key), last_item.id)
+    else:
+        next_cursor = None
+
+    return items, total_items, _total_pages(total_items, per_page), next_cursor
+
+
+def encode_pagination_cursor(sort_value, item_id):
+    if isinstance(sort_value, (datetime.datetime, datetime.date)):
+        sort_value = sort_value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([sort_value, item_id]).encode()).decode()
+
 
+def decode_pagination_cursor(cursor, sort_attribute):
+    """
+    :return: [sort value, id] of the last item of the previous page
+    """
+    try:
+        sort_value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise PaginationCursorError(f'Invalid pagination cursor {cursor}')
+    if sort_attribute.expression.comparator.type.python_type == datetime.datetime and sort_value is not None:
+        sort_value = parser.isoparse(sort_value)
+    return [sort_value, item_id]
+
+
+def estimate_query_count(query):
+    """
+    Estimates how many rows a query returns from the query planner's statistics, rather than counting them.
+    Good enough for page counts, and doesn't get slower as the table grows.
+    Falls back to an exact count on databases other than postgres
+    """
+    query = query.order_by(None)
+    if db.engine.dialect.name != 'postgresql':
+        return query.count()
+    plan = db.session.execute(_Explain(query.statement)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class _Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def _total_pages(total_items, per_page):
+    if total_items is None:
+        return None
+    return max(math.ceil(total_items / per_page), 1)
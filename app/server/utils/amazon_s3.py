@@ -5,6 +5,10 @@ from flask import g, current_app
 from botocore.exceptions import ClientError
 from server import s3
 import base64
+import io
+
+# S3 needs every part of a multipart upload but the last to be at least 5MB
+MULTIPART_UPLOAD_PART_SIZE = 8 * 1024 * 1024
 
 class LoadFileException(Exception):
     pass
@@ -12,10 +16,7 @@ class LoadFileException(Exception):
 def get_bucket_name():
     return 'sempoctp-' + str(current_app.config['DEPLOYMENT_NAME'].lower())
 
-def upload_local_file_to_s3(local_file_path, filename):
-    # generate bucket name unique to this deployment
-    bucket_name = get_bucket_name()
-
+def ensure_bucket_exists(bucket_name):
     # Call S3 to list current buckets
     response = s3.list_buckets()
 
@@ -32,6 +33,14 @@ def upload_local_file_to_s3(local_file_path, filename):
             else:
                 print("Unexpected error: %s" % e)
 
+
+def upload_local_file_to_s3(local_file_path, filename):
+    # generate bucket name unique to this deployment
+    bucket_name = get_bucket_name()
+
+    ensure_bucket_exists(bucket_name)
+
+    # Large files are uploaded in parts
     s3.upload_file(local_file_path, bucket_name, filename)
 
     file_url = s3.generate_presigned_url('get_object',
@@ -40,6 +49,54 @@ def upload_local_file_to_s3(local_file_path, filename):
     return file_url
 
 
+class S3MultipartUpload(object):
+    """
+    Uploads a file to S3 in parts as it's written, so the whole file never has to be held in memory or on disk.
+    Parts are buffered until they're MULTIPART_UPLOAD_PART_SIZE
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.bucket_name = get_bucket_name()
+        ensure_bucket_exists(self.bucket_name)
+        self.upload_id = s3.create_multipart_upload(Bucket=self.bucket_name, Key=filename)['UploadId']
+        self.parts = []
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= MULTIPART_UPLOAD_PART_SIZE:
+            self._upload_part()
+
+    def complete(self):
+        """
+        :return: presigned url of the uploaded file
+        """
+        if self.buffer.tell() or not self.parts:
+            self._upload_part()
+        s3.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.filename,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+        return get_file_url(self.filename)
+
+    def abort(self):
+        s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.filename, UploadId=self.upload_id)
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.filename,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=self.buffer.getvalue()
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = io.BytesIO()
+
+
 def get_file_url(filename):
 
     # generate bucket name unique to this deployment
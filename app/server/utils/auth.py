@@ -10,7 +10,9 @@ from server.models.transfer_usage import TransferUsage
 from server.models.user import User
 from server.models.ip_address import IpAddress
 from server.models.organisation import Organisation
+from server.models.utils import call_after_commit
 from server.utils.access_control import AccessControl
+from server.utils.auth_context import load_auth_context, store_auth_context, record_last_seen
 import config, hmac, hashlib, json
 from typing import Optional, Tuple, Dict
 
@@ -196,7 +198,9 @@ def requires_auth(f=None,
                     # ----- AUTH PASSED, DO FINAL SETUP -----
 
                     g.user = user
-                    g.member_organisations = [org.id for org in user.organisations]
+                    # Organisations and known IP addresses are cached for each token, see auth_context.py
+                    context = load_auth_context(user, auth_token)
+                    g.member_organisations = context['member_organisations']
                     try:
                         g.active_organisation = None
 
@@ -211,8 +215,8 @@ def requires_auth(f=None,
                                 pass
 
                         # Then get the fallback organisation
-                        if g.active_organisation is None:
-                            g.active_organisation = user.fallback_active_organisation()
+                        if g.active_organisation is None and context['fallback_organisation_id'] is not None:
+                            g.active_organisation = Organisation.query.get(context['fallback_organisation_id'])
 
                         # Check for query_organisations as well. These are stored in g and used for operations which
                         # are allowed to be run against multiple orgs. Submitted as a CSV
@@ -231,10 +235,23 @@ def requires_auth(f=None,
                     except NotImplementedError:
                         g.active_organisation = None
 
-                    check_ip(user)
+                    # IP addresses already known for this token only get their last seen timestamp updated,
+                    # along with the user's. An address that's already saved is cached as known straight away,
+                    # but a new one only once the request that saved it commits
+                    ip_address = request.remote_addr
+                    if ip_address is not None and ip_address not in context['known_ips']:
+                        already_saved = check_ip(user)
+                        context['known_ips'].append(ip_address)
+                        if already_saved:
+                            store_auth_context(user.id, auth_token, context)
+                        else:
+                            call_after_commit(
+                                ('auth_context', user.id, auth_token),
+                                partial(store_auth_context, user.id, auth_token, context)
+                            )
 
                     # updates the validated user last seen timestamp
-                    user.update_last_seen_ts()
+                    record_last_seen(user.id, ip_address)
 
                     #This is the point where you've made it through ok and you can return the top method
                     return f(*args, **kwargs)
@@ -310,6 +327,10 @@ def tfa_logic(user, tfa_token, ignore_tfa_requirement=False):
 
 
 def check_ip(user):
+    """
+    Saves the request's IP address for user, or updates when it was last seen if it's already saved
+    :return: whether the IP address was already saved
+    """
     real_ip_address = request.remote_addr
     if real_ip_address is not None:
         address = IpAddress.check_user_ips(user, real_ip_address)
@@ -318,8 +339,11 @@ def check_ip(user):
             new_ip = IpAddress(ip=real_ip_address)
             new_ip.user = user
             db.session.add(new_ip)
+            return False
         else:
             address.updated = datetime.datetime.utcnow()
+            return True
+    return False
 
 def verify_slack_requests(f=None):
     """
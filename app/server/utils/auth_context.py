@@ -0,0 +1,126 @@
+import datetime
+import hashlib
+import json
+import time
+
+from server import db, red
+from server.utils.executor import standard_executor_job, add_after_request_executor_job
+
+# requires_auth caches what it works out about a user's organisations and IP addresses for each auth token.
+# The cached context carries the user's auth context version, which is bumped whenever the fields it's built from
+# change, so the TTL only bounds how stale it can get from changes made outside the ORM
+AUTH_CONTEXT_TTL_SECONDS = 60
+
+# User attributes the auth context depends on
+AUTH_CONTEXT_USER_ATTRIBUTES = ['organisations', 'default_organisation', 'default_organisation_id', '_deleted']
+
+# Last seen timestamps (of users, and of their IP addresses) are held in redis, and written to the database in one
+# batch at most once every LAST_SEEN_FLUSH_INTERVAL_SECONDS
+LAST_SEEN_FLUSH_INTERVAL_SECONDS = 60
+LAST_SEEN_PENDING_KEY = 'last_seen_pending'
+IP_LAST_SEEN_PENDING_KEY = 'ip_last_seen_pending'
+LAST_SEEN_FLUSH_LOCK_KEY = 'last_seen_flush_lock'
+
+
+def _version_key(user_id):
+    return f'auth_context_version_{user_id}'
+
+
+def _context_key(user_id, auth_token):
+    token_id = hashlib.sha256(auth_token.encode()).hexdigest()
+    return f'auth_context_{user_id}_{token_id}'
+
+
+def load_auth_context(user, auth_token):
+    """
+    Gets the cached auth context of a user, or builds and caches a new one
+    :param user: the user the auth token belongs to
+    :param auth_token: the auth token the request was made with
+    :return: dict with the user's member_organisations, fallback_organisation_id and known_ips
+    """
+    cached_context, version = red.mget(_context_key(user.id, auth_token), _version_key(user.id))
+    version = int(version or 0)
+    if cached_context:
+        context = json.loads(cached_context)
+        if context['version'] == version:
+            return context
+
+    try:
+        fallback_organisation = user.fallback_active_organisation()
+    except NotImplementedError:
+        fallback_organisation = None
+
+    context = {
+        'version': version,
+        'member_organisations': [org.id for org in user.organisations],
+        'fallback_organisation_id': fallback_organisation.id if fallback_organisation else None,
+        'known_ips': []
+    }
+    store_auth_context(user.id, auth_token, context)
+    return context
+
+
+def store_auth_context(user_id, auth_token, context):
+    red.set(_context_key(user_id, auth_token), json.dumps(context), ex=AUTH_CONTEXT_TTL_SECONDS)
+
+
+def invalidate_auth_context(user_id):
+    """
+    Invalidates every cached auth context of a user
+    """
+    red.incr(_version_key(user_id))
+
+
+def record_last_seen(user_id, ip_address=None):
+    """
+    Records that a user (and optionally an IP address of theirs) was seen just now. The timestamps are written
+    to the database by flush_last_seen, which the first request after each flush interval schedules
+    """
+    now = time.time()
+    pipe = red.pipeline(transaction=False)
+    pipe.hset(LAST_SEEN_PENDING_KEY, user_id, now)
+    if ip_address:
+        pipe.hset(IP_LAST_SEEN_PENDING_KEY, f'{user_id}|{ip_address}', now)
+    pipe.set(LAST_SEEN_FLUSH_LOCK_KEY, now, nx=True, ex=LAST_SEEN_FLUSH_INTERVAL_SECONDS)
+    if pipe.execute()[-1]:
+        add_after_request_executor_job(flush_last_seen)
+
+
+@standard_executor_job
+def flush_last_seen():
+    """
+    Writes every pending last seen timestamp to the database in one batch
+    """
+    from server.models.user import User
+    from server.models.ip_address import IpAddress
+
+    pipe = red.pipeline()
+    pipe.hgetall(LAST_SEEN_PENDING_KEY)
+    pipe.hgetall(IP_LAST_SEEN_PENDING_KEY)
+    pipe.delete(LAST_SEEN_PENDING_KEY, IP_LAST_SEEN_PENDING_KEY)
+    user_last_seen, ip_last_seen, _ = pipe.execute()
+
+    if user_last_seen:
+        db.session.bulk_update_mappings(User, [
+            {'id': int(user_id), '_last_seen': datetime.datetime.utcfromtimestamp(float(seen))}
+            for user_id, seen in user_last_seen.items()
+        ])
+
+    if ip_last_seen:
+        pending_ips = {}
+        for key, seen in ip_last_seen.items():
+            user_id, ip = key.decode().split('|', 1)
+            pending_ips[(int(user_id), ip)] = datetime.datetime.utcfromtimestamp(float(seen))
+
+        addresses = IpAddress.query.filter(
+            IpAddress.user_id.in_({user_id for user_id, _ in pending_ips}),
+            IpAddress._ip.in_({ip for _, ip in pending_ips})
+        ).all()
+        # IP addresses are only saved by the request that first sees them, so pending timestamps for addresses
+        # whose request didn't commit are dropped
+        for address in addresses:
+            seen = pending_ips.get((address.user_id, str(address.ip)))
+            if seen:
+                address.updated = seen
+
+    db.session.commit()
@@ -47,6 +47,23 @@ class BlockchainTasker(object):
         }
         return self._execute_synchronous_celery(self._eth_endpoint('call_contract_function'), kwargs, queue=queue)
 
+    def _transaction_task_kwargs(self,
+                                 signing_address,
+                                 contract_address, contract_type,
+                                 func, args=None,
+                                 gas_limit=None,
+                                 prior_tasks=None
+                                 ):
+        return {
+            'signing_address': signing_address,
+            'contract_address': contract_address,
+            'abi_type': contract_type,
+            'function': func,
+            'args': args,
+            'gas_limit': gas_limit,
+            'prior_tasks': prior_tasks
+        }
+
     def _transaction_task(self,
                           signing_address,
                           contract_address, contract_type,
@@ -56,15 +73,9 @@ class BlockchainTasker(object):
                           queue=None,
                           task_uuid=None
                           ):
-        kwargs = {
-            'signing_address': signing_address,
-            'contract_address': contract_address,
-            'abi_type': contract_type,
-            'function': func,
-            'args': args,
-            'gas_limit': gas_limit,
-            'prior_tasks': prior_tasks
-        }
+        kwargs = self._transaction_task_kwargs(
+            signing_address, contract_address, contract_type, func, args, gas_limit, prior_tasks
+        )
         return task_runner.delay_task(
             self._eth_endpoint('transact_with_contract_function'),
             kwargs=kwargs, queue=queue, task_uuid=task_uuid
@@ -255,6 +266,36 @@ class BlockchainTasker(object):
             task_uuid=task_uuid
         )
 
+    def make_token_transfers(self, transfers, queue='high-priority'):
+        """
+        Makes several token transfers at once, publishing their tasks together rather than one at a time.
+
+        :param transfers: list of dicts of make_token_transfer's arguments, other than queue
+        :return: task uuids for the transfers, in the same order
+        """
+        tasks = []
+        for transfer in transfers:
+            signing_address = transfer['signing_address']
+            from_address = transfer['from_address']
+            to_address = transfer['to_address']
+            raw_amount = transfer['token'].system_amount_to_token(transfer['amount'], queue=queue)
+            if signing_address == from_address:
+                func, args = 'transfer', [to_address, raw_amount]
+            else:
+                func, args = 'transferFrom', [from_address, to_address, raw_amount]
+
+            kwargs = self._transaction_task_kwargs(
+                signing_address=signing_address,
+                contract_address=transfer['token'].address,
+                contract_type='ERC20',
+                func=func,
+                args=args,
+                prior_tasks=transfer.get('prior_tasks')
+            )
+            tasks.append((self._eth_endpoint('transact_with_contract_function'), kwargs, transfer.get('task_uuid')))
+
+        return [result.id for result in task_runner.delay_tasks(tasks, queue=queue)]
+
     def make_approval(self,
                       signing_address, token,
                       spender, amount,
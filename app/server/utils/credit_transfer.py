@@ -17,7 +17,8 @@ from server.exceptions import (
 
 from server import db
 from server.models.transfer_usage import TransferUsage
-from server.models.transfer_account import TransferAccount
+from server.models.token import Token
+from server.models.transfer_account import TransferAccount, TransferAccountType
 from server.models.blockchain_address import BlockchainAddress
 from server.models.credit_transfer import CreditTransfer
 from server.models.user import User
@@ -25,6 +26,7 @@ from server.schemas import me_credit_transfer_schema
 from server.utils import user as UserUtils
 from server.utils.transfer_enums import TransferTypeEnum, TransferSubTypeEnum, TransferModeEnum, BlockchainStatus
 from server.utils.user import create_transfer_account_if_required
+from server.utils.transfer_account import deferred_ledger_writes
 
 
 def cents_to_dollars(amount_cents):
@@ -233,7 +235,7 @@ def make_payment_transfer(
     if transfer_subtype is TransferSubTypeEnum.RECLAMATION:
         require_sender_approved = False
         # primary NGO wallet to reclaim to
-        receive_transfer_account = send_user.default_organisation.queried_org_level_transfer_account
+        receive_transfer_account = receive_transfer_account or send_user.default_organisation.queried_org_level_transfer_account
 
     if transfer_subtype is TransferSubTypeEnum.INCENTIVE:
         send_transfer_account = send_transfer_account or receive_transfer_account.token.float_account
@@ -448,6 +450,109 @@ def transfer_credit_via_phone(send_phone, receive_phone, transfer_amount):
     }
 
 
+def ingest_third_party_transfers(transfers):
+    """
+    Records a batch of transfers found by the worker's third party sync, if they involve any Sempo transfer accounts.
+    Every blockchain hash, token and transfer account in the batch is looked up up-front with a handful of IN queries,
+    rather than several queries per transfer, and new transfers are only flushed once at the end. Their changes to
+    the accounts' running totals are collected, and written with one UPDATE for every account in the batch.
+
+    :param transfers: list of dicts with transfer_amount, sender_blockchain_address, recipient_blockchain_address,
+        blockchain_transaction_hash and contract_address
+    :return: list of result dicts in the same order, each with blockchain_transaction_hash, message
+        and the matching credit_transfer (or None if the transfer isn't tracked)
+    """
+    hashes = {t.get('blockchain_transaction_hash') for t in transfers}
+    contract_addresses = {t.get('contract_address') for t in transfers}
+    blockchain_addresses = {
+        address for t in transfers
+        for address in (t.get('sender_blockchain_address'), t.get('recipient_blockchain_address'))
+    }
+
+    transfers_by_hash = {
+        transfer.blockchain_hash: transfer for transfer in
+        CreditTransfer.query.execution_options(show_all=True).filter(CreditTransfer.blockchain_hash.in_(hashes)).all()
+    }
+    tokens_by_address = {
+        token.address: token for token in Token.query.filter(Token.address.in_(contract_addresses)).all()
+    }
+    transfer_accounts_by_address = {}
+    for transfer_account in TransferAccount.query.execution_options(show_all=True)\
+            .filter(TransferAccount.blockchain_address.in_(blockchain_addresses))\
+            .order_by(TransferAccount.id).all():
+        transfer_accounts_by_address.setdefault(transfer_account.blockchain_address, transfer_account)
+
+    def _is_external(transfer_account):
+        # An account we haven't seen before can be inferred to be external
+        return not transfer_account or transfer_account.account_type == TransferAccountType.EXTERNAL
+
+    def _single_user(transfer_account):
+        return transfer_account.users[0] if transfer_account and len(transfer_account.users) == 1 else None
+
+    def _get_or_create_transfer_account(blockchain_address, token):
+        if blockchain_address not in transfer_accounts_by_address:
+            transfer_accounts_by_address[blockchain_address] = TransferAccount(
+                blockchain_address=blockchain_address,
+                token=token,
+                account_type=TransferAccountType.EXTERNAL
+            )
+        return transfer_accounts_by_address[blockchain_address]
+
+    results = []
+    with deferred_ledger_writes():
+        for transfer_data in transfers:
+            blockchain_transaction_hash = transfer_data.get('blockchain_transaction_hash')
+            sender_blockchain_address = transfer_data.get('sender_blockchain_address')
+            recipient_blockchain_address = transfer_data.get('recipient_blockchain_address')
+
+            transfer = transfers_by_hash.get(blockchain_transaction_hash)
+            maybe_sender_transfer_account = transfer_accounts_by_address.get(sender_blockchain_address)
+            maybe_recipient_transfer_account = transfer_accounts_by_address.get(recipient_blockchain_address)
+
+            # Case 1: Transfer exists in the database already. Mark received_third_party_sync as true
+            if transfer:
+                transfer.received_third_party_sync = True
+                message = 'Transfer Successful'
+
+            # Case 2: Two non-sempo users making a trade on our token. We don't have to track this!
+            elif not maybe_recipient_transfer_account and not maybe_sender_transfer_account:
+                message = 'No existing users involved in this transfer'
+
+            # Case 3: Two non-Sempo users, at least one of whom has interacted with Sempo users before transacting
+            # with one another. We don't have to track this either!
+            elif _is_external(maybe_recipient_transfer_account) and _is_external(maybe_sender_transfer_account):
+                message = 'Only external users involved in this transfer'
+
+            # Case 4: One or both of the transfer accounts are affiliated with Sempo accounts.
+            # This is the only case where we want to generate a new CreditTransfer object.
+            else:
+                token = tokens_by_address.get(transfer_data.get('contract_address'))
+                transfer = CreditTransfer(
+                    transfer_data.get('transfer_amount'),
+                    token=token,
+                    sender_transfer_account=_get_or_create_transfer_account(sender_blockchain_address, token),
+                    recipient_transfer_account=_get_or_create_transfer_account(recipient_blockchain_address, token),
+                    transfer_type=TransferTypeEnum.PAYMENT,
+                    sender_user=_single_user(maybe_sender_transfer_account),
+                    recipient_user=_single_user(maybe_recipient_transfer_account),
+                    require_sufficient_balance=False,
+                    received_third_party_sync=True
+                )
+
+                transfer.resolve_as_complete_with_existing_blockchain_transaction(blockchain_transaction_hash)
+                # So that a repeated hash later in the batch is treated as already existing
+                transfers_by_hash[blockchain_transaction_hash] = transfer
+                message = 'Transfer Successful'
+
+            results.append({
+                'blockchain_transaction_hash': blockchain_transaction_hash,
+                'message': message,
+                'credit_transfer': transfer
+            })
+
+    return results
+
+
 def check_for_any_valid_hash(transfer_amount, transfer_account_id, user_secret, hash_to_check):
     # How many seconds each hash lasts for
     time_interval = 5
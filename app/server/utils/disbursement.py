@@ -0,0 +1,180 @@
+import math
+from decimal import Decimal
+from uuid import uuid4
+
+from flask import g
+from sqlalchemy.orm import selectinload
+
+import config
+from server import db
+from server.models.transfer_account import TransferAccount
+from server.exceptions import TransferLimitError
+from server.models.user import User
+from server.models.utils import disbursement_transfer_account_association_table
+from server.utils.credit_transfer import make_payment_transfer, make_target_balance_transfer
+from server.utils.executor import bulk_process_transactions
+from server.utils.misc import chunk_list
+from server.utils.transfer_account import deferred_ledger_writes
+from server.utils.transfer_enums import TransferSubTypeEnum, TransferModeEnum
+from server.utils.transfer_limits.limits import MaximumAmountPerTransferLimit, TotalAmountLimit, TransferCountLimit
+
+
+def make_disbursement_transfers(disbursement, send_transfer_account, auto_resolve=False, batch_size=None):
+    """
+    Makes a disbursement's transfers a batch of recipients at a time. Each batch's accounts and users are loaded in
+    one query, every account's ledger changes are written in one statement, and once the batch is committed its
+    blockchain tasks are published together. A DISBURSEMENT's transfers all come from the same account, so the
+    sender's balance and transfer limits are checked once for the whole disbursement rather than per transfer.
+    :param disbursement: the disbursement to make transfers for
+    :param send_transfer_account: the organisation's account, which disbursements are sent from
+    :param auto_resolve: whether to complete the transfers of an approved disbursement
+    :param batch_size: recipients per batch, defaulting to config.DISBURSEMENT_BATCH_SIZE
+    :return: generator of the job's progress, yielded after each batch
+    """
+    batch_size = batch_size or config.DISBURSEMENT_BATCH_SIZE
+    association = disbursement_transfer_account_association_table
+    transfer_account_ids = [
+        transfer_account_id for transfer_account_id, in
+        db.session.query(association.c.transfer_account_id)
+        .filter(association.c.disbursement_id == disbursement.id)
+        .order_by(association.c.transfer_account_id)
+    ]
+    recipient_count = len(transfer_account_ids)
+    amount = disbursement.disbursement_amount
+    resolve = auto_resolve and disbursement.state == 'APPROVED'
+    # Every transfer of the disbursement shares a batch, so that they don't have to go to chain one after another
+    batch_uuid = str(uuid4())
+
+    # Disbursements all come from the same account, so we know up front how many recipients it can cover
+    affordable_count = recipient_count
+    if disbursement.transfer_type == 'DISBURSEMENT' and amount > 0:
+        affordable_count = min(recipient_count, int(send_transfer_account.unrounded_balance // Decimal(amount)))
+
+    # How many transfers the sender's transfer limits allow, worked out from the first transfer made
+    limited_count = None
+
+    made_count = 0
+    # Only transfers that were actually created use up what the sender can afford
+    created_count = 0
+    for transfer_account_ids_batch in chunk_list(transfer_account_ids, batch_size):
+        transfer_accounts = {
+            ta.id: ta for ta in
+            db.session.query(TransferAccount)
+            .filter(TransferAccount.id.in_(transfer_account_ids_batch))
+            .options(selectinload(TransferAccount.users).selectinload(User.transfer_card))
+        }
+        approver = db.session.query(User).filter(User.id == g.user.id).first() if resolve else None
+        errors = []
+
+        with deferred_ledger_writes():
+            for transfer_account_id in transfer_account_ids_batch:
+                ta = transfer_accounts.get(transfer_account_id)
+                made_count += 1
+                try:
+                    if ta is None:
+                        raise Exception('Transfer account not found')
+
+                    transfer = _make_disbursement_transfer(
+                        disbursement, amount, ta, send_transfer_account, is_affordable=created_count < affordable_count
+                    )
+                    disbursement.credit_transfers.append(transfer)
+                    created_count += 1
+                    if resolve:
+                        if disbursement.transfer_type == 'DISBURSEMENT' and limited_count is None:
+                            limited_count = _count_within_transfer_limits(transfer, recipient_count)
+                        transfer.approvers = disbursement.approvers
+                        transfer.add_approver_and_resolve_as_completed(
+                            user=approver,
+                            batch_uuid=batch_uuid,
+                            # Transfers past what the limits allow are checked one by one, so they're rejected
+                            # with the limit's own error, or let through with a warning for sempo admins
+                            check_limits=limited_count is None or created_count > limited_count
+                        )
+                except Exception as e:
+                    errors.append(f'{ta or transfer_account_id}: {e}')
+
+        if errors:
+            disbursement.errors = disbursement.errors + errors
+        db.session.commit()
+        if g.pending_transactions:
+            bulk_process_transactions()
+
+        percent_complete = (made_count / recipient_count) * 100
+        yield {
+            'message': 'Success' if made_count == recipient_count else
+            f'Creating transfer {made_count} of {recipient_count}',
+            'percent_complete': math.floor(percent_complete),
+        }
+
+
+def _make_disbursement_transfer(disbursement, amount, ta, send_transfer_account, is_affordable):
+    user = ta.primary_user
+    if disbursement.transfer_type == 'DISBURSEMENT':
+        if not is_affordable:
+            raise Exception(f'Sender {send_transfer_account} has insufficient balance')
+        return make_payment_transfer(
+            amount,
+            send_user=g.user,
+            receive_user=user,
+            send_transfer_account=send_transfer_account,
+            receive_transfer_account=ta,
+            transfer_subtype=TransferSubTypeEnum.DISBURSEMENT,
+            transfer_mode=TransferModeEnum.WEB,
+            # Already checked against the affordable count
+            require_sufficient_balance=False,
+            automatically_resolve_complete=False,
+        )
+
+    if disbursement.transfer_type == 'RECLAMATION':
+        if ta.unrounded_balance < Decimal(amount):
+            raise Exception(f'Sender {ta} has insufficient balance')
+        return make_payment_transfer(
+            amount,
+            send_user=user,
+            send_transfer_account=ta,
+            receive_transfer_account=send_transfer_account,
+            transfer_subtype=TransferSubTypeEnum.RECLAMATION,
+            transfer_mode=TransferModeEnum.WEB,
+            require_recipient_approved=False,
+            automatically_resolve_complete=False,
+        )
+
+    if disbursement.transfer_type == 'BALANCE':
+        return make_target_balance_transfer(
+            amount,
+            user,
+            automatically_resolve_complete=False,
+            transfer_mode=TransferModeEnum.WEB,
+        )
+
+    raise Exception(f'Unknown disbursement type {disbursement.transfer_type}')
+
+
+def _count_within_transfer_limits(transfer, count):
+    """
+    Every transfer of a DISBURSEMENT has the same sender, token, type and amount, so the same transfer limits apply to
+    all of them, and they use up those limits at the same rate. This works out from the disbursement's first transfer
+    how many of its transfers the limits allow, so each one doesn't have to query them again.
+    Limits whose use can't be worked out this way allow none, leaving every transfer to be checked on its own.
+    :param transfer: the disbursement's first transfer, not yet resolved
+    :param count: how many transfers the disbursement makes
+    :return: how many of the disbursement's transfers can skip their own limit checks
+    """
+    if transfer.sender_user is None:
+        # No limits apply to system sends
+        return count
+
+    for limit in transfer.get_transfer_limits():
+        try:
+            limit.validate_transfer(transfer)
+        except TransferLimitError:
+            return 0
+
+        if isinstance(limit, (TotalAmountLimit, TransferCountLimit)):
+            used = limit.case_will_use(transfer)
+            if used:
+                count = min(count, int(limit.available(transfer) // used))
+        elif not isinstance(limit, MaximumAmountPerTransferLimit):
+            return 0
+
+    return count
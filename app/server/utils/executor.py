@@ -88,14 +88,21 @@ def bulk_process_transactions():
     from server.models.credit_transfer import CreditTransfer
     from server.models.exchange import Exchange
     from server.utils import pusher_utils
+    pusher_transactions = []
+    # Credit transfers going to the same queue are loaded and sent to the worker together
+    credit_transfer_ids_by_queue = {}
     for transaction, queue in g.pending_transactions:
-        pusher_transactions = []
         if isinstance(transaction, CreditTransfer):
-            transaction = db.session.query(CreditTransfer).filter(CreditTransfer.id == transaction.id).first()
+            credit_transfer_ids_by_queue.setdefault(queue, []).append(transaction.id)
         else:
             transaction = db.session.query(Exchange).filter(Exchange.id == transaction.id).first()
-        transaction.send_blockchain_payload_to_worker(queue=queue)
-        pusher_transactions.append(transaction)
+            transaction.send_blockchain_payload_to_worker(queue=queue)
+            pusher_transactions.append(transaction)
+    for queue, credit_transfer_ids in credit_transfer_ids_by_queue.items():
+        transfers = db.session.query(CreditTransfer).filter(CreditTransfer.id.in_(credit_transfer_ids))\
+            .order_by(CreditTransfer.id).all()
+        CreditTransfer.send_blockchain_payloads_to_worker(transfers, queue=queue)
+        pusher_transactions.extend(transfers)
     g.pending_transactions = []
     if not current_app.config['IS_TEST']:
         pusher_utils.push_admin_credit_transfer([txn for txn in pusher_transactions])
@@ -1,13 +1,20 @@
+import csv
+import io
 import os
 
 from flask import render_template, current_app, g
+from openpyxl import Workbook
 from weasyprint import HTML
 
 from server.schemas import pdf_users_schema
-from server.utils.amazon_s3 import upload_local_file_to_s3, get_local_save_path
+from server.utils.amazon_s3 import upload_local_file_to_s3, get_local_save_path, S3MultipartUpload
 from server.utils.amazon_ses import send_export_email
 from pdfrw import PdfReader, PdfWriter
 
+# Bytes of csv rows held in memory before they're passed on to the upload
+CSV_FLUSH_SIZE = 1024 * 1024
+
+
 def generate_pdf_export(users, pdf_filename):
     users = list(users)
     serialised_users = pdf_users_schema.dump(users).data
@@ -53,18 +60,113 @@ def _export_via_s3(save_method, filename, email=None):
         # upload to s3
         file_url = upload_local_file_to_s3(local_save_path, filename)
 
-        if email:
-            send_export_email(file_url, email)
-
-        else:
-            if g.user.email is not None:
-                send_export_email(file_url, g.user.email)
+        send_export_emails([file_url], email)
 
         # remove local file path
         os.remove(local_save_path)
 
     return file_url
 
+
+def send_export_emails(file_urls, email=None):
+    email = email or g.user.email
+    if email is not None:
+        for file_url in file_urls:
+            send_export_email(file_url, email)
+
+
+class XlsxExportWriter(object):
+    """
+    Writes an export one row at a time to a write-only workbook, which keeps finished rows on disk rather than in
+    memory. The workbook is uploaded once it's closed
+    """
+    def __init__(self, base_filename):
+        self.filename = base_filename + '.xlsx'
+        self.local_save_path = get_local_save_path(self.filename)
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None
+
+    def add_sheet(self, name, headers):
+        self.sheet = self.workbook.create_sheet(name)
+        self.sheet.append(headers)
+
+    def write_row(self, row):
+        self.sheet.append(row)
+
+    def close(self):
+        """
+        :return: list of urls of the exported files
+        """
+        self.workbook.save(self.local_save_path)
+        file_url = ''
+        if not current_app.config['IS_TEST']:
+            file_url = upload_local_file_to_s3(self.local_save_path, self.filename)
+        os.remove(self.local_save_path)
+        return [file_url]
+
+    def abort(self):
+        if os.path.exists(self.local_save_path):
+            os.remove(self.local_save_path)
+
+
+class CsvExportWriter(object):
+    """
+    Writes each sheet of an export to its own csv file, which is uploaded to S3 in parts as it's written
+    """
+    def __init__(self, base_filename):
+        self.base_filename = base_filename
+        self.file_urls = []
+        self.output = None
+        self.rows = io.StringIO()
+        self.csv_writer = csv.writer(self.rows)
+
+    def add_sheet(self, name, headers):
+        self._finish_sheet()
+        filename = f'{self.base_filename}-{name}.csv'
+        if current_app.config['IS_TEST']:
+            self.local_save_path = get_local_save_path(filename)
+            self.output = open(self.local_save_path, 'wb')
+        else:
+            self.output = S3MultipartUpload(filename)
+        self.write_row(headers)
+
+    def write_row(self, row):
+        self.csv_writer.writerow(row)
+        if self.rows.tell() >= CSV_FLUSH_SIZE:
+            self._flush()
+
+    def close(self):
+        """
+        :return: list of urls of the exported files, one for each sheet
+        """
+        self._finish_sheet()
+        return self.file_urls
+
+    def abort(self):
+        if isinstance(self.output, S3MultipartUpload):
+            self.output.abort()
+        elif self.output:
+            self.output.close()
+            os.remove(self.local_save_path)
+        self.output = None
+
+    def _flush(self):
+        self.output.write(self.rows.getvalue().encode())
+        self.rows.seek(0)
+        self.rows.truncate()
+
+    def _finish_sheet(self):
+        if self.output is None:
+            return
+        self._flush()
+        if isinstance(self.output, S3MultipartUpload):
+            self.file_urls.append(self.output.complete())
+        else:
+            self.output.close()
+            os.remove(self.local_save_path)
+            self.file_urls.append('')
+        self.output = None
+
 WINDOW_SIZE = 250
 def partition_query(query):
     start = 0
@@ -0,0 +1,165 @@
+import hashlib
+import hmac
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from cryptography.fernet import Fernet
+
+import config
+from server.exceptions import HashingBusyError
+
+# Password and PIN hashes are bcrypt hashes, encrypted with the password pepper. bcrypt is deliberately slow, so
+# hashing and checking run on a small process pool rather than on the request thread, with a bounded number of
+# requests allowed to queue for it. Requests that can't get a place in the queue are turned away with a
+# HashingBusyError, which the API returns as a 503, rather than hashing on the request thread.
+
+# Successful checks are remembered for a short while, keyed by an HMAC of the hash and the secret, so a user
+# entering their PIN several times in one USSD session only pays for bcrypt once. Failed checks are never
+# remembered, so guessing doesn't get any cheaper
+VERIFIED_CACHE_TTL_SECONDS = 300
+VERIFIED_CACHE_MAX_ENTRIES = 10000
+
+_pool_lock = threading.Lock()
+_pool = {'pid': None, 'executor': None, 'slots': None}
+_verified_cache = OrderedDict()
+_verified_cache_lock = threading.Lock()
+
+
+class WorkFactorPolicy(object):
+    """
+    Picks the bcrypt cost for new hashes: the highest cost between min_rounds and max_rounds whose hash takes at
+    most target_seconds on this machine. Each extra round doubles the time a hash takes, so one timed hash is
+    enough to work it out. Hashes with a lower cost are rehashed the next time they're checked successfully.
+    Higher costs are left alone, so processes that calibrate a little differently don't keep rehashing each
+    other's hashes
+    """
+    def __init__(self, target_seconds, min_rounds, max_rounds):
+        self.target_seconds = target_seconds
+        self.min_rounds = min_rounds
+        self.max_rounds = max_rounds
+        self._rounds = None
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            elapsed = _run(_time_hash, self.min_rounds)
+            extra_rounds = math.floor(math.log2(self.target_seconds / elapsed)) if elapsed > 0 else 0
+            self._rounds = min(self.max_rounds, max(self.min_rounds, self.min_rounds + extra_rounds))
+        return self._rounds
+
+    def needs_rehash(self, hashed_secret):
+        try:
+            rounds = int(_decrypt(hashed_secret).split(b'$')[2])
+        except Exception:
+            return False
+        return rounds < self.rounds
+
+
+work_factor_policy = WorkFactorPolicy(
+    target_seconds=config.BCRYPT_TARGET_SECONDS,
+    min_rounds=config.BCRYPT_MIN_ROUNDS,
+    max_rounds=config.BCRYPT_MAX_ROUNDS
+)
+
+
+def hash_secret(secret):
+    """
+    :param secret: password or PIN
+    :return: the encrypted bcrypt hash of the secret, using the work factor policy's cost
+    """
+    return _run(_hash, secret, work_factor_policy.rounds)
+
+
+def check_secret(secret, hashed_secret):
+    """
+    :param secret: password or PIN
+    :param hashed_secret: a hash from hash_secret
+    :return: whether the secret matches the hash
+    """
+    if not hashed_secret:
+        return False
+    cache_key = hmac.new(
+        config.PASSWORD_PEPPER.encode(), f'{hashed_secret}\0{secret}'.encode(), hashlib.sha256
+    ).digest()
+    with _verified_cache_lock:
+        expiry = _verified_cache.get(cache_key)
+        if expiry and expiry > time.time():
+            _verified_cache.move_to_end(cache_key)
+            return True
+
+    verified = _run(_check, secret, hashed_secret)
+    if verified:
+        with _verified_cache_lock:
+            _verified_cache[cache_key] = time.time() + VERIFIED_CACHE_TTL_SECONDS
+            _verified_cache.move_to_end(cache_key)
+            while len(_verified_cache) > VERIFIED_CACHE_MAX_ENTRIES:
+                _verified_cache.popitem(last=False)
+    return verified
+
+
+def needs_rehash(hashed_secret):
+    return work_factor_policy.needs_rehash(hashed_secret)
+
+
+def _run(fn, *args):
+    # Runs one of the hashing functions below on the pool, or inline if there's no pool (as in tests). A request
+    # that can't get a queue slot within HASHING_QUEUE_TIMEOUT_SECONDS is turned away, so bcrypt never runs on more
+    # than the pool's processes at once. If the pool breaks, eg because one of its processes was killed, the
+    # request is retried once on a new pool
+    for _ in range(2):
+        executor, slots = _get_pool()
+        if not executor:
+            return fn(*args)
+        if not slots.acquire(timeout=config.HASHING_QUEUE_TIMEOUT_SECONDS):
+            raise HashingBusyError('Too many password and PIN checks in progress, please try again')
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            _reset_pool(executor)
+        finally:
+            slots.release()
+    raise HashingBusyError('Password and PIN checks are unavailable, please try again')
+
+
+def _get_pool():
+    if not config.HASHING_POOL_SIZE:
+        return None, None
+    with _pool_lock:
+        # Pools don't survive forking, so each worker process makes its own
+        if _pool['pid'] != os.getpid():
+            _pool['pid'] = os.getpid()
+            _pool['executor'] = ProcessPoolExecutor(max_workers=config.HASHING_POOL_SIZE)
+            _pool['slots'] = threading.BoundedSemaphore(config.HASHING_POOL_SIZE + config.HASHING_QUEUE_SIZE)
+        return _pool['executor'], _pool['slots']
+
+
+def _reset_pool(executor):
+    with _pool_lock:
+        if _pool['executor'] is executor:
+            _pool['pid'] = None
+    executor.shutdown(wait=False)
+
+
+# Functions run on the pool
+def _decrypt(hashed_secret):
+    return Fernet(config.PASSWORD_PEPPER).decrypt(hashed_secret.encode())
+
+
+def _hash(secret, rounds):
+    return Fernet(config.PASSWORD_PEPPER).encrypt(bcrypt.hashpw(secret.encode(), bcrypt.gensalt(rounds))).decode()
+
+
+def _check(secret, hashed_secret):
+    return bcrypt.checkpw(secret.encode(), _decrypt(hashed_secret))
+
+
+def _time_hash(rounds):
+    started = time.time()
+    bcrypt.hashpw(b'work factor calibration', bcrypt.gensalt(rounds))
+    return time.time() - started
@@ -2,6 +2,7 @@ from server.models.credit_transfer import CreditTransfer
 from server.models.transfer_account import TransferAccount
 from server.models.custom_attribute_user_storage import CustomAttributeUserStorage
 from server.models.custom_attribute import CustomAttribute
+from server.models.metrics_rollup import MetricsDailyRollup
 
 from server.utils.transfer_enums import TransferTypeEnum, TransferSubTypeEnum, TransferStatusEnum
 from server.models.user import User
@@ -148,3 +149,35 @@ standard_payment_filters = [
 complete_transfer_filter = [
     CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE,
 ]
+
+# Equivalents of the filters above for metrics read from the daily rollups, which only hold complete transfers
+disbursement_rollup_filters = [
+    MetricsDailyRollup.object_type == CreditTransfer.__tablename__,
+    MetricsDailyRollup.transfer_type == TransferTypeEnum.PAYMENT.value,
+    MetricsDailyRollup.transfer_subtype == TransferSubTypeEnum.DISBURSEMENT.value
+]
+
+reclamation_rollup_filters = [
+    MetricsDailyRollup.object_type == CreditTransfer.__tablename__,
+    MetricsDailyRollup.transfer_type == TransferTypeEnum.PAYMENT.value,
+    MetricsDailyRollup.transfer_subtype == TransferSubTypeEnum.RECLAMATION.value
+]
+
+withdrawal_rollup_filters = [
+    MetricsDailyRollup.object_type == CreditTransfer.__tablename__,
+    MetricsDailyRollup.transfer_type == TransferTypeEnum.WITHDRAWAL.value
+]
+
+standard_payment_rollup_filters = [
+    MetricsDailyRollup.object_type == CreditTransfer.__tablename__,
+    MetricsDailyRollup.transfer_type == TransferTypeEnum.PAYMENT.value,
+    MetricsDailyRollup.transfer_subtype == TransferSubTypeEnum.STANDARD.value
+]
+
+complete_transfer_rollup_filter = [
+    MetricsDailyRollup.object_type == CreditTransfer.__tablename__,
+]
+
+user_rollup_filter = [
+    MetricsDailyRollup.object_type == User.__tablename__,
+]
@@ -1,9 +1,9 @@
-from server.utils.metrics import filters, metrics_cache, postprocessing_actions, group
+from server.utils.metrics import filters, metrics_cache, postprocessing_actions, group, rollups
 from server.utils.metrics.metrics_const import *
 import datetime
 from server import db
 class Metric(object):
-    def execute_query(self, user_filters: dict = None, date_filter_attributes=None, enable_caching=True, population_query_result=False, dont_include_timeseries=False, start_date=None, end_date=None, group_by=None):
+    def execute_query(self, user_filters: dict = None, date_filter_attributes=None, enable_caching=True, population_query_result=False, dont_include_timeseries=False, start_date=None, end_date=None, group_by=None, fused_results=None):
         """
         :param user_filters: dict of filters to apply to all metrics
         :param date_filter_attributes: lookup table indicating which row to use when filtering by date  
@@ -15,7 +15,10 @@ class Metric(object):
         :param start_date: Start date for metrics queries (for calculating percent change within date range)
         :param End_date: End date for metrics queries (for calculating percent change within date range)
         :param group_by: Name of the group-by used, used for metrics cache key names
+        :param fused_results: dict of query name to raw results of this metric's queries which have already been
+            run together with other metrics' queries. See planner.py for more details
         """
+        fused_results = fused_results or {}
         actions = {
                     'primary': self.query_actions, 
                     'aggregated_query': self.aggregated_query_actions, 
@@ -23,87 +26,24 @@ class Metric(object):
                     'start_day_query': self.total_query_actions,
                     'end_day_query': self.total_query_actions
                 }
-        combinatory_strategies = {
-            'primary': self.query_caching_combinatory_strategy, 
-            'aggregated_query': self.aggregated_query_caching_combinatory_strategy, 
-            'total_query': self.total_query_caching_combinatory_strategy,
-            'start_day_query': metrics_cache.QUERY_ALL,
-            'end_day_query': metrics_cache.QUERY_ALL
-        }
-        # Build the dict of queries to execute. Ungrouped metrics don't have aggregated queries,
-        # and sometimes we only want aggregates and totals (based on dont_include_timeseries)
-        if self.is_timeseries:
-            if dont_include_timeseries:
-                queries = { 'total_query': self.total_query, 'start_day_query': self.total_query, 'end_day_query': self.total_query }
-            else:   
-                queries = { 'primary': self.query, 'total_query': self.total_query, 'start_day_query': self.total_query, 'end_day_query': self.total_query }
-            if self.aggregated_query:
-                queries['aggregated_query'] = self.aggregated_query
-            if None in queries.values():
-                raise Exception('Timeseries query requires a query, and a total_query')
-        else:
-            queries = { 'primary': self.query }
+        queries = self._queries(dont_include_timeseries)
 
-        results = {}
-        for query in queries:
-            user_filters = user_filters or {}
-            # Apply stock filters
-            filtered_query = queries[query]
-            for f in self.stock_filters:
-                filtered_query = filtered_query.filter(*f)
+        # Validate that the filters we're applying are in the metrics' filterable_by
+        for f, _ in user_filters or []:
+            if f not in self.filterable_by:
+                raise Exception(f'{self.metric_name} not filterable by {f}')
 
-            # Validate that the filters we're applying are in the metrics' filterable_by
-            for f, _ in user_filters or []:
-                if f not in self.filterable_by:
-                    raise Exception(f'{self.metric_name} not filterable by {f}')
-
-            # Apply the applicable date filters
-            if DATE in self.filterable_by or []:
-                if start_date or end_date:
-                    date_filter_attribute = date_filter_attributes[self.object_model]
-                    date_filters = []
-                    if start_date:
-                        date_filters.append(date_filter_attribute >= start_date)
-                    if end_date:
-                        date_filters.append(date_filter_attribute <=  datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1)  )
-                    if not self.bypass_user_filters:
-                        filtered_query = filtered_query.filter(*date_filters)
-
-            # Handle start_day and end_day queries so we can have a percentage change for the whole day range
-            if query in ['start_day_query', 'end_day_query']:
-                date_filter_attribute = date_filter_attributes[self.object_model]
-                # If a user provided end-date goes past today, just use today. Also if the user doesn't provide a day
-                # also use today
-                today = datetime.datetime.now().replace(minute=0, hour=0, second=0, microsecond=0)
-                if not end_date or datetime.datetime.strptime(end_date, "%Y-%m-%d") > today:
-                    last_day = today
-                else:
-                    last_day = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-                if not start_date:
-                    # Get first date where data is present if no other date is given
-                    first_day = metrics_cache.get_first_day(date_filter_attribute, enable_caching)
-                else:
-                    first_day = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-
-                day = first_day if query == 'start_day_query' else last_day
-                date_filters = []
-                # To filter for items on day n, we have to filter between day n and day n+1
-                date_filters.append(date_filter_attribute >= day)
-                date_filters.append(date_filter_attribute <=  day + datetime.timedelta(days=1)  )
-                filtered_query = filtered_query.filter(*date_filters)
-
-            if not self.bypass_user_filters:
-                filtered_query = filters.apply_filters(filtered_query, user_filters, self.object_model)
+        rollup_organisation = self._rollup_organisation(user_filters, group_by)
 
-            strategy = combinatory_strategies[query]
-            result = metrics_cache.execute_with_partial_history_cache(
-                self.metric_name, 
-                filtered_query, 
-                self.object_model, 
-                strategy, 
-                enable_caching,
-                group_by=group_by,
-                query_name=query)
+        results = {}
+        for query in queries:
+            if query in fused_results:
+                result = fused_results[query]
+            else:
+                result = self._execute_single_query(
+                    query, queries[query], rollup_organisation, user_filters, date_filter_attributes, enable_caching,
+                    start_date, end_date, group_by
+                )
 
             if not actions[query]:
                 results[query] = result
@@ -142,6 +82,140 @@ class Metric(object):
         else:
             return results['primary']
 
+    def _execute_single_query(self, query, base_query, rollup_organisation, user_filters, date_filter_attributes, enable_caching, start_date, end_date, group_by):
+        if rollup_organisation:
+            filtered_query = rollups.build_rollup_query(
+                rollup_organisation,
+                query,
+                self.rollup_value,
+                self.rollup_filters,
+                self.is_timeseries,
+                timeseries_unit=self.timeseries_unit,
+                group_by=group_by,
+                start_date=None if self.bypass_user_filters else start_date,
+                end_date=None if self.bypass_user_filters else end_date
+            )
+        else:
+            filtered_query = self._filter_query(
+                query, base_query, user_filters, date_filter_attributes, enable_caching, start_date, end_date
+            )
+
+        return metrics_cache.execute_with_partial_history_cache(
+            self.metric_name, 
+            filtered_query, 
+            self.object_model, 
+            self._combinatory_strategies()[query], 
+            enable_caching and not rollup_organisation,
+            group_by=group_by,
+            query_name=query)
+
+    def fusable_queries(self, user_filters: dict = None, date_filter_attributes=None, enable_caching=True, dont_include_timeseries=False, start_date=None, end_date=None, group_by=None):
+        """
+        Gets the queries of this metric which would be run straight against the database, without the cache or
+        the rollups, so they can be run together with other metrics' queries. See planner.py for more details.
+        Takes the same parameters as execute_query
+        :return: dict of query name to (query with every filter but the stock filters, stock filters, combinatory strategy)
+        """
+        if self._rollup_organisation(user_filters, group_by):
+            return {}
+        combinatory_strategies = self._combinatory_strategies()
+        stock_filters = [f for stock_filter in self.stock_filters for f in stock_filter]
+        fusable = {}
+        for query, base_query in self._queries(dont_include_timeseries).items():
+            strategy = combinatory_strategies[query]
+            if enable_caching and strategy not in metrics_cache.dumb_strategies:
+                continue
+            filtered_query = self._filter_query(
+                query, base_query, user_filters, date_filter_attributes, enable_caching, start_date, end_date,
+                apply_stock_filters=False
+            )
+            fusable[query] = (filtered_query, stock_filters, strategy)
+        return fusable
+
+    def _queries(self, dont_include_timeseries):
+        # Build the dict of queries to execute. Ungrouped metrics don't have aggregated queries,
+        # and sometimes we only want aggregates and totals (based on dont_include_timeseries)
+        if self.is_timeseries:
+            if dont_include_timeseries:
+                queries = { 'total_query': self.total_query, 'start_day_query': self.total_query, 'end_day_query': self.total_query }
+            else:   
+                queries = { 'primary': self.query, 'total_query': self.total_query, 'start_day_query': self.total_query, 'end_day_query': self.total_query }
+            if self.aggregated_query:
+                queries['aggregated_query'] = self.aggregated_query
+            if None in queries.values():
+                raise Exception('Timeseries query requires a query, and a total_query')
+        else:
+            queries = { 'primary': self.query }
+        return queries
+
+    def _combinatory_strategies(self):
+        return {
+            'primary': self.query_caching_combinatory_strategy, 
+            'aggregated_query': self.aggregated_query_caching_combinatory_strategy, 
+            'total_query': self.total_query_caching_combinatory_strategy,
+            'start_day_query': metrics_cache.QUERY_ALL,
+            'end_day_query': metrics_cache.QUERY_ALL
+        }
+
+    def _rollup_organisation(self, user_filters, group_by):
+        # Unfiltered metrics over a single organisation can be read from the daily rollups instead
+        if self.rollup_value and (self.bypass_user_filters or not user_filters):
+            return rollups.get_rollup_organisation(self.object_model, group_by)
+        return None
+
+    def _filter_query(self, query, base_query, user_filters, date_filter_attributes, enable_caching, start_date, end_date, apply_stock_filters=True):
+        """
+        Applies the stock, user and date filters to one of the metric's raw queries
+        :param query: which query this is (primary, aggregated_query, total_query, start_day_query or end_day_query)
+        :param base_query: the query to filter
+        :param apply_stock_filters: set to False to leave the stock filters to the caller
+        """
+        user_filters = user_filters or {}
+        # Apply stock filters
+        filtered_query = base_query
+        if apply_stock_filters:
+            for f in self.stock_filters:
+                filtered_query = filtered_query.filter(*f)
+
+        # Apply the applicable date filters
+        if DATE in self.filterable_by or []:
+            if start_date or end_date:
+                date_filter_attribute = date_filter_attributes[self.object_model]
+                date_filters = []
+                if start_date:
+                    date_filters.append(date_filter_attribute >= start_date)
+                if end_date:
+                    date_filters.append(date_filter_attribute <=  datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1)  )
+                if not self.bypass_user_filters:
+                    filtered_query = filtered_query.filter(*date_filters)
+
+        # Handle start_day and end_day queries so we can have a percentage change for the whole day range
+        if query in ['start_day_query', 'end_day_query']:
+            date_filter_attribute = date_filter_attributes[self.object_model]
+            # If a user provided end-date goes past today, just use today. Also if the user doesn't provide a day
+            # also use today
+            today = datetime.datetime.now().replace(minute=0, hour=0, second=0, microsecond=0)
+            if not end_date or datetime.datetime.strptime(end_date, "%Y-%m-%d") > today:
+                last_day = today
+            else:
+                last_day = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+            if not start_date:
+                # Get first date where data is present if no other date is given
+                first_day = metrics_cache.get_first_day(date_filter_attribute, enable_caching)
+            else:
+                first_day = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+
+            day = first_day if query == 'start_day_query' else last_day
+            date_filters = []
+            # To filter for items on day n, we have to filter between day n and day n+1
+            date_filters.append(date_filter_attribute >= day)
+            date_filters.append(date_filter_attribute <=  day + datetime.timedelta(days=1)  )
+            filtered_query = filtered_query.filter(*date_filters)
+
+        if not self.bypass_user_filters:
+            filtered_query = filters.apply_filters(filtered_query, user_filters, self.object_model)
+        return filtered_query
+
     def __repr__(self):
         return f"<Metric {self.metric_name}>"
 
@@ -164,7 +238,10 @@ class Metric(object):
             total_query_actions=None,
             groupable_attributes=[],
             value_type=COUNT,
-            token=None
+            token=None,
+            timeseries_unit=DAY,
+            rollup_value=None,
+            rollup_filters=None
         ):
         """
         :param metric_name: eg 'total_exchanged' or 'has_transferred_count'. Used for cache
@@ -191,6 +268,10 @@ class Metric(object):
         :param groupable_attributes: list of attributes this metric is allowed to be grouped by
         :param value_type: type of metric (count, currency)
         :param token: Token obj to determine label attributable to the metric (Dollars, Euro, etc...)
+        :param timeseries_unit: the unit the timeseries query is truncated to, used when reading from rollups
+        :param rollup_value: what the metric sums when it's read from the daily rollups (rollups.AMOUNT or
+            rollups.ITEM_COUNT). Metrics without one always run their queries. See rollups.py for more details
+        :param rollup_filters: filters on the rollups equivalent to stock_filters
         """        
         self.metric_name = metric_name
         self.is_timeseries = is_timeseries
@@ -214,3 +295,7 @@ class Metric(object):
         self.groupable_attributes = groupable_attributes
         self.value_type = value_type
         self.token = token
+        # Rollups
+        self.timeseries_unit = timeseries_unit
+        self.rollup_value = rollup_value
+        self.rollup_filters = rollup_filters or []
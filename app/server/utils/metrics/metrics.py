@@ -4,7 +4,7 @@ from flask import g
 
 from server import executor
 from server.utils.transfer_enums import TransferTypeEnum, TransferSubTypeEnum, TransferStatusEnum
-from server.utils.metrics import metrics_const
+from server.utils.metrics import metrics_const, metrics_cache, planner, rollups
 from server.utils.metrics.transfer_stats import TransferStats
 from server.utils.metrics.participant_stats import ParticipantStats
 from server.utils.metrics.total_users import TotalUsers
@@ -22,7 +22,6 @@ from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy import text
 
 import datetime, json
-import pendulum
 
 def calculate_transfer_stats(
     start_date=None,
@@ -66,9 +65,7 @@ def calculate_transfer_stats(
         token = org.token
         timezone = org.timezone or 'UTC'
 
-    tz = g.active_organisation.timezone or 'UTC'
-    # Gets hours offset from UTC in timezone in hours
-    time_offset = pendulum.from_timestamp(0, tz).offset/60/60
+    time_offset = rollups.time_offset_hours(g.active_organisation.timezone)
 
     date_filter_attributes = {
         CreditTransfer: CreditTransfer.created + text(f"interval '{time_offset} hours'"),
@@ -91,57 +88,79 @@ def calculate_transfer_stats(
         for f in user_filter or []:
             groups_and_filters_tables.append(f)
 
-    total_users = {}
-    if group_strategy and set(groups_and_filters_tables).issubset(set([CustomAttributeUserStorage.__tablename__, User.__tablename__, TransferAccount.__tablename__])):
-        total_users_stats = TotalUsers(group_strategy, timeseries_unit, date_filter_attributes=date_filter_attributes)
-        total_users[metrics_const.GROUPED] = total_users_stats.total_users_grouped_timeseries.execute_query(user_filters=user_filter, date_filter_attributes=date_filter_attributes, enable_caching=enable_cache, end_date=end_date)
-        total_users[metrics_const.UNGROUPED] = total_users_stats.total_users_timeseries.execute_query(user_filters=[], date_filter_attributes=date_filter_attributes, enable_caching=enable_cache, end_date=end_date)
-    else:
-        total_users_stats = TotalUsers(None, timeseries_unit, date_filter_attributes=date_filter_attributes)
-        total_users[metrics_const.UNGROUPED] = total_users_stats.total_users_timeseries.execute_query(user_filters=[], date_filter_attributes=date_filter_attributes, enable_caching=enable_cache, end_date=end_date)
-
-    # Determines which metrics the user is asking for, and calculate them
-    if metric_type == metrics_const.TRANSFER:
-        metrics_list = TransferStats(group_strategy, timeseries_unit, token, date_filter_attributes=date_filter_attributes).metrics
-    elif metric_type == metrics_const.USER:
-        metrics_list = ParticipantStats(group_strategy, timeseries_unit, date_filter_attributes=date_filter_attributes).metrics
-    else:
-        metrics_list = TransferStats(group_strategy, timeseries_unit, token, date_filter_attributes=date_filter_attributes).metrics + ParticipantStats(group_strategy, timeseries_unit, date_filter_attributes=date_filter_attributes).metrics
+    # The metrics cache reads and writes of every metric are batched, and sent to redis once they're all done
+    with metrics_cache.metrics_cache_batch() as cache_batch:
+        if enable_cache:
+            cache_batch.prefetch(group_by, metrics_cache.FIRST_DAY_PARTITION)
+
+        total_users = {}
+        if group_strategy and set(groups_and_filters_tables).issubset(set([CustomAttributeUserStorage.__tablename__, User.__tablename__, TransferAccount.__tablename__])):
+            total_users_stats = TotalUsers(group_strategy, timeseries_unit, date_filter_attributes=date_filter_attributes)
+            total_users[metrics_const.GROUPED] = total_users_stats.total_users_grouped_timeseries.execute_query(user_filters=user_filter, date_filter_attributes=date_filter_attributes, enable_caching=enable_cache, end_date=end_date)
+            total_users[metrics_const.UNGROUPED] = total_users_stats.total_users_timeseries.execute_query(user_filters=[], date_filter_attributes=date_filter_attributes, enable_caching=enable_cache, end_date=end_date)
+        else:
+            total_users_stats = TotalUsers(None, timeseries_unit, date_filter_attributes=date_filter_attributes)
+            total_users[metrics_const.UNGROUPED] = total_users_stats.total_users_timeseries.execute_query(user_filters=[], date_filter_attributes=date_filter_attributes, enable_caching=enable_cache, end_date=end_date)
+
+        # Determines which metrics the user is asking for, and calculate them
+        if metric_type == metrics_const.TRANSFER:
+            metrics_list = TransferStats(group_strategy, timeseries_unit, token, date_filter_attributes=date_filter_attributes).metrics
+        elif metric_type == metrics_const.USER:
+            metrics_list = ParticipantStats(group_strategy, timeseries_unit, date_filter_attributes=date_filter_attributes).metrics
+        else:
+            metrics_list = TransferStats(group_strategy, timeseries_unit, token, date_filter_attributes=date_filter_attributes).metrics + ParticipantStats(group_strategy, timeseries_unit, date_filter_attributes=date_filter_attributes).metrics
     
-    # Ensure that the metric requested by the user is available
-    available_metrics = [m.metric_name for m in metrics_list]
-    available_metrics.append(metrics_const.ALL)
-    if requested_metric not in available_metrics:
-        raise Exception(f'{requested_metric} is not an available metric of type {metric_type}. Please choose one of the following: {", ".join(available_metrics)}')
-
-    def calculate_metric(metric):
-        dont_include_timeseries = True
-        if requested_metric in [metric.metric_name, metrics_const.ALL]:
-            dont_include_timeseries = False
-        result = metric.execute_query(user_filters=user_filter, 
-                                                    date_filter_attributes=date_filter_attributes, 
-                                                    enable_caching=enable_cache, 
-                                                    population_query_result=total_users, 
-                                                    dont_include_timeseries=dont_include_timeseries, 
-                                                    start_date=start_date, 
-                                                    end_date=end_date,
-                                                    group_by=group_by)
-        db.session.close()
-        return metric.metric_name, result
-
-    # After request, do things synchronously since time doesn't matter much
-    data = {}
-    if g.get('is_after_request'):
-        for metric in metrics_list:
-            metric_name, result = calculate_metric(metric)
-            data[metric_name] = result
-    else:
-        futures = []
-        for metric in metrics_list:
-            futures.append(executor.submit(calculate_metric, metric))
-        for future in futures:
-            metric_name, result = future.result()
-            data[metric_name] = result
+        # Ensure that the metric requested by the user is available
+        available_metrics = [m.metric_name for m in metrics_list]
+        available_metrics.append(metrics_const.ALL)
+        if requested_metric not in available_metrics:
+            raise Exception(f'{requested_metric} is not an available metric of type {metric_type}. Please choose one of the following: {", ".join(available_metrics)}')
+
+        def dont_include_timeseries(metric):
+            return requested_metric not in [metric.metric_name, metrics_const.ALL]
+
+        def run_all(function, items):
+            # After request, do things synchronously since time doesn't matter much
+            if g.get('is_after_request'):
+                return [function(item) for item in items]
+            futures = [executor.submit(function, item) for item in items]
+            return [future.result() for future in futures]
+
+        # Queries which scan the same rows for different metrics are run together first
+        fused_queries = planner.plan_fused_queries(
+            [(metric, dont_include_timeseries(metric)) for metric in metrics_list],
+            user_filters=user_filter,
+            date_filter_attributes=date_filter_attributes,
+            enable_caching=enable_cache,
+            start_date=start_date,
+            end_date=end_date,
+            group_by=group_by
+        )
+
+        def execute_fused_query(fused_query):
+            result = fused_query.execute()
+            db.session.close()
+            return result
+
+        fused_results = {}
+        for result in run_all(execute_fused_query, fused_queries):
+            for metric, query_results in result.items():
+                fused_results.setdefault(metric, {}).update(query_results)
+
+        def calculate_metric(metric):
+            result = metric.execute_query(user_filters=user_filter, 
+                                                        date_filter_attributes=date_filter_attributes, 
+                                                        enable_caching=enable_cache, 
+                                                        population_query_result=total_users, 
+                                                        dont_include_timeseries=dont_include_timeseries(metric), 
+                                                        start_date=start_date, 
+                                                        end_date=end_date,
+                                                        group_by=group_by,
+                                                        fused_results=fused_results.get(metric))
+            db.session.close()
+            return metric.metric_name, result
+
+        data = dict(run_all(calculate_metric, metrics_list))
 
     data['mandatory_filter'] = mandatory_filter
 
@@ -1,6 +1,10 @@
 from server import red, db
 from flask import g
+from sqlalchemy import and_, or_
+from contextlib import contextmanager
+import threading
 import pickle
+import zlib
 import config
 import datetime
 from server.utils.executor import standard_executor_job
@@ -16,45 +20,170 @@ valid_strategies = [SUM, TALLY, COUNT, SUM_OBJECTS, FIRST_COUNT, QUERY_ALL]
 # Combinatory stategies which aren't cachable
 dumb_strategies = [FIRST_COUNT, QUERY_ALL]
 
+# How far behind the present the updated watermark is kept, so rows from transactions which were still being
+# committed during a run are looked at again on the next one
+UPDATED_WATERMARK_LAG_SECONDS = 60
+
+# Unsettled rows are only held back for this long. Anything still unsettled after that (such as a transfer that's
+# never resolved) is folded into the cache as it is then, so the list of unsettled ids carried by each entry stays
+# bounded. If such a row settles later, the cache only reflects it once it's cleared
+UNSETTLED_MAX_AGE_DAYS = 30
+
+# Redis names, under the org string. Entries live in one hash per partition (the group_by of the metric, or
+# FIRST_DAY), under the org's current version. Bumping the version orphans every entry, which then expire
+CACHE_VERSION = 'version'
+CACHE_STATS = 'cache_stats'
+FIRST_DAY_PARTITION = 'FIRST_DAY'
+
+# Cache hits and misses are counted in one hash per day, each of which expires once it falls out of the window
+# the stats are reported over
+CACHE_STATS_WINDOW_DAYS = 7
+
+# Serialised entries bigger than this are compressed
+COMPRESSION_THRESHOLD_BYTES = 1024
+_PICKLED = b'p'
+_COMPRESSED = b'z'
+
 # Workaround for an incongruity between flask-sqlalchemy and sqlalchemy
 def dummy_function():
     return True
 db.session._autoflush = dummy_function
 
-def _store_cache(key, value):
-    pickled_object = pickle.dumps(value)
-    red.set(key, pickled_object, config.METRICS_CACHE_TIMEOUT)
-    return True
+def _dumps(value):
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) > COMPRESSION_THRESHOLD_BYTES:
+        return _COMPRESSED + zlib.compress(data)
+    return _PICKLED + data
 
-def _load_cache(key):
-    cached_object = red.get(key)
-    if not cached_object:
-        return None
+def _loads(data):
     try:
-        return pickle.loads(cached_object)
+        if data[:1] == _COMPRESSED:
+            return pickle.loads(zlib.decompress(data[1:]))
+        if data[:1] == _PICKLED:
+            return pickle.loads(data[1:])
     except:
-        red.delete(key)
-        return None
+        pass
+    return None
 
 def get_metrics_org_string(org_id):
     return str(org_id)+'_metrics_'
 
+def _cache_stats_key(org_string, day):
+    return f'{org_string}{CACHE_STATS}_{day.isoformat()}'
+
+def _get_org_string():
+    if g.get('query_organisations'):
+        return get_metrics_org_string(g.query_organisations)
+    return get_metrics_org_string(g.active_organisation.id)
+
+class MetricsCacheBatch(object):
+    """
+    Batches the metrics cache reads and writes of one org, so that a whole calculate_transfer_stats call costs a
+    couple of Redis round trips. Partitions are loaded with one HGETALL the first time they're used, and
+    writes and hit/miss counts are held until flush, which sends them in one pipeline.
+    Metrics are calculated on executor threads sharing the same g, hence the lock.
+    """
+    def __init__(self, org_string):
+        self.org_string = org_string
+        self.version = None
+        self.partitions = {}
+        self.pending = {}
+        self.stats = {}
+        self.max_ids = {}
+        self.lock = threading.RLock()
+
+    def _partition_key(self, partition):
+        return f'{self.org_string}v{self.version}_{partition}'
+
+    def prefetch(self, *partitions):
+        with self.lock:
+            if self.version is None:
+                self.version = int(red.get(self.org_string + CACHE_VERSION) or 0)
+            partitions = [str(p) for p in partitions if str(p) not in self.partitions]
+            if not partitions:
+                return
+            pipe = red.pipeline(transaction=False)
+            for partition in partitions:
+                pipe.hgetall(self._partition_key(partition))
+            for partition, entries in zip(partitions, pipe.execute()):
+                self.partitions[partition] = {field.decode(): value for field, value in entries.items()}
+
+    def get(self, partition, field):
+        partition = str(partition)
+        self.prefetch(partition)
+        with self.lock:
+            data = self.partitions[partition].get(field)
+        return _loads(data) if data else None
+
+    def set(self, partition, field, value):
+        partition = str(partition)
+        self.prefetch(partition)
+        data = _dumps(value)
+        with self.lock:
+            self.partitions[partition][field] = data
+            self.pending.setdefault(partition, {})[field] = data
+
+    def record(self, metric_name, hit):
+        stat = f'{metric_name}:{"hits" if hit else "misses"}'
+        with self.lock:
+            self.stats[stat] = self.stats.get(stat, 0) + 1
+
+    def max_id(self, object_model):
+        # Read once per batch, so every metric in it folds rows up to the same id
+        with self.lock:
+            if object_model not in self.max_ids:
+                self.max_ids[object_model] = db.session.query(db.func.max(object_model.id))\
+                    .with_session(db.session).scalar() or 0
+            return self.max_ids[object_model]
+
+    def flush(self):
+        with self.lock:
+            pending, stats = self.pending, self.stats
+            self.pending, self.stats = {}, {}
+        if not pending and not stats:
+            return
+        pipe = red.pipeline(transaction=False)
+        for partition, entries in pending.items():
+            pipe.hset(self._partition_key(partition), mapping=entries)
+            pipe.expire(self._partition_key(partition), config.METRICS_CACHE_TIMEOUT)
+        if stats:
+            stats_key = _cache_stats_key(self.org_string, datetime.datetime.utcnow().date())
+            for stat, count in stats.items():
+                pipe.hincrby(stats_key, stat, count)
+            pipe.expire(stats_key, CACHE_STATS_WINDOW_DAYS * 24 * 60 * 60)
+        pipe.execute()
+
+@contextmanager
+def metrics_cache_batch():
+    """
+    Yields the metrics cache batch for the current org. Nested calls share the outermost batch,
+    which is flushed when it exits.
+    """
+    org_string = _get_org_string()
+    batch = g.get('metrics_cache_batch')
+    if batch and batch.org_string == org_string:
+        yield batch
+        return
+    g.metrics_cache_batch = MetricsCacheBatch(org_string)
+    try:
+        yield g.metrics_cache_batch
+        g.metrics_cache_batch.flush()
+    finally:
+        g.metrics_cache_batch = batch
+
 def get_first_day(date_filter_attribute, enable_cache = True):
     # We need to get the first day data exists for every table, in order to calculate percentage-changes
     # This is a rather expensive operation, but the result is always the same so we can cache it! 
     if enable_cache:
-        if g.get('query_organisations'):
-            ORG_STRING = get_metrics_org_string(g.query_organisations)
-        else:
-            ORG_STRING = get_metrics_org_string(g.active_organisation.id)
-        FIRST_DAY = f'{ORG_STRING}_FIRST_DAY_{str(date_filter_attribute)}'
-        result = _load_cache(FIRST_DAY)
+        with metrics_cache_batch() as batch:
+            result = batch.get(FIRST_DAY_PARTITION, str(date_filter_attribute))
         if result:
             return result
     today = datetime.datetime.now().replace(minute=0, hour=0, second=0, microsecond=0)
     first_day = db.session.query(db.func.min(date_filter_attribute)).scalar() or today
     if first_day and enable_cache:
-        _store_cache(FIRST_DAY, first_day)
+        with metrics_cache_batch() as batch:
+            batch.set(FIRST_DAY_PARTITION, str(date_filter_attribute), first_day)
     return first_day or today
 
 def execute_with_partial_history_cache(metric_name, query, object_model, strategy, enable_cache = True, group_by=None, query_name=''):
@@ -63,59 +192,95 @@ def execute_with_partial_history_cache(metric_name, query, object_model, strateg
         return _handle_combinatory_strategy(query, None, strategy)
     if query_name:
         metric_name = metric_name + '_' + query_name
-    # Redis object names
-    if g.get('query_organisations'):
-        ORG_STRING = get_metrics_org_string(g.query_organisations)
-    else:
-        ORG_STRING = get_metrics_org_string(g.active_organisation.id)
-    CURRENT_MAX_ID = f'{ORG_STRING}_{object_model.__table__.name}_max_id'
-    HIGHEST_ID_CACHED = f'{ORG_STRING}_{metric_name}_{group_by}_max_cached_id'
-    CACHE_RESULT = f'{ORG_STRING}_{metric_name}_{group_by}'
     # Checks if provided combinatry strategy is valid
     if strategy not in valid_strategies:
         raise Exception(f'Invalid combinatory strategy {strategy} requested.')
 
-    # Getting the current maximum ID in the database. Also caching it so we don't have to
+    with metrics_cache_batch() as batch:
+        return _execute_with_batch(batch, metric_name, query, object_model, strategy, group_by)
+
+def _execute_with_batch(batch, metric_name, query, object_model, strategy, group_by):
+    # Getting the current maximum ID in the database. It's shared by the whole batch, so we don't have to
     # get it from the DB many times in the same request
-    current_max_id = red.get(CURRENT_MAX_ID)
-    if not current_max_id:
-        query_max = db.session.query(db.func.max(object_model.id)).with_session(db.session).first()
-        try:
-            current_max_id = query_max[0]
-        except IndexError:
-            current_max_id = 0
+    current_max_id = batch.max_id(object_model)
 
-        red.set(CURRENT_MAX_ID, current_max_id, 10)
+    # Rows which can still change in a way that matters to the metrics (eg pending transfers) are never folded
+    # into the cache. Their ids are kept instead, and they're folded in once they've settled. Anything else
+    # is only ever counted once, from the id watermark
+    unsettled_filter = getattr(object_model, 'metrics_unsettled_filter', None)
+    updated_watermark = datetime.datetime.utcnow() - datetime.timedelta(seconds=UPDATED_WATERMARK_LAG_SECONDS)
+    unsettled_cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=UNSETTLED_MAX_AGE_DAYS)
 
     # Gets cache results since the last time the metrics were fetched
-    highest_id_in_cache = int(red.get(HIGHEST_ID_CACHED) or 0)
-    cache_result = _load_cache(CACHE_RESULT)
-    # If there's no cache (either it's a new attribute we're tracking, or the cache is corrupted)
-    # then we should pull results starting at id=0
-    if cache_result:
-        filtered_query = query.filter(object_model.id > highest_id_in_cache)
+    state = batch.get(group_by, metric_name)
+    batch.record(metric_name, hit=bool(state))
+    if state:
+        cache_result = state['result']
+        unsettled_ids = set(state['unsettled_ids'])
+        settled_ids = []
+        if unsettled_ids:
+            # Only rows updated since the last run can have settled. Rows that have been unsettled for too long
+            # are folded in as they are
+            settled_ids = [r[0] for r in _id_query(object_model)
+                .filter(object_model.id.in_(unsettled_ids))
+                .filter(or_(
+                    and_(object_model.updated > state['updated'], ~unsettled_filter()),
+                    object_model.created < unsettled_cutoff
+                ))]
+            unsettled_ids.difference_update(settled_ids)
+        new_rows = and_(object_model.id > state['max_id'], object_model.id <= current_max_id)
+        fold_filter = or_(new_rows, object_model.id.in_(settled_ids)) if settled_ids else new_rows
     else:
-        filtered_query = query
+        cache_result = None
+        unsettled_ids = set()
+        new_rows = object_model.id <= current_max_id
+        fold_filter = new_rows
+
+    if unsettled_filter:
+        held_back = and_(unsettled_filter(), object_model.created >= unsettled_cutoff)
+        unsettled_ids.update(r[0] for r in _id_query(object_model).filter(new_rows).filter(held_back))
+        fold_filter = and_(fold_filter, ~held_back)
 
     #Combines results
-    result = _handle_combinatory_strategy(filtered_query, cache_result, strategy)
+    result = _handle_combinatory_strategy(query.filter(fold_filter), cache_result, strategy)
     # Updates the cache with new data
-    _store_cache(CACHE_RESULT, result)
-    red.set(HIGHEST_ID_CACHED, current_max_id, config.METRICS_CACHE_TIMEOUT)
+    batch.set(group_by, metric_name, {
+        'result': result,
+        'max_id': current_max_id,
+        'updated': updated_watermark,
+        'unsettled_ids': sorted(unsettled_ids)
+    })
+
+    # Unsettled rows are counted as they are right now, without being cached
+    if unsettled_ids:
+        result = _handle_combinatory_strategy(query.filter(object_model.id.in_(unsettled_ids)), result, strategy)
 
     return result
+
+def _id_query(object_model):
+    # Uses the same organisation scoping as the metric queries
+    return db.session.query(object_model.id).with_session(db.session)
     
-# Nukes metrics cache for the active org, returns number of deleted entries!
+# Invalidates the metrics cache for the active org by moving it to a new version, returns the new version.
+# Entries of the old version are never read again, and are left to expire
 def clear_metrics_cache():
-    if g.get('query_organisations'):
-        ORG_STRING = get_metrics_org_string(g.query_organisations)
-    else:
-        ORG_STRING = get_metrics_org_string(g.active_organisation.id)
-    keys = red.keys(ORG_STRING+'*')
-    key_count = len(keys)
-    for key in keys:
-        red.delete(key)
-    return key_count
+    return red.incr(_get_org_string() + CACHE_VERSION)
+
+# Cache hits and misses per metric for the active org over the last CACHE_STATS_WINDOW_DAYS days,
+# across every version of its cache
+def get_metrics_cache_stats():
+    org_string = _get_org_string()
+    today = datetime.datetime.utcnow().date()
+    pipe = red.pipeline(transaction=False)
+    for days_ago in range(CACHE_STATS_WINDOW_DAYS):
+        pipe.hgetall(_cache_stats_key(org_string, today - datetime.timedelta(days=days_ago)))
+    stats = {}
+    for day_stats in pipe.execute():
+        for stat, count in day_stats.items():
+            metric_name, outcome = stat.decode().rsplit(':', 1)
+            metric_stats = stats.setdefault(metric_name, {'hits': 0, 'misses': 0})
+            metric_stats[outcome] += int(count)
+    return stats
 
 def rebuild_metrics_cache():
     CACHE_REBUILDING = 'CACHE_REBUILDING'
@@ -5,7 +5,7 @@ from server import db
 
 from server.models.credit_transfer import CreditTransfer
 from server.models.user import User
-from server.utils.metrics import metrics_cache, metric, metric_group
+from server.utils.metrics import filters, metrics_cache, metric, metric_group, rollups
 from server.utils.metrics.metrics_const import *
 
 
@@ -45,6 +45,9 @@ class ParticipantStats(metric_group.MetricGroup):
             query_actions=[FORMAT_TIMESERIES],
             aggregated_query_actions=[FORMAT_AGGREGATE_METRICS],
             total_query_actions=[GET_FIRST],
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.ITEM_COUNT,
+            rollup_filters=filters.user_rollup_filter
         ))
 
         if group_strategy:
@@ -99,7 +102,10 @@ class ParticipantStats(metric_group.MetricGroup):
             filterable_by=self.filterable_attributes,
             aggregated_query_actions=[FORMAT_AGGREGATE_METRICS],
             total_query_actions=[GET_FIRST],
-            query_actions=[ADD_MISSING_DAYS_TO_TODAY, ACCUMULATE_TIMESERIES, FORMAT_TIMESERIES]
+            query_actions=[ADD_MISSING_DAYS_TO_TODAY, ACCUMULATE_TIMESERIES, FORMAT_TIMESERIES],
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.ITEM_COUNT,
+            rollup_filters=filters.user_rollup_filter
         ))
 
 
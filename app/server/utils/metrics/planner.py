@@ -0,0 +1,122 @@
+from sqlalchemy import and_, or_, func, literal_column
+from sqlalchemy.sql.elements import Label
+from sqlalchemy.sql.functions import FunctionElement
+
+from server import db
+from server.utils.metrics import metrics_cache
+
+# Lots of metrics scan the same rows, only with different stock filters. For example total_distributed,
+# total_reclaimed and total_withdrawn all sum credit_transfer amounts. Queries which are the same apart from
+# their aggregate and stock filters are run as a single statement, with an `aggregate FILTER (WHERE stock filters)`
+# column for each of them, and the results are handed back to each metric as if it had run its own query.
+# Only queries which skip the cache and the rollups are fused, since cached queries each have their own history
+
+# Strategies which combine to a single number, and so can only be fused for ungrouped queries
+SCALAR_STRATEGIES = [metrics_cache.SUM, metrics_cache.TALLY]
+FUSABLE_STRATEGIES = SCALAR_STRATEGIES + [metrics_cache.SUM_OBJECTS, metrics_cache.QUERY_ALL]
+
+class FusedQueryMember(object):
+    def __init__(self, metric, query_name, query, stock_filters, strategy):
+        self.metric = metric
+        self.query_name = query_name
+        self.query = query
+        self.stock_filters = stock_filters
+        self.strategy = strategy
+
+class FusedQuery(object):
+    def __init__(self, members):
+        self.members = members
+
+    def build(self):
+        """
+        :return: a query with a value (and a row count, for grouped queries) column for each member, followed by
+            the group columns shared by all the members
+        """
+        group_columns = _columns(self.members[0].query)[1:]
+        columns = []
+        conditions = []
+        for i, member in enumerate(self.members):
+            aggregate = _columns(member.query)[0].element
+            rows = func.count()
+            condition = and_(*member.stock_filters) if member.stock_filters else None
+            if condition is not None:
+                aggregate = aggregate.filter(condition)
+                rows = rows.filter(condition)
+            conditions.append(condition)
+            columns.append(aggregate.label(f'value_{i}'))
+            # Groups without any rows for a member wouldn't be returned by its own query
+            if group_columns:
+                columns.append(rows.label(f'rows_{i}'))
+
+        query = self.members[0].query.with_entities(*columns, *group_columns)
+        # Only scan rows at least one of the members needs
+        if None not in conditions:
+            query = query.filter(or_(*conditions))
+        return query
+
+    def execute(self):
+        """
+        :return: dict of metric to dict of query name to results, as execute_with_partial_history_cache returns them
+        """
+        rows = self.build().with_session(db.session).all()
+        stride = 2 if len(_columns(self.members[0].query)) > 1 else 1
+        results = {}
+        for i, member in enumerate(self.members):
+            member_rows = []
+            for row in rows:
+                if stride == 2 and not row[i * stride + 1]:
+                    continue
+                member_rows.append((row[i * stride], *row[len(self.members) * stride:]))
+            results.setdefault(member.metric, {})[member.query_name] = _format_result(member.strategy, member_rows)
+        return results
+
+def plan_fused_queries(metrics, user_filters=None, date_filter_attributes=None, enable_caching=True, start_date=None, end_date=None, group_by=None):
+    """
+    Works out which of the metrics' queries can be run together
+    :param metrics: list of (metric, dont_include_timeseries) tuples
+    The other parameters are the ones passed to each metric's execute_query
+    :return: list of FusedQuery, each fusing at least two queries
+    """
+    candidates = {}
+    for metric, dont_include_timeseries in metrics:
+        fusable = metric.fusable_queries(
+            user_filters=user_filters,
+            date_filter_attributes=date_filter_attributes,
+            enable_caching=enable_caching,
+            dont_include_timeseries=dont_include_timeseries,
+            start_date=start_date,
+            end_date=end_date,
+            group_by=group_by
+        )
+        for query_name, (query, stock_filters, strategy) in fusable.items():
+            key = _fusion_key(metric.object_model, query, strategy)
+            if key:
+                candidates.setdefault(key, []).append(FusedQueryMember(metric, query_name, query, stock_filters, strategy))
+    return [FusedQuery(members) for members in candidates.values() if len(members) > 1]
+
+def _columns(query):
+    return [c['expr'] for c in query.column_descriptions]
+
+def _fusion_key(object_model, query, strategy):
+    # Queries can be fused if they're the same with their aggregate (the first column) taken out
+    if strategy not in FUSABLE_STRATEGIES:
+        return None
+    columns = _columns(query)
+    if not isinstance(columns[0], Label) or not isinstance(columns[0].element, FunctionElement):
+        return None
+    if strategy in SCALAR_STRATEGIES and len(columns) > 1:
+        return None
+    # org_check skips the org filter here, all the fused queries get it when they're run
+    shape = query.with_entities(literal_column('0'), *columns[1:]).execution_options(org_check=True)
+    try:
+        compiled = shape.statement.compile(dialect=db.engine.dialect)
+    except Exception:
+        return None
+    return object_model, str(compiled), repr(sorted(compiled.params.items()))
+
+def _format_result(strategy, rows):
+    if strategy == metrics_cache.SUM:
+        return float(rows[0][0] or 0)
+    if strategy == metrics_cache.TALLY:
+        return [[float(rows[0][0] or 0)]]
+    return rows
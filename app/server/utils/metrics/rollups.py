@@ -0,0 +1,396 @@
+"""
+Daily rollups let the metrics engine answer the common (unfiltered, single organisation) metrics from
+metrics_daily_rollup instead of aggregating every credit transfer and user each time.
+
+Rows are written from flush listeners on CreditTransfer and User as transfers complete (or stop being complete),
+users are created or deleted, and either are moved between organisations. Transfers are counted once under every
+dimension they can be grouped by, so a grouped timeseries is a plain sum over one dimension's rows, and week and
+month units are derived by truncating the days.
+
+Only groupings that are fixed once a transfer completes are rolled up. Transfer usages, account types and custom
+attributes can all change afterwards, and the raw queries group by their current values, so those groupings always
+use the raw queries rather than rollups that would have to be re-rolled whenever one of them changed.
+"""
+import datetime
+from collections import defaultdict
+
+import pendulum
+from flask import g
+from sqlalchemy import inspect, func, cast, literal, text, Date, DateTime, String
+from sqlalchemy.dialects.postgresql import insert
+
+from server import db
+from server.models.metrics_rollup import MetricsDailyRollup
+from server.models.utils import organisation_association_table
+from server.utils.transfer_enums import TransferStatusEnum, TransferTypeEnum, TransferSubTypeEnum
+from server.utils.metrics.metrics_const import *
+
+# What a rollup metric is summing
+AMOUNT = 'amount'
+ITEM_COUNT = 'item_count'
+
+# Group-bys that can be served from rollups. Any other group-by uses the raw queries
+TRANSFER_DIMENSIONS = [
+    UNGROUPED,
+    TRANSFER_TYPE,
+    TRANSFER_MODE,
+    TRANSFER_STATUS
+]
+
+
+def time_offset_hours(timezone):
+    # Gets hours offset from UTC in timezone in hours
+    return pendulum.from_timestamp(0, timezone or 'UTC').offset/60/60
+
+
+def _local_day(timestamp, offset_hours):
+    return (timestamp + datetime.timedelta(hours=offset_hours)).date()
+
+
+def _enum_value(value):
+    if value is None:
+        return ''
+    return getattr(value, 'value', value)
+
+
+def _public_transfer_type(transfer_type, transfer_subtype):
+    # Mirrors the SQL expression of CreditTransfer.public_transfer_type, which is what the transfer_type group uses
+    if transfer_subtype == TransferSubTypeEnum.STANDARD:
+        return transfer_type
+    if transfer_type == TransferTypeEnum.PAYMENT:
+        return transfer_subtype
+    return transfer_type
+
+
+def _is_complete(status):
+    return status in [TransferStatusEnum.COMPLETE, TransferStatusEnum.COMPLETE.value]
+
+
+def _first(*values):
+    for v in values:
+        if v:
+            return v[0]
+    return None
+
+
+def _rollup_changes(target, counted_attribute, is_counted):
+    """
+    Works out which organisations' rollups target needs taking out of (-1) and adding to (1) on which days,
+    given whether it was counted before this flush and is counted after it. This covers it becoming or
+    ceasing to be counted, being added to or removed from organisations, and its created date changing
+    :param target: CreditTransfer or User being flushed
+    :param counted_attribute: the attribute deciding whether target is counted (eg transfer_status)
+    :param is_counted: function of counted_attribute's value returning whether target is counted
+    :return: list of (Organisation, created, 1 or -1), or an empty list if nothing relevant changed
+    """
+    attrs = inspect(target).attrs
+    counted_history = getattr(attrs, counted_attribute).history
+    organisations_history = attrs.organisations.history
+    created_history = attrs.created.history
+    if not (counted_history.has_changes() or organisations_history.has_changes() or created_history.has_changes()):
+        return []
+
+    changes = []
+    if is_counted(_first(counted_history.deleted, counted_history.unchanged)):
+        created = _first(created_history.deleted, created_history.unchanged) or target.created
+        for organisation in list(organisations_history.unchanged) + list(organisations_history.deleted):
+            changes.append((organisation, created, -1))
+    if is_counted(_first(counted_history.added, counted_history.unchanged)):
+        for organisation in list(organisations_history.unchanged) + list(organisations_history.added):
+            changes.append((organisation, target.created, 1))
+    return changes
+
+
+def transfer_group_values(transfer):
+    """
+    The (dimension, group value) pairs a transfer is counted under, matching how the group strategies
+    in group.py group it
+    """
+    return [
+        (UNGROUPED, ''),
+        (TRANSFER_TYPE, _enum_value(_public_transfer_type(transfer.transfer_type, transfer.transfer_subtype))),
+        (TRANSFER_MODE, _enum_value(transfer.transfer_mode)),
+        (TRANSFER_STATUS, _enum_value(transfer.transfer_status)),
+    ]
+
+
+def _apply_deltas(connection, deltas):
+    rows = []
+    now = datetime.datetime.utcnow()
+    # Sorted so concurrent flushes lock rows in the same order
+    for key in sorted(deltas):
+        amount_wei, count = deltas[key]
+        if not amount_wei and not count:
+            continue
+        organisation_id, token_id, day, object_type, transfer_type, transfer_subtype, dimension, group_value = key
+        rows.append(dict(
+            organisation_id=organisation_id,
+            token_id=token_id,
+            day=day,
+            object_type=object_type,
+            transfer_type=transfer_type,
+            transfer_subtype=transfer_subtype,
+            dimension=dimension,
+            group_value=group_value,
+            total_amount_wei=amount_wei,
+            item_count=count,
+            created=now,
+            updated=now
+        ))
+    if not rows:
+        return
+
+    table = MetricsDailyRollup.__table__
+    statement = insert(table).values(rows)
+    connection.execute(statement.on_conflict_do_update(
+        constraint='uq_metrics_daily_rollup_key',
+        set_={
+            'total_amount_wei': table.c.total_amount_wei + statement.excluded.total_amount_wei,
+            'item_count': table.c.item_count + statement.excluded.item_count,
+            'updated': statement.excluded.updated
+        }
+    ))
+
+
+def record_transfer_rollup_change(connection, transfer):
+    """
+    Adds a transfer to (or takes it out of) its organisations' rollups when it becomes complete (or stops being
+    complete), or moves organisations or days while complete. Organisations whose rollups haven't been built are skipped
+    :param connection: the flush's connection
+    :param transfer: the CreditTransfer being flushed
+    """
+    changes = _rollup_changes(transfer, 'transfer_status', _is_complete)
+
+    deltas = defaultdict(lambda: [0, 0])
+    group_values = None
+    for organisation, created, change in changes:
+        if organisation.metrics_rollup_offset_hours is None:
+            continue
+        token_id = transfer.token_id or organisation.token_id
+        if token_id is None:
+            continue
+        if group_values is None:
+            group_values = transfer_group_values(transfer)
+
+        day = _local_day(created, organisation.metrics_rollup_offset_hours)
+        for dimension, group_value in group_values:
+            key = (
+                organisation.id, token_id, day, transfer.__tablename__,
+                _enum_value(transfer.transfer_type), _enum_value(transfer.transfer_subtype),
+                dimension, group_value
+            )
+            deltas[key][0] += change * (transfer._transfer_amount_wei or 0)
+            deltas[key][1] += change
+
+    _apply_deltas(connection, deltas)
+
+
+def record_user_rollup_change(connection, user):
+    """
+    Adds a user to (or takes them out of) their organisations' rollups when they're created, deleted,
+    or added to or removed from an organisation. Users are only rolled up ungrouped
+    :param connection: the flush's connection
+    :param user: the User being flushed
+    """
+    changes = _rollup_changes(user, '_deleted', lambda deleted: not deleted)
+
+    deltas = defaultdict(lambda: [0, 0])
+    for organisation, created, change in changes:
+        if organisation.metrics_rollup_offset_hours is None or organisation.token_id is None:
+            continue
+        day = _local_day(created, organisation.metrics_rollup_offset_hours)
+        key = (organisation.id, organisation.token_id, day, user.__tablename__, '', '', UNGROUPED, '')
+        deltas[key][1] += change
+
+    _apply_deltas(connection, deltas)
+
+
+def supports_group_by(object_model, group_by):
+    if group_by in [None, UNGROUPED]:
+        return True
+    if object_model.__tablename__ != 'credit_transfer':
+        return False
+    return group_by in TRANSFER_DIMENSIONS
+
+
+def get_rollup_organisation(object_model, group_by):
+    """
+    Finds the organisation whose rollups can stand in for a metric's raw queries. Rollups are per organisation,
+    so this only works when exactly one is being queried, and only once they've been built with the same
+    timezone offset the metrics date filters are using
+    :return: the Organisation, or None if the raw queries have to be used
+    """
+    from server.models.organisation import Organisation
+
+    if not supports_group_by(object_model, group_by):
+        return None
+
+    organisation_ids = g.get('query_organisations') or [g.active_organisation.id]
+    if len(organisation_ids) != 1:
+        return None
+
+    # Every metric in a request checks this, so each organisation is only looked up once
+    rollup_organisations = g.setdefault('rollup_organisations', {})
+    if organisation_ids[0] not in rollup_organisations:
+        rollup_organisations[organisation_ids[0]] = Organisation.query.get(organisation_ids[0])
+    organisation = rollup_organisations[organisation_ids[0]]
+    if organisation is None or organisation.metrics_rollup_offset_hours is None:
+        return None
+    if organisation.metrics_rollup_offset_hours != time_offset_hours(g.active_organisation.timezone):
+        return None
+    return organisation
+
+
+def build_rollup_query(
+        organisation,
+        query_name,
+        value,
+        rollup_filters,
+        is_timeseries,
+        timeseries_unit=DAY,
+        group_by=None,
+        start_date=None,
+        end_date=None
+):
+    """
+    Builds the rollup equivalent of one of a metric's queries, with the same columns, so that it can be run with the
+    same combinatory strategy and postprocessing actions
+    :param organisation: organisation from get_rollup_organisation
+    :param query_name: which of the metric's queries this stands in for (primary, aggregated_query, etc)
+    :param value: AMOUNT or ITEM_COUNT
+    :param rollup_filters: filters on MetricsDailyRollup equivalent to the metric's stock filters
+    :param is_timeseries: whether the metric is a timeseries
+    :param timeseries_unit: day, week, month or year
+    :param group_by: Name of the group-by used
+    :param start_date: Start date for metrics queries
+    :param end_date: End date for metrics queries
+    :return: query
+    """
+    if value == AMOUNT:
+        value_column = func.sum(MetricsDailyRollup.total_amount_wei) / int(1e16)
+    else:
+        value_column = func.sum(MetricsDailyRollup.item_count)
+    value_column = value_column.label('volume' if is_timeseries else 'total')
+    date_column = func.date_trunc(timeseries_unit, cast(MetricsDailyRollup.day, DateTime))
+    group_column = func.nullif(MetricsDailyRollup.group_value, '')
+
+    is_grouped = group_by not in [None, UNGROUPED] and (
+        query_name == 'aggregated_query' or (query_name == 'primary' and is_timeseries)
+    )
+    columns = [value_column]
+    grouping = []
+    if query_name == 'primary' and is_timeseries:
+        columns.append(date_column.label('date'))
+        grouping.append(date_column)
+    if is_grouped:
+        columns.append(group_column)
+        grouping.append(group_column)
+
+    query = db.session.query(*columns).filter(
+        MetricsDailyRollup.organisation_id == organisation.id,
+        MetricsDailyRollup.dimension == (group_by if is_grouped else UNGROUPED),
+        *rollup_filters
+    )
+
+    if query_name in ['start_day_query', 'end_day_query']:
+        query = query.filter(MetricsDailyRollup.day == _percent_change_day(organisation, query_name, start_date, end_date))
+    else:
+        if start_date:
+            query = query.filter(MetricsDailyRollup.day >= datetime.datetime.strptime(start_date, "%Y-%m-%d").date())
+        if end_date:
+            query = query.filter(MetricsDailyRollup.day <= datetime.datetime.strptime(end_date, "%Y-%m-%d").date())
+
+    if grouping:
+        # Transfers which completed and were then reversed leave zeroed rows behind
+        query = query.group_by(*grouping).having(func.sum(MetricsDailyRollup.item_count) != 0)
+        if query_name == 'primary':
+            query = query.order_by(date_column)
+    return query
+
+
+def _percent_change_day(organisation, query_name, start_date, end_date):
+    today = datetime.date.today()
+    if query_name == 'end_day_query':
+        if not end_date:
+            return today
+        return min(datetime.datetime.strptime(end_date, "%Y-%m-%d").date(), today)
+    if start_date:
+        return datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+    first_day = db.session.query(func.min(MetricsDailyRollup.day))\
+        .filter(MetricsDailyRollup.organisation_id == organisation.id).scalar()
+    return first_day or today
+
+
+def rebuild_metrics_rollups(organisation):
+    """
+    Rebuilds an organisation's rollups from its complete transfers and users, and marks them as built using the
+    organisation's current timezone. Needed once for existing organisations, and after an organisation's timezone
+    changes (until then its metrics use the raw queries)
+    :param organisation: the Organisation to rebuild
+    :return: number of rollup rows written
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.models.user import User
+    from server.utils.metrics.group import Groups
+
+    if organisation.token_id is None:
+        raise Exception(f'Organisation {organisation.id} has no token to roll metrics up under')
+
+    offset = time_offset_hours(organisation.timezone)
+    now = datetime.datetime.utcnow()
+    columns = [
+        'organisation_id', 'token_id', 'day', 'object_type', 'transfer_type', 'transfer_subtype',
+        'dimension', 'group_value', 'total_amount_wei', 'item_count', 'created', 'updated'
+    ]
+
+    db.session.query(MetricsDailyRollup)\
+        .filter(MetricsDailyRollup.organisation_id == organisation.id)\
+        .delete(synchronize_session=False)
+
+    group_types = Groups().GROUP_TYPES
+    transfer_groups = {dimension: group_types[dimension] for dimension in TRANSFER_DIMENSIONS}
+
+    rows_written = 0
+    day = cast(CreditTransfer.created + text(f"interval '{offset} hours'"), Date)
+    token_id = func.coalesce(CreditTransfer.token_id, organisation.token_id)
+    transfer_type = func.coalesce(cast(CreditTransfer.transfer_type, String), '')
+    transfer_subtype = func.coalesce(cast(CreditTransfer.transfer_subtype, String), '')
+    for dimension, group_strategy in transfer_groups.items():
+        if group_strategy is None:
+            group_value = literal('')
+            grouping = [token_id, day, transfer_type, transfer_subtype]
+        else:
+            group_value = func.coalesce(cast(group_strategy.group_by_column, String), '')
+            grouping = [token_id, day, transfer_type, transfer_subtype, group_value]
+        query = db.session.query(
+            literal(organisation.id), token_id, day, literal(CreditTransfer.__tablename__),
+            transfer_type, transfer_subtype, literal(dimension), group_value,
+            func.sum(CreditTransfer._transfer_amount_wei), func.count(CreditTransfer.id), literal(now), literal(now)
+        ).select_from(CreditTransfer)\
+            .join(organisation_association_table, organisation_association_table.c.credit_transfer_id == CreditTransfer.id)\
+            .filter(organisation_association_table.c.organisation_id == organisation.id)\
+            .filter(CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE)\
+            .group_by(*grouping)\
+            .execution_options(show_all=True)
+        if group_strategy is not None:
+            query = group_strategy.build_query_group_by_with_join(query, CreditTransfer)
+        result = db.session.execute(insert(MetricsDailyRollup.__table__).from_select(columns, query.statement))
+        rows_written += result.rowcount
+
+    day = cast(User.created + text(f"interval '{offset} hours'"), Date)
+    query = db.session.query(
+        literal(organisation.id), literal(organisation.token_id), day, literal(User.__tablename__),
+        literal(''), literal(''), literal(UNGROUPED), literal(''),
+        literal(0), func.count(User.id), literal(now), literal(now)
+    ).select_from(User)\
+        .join(organisation_association_table, organisation_association_table.c.user_id == User.id)\
+        .filter(organisation_association_table.c.organisation_id == organisation.id)\
+        .filter(User._deleted == None)\
+        .group_by(day)\
+        .execution_options(show_all=True)
+    result = db.session.execute(insert(MetricsDailyRollup.__table__).from_select(columns, query.statement))
+    rows_written += result.rowcount
+
+    organisation.metrics_rollup_offset_hours = offset
+    db.session.flush()
+    return rows_written
@@ -1,7 +1,7 @@
 from sqlalchemy.sql import func
 
 from server.models.credit_transfer import CreditTransfer
-from server.utils.metrics import filters, metrics_cache, metric, metric_group, group
+from server.utils.metrics import filters, metrics_cache, metric, metric_group, group, rollups
 from server.utils.metrics.metrics_const import *
 
 from server import db
@@ -22,6 +22,9 @@ class TransferStats(metric_group.MetricGroup):
             query_caching_combinatory_strategy=metrics_cache.SUM,
             filterable_by=self.filterable_attributes,
             bypass_user_filters=True,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.AMOUNT,
+            rollup_filters=filters.disbursement_rollup_filters
         ))
 
         self.metrics.append(metric.Metric(
@@ -32,6 +35,9 @@ class TransferStats(metric_group.MetricGroup):
             query_caching_combinatory_strategy=metrics_cache.SUM,
             filterable_by=self.filterable_attributes,
             bypass_user_filters=True,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.AMOUNT,
+            rollup_filters=filters.reclamation_rollup_filters
         ))
 
         self.metrics.append(metric.Metric(
@@ -42,6 +48,9 @@ class TransferStats(metric_group.MetricGroup):
             query_caching_combinatory_strategy=metrics_cache.SUM,
             filterable_by=self.filterable_attributes,
             bypass_user_filters=True,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.AMOUNT,
+            rollup_filters=filters.withdrawal_rollup_filters
         ))
 
         # Timeseries Metrics
@@ -71,7 +80,10 @@ class TransferStats(metric_group.MetricGroup):
             aggregated_query_actions=[FORMAT_AGGREGATE_METRICS],
             total_query_actions=[GET_FIRST],
             value_type=CURRENCY,
-            token=token
+            token=token,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.AMOUNT,
+            rollup_filters=filters.complete_transfer_rollup_filter
         ))
 
         self.metrics.append(metric.Metric(
@@ -90,7 +102,10 @@ class TransferStats(metric_group.MetricGroup):
             aggregated_query_actions=[CALCULATE_AGGREGATE_PER_USER, FORMAT_AGGREGATE_METRICS],
             total_query_actions=[GET_FIRST, CALCULATE_TOTAL_PER_USER],
             value_type=CURRENCY,
-            token=token
+            token=token,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.AMOUNT,
+            rollup_filters=filters.standard_payment_rollup_filters
         ))
 
         if group_strategy:
@@ -117,7 +132,10 @@ class TransferStats(metric_group.MetricGroup):
             query_actions=[FORMAT_TIMESERIES],
             aggregated_query_actions=[FORMAT_AGGREGATE_METRICS],
             total_query_actions=[GET_FIRST],
-            value_type=COUNT
+            value_type=COUNT,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.ITEM_COUNT,
+            rollup_filters=filters.standard_payment_rollup_filters
         ))
         
         self.metrics.append(metric.Metric(
@@ -136,6 +154,9 @@ class TransferStats(metric_group.MetricGroup):
             aggregated_query_actions=[CALCULATE_AGGREGATE_PER_USER, FORMAT_AGGREGATE_METRICS],
             total_query_actions=[GET_FIRST, CALCULATE_TOTAL_PER_USER],
             value_type=COUNT_AVERAGE,
+            timeseries_unit=self.timeseries_unit,
+            rollup_value=rollups.ITEM_COUNT,
+            rollup_filters=filters.standard_payment_rollup_filters
         ))
 
         if group_strategy:
@@ -1,5 +1,6 @@
 from sqlalchemy.sql.expression import func
 
+import config
 from flask import g
 from server import db
 from server.utils.metrics.filters import apply_filters
@@ -8,7 +9,7 @@ from server.models.credit_transfer import CreditTransfer
 from server.models.user import User
 from functools import reduce
 from sqlalchemy.orm import lazyload, aliased
-from sqlalchemy import or_, desc
+from sqlalchemy import desc, select, union_all
 from server.utils.access_control import AccessControl
 
 class SearchableColumn:
@@ -67,7 +68,7 @@ def generate_search_query(search_string, filters, order, sort_by_arg, include_us
         raise Exception(f'Invalid sort_by value {sort_by_arg}. Please use one of the following: {sort_types_to_database_types[search_type].keys()}')
 
     # To add new searchable column, simply add a new SearchableColumn object!
-    # And don't forget to add a trigram index on that column too-- see migration 33df5e72fca4 for reference
+    # And don't forget to add it to the user search document too-- see SEARCH_DOCUMENT_ATTRIBUTES
     user_search_columns = [
         SearchableColumn('first_name', User.first_name, rank=1.5),
         SearchableColumn('last_name', User.last_name, rank=1.5),
@@ -78,6 +79,12 @@ def generate_search_query(search_string, filters, order, sort_by_arg, include_us
     ]
     sum_search = reduce(lambda x,y: x+y, [sc.get_similarity_query(search_string) for sc in user_search_columns])
     sort_by = sum_search if sort_by_arg == 'rank' else sort_types_to_database_types[search_type][sort_by_arg]
+    # Users matching the search string, found with the search document's trigram index rather than by ranking
+    # every user. Only these candidates are ranked
+    user_matches_search = User.search_document.op('%')(search_string)
+    if search_string:
+        set_search_similarity_threshold()
+
     # If there's no search string, the process is the same, just sort by account creation date
     if search_type == TRANSFER_ACCOUNT:
         # If the sort by argument is rank, but there are no ranks because there is no search string, sort by date account created
@@ -91,24 +98,46 @@ def generate_search_query(search_string, filters, order, sort_by_arg, include_us
         # Joining custom attributes is quite expensive, and we don't need them in a listing of search results
         if include_user:
             final_query = final_query.options(lazyload(User.custom_attributes))
-
-    else:
-        # If the sort by argument is rank, but there are no ranks because there is no search string, sort by date transfer created
-        sort_by = sort_types_to_database_types[search_type]['id'] if sort_by_arg == 'rank' and not search_string else sort_by
+        # If there is a search string, we only want to return ranked results!
         if search_string:
-            final_query = db.session.query(CreditTransfer, sum_search)\
-                .join(sender, sender.id == User.id)\
-                .join(recipient, recipient.id == User.id)\
-                .join(CreditTransfer, or_((recipient.id == CreditTransfer.recipient_user_id), (sender.id == CreditTransfer.sender_user_id)))\
-                .with_entities(CreditTransfer)\
-                .order_by(order(sort_by))
-        else:
-            final_query = db.session.query(CreditTransfer)\
-                .order_by(order(sort_by))
-
-    # If there is a search string, we only want to return ranked results!
-    final_query = final_query.filter(sum_search!=0) if search_string else final_query
-    if search_type == CREDIT_TRANSFER:
-        return apply_filters(final_query, filters, CreditTransfer)
-    if search_type == TRANSFER_ACCOUNT:
+            final_query = final_query.filter(user_matches_search)
         return apply_filters(final_query, filters, User)
+
+    # If the sort by argument is rank, but there are no ranks because there is no search string, sort by date transfer created
+    sort_by = sort_types_to_database_types[search_type]['id'] if sort_by_arg == 'rank' and not search_string else sort_by
+    final_query = db.session.query(CreditTransfer)
+    if search_string:
+        # Transfers sent or received by a matching user, each found through the sender and recipient indexes.
+        # A transfer between two matching users is ranked by the better match
+        matching_users = db.session.query(User.id.label('user_id'), sum_search.label('rank'))\
+            .filter(user_matches_search)\
+            .subquery()
+        matching_transfers = union_all(
+            select([CreditTransfer.id.label('credit_transfer_id'), matching_users.c.rank])
+                .where(CreditTransfer.sender_user_id == matching_users.c.user_id),
+            select([CreditTransfer.id.label('credit_transfer_id'), matching_users.c.rank])
+                .where(CreditTransfer.recipient_user_id == matching_users.c.user_id),
+        ).alias('matching_transfers')
+        ranked_transfers = select([matching_transfers.c.credit_transfer_id, func.max(matching_transfers.c.rank).label('rank')])\
+            .group_by(matching_transfers.c.credit_transfer_id)\
+            .alias('ranked_transfers')
+        final_query = final_query.join(ranked_transfers, ranked_transfers.c.credit_transfer_id == CreditTransfer.id)
+        if sort_by_arg == 'rank':
+            sort_by = ranked_transfers.c.rank
+    if sort_by_arg in ['sender_first_name', 'sender_last_name']:
+        final_query = final_query.outerjoin(sender, sender.id == CreditTransfer.sender_user_id)
+    if sort_by_arg in ['recipient_first_name', 'recipient_last_name']:
+        final_query = final_query.outerjoin(recipient, recipient.id == CreditTransfer.recipient_user_id)
+    # Ties are broken by id, so equally ranked transfers come back in a stable order
+    final_query = final_query.order_by(order(sort_by), order(CreditTransfer.id))
+    return apply_filters(final_query, filters, CreditTransfer)
+
+
+def set_search_similarity_threshold():
+    """
+    Sets how similar the search document of a user has to be to the search string for the trigram index to return
+    them as a candidate, for the rest of the transaction.
+    """
+    db.session.execute(
+        select([func.set_config('pg_trgm.similarity_threshold', str(config.SEARCH_SIMILARITY_THRESHOLD), True)])
+    )
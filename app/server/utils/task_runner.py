@@ -1,5 +1,6 @@
 from . import worker_simulator
 from flask import current_app
+from celery import group
 from server import celery_app
 
 def delay_task(task, kwargs=None, args=None, force_simulate=False, queue='high-priority', task_uuid=None):
@@ -7,3 +8,14 @@ def delay_task(task, kwargs=None, args=None, force_simulate=False, queue='high-p
         return worker_simulator.simulate(task, kwargs, args, queue)
     signature = celery_app.signature(task, kwargs=kwargs, args=args)
     return signature.apply_async(queue=queue, task_id=task_uuid)
+
+def delay_tasks(tasks, force_simulate=False, queue='high-priority'):
+    """
+    Publishes several tasks to the same queue together as a celery group, rather than one message round trip each
+    :param tasks: list of (task, kwargs, task_uuid) tuples
+    :return: list of results, in the same order as tasks
+    """
+    if current_app.config['ENABLE_SIMULATOR_MODE'] or force_simulate:
+        return [worker_simulator.simulate(task, kwargs, None, queue) for task, kwargs, _ in tasks]
+    signatures = [celery_app.signature(task, kwargs=kwargs, task_id=task_uuid) for task, kwargs, task_uuid in tasks]
+    return group(signatures).apply_async(queue=queue).results
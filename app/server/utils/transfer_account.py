@@ -1,3 +1,7 @@
+from contextlib import contextmanager
+
+from flask import g
+
 from server.exceptions import NoTransferAccountError
 
 
@@ -11,3 +15,169 @@ def find_transfer_accounts_with_matching_token(account_holder, token):
     if len(matching_transfer_accounts) > 1:
         raise Exception(f"User has multiple transfer accounts for token {token}")
     return matching_transfer_accounts[0]
+
+
+def reconcile_transfer_account_ledgers(fix=False):
+    """
+    Recomputes every transfer account's running transfer totals from scratch and reports any drift from the stored
+    totals. If fix is True, drifted accounts have their totals and balance corrected.
+    :return: list of dicts describing each account whose stored totals don't match its credit transfers
+    """
+    from sqlalchemy import case, func
+    from server import db
+    from server.models.credit_transfer import CreditTransfer
+    from server.models.transfer_account import TransferAccount
+    from server.utils.transfer_enums import TransferStatusEnum
+
+    def _sum_where(condition):
+        return func.coalesce(func.sum(case([(condition, CreditTransfer._transfer_amount_wei)], else_=0)), 0)
+
+    received = dict(
+        db.session.query(CreditTransfer.recipient_transfer_account_id,
+                         _sum_where(CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE))
+        .execution_options(show_all=True, show_deleted=True)
+        .group_by(CreditTransfer.recipient_transfer_account_id)
+        .all()
+    )
+
+    sent = {
+        account_id: (complete, pending) for account_id, complete, pending in
+        db.session.query(CreditTransfer.sender_transfer_account_id,
+                         _sum_where(CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE),
+                         _sum_where(CreditTransfer.transfer_status.in_(
+                             [TransferStatusEnum.PENDING, TransferStatusEnum.PARTIAL])))
+        .execution_options(show_all=True, show_deleted=True)
+        .group_by(CreditTransfer.sender_transfer_account_id)
+        .all()
+    }
+
+    stored_totals = (
+        db.session.query(TransferAccount.id,
+                         TransferAccount._total_received_complete_wei,
+                         TransferAccount._total_sent_complete_wei,
+                         TransferAccount._total_sent_pending_wei)
+        .execution_options(show_all=True, show_deleted=True)
+        .all()
+    )
+
+    drift = []
+    for account_id, stored_received, stored_sent_complete, stored_sent_pending in stored_totals:
+        stored = (stored_received or 0, stored_sent_complete or 0, stored_sent_pending or 0)
+        expected = (received.get(account_id, 0), *sent.get(account_id, (0, 0)))
+        if stored != expected:
+            drift.append({
+                'transfer_account_id': account_id,
+                'stored': dict(zip(['received_complete_wei', 'sent_complete_wei', 'sent_pending_wei'], stored)),
+                'expected': dict(zip(['received_complete_wei', 'sent_complete_wei', 'sent_pending_wei'], expected)),
+            })
+
+    if fix and drift:
+        for item in drift:
+            account = TransferAccount.query.execution_options(show_all=True, show_deleted=True)\
+                .get(item['transfer_account_id'])
+            expected = item['expected']
+            account._total_received_complete_wei = expected['received_complete_wei']
+            account._total_sent_complete_wei = expected['sent_complete_wei']
+            account._total_sent_pending_wei = expected['sent_pending_wei']
+            account.update_balance()
+        db.session.commit()
+
+    return drift
+
+
+@contextmanager
+def deferred_ledger_writes():
+    """
+    Holds back the running total and last completed send changes that transfers make to accounts already in the
+    database, and writes them for every account in one UPDATE when the block exits. Totals are kept up to date in
+    memory in the meantime, so balance checks inside the block still see every transfer made in it.
+    Recipients' completed receive counts are held back and written in one UPDATE in the same way.
+    Meant for bulk jobs, where doing it a transfer at a time means one UPDATE per transfer against the same account.
+    Nested blocks share the outermost one, which writes everything held back when it exits.
+    """
+    from server import db
+
+    if g.get('deferred_ledger_writes') is not None:
+        yield
+        return
+
+    g.deferred_ledger_writes = {}
+    g.deferred_receive_counts = {}
+    try:
+        yield
+        # Transfers made in the block may still be waiting to be inserted, which is when their sends are recorded
+        db.session.flush()
+        deferred_writes = list(g.deferred_ledger_writes.values())
+        deferred_receive_counts = g.deferred_receive_counts
+    finally:
+        g.deferred_ledger_writes = None
+        g.deferred_receive_counts = None
+
+    if deferred_writes:
+        _apply_ledger_writes(deferred_writes)
+    if deferred_receive_counts:
+        _apply_receive_counts(deferred_receive_counts)
+
+
+def _apply_ledger_writes(writes):
+    from sqlalchemy import text
+    from sqlalchemy.orm.attributes import set_committed_value
+    from server import db
+
+    rows, params = [], {}
+    for i, write in enumerate(writes):
+        rows.append(f'(:id_{i}, CAST(:received_{i} AS NUMERIC), CAST(:sent_complete_{i} AS NUMERIC), '
+                    f'CAST(:sent_pending_{i} AS NUMERIC), :last_send_{i})')
+        params.update({
+            f'id_{i}': write['transfer_account'].id,
+            f'received_{i}': write['received_complete_wei'],
+            f'sent_complete_{i}': write['sent_complete_wei'],
+            f'sent_pending_{i}': write['sent_pending_wei'],
+            f'last_send_{i}': write['last_completed_send_id'],
+        })
+
+    # Right hand sides see the row as it was before the update, so the balance is worked out from the new totals
+    results = db.session.execute(text(f'''
+        UPDATE transfer_account AS ta SET
+            _total_received_complete_wei = coalesce(ta._total_received_complete_wei, 0) + d.received,
+            _total_sent_complete_wei = coalesce(ta._total_sent_complete_wei, 0) + d.sent_complete,
+            _total_sent_pending_wei = coalesce(ta._total_sent_pending_wei, 0) + d.sent_pending,
+            _balance_wei = coalesce(ta._total_received_complete_wei, 0) + d.received
+                - coalesce(ta._total_sent_complete_wei, 0) - d.sent_complete
+                - coalesce(ta._total_sent_pending_wei, 0) - d.sent_pending
+                + coalesce(ta._balance_offset_wei, 0),
+            _last_completed_send_id = nullif(greatest(coalesce(ta._last_completed_send_id, 0), d.last_send), 0)
+        FROM (VALUES {', '.join(rows)}) AS d (id, received, sent_complete, sent_pending, last_send)
+        WHERE ta.id = d.id
+        RETURNING ta.id, ta._total_received_complete_wei, ta._total_sent_complete_wei, ta._total_sent_pending_wei,
+            ta._balance_wei, ta._last_completed_send_id
+    '''), params).fetchall()
+
+    accounts = {write['transfer_account'].id: write['transfer_account'] for write in writes}
+    for account_id, received, sent_complete, sent_pending, balance, last_send in results:
+        account = accounts[account_id]
+        set_committed_value(account, '_total_received_complete_wei', received)
+        set_committed_value(account, '_total_sent_complete_wei', sent_complete)
+        set_committed_value(account, '_total_sent_pending_wei', sent_pending)
+        set_committed_value(account, '_balance_wei', balance)
+        set_committed_value(account, '_last_completed_send_id', last_send)
+
+
+def _apply_receive_counts(receive_counts):
+    from sqlalchemy import text
+    from server import db
+
+    rows, params = [], {}
+    for i, (user_id, change) in enumerate(sorted(receive_counts.items())):
+        if not change:
+            continue
+        rows.append(f'(:id_{i}, :change_{i})')
+        params.update({f'id_{i}': user_id, f'change_{i}': change})
+    if not rows:
+        return
+
+    db.session.execute(text(f'''
+        UPDATE "user" AS u SET completed_receive_count = u.completed_receive_count + d.change
+        FROM (VALUES {', '.join(rows)}) AS d (id, change)
+        WHERE u.id = d.id
+    '''), params)
@@ -0,0 +1,59 @@
+import json
+
+from server import red
+from server.models.transfer_usage import TransferUsageCatalogue
+
+# The order transfer usages are offered to each user in is cached, since working it out means going through their
+# recent transfers. It's invalidated whenever a transfer they sent completes (or stops being complete), or the
+# usages of a completed one are edited, and carries the catalogue version it was ranked against, so changes to the
+# usages themselves invalidate it too
+TRANSFER_USAGE_RANKING_TTL_SECONDS = 60 * 60 * 24
+
+
+def _ranking_key(user_id):
+    return f'transfer_usage_ranking_{user_id}'
+
+
+def rank_transfer_usages(usages, most_common_uses):
+    """
+    Orders transfer usages with prioritised usages first (lowest priority first), then the ones the user has used
+    (most used first), then everything else. Ties keep the order usages are given in
+    :param usages: transfer usages, as TransferUsage or CataloguedTransferUsage
+    :param most_common_uses: dict of usage name to how many of the user's recent transfers were for it
+    :return: list of the usages in ranked order
+    """
+    def usage_rank(usage):
+        if usage.priority:
+            return 0, usage.priority
+        if usage.name in most_common_uses:
+            return 1, -most_common_uses[usage.name]
+        return 2, 0
+
+    return sorted(usages, key=usage_rank)
+
+
+def transfer_usage_ranking(user, catalogue=None):
+    """
+    Gets the ids of every transfer usage in the order they're offered to user, from the cache if it's current
+    :param catalogue: the TransferUsageCatalogue to rank, defaulting to the current one
+    :return: list of transfer usage ids
+    """
+    catalogue = catalogue or TransferUsageCatalogue.current()
+    cached_ranking = red.get(_ranking_key(user.id))
+    if cached_ranking:
+        ranking = json.loads(cached_ranking)
+        if ranking['catalogue_version'] == catalogue.version:
+            return ranking['usage_ids']
+
+    ranked_usages = rank_transfer_usages(catalogue.usages, user.get_most_relevant_transfer_usages())
+    usage_ids = [usage.id for usage in ranked_usages]
+    red.set(
+        _ranking_key(user.id),
+        json.dumps({'catalogue_version': catalogue.version, 'usage_ids': usage_ids}),
+        ex=TRANSFER_USAGE_RANKING_TTL_SECONDS
+    )
+    return usage_ids
+
+
+def invalidate_transfer_usage_ranking(user_id):
+    red.delete(_ranking_key(user_id))
@@ -1,5 +1,4 @@
 import threading
-from functools import cmp_to_key
 from typing import Optional, List
 from phonenumbers.phonenumberutil import NumberParseException
 from sqlalchemy.orm.attributes import flag_modified
@@ -12,7 +11,7 @@ from server import db
 from server.models.device_info import DeviceInfo
 from server.models.organisation import Organisation
 from server.models.token import Token
-from server.models.transfer_usage import TransferUsage
+from server.models.transfer_usage import TransferUsage, TransferUsageCatalogue, CataloguedTransferUsage
 from server.models.upload import UploadedResource
 from server.models.user import User
 from server.models.custom_attribute_user_storage import CustomAttributeUserStorage
@@ -31,6 +30,7 @@ from server.utils.internationalization import i18n_for
 from server.utils.misc import rounded_dollars
 from server.utils.multi_chain import get_chain
 from server.utils.audit_history import manually_add_history_entry
+from server.utils.transfer_usage import transfer_usage_ranking
 
 def save_photo_and_check_for_duplicate(url, new_filename, image_id):
     save_to_s3_from_url(url, new_filename)
@@ -809,37 +809,16 @@ def get_user_by_phone(phone: str, region: Optional[str] = None, should_raise=Fal
             return None
 
 
-def transfer_usages_for_user(user: User) -> List[TransferUsage]:
-    most_common_uses = user.get_most_relevant_transfer_usages()
-
-    def usage_sort(a, b):
-        ma = most_common_uses.get(a.name)
-        mb = most_common_uses.get(b.name)
-
-        # return prioritied, then used, then everything else
-        if a.priority and b.priority:
-            if a.priority < b.priority:
-                return -1
-            else:
-                return 1
-        elif a.priority:
-            return -1
-        elif b.priority:
-            return 1
-        elif ma is not None and mb is not None:
-            if ma >= mb:
-                return -1
-            else:
-                return 1
-        elif ma is not None:
-            return -1
-        elif mb is not None:
-            return 1
-        else:
-            return -1
+def transfer_usages_for_user(user: User) -> List[CataloguedTransferUsage]:
+    """
+    :return: every transfer usage, in the order they're offered to the user. See rank_transfer_usages
+    """
+    catalogue = TransferUsageCatalogue.current()
+    return [
+        catalogue.by_id[usage_id] for usage_id in transfer_usage_ranking(user, catalogue)
+        if usage_id in catalogue.by_id
+    ]
 
-    ordered_transfer_usages = sorted(TransferUsage.query.all(), key=cmp_to_key(usage_sort))
-    return ordered_transfer_usages
 
 def create_transfer_account_if_required(blockchain_address, token, account_type=TransferAccountType.EXTERNAL):
     transfer_account = TransferAccount.query.execution_options(show_all=True).filter_by(blockchain_address=blockchain_address).first()
@@ -1,12 +1,7 @@
-from sqlalchemy import text
-from sqlalchemy.sql import func
-
-from server import db
 from server.utils.phone import send_translated_message
 from server.models.user import User
 from server.models.transfer_account import TransferAccount
 from server.models.transfer_usage import TransferUsage
-from server.models.credit_transfer import CreditTransfer
 from server.utils.user import default_token
 
 from server.constants import NUMBER_OF_DIRECTORY_LISTING_RESULTS
@@ -39,44 +34,23 @@ class DirectoryListingProcessor(object):
             - users matching recipient provided business category
             - users with the recipient's token
             - users who are opted in to market [custom_attribute 'market_enabled' has value true]
-            - order query by transaction count and limit to top 5 transacting users
+            - order by completed receive count and limit to top 5 transacting users. Users who haven't received
+              any transfers fill out the listing when there aren't enough who have
+
+        Completed receive counts are kept up to date as transfers complete, so the ranking is read straight off
+        the ix_user_directory_ranking index rather than counting every user's transfers
         """
-        count_list = (
-            db.session.query(
-                User.id,
-                func.count(CreditTransfer.id).label('count'))
-            .execution_options(show_all=True)
-            .join(User.credit_receives)
-            .join(TransferAccount, TransferAccount.id == User.default_transfer_account_id)
-            .group_by(User.id)
-            .filter(TransferAccount.token_id == token_id)
-            .filter(User.is_market_enabled == True)
-            .filter(User.business_usage_id == self.selected_business_category.id)
-            .filter(CreditTransfer.transfer_status == 'COMPLETE')
-            .limit(NUMBER_OF_DIRECTORY_LISTING_RESULTS).all()
+        return (
+            User.query
+                .execution_options(show_all=True)
+                .join(TransferAccount, TransferAccount.id == User.default_transfer_account_id)
+                .filter(TransferAccount.token_id == token_id)
+                .filter(User.is_market_enabled == True)
+                .filter(User.business_usage_id == self.selected_business_category.id)
+                .order_by(User.completed_receive_count.desc(), User.id)
+                .limit(NUMBER_OF_DIRECTORY_LISTING_RESULTS).all()
         )
 
-        user_ids = list(map(lambda x: x[0], count_list))
-
-        count_based_users = list(map(lambda x: User.query.execution_options(show_all=True).get(x), user_ids))
-
-        shortfall = NUMBER_OF_DIRECTORY_LISTING_RESULTS - len(count_based_users)
-
-        matching_category_users = []
-        if shortfall > 0:
-            matching_category_users = (
-                User.query
-                    .execution_options(show_all=True)
-                    .join(TransferAccount, TransferAccount.id == User.default_transfer_account_id)
-                    .filter(User.id.notin_(user_ids))
-                    .filter(TransferAccount.token_id == token_id)
-                    .filter(User.is_market_enabled == True)
-                    .filter(User.business_usage_id == self.selected_business_category.id)
-                    .limit(shortfall).all()
-            )
-
-        return count_based_users + matching_category_users
-
     def get_business_category_translation(self):
         try:
             if self.recipient.preferred_language and self.selected_business_category.translations:
@@ -0,0 +1,140 @@
+import datetime
+import json
+from typing import Optional
+
+from flask import g
+from sqlalchemy.dialects.postgresql import insert
+
+from server import db, red
+from server.models.user import User
+from server.models.ussd import UssdSession
+from server.utils.executor import standard_executor_job, add_after_request_executor_job
+
+# Live USSD sessions are held in redis rather than the database, since every keystroke reads and writes them.
+# Sessions last a couple of minutes at most, so they're kept for a while longer than that
+USSD_SESSION_TTL_SECONDS = 300
+
+# Sessions are written to the ussd_session table for auditing, in one batch at most once every
+# USSD_SESSION_FLUSH_INTERVAL_SECONDS, as well as when a session starts or ends
+USSD_SESSION_FLUSH_INTERVAL_SECONDS = 30
+USSD_SESSION_PENDING_KEY = 'ussd_sessions_pending'
+USSD_SESSION_FLUSH_LOCK_KEY = 'ussd_sessions_flush_lock'
+
+
+def _session_key(session_id):
+    return f'ussd_session_{session_id}'
+
+
+class CachedUssdSession(object):
+    """
+    A live USSD session, as held in redis. Has the same interface as UssdSession, which it's eventually written to
+    """
+    FIELDS = ['session_id', 'service_code', 'msisdn', 'user_input', 'state', 'session_data', 'ussd_menu_id', 'user_id']
+
+    def __init__(self, user: Optional[User] = None, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field))
+        self.user = user
+        self.is_new = False
+
+    def set_data(self, key, value):
+        if self.session_data is None:
+            self.session_data = {}
+        self.session_data[key] = value
+
+    def get_data(self, key):
+        if self.session_data is not None:
+            return self.session_data.get(key)
+        else:
+            return None
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"<CachedUssdSession {self.session_id}: {self.state}>"
+
+
+def get_ussd_session(session_id: str) -> Optional[CachedUssdSession]:
+    """
+    Gets a live session from redis. Sessions are only read from redis once per request, so changes made to one
+    by any part of the request are seen by the rest of it
+    """
+    request_sessions = g.setdefault('ussd_sessions', {})
+    if session_id not in request_sessions:
+        cached_session = red.get(_session_key(session_id))
+        request_sessions[session_id] = CachedUssdSession(**json.loads(cached_session)) if cached_session else None
+    return request_sessions[session_id]
+
+
+def create_or_update_cached_session(session_id: str, user: User, current_menu, user_input: str,
+                                    service_code: str) -> CachedUssdSession:
+    session = get_ussd_session(session_id)
+    if session:
+        session.user_input = user_input
+        session.ussd_menu_id = current_menu.id
+        session.state = current_menu.name
+    else:
+        session = CachedUssdSession(session_id=session_id, msisdn=user.phone, user_input=user_input,
+                                    state=current_menu.name, service_code=service_code,
+                                    ussd_menu_id=current_menu.id, user_id=user.id)
+        session.is_new = True
+        g.ussd_sessions[session_id] = session
+
+    session.user = user
+    return session
+
+
+def save_ussd_session(session: CachedUssdSession, is_ended=False):
+    """
+    Saves a live session to redis, and queues it to be written to the database
+    :param is_ended: whether the session has ended, so its final state is written to the database straight away
+    """
+    data = json.dumps(session.to_dict())
+    pipe = red.pipeline(transaction=False)
+    pipe.set(_session_key(session.session_id), data, ex=USSD_SESSION_TTL_SECONDS)
+    pipe.hset(USSD_SESSION_PENDING_KEY, session.session_id, data)
+    pipe.set(USSD_SESSION_FLUSH_LOCK_KEY, 1, nx=True, ex=USSD_SESSION_FLUSH_INTERVAL_SECONDS)
+    if pipe.execute()[-1] or session.is_new or is_ended:
+        add_after_request_executor_job(flush_ussd_sessions)
+
+
+@standard_executor_job
+def flush_ussd_sessions():
+    """
+    Writes every pending session to the ussd_session table in one batch. Sessions are only taken off the pending
+    list once they've been committed, and only if they haven't been saved again since they were read
+    """
+    pending_sessions = red.hgetall(USSD_SESSION_PENDING_KEY)
+    if not pending_sessions:
+        return
+
+    now = datetime.datetime.utcnow()
+    rows = []
+    for data in pending_sessions.values():
+        pending_session = json.loads(data)
+        rows.append(dict(
+            {field: pending_session[field] for field in CachedUssdSession.FIELDS},
+            created=now,
+            updated=now
+        ))
+
+    table = UssdSession.__table__
+    statement = insert(table).values(rows)
+    set_ = {field: statement.excluded[field] for field in CachedUssdSession.FIELDS if field != 'session_id'}
+    set_['updated'] = statement.excluded.updated
+    db.session.execute(statement.on_conflict_do_update(index_elements=['session_id'], set_=set_))
+    db.session.commit()
+
+    def remove_flushed_sessions(pipe):
+        session_ids = list(pending_sessions.keys())
+        current_sessions = pipe.hmget(USSD_SESSION_PENDING_KEY, session_ids)
+        unchanged_session_ids = [
+            session_id for session_id, data in zip(session_ids, current_sessions)
+            if data == pending_sessions[session_id]
+        ]
+        pipe.multi()
+        if unchanged_session_ids:
+            pipe.hdel(USSD_SESSION_PENDING_KEY, *unchanged_session_ids)
+
+    red.transaction(remove_flushed_sessions, USSD_SESSION_PENDING_KEY)
@@ -1,8 +1,8 @@
-from typing import Optional
+from typing import Optional, Union
 
 from server import db
 from server.models.user import User
-from server.models.ussd import UssdMenu, UssdSession
+from server.models.ussd import UssdMenu, UssdSession, RegisteredUssdMenu
 from server.utils.internationalization import i18n_for
 
 
@@ -14,15 +14,23 @@ def create_or_update_session(session_id: str, user: User, current_menu: UssdMenu
     session: Optional[UssdSession] = UssdSession.query.filter_by(session_id=session_id).first()
     if session:
         session.user_input = user_input
-        session.ussd_menu = current_menu
+        set_session_menu(session, current_menu)
         session.state = current_menu.name
     else:
         session = UssdSession(session_id=session_id, msisdn=user.phone, user_input=user_input,
                               state=current_menu.name, service_code=service_code)
 
         session.user = user
-        session.ussd_menu = current_menu
+        set_session_menu(session, current_menu)
 
         db.session.add(session)
 
     return session
+
+
+def set_session_menu(session: UssdSession, current_menu: Union[UssdMenu, RegisteredUssdMenu]):
+    if isinstance(current_menu, UssdMenu):
+        session.ussd_menu = current_menu
+    else:
+        # Menus from the registry don't belong to any database session, so the session only gets the menu's id
+        session.ussd_menu_id = current_menu.id
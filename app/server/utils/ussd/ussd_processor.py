@@ -5,6 +5,7 @@ from server.models.ussd import UssdMenu, UssdSession
 from server.models.user import User
 from server.utils.user import get_user_by_phone, default_token
 from server.utils.ussd.ussd_state_machine import UssdStateMachine, ITEMS_PER_MENU, USSD_MAX_LENGTH
+from server.utils.ussd.session_store import CachedUssdSession, get_ussd_session
 from server.utils.internationalization import i18n_for
 from server.utils.credit_transfer import cents_to_dollars
 
@@ -12,7 +13,7 @@ from server.utils.credit_transfer import cents_to_dollars
 class UssdProcessor:
     @staticmethod
     def process_request(session_id: str, user_input: str, user: User) -> UssdMenu:
-        session: Optional[UssdSession] = UssdSession.query.filter_by(session_id=session_id).first()
+        session: Optional[CachedUssdSession] = get_ussd_session(session_id)
         # returning session
         if session:
             if user_input == "":
@@ -44,24 +45,50 @@ class UssdProcessor:
         return new_state
 
     @staticmethod
-    def fit_usages(ussd_session, most_relevant_usages, blank_len, user, list_start, previous_stack):
-
-        current_usages = []
-        previous_set_of_options = ''
-        last_index = 0
-        for index, usage in enumerate(most_relevant_usages[list_start:]):
-            current_usages.append(usage)
-            menu_options = UssdProcessor.create_usages_list(current_usages, user)
-
-            if len(menu_options) + blank_len > USSD_MAX_LENGTH or index + 1 > ITEMS_PER_MENU:
-                continue
-
-            previous_set_of_options = menu_options
-            last_index = index
+    def fit_usages(most_relevant_usages, blank_len, user, list_start):
+        """
+        :return: the index of the usage after the last one that fits on a menu page starting at list_start, given
+        the length of the menu's text without any usages. Pages always have at least one usage on them
+        """
+        menu_len = blank_len
+        list_end = list_start
+        for index, usage in enumerate(most_relevant_usages[list_start:list_start + ITEMS_PER_MENU]):
+            option = UssdProcessor.create_usages_list([usage], user)
+            # Options after the first start with a newline, and are numbered from the start of the page
+            menu_len += len(option) + len(str(index + 1)) - 1 + (1 if index else 0)
+            if menu_len > USSD_MAX_LENGTH:
+                break
+            list_end = list_start + index + 1
+
+        return max(list_end, list_start + 1)
 
-        ussd_session.set_data('usage_index_stack', previous_stack + [list_start + last_index + 1])
+    @staticmethod
+    def fits_on_last_page(most_relevant_usages, last_blank_len, user, list_start):
+        remaining_usages = most_relevant_usages[list_start:]
+        if list_start + ITEMS_PER_MENU <= len(most_relevant_usages):
+            return False
+        return len(UssdProcessor.create_usages_list(remaining_usages, user)) + last_blank_len <= USSD_MAX_LENGTH
 
-        return previous_set_of_options
+    @staticmethod
+    def paginate_usages(most_relevant_usages, first_blank_len, other_display_key, user):
+        """
+        Works out where every page of a usage menu starts, so that showing a page is a slice of the usages.
+        The first page is the menu itself, and later pages are the "other" menu, whose last page shows everything
+        left if it can
+        :return: list of the index of the first usage on each page
+        """
+        middle_blank_len = len(i18n_for(user, "{}.middle".format(other_display_key), other_options=''))
+        last_blank_len = len(i18n_for(user, "{}.last".format(other_display_key), other_options=''))
+
+        usage_index_stack = [0, UssdProcessor.fit_usages(most_relevant_usages, first_blank_len, user, 0)]
+        while usage_index_stack[-1] < len(most_relevant_usages):
+            list_start = usage_index_stack[-1]
+            if UssdProcessor.fits_on_last_page(most_relevant_usages, last_blank_len, user, list_start):
+                break
+            usage_index_stack.append(
+                UssdProcessor.fit_usages(most_relevant_usages, middle_blank_len, user, list_start)
+            )
+        return usage_index_stack
 
     @staticmethod
     def custom_display_text(menu: UssdMenu, ussd_session: UssdSession) -> str:
@@ -141,16 +168,19 @@ class UssdProcessor:
 
             most_relevant_usages = ussd_session.get_data('transfer_usage_mapping')
 
-            options = UssdProcessor.fit_usages(
-                ussd_session,
+            # Every page is worked out now, so that moving between pages is only a slice of the usages
+            usage_index_stack = UssdProcessor.paginate_usages(
                 most_relevant_usages,
                 blank_len,
-                user,
-                0,
-                [0]
+                "{}_other".format(menu.display_key),
+                user
+            )
+            ussd_session.set_data('usage_index_stack', usage_index_stack)
+
+            options = UssdProcessor.create_usages_list(
+                most_relevant_usages[:usage_index_stack[1]], user
             )
 
-            # current_usages = most_relevant_usages[:ITEMS_PER_MENU]
             return i18n_for(
                 user, menu.display_key,
                 options=options
@@ -184,22 +214,25 @@ class UssdProcessor:
 
             part = 'first' if start_of_list == 0 else 'middle'
 
-            blank_template = i18n_for(
-                user, "{}.{}".format(menu.display_key, part),
-                other_options=''
-            )
+            if usage_menu_nr + 1 < len(usage_stack):
+                end_of_list = usage_stack[usage_menu_nr + 1]
+            else:
+                # The page wasn't worked out with the rest, so work it out now
+                blank_template = i18n_for(
+                    user, "{}.{}".format(menu.display_key, part),
+                    other_options=''
+                )
 
-            blank_len = len(blank_template)
+                end_of_list = UssdProcessor.fit_usages(
+                    most_relevant_usages,
+                    len(blank_template),
+                    user,
+                    start_of_list
+                )
+                ussd_session.set_data('usage_index_stack', usage_stack[:usage_menu_nr + 1] + [end_of_list])
 
-            options = UssdProcessor.fit_usages(
-                ussd_session,
-                most_relevant_usages,
-                blank_len,
-                user,
-                start_of_list,
-                usage_stack)
+            options = UssdProcessor.create_usages_list(most_relevant_usages[start_of_list:end_of_list], user)
 
-            # current_usages = most_relevant_usages[:ITEMS_PER_MENU]
             return i18n_for(
                 user, "{}.{}".format(menu.display_key, part),
                 other_options=options
@@ -6,8 +6,8 @@ The class contains methods responsible for validation of user input and processi
 the services provided by the ussd app.
 """
 import re
+from collections import namedtuple
 from phonenumbers.phonenumberutil import NumberParseException
-from transitions import Machine, State
 
 from server import ussd_tasker
 from server.utils.phone import send_translated_message
@@ -24,8 +24,59 @@ ITEMS_PER_MENU = 8
 USSD_MAX_LENGTH = 164
 MIN_EXCHANGE_AMOUNT_CENTS = 40
 
+# A transition's conditions and after callbacks are names of UssdStateMachine methods, called with the user's input
+CompiledTransition = namedtuple('CompiledTransition', ['dest', 'conditions', 'after'])
+# A state's transitions: those that only need the input to be a particular menu option are looked up by that option,
+# and the rest are tried in order
+CompiledStateTransitions = namedtuple('CompiledStateTransitions', ['menu_options', 'transitions'])
+
+# Conditions that just check which menu option was chosen, see UssdStateMachine.menu_one_selected etc.
+MENU_OPTION_CONDITIONS = {
+    'menu_one_selected': '1',
+    'menu_two_selected': '2',
+    'menu_three_selected': '3',
+    'menu_four_selected': '4',
+    'menu_five_selected': '5',
+    'menu_nine_selected': '9',
+    'menu_ten_selected': '10',
+}
+
+
+def _listify(value):
+    if value is None:
+        return ()
+    return tuple(value) if isinstance(value, list) else (value,)
+
+
+def compile_transitions(transitions):
+    """
+    Builds the table UssdStateMachine.feed_char looks transitions up in, from a list of transition definitions
+    :param transitions: list of dicts with a source, dest, and optionally conditions and after callbacks
+    :return: dict of CompiledStateTransitions by source state
+    """
+    table = {}
+    for transition in transitions:
+        compiled = CompiledTransition(
+            dest=transition['dest'],
+            conditions=_listify(transition.get('conditions')),
+            after=_listify(transition.get('after'))
+        )
+        menu_options, ordered = table.setdefault(transition['source'], ({}, []))
+        menu_option = MENU_OPTION_CONDITIONS.get(compiled.conditions[0]) if len(compiled.conditions) == 1 else None
+        # Different menu options can't both hold, so these can be looked up as long as no transition with any other
+        # sort of condition comes before them
+        if menu_option is not None and not ordered and menu_option not in menu_options:
+            menu_options[menu_option] = compiled
+        else:
+            ordered.append(compiled)
+
+    return {
+        source: CompiledStateTransitions(menu_options=menu_options, transitions=tuple(ordered))
+        for source, (menu_options, ordered) in table.items()
+    }
 
-class UssdStateMachine(Machine):
+
+class UssdStateMachine(object):
 
     def __repr__(self):
         return f"<UssdStateMachine: {self.state}>"
@@ -81,9 +132,17 @@ class UssdStateMachine(Machine):
         'exit_pin_blocked',
         'exit_invalid_token_agent',
         'exit_invalid_exchange_amount',
-        State(name='complete', on_enter=['send_terms_to_user_if_required'])
+        'complete'
     ]
 
+    # callbacks called with the user's input on entering a state, before the transition's after callbacks
+    on_enter = {
+        'complete': ('send_terms_to_user_if_required',)
+    }
+
+    # built once, from define_transitions, when this module is imported
+    transition_table = None
+
     def send_sms(self, phone, message_key, **kwargs):
         send_translated_message(phone=phone, message_key="ussd.sempo.{}".format(message_key), **kwargs)
 
@@ -337,12 +396,35 @@ class UssdStateMachine(Machine):
     def __init__(self, session: UssdSession, user: User):
         self.session = session
         self.user = user
-        Machine.__init__(
-            self,
-            model=self,
-            states=self.states,
-            initial=session.state
-        )
+        self.state = session.state
+
+    def feed_char(self, user_input):
+        """
+        Takes the first of the current state's transitions whose conditions all hold for the user's input, calling
+        the destination's on_enter callbacks and then the transition's after callbacks with the input
+        :return: whether a transition was taken
+        """
+        state_transitions = self.transition_table.get(self.state)
+        if state_transitions is None:
+            raise Exception(f"Can't trigger event feed_char from state {self.state}!")
+
+        transition = state_transitions.menu_options.get(user_input)
+        if transition is None:
+            transition = next(
+                (t for t in state_transitions.transitions if all(getattr(self, c)(user_input) for c in t.conditions)),
+                None
+            )
+        if transition is None:
+            return False
+
+        self.state = transition.dest
+        for callback in self.on_enter.get(transition.dest, ()) + transition.after:
+            getattr(self, callback)(user_input)
+        return True
+
+    @staticmethod
+    def define_transitions():
+        transitions = []
 
         # event: initial_language_selection transitions
         initial_language_selection_transitions = [
@@ -364,7 +446,7 @@ class UssdStateMachine(Machine):
              'source': 'initial_language_selection',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(initial_language_selection_transitions)
+        transitions.extend(initial_language_selection_transitions)
 
         # event: initial_pin_entry transitions
         initial_pin_entry_transitions = [
@@ -377,7 +459,7 @@ class UssdStateMachine(Machine):
              'source': 'initial_pin_entry',
              'dest': 'exit_invalid_pin'}
         ]
-        self.add_transitions(initial_pin_entry_transitions)
+        transitions.extend(initial_pin_entry_transitions)
 
         # event: initial_pin_confirmation transitions
         initial_pin_confirmation_transitions = [
@@ -390,7 +472,7 @@ class UssdStateMachine(Machine):
              'source': 'initial_pin_confirmation',
              'dest': 'exit_pin_mismatch'}
         ]
-        self.add_transitions(initial_pin_confirmation_transitions)
+        transitions.extend(initial_pin_confirmation_transitions)
 
         # event: directory_listing
         start_transitions = [
@@ -419,7 +501,7 @@ class UssdStateMachine(Machine):
              'source': 'start',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(start_transitions)
+        transitions.extend(start_transitions)
 
         # event: send_enter_recipient transitions
         send_enter_recipient_transitions = [
@@ -437,7 +519,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_invalid_recipient',
              'after': 'upsell_unregistered_recipient'}
         ]
-        self.add_transitions(send_enter_recipient_transitions)
+        transitions.extend(send_enter_recipient_transitions)
 
         # event: send_token_amount transitions
         send_token_amount_transitions = [
@@ -451,7 +533,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_invalid_input',
             },
         ]
-        self.add_transitions(send_token_amount_transitions)
+        transitions.extend(send_token_amount_transitions)
 
         # event: send_token_reason transitions
         send_token_reason_transitions = [
@@ -487,7 +569,7 @@ class UssdStateMachine(Machine):
              'source': 'send_token_reason_other',
              'dest': 'exit_invalid_menu_option'},
         ]
-        self.add_transitions(send_token_reason_transitions)
+        transitions.extend(send_token_reason_transitions)
 
         directory_listing_transitions = [
             {'trigger': 'feed_char',
@@ -522,7 +604,7 @@ class UssdStateMachine(Machine):
              'source': 'directory_listing_other',
              'dest': 'exit_invalid_menu_option'},
         ]
-        self.add_transitions(directory_listing_transitions)
+        transitions.extend(directory_listing_transitions)
 
         # event: send_token_pin_authorization transitions
         send_token_pin_authorization_transitions = [
@@ -535,7 +617,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_pin_blocked',
              'conditions': 'is_blocked_pin'}
         ]
-        self.add_transitions(send_token_pin_authorization_transitions)
+        transitions.extend(send_token_pin_authorization_transitions)
 
         # event: send_token_confirmation transitions
         send_token_confirmation_transitions = [
@@ -552,7 +634,7 @@ class UssdStateMachine(Machine):
              'source': 'send_token_confirmation',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(send_token_confirmation_transitions)
+        transitions.extend(send_token_confirmation_transitions)
 
         # event: account_management transitions
         account_management_transitions = [
@@ -580,7 +662,7 @@ class UssdStateMachine(Machine):
              'source': 'account_management',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(account_management_transitions)
+        transitions.extend(account_management_transitions)
 
         # event: my_business transitions
         my_business_transitions = [
@@ -596,13 +678,13 @@ class UssdStateMachine(Machine):
              'source': 'my_business',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(my_business_transitions)
+        transitions.extend(my_business_transitions)
 
         # event change_my_business_prompt transition
-        self.add_transition(trigger='feed_char',
-                            source='change_my_business_prompt',
-                            dest='exit',
-                            after='save_business_directory_info')
+        transitions.append({'trigger': 'feed_char',
+                            'source': 'change_my_business_prompt',
+                            'dest': 'exit',
+                            'after': 'save_business_directory_info'})
 
         # event: choose_language transition
         choose_language_transitions = [
@@ -620,7 +702,7 @@ class UssdStateMachine(Machine):
              'source': 'choose_language',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(choose_language_transitions)
+        transitions.extend(choose_language_transitions)
 
         # event: balance_inquiry_pin_authorization transitions
         balance_inquiry_pin_authorization_transitions = [
@@ -635,7 +717,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_pin_blocked',
              'conditions': 'is_blocked_pin'}
         ]
-        self.add_transitions(balance_inquiry_pin_authorization_transitions)
+        transitions.extend(balance_inquiry_pin_authorization_transitions)
 
         # event: current_pin transitions
         current_pin_transitions = [
@@ -648,7 +730,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_pin_blocked',
              'conditions': 'is_blocked_pin'}
         ]
-        self.add_transitions(current_pin_transitions)
+        transitions.extend(current_pin_transitions)
 
         # event: new_pin transitions
         new_pin_transitions = [
@@ -661,7 +743,7 @@ class UssdStateMachine(Machine):
              'source': 'new_pin',
              'dest': 'exit_invalid_pin'}
         ]
-        self.add_transitions(new_pin_transitions)
+        transitions.extend(new_pin_transitions)
 
         # event: new_pin_confirmation transitions
         new_pin_confirmation = [
@@ -674,7 +756,7 @@ class UssdStateMachine(Machine):
              'source': 'new_pin_confirmation',
              'dest': 'exit_pin_mismatch'}
         ]
-        self.add_transitions(new_pin_confirmation)
+        transitions.extend(new_pin_confirmation)
 
         # event: opt_out_of_market_place_pin_authorization transitions
         opt_out_of_market_place_pin_authorization_transitions = [
@@ -688,7 +770,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_pin_blocked',
              'conditions': 'is_blocked_pin'}
         ]
-        self.add_transitions(opt_out_of_market_place_pin_authorization_transitions)
+        transitions.extend(opt_out_of_market_place_pin_authorization_transitions)
 
         # event: exchange_token transitions
         exchange_token_transitions = [
@@ -705,7 +787,7 @@ class UssdStateMachine(Machine):
              'source': 'exchange_token',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(exchange_token_transitions)
+        transitions.extend(exchange_token_transitions)
 
         # DEPRECATED - exchange rate currently given without requiring pin
         # event: exchange_rate_pin_authorization transitions
@@ -720,7 +802,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_pin_blocked',
              'conditions': 'is_blocked_pin'}
         ]
-        self.add_transitions(exchange_rate_pin_authorization_transitions)
+        transitions.extend(exchange_rate_pin_authorization_transitions)
 
         # event: exchange_token_agent_number_entry transitions
         exchange_token_agent_number_entry_transitions = [
@@ -733,7 +815,7 @@ class UssdStateMachine(Machine):
              'source': 'exchange_token_agent_number_entry',
              'dest': 'exit_invalid_token_agent'}
         ]
-        self.add_transitions(exchange_token_agent_number_entry_transitions)
+        transitions.extend(exchange_token_agent_number_entry_transitions)
 
         # event: exchange_token_amount_entry transitions
         exchange_token_amount_entry_transitions = [
@@ -746,7 +828,7 @@ class UssdStateMachine(Machine):
              'source': 'exchange_token_amount_entry',
              'dest': 'exit_invalid_exchange_amount'}
         ]
-        self.add_transitions(exchange_token_amount_entry_transitions)
+        transitions.extend(exchange_token_amount_entry_transitions)
 
         # event: exchange_token_pin_authorization transitions
         exchange_token_pin_authorization_transitions = [
@@ -759,7 +841,7 @@ class UssdStateMachine(Machine):
              'dest': 'exit_pin_blocked',
              'conditions': 'is_blocked_pin'}
         ]
-        self.add_transitions(exchange_token_pin_authorization_transitions)
+        transitions.extend(exchange_token_pin_authorization_transitions)
 
         # event: exchange_token_confirmation transitions
         exchange_token_confirmation_transitions = [
@@ -776,4 +858,9 @@ class UssdStateMachine(Machine):
              'source': 'exchange_token_confirmation',
              'dest': 'exit_invalid_menu_option'}
         ]
-        self.add_transitions(exchange_token_confirmation_transitions)
+        transitions.extend(exchange_token_confirmation_transitions)
+
+        return transitions
+
+
+UssdStateMachine.transition_table = compile_transitions(UssdStateMachine.define_transitions())
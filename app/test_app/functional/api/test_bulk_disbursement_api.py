@@ -327,3 +327,48 @@ def test_sempoadmin_can_approve_anything(include_list, disbursement_amount, expe
             assert t.transfer_status == TransferStatusEnum.COMPLETE
             assert t.transfer_amount == disbursement_amount
             db.session.delete(t)
+
+
+def test_disbursement_transfer_limits(test_client, complete_admin_auth_token, create_organisation, monkeypatch, mocker):
+    """
+    GIVEN a transfer limit that allows an admin two disbursement transfers
+    WHEN the admin approves a disbursement to four recipients
+    THEN check that the limit is only checked once for the transfers it allows, and that the rest are rejected
+    """
+    from server.utils import transfer_limits
+    from server.utils.transfer_enums import TransferTypeEnum, TransferSubTypeEnum
+    from server.utils.transfer_limits.limits import TransferCountLimit
+    global sample_token_1
+
+    current_app.config['REQUIRE_MULTIPLE_APPROVALS'] = False
+    current_app.config['ALLOWED_APPROVERS'] = []
+    create_organisation.queried_org_level_transfer_account.set_balance_offset(10000000000)
+    monkeypatch.setattr(transfer_limits, 'LIMIT_IMPLEMENTATIONS', [
+        TransferCountLimit('Disbursements', [(TransferTypeEnum.PAYMENT, TransferSubTypeEnum.DISBURSEMENT)],
+                           lambda transfer: True, 7, transfer_count=2)
+    ])
+    check_limits = mocker.spy(CreditTransfer, 'check_sender_transfer_limits')
+
+    response = test_client.post('/api/v1/disbursement',
+                                headers=dict(Authorization=complete_admin_auth_token, Accept='application/json'),
+                                json={'search_string': '', 'params': '', 'include_accounts': [],
+                                      'exclude_accounts': [], 'disbursement_amount': 50},
+                                follow_redirects=True)
+    assert response.status_code == 201
+    resp_id = response.json['data']['disbursement']['id']
+
+    response = test_client.put(f'/api/v1/disbursement/{resp_id}',
+                               headers=dict(Authorization=sample_token_1, Accept='application/json'),
+                               json={'action': 'APPROVE'},
+                               follow_redirects=True)
+    assert response.status_code == 200
+
+    transfers = CreditTransfer.query.all()
+    statuses = [t.transfer_status for t in sorted(transfers, key=lambda t: t.id)]
+    assert statuses == [TransferStatusEnum.COMPLETE] * 2 + [TransferStatusEnum.REJECTED] * 2
+    # Only the transfers past what the limit allows were checked on their own
+    assert check_limits.call_count == 2
+
+    for t in transfers:
+        db.session.delete(t)
+    db.session.commit()
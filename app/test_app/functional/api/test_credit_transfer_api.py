@@ -341,6 +341,57 @@ def test_credit_transfer_internal_callback(mocker, test_client, authed_sempo_adm
     from flask import g
     assert len(g.pending_transactions) == 0
 
+def test_credit_transfer_internal_batch_callback(mocker, test_client, authed_sempo_admin_user, create_organisation):
+    mocker.patch('server.models.credit_transfer.CreditTransfer.send_blockchain_payload_to_worker')
+
+    org = create_organisation
+    token = org.token
+
+    existing_user = create_transfer_account_user(first_name='Francine',
+                                                 last_name='Frensky',
+                                                 phone="+19025559876",
+                                                 organisation=org)
+
+    stranger_address = '0xA9450d3dB5A909b08197BC4a0665A4d632539999'
+    other_stranger_address = '0xA9450d3dB5A909b08197BC4a0665A4d632538888'
+    tracked_hash = '0x3333beef2322d396649ed2fa2b7e0a944474b65cfab2c4b1435c81bb16697ecb'
+    untracked_hash = '0x4444beef2322d396649ed2fa2b7e0a944474b65cfab2c4b1435c81bb16697ecb'
+
+    basic_auth = 'Basic ' + base64.b64encode(bytes(config.INTERNAL_AUTH_USERNAME + ":" + config.INTERNAL_AUTH_PASSWORD, 'ascii')).decode('ascii')
+    resp = test_client.post(
+        '/api/v1/credit_transfer/internal/batch/',
+        headers=dict(
+            Authorization=basic_auth,
+            Accept='application/json'
+        ),
+        data=json.dumps(dict(transfers=[
+            dict(
+                sender_blockchain_address=stranger_address,
+                recipient_blockchain_address=existing_user.default_transfer_account.blockchain_address,
+                blockchain_transaction_hash=tracked_hash,
+                transfer_amount=100,
+                contract_address=token.address,
+            ),
+            dict(
+                sender_blockchain_address=stranger_address,
+                recipient_blockchain_address=other_stranger_address,
+                blockchain_transaction_hash=untracked_hash,
+                transfer_amount=100,
+                contract_address=token.address,
+            ),
+        ])),
+        content_type='application/json', follow_redirects=True)
+
+    assert resp.status_code == 201
+    results = resp.json['data']['results']
+    assert [r['blockchain_transaction_hash'] for r in results] == [tracked_hash, untracked_hash]
+    assert all(r['ok'] for r in results)
+    assert results[1]['message'] == 'Only external users involved in this transfer'
+
+    transfer = CreditTransfer.query.execution_options(show_all=True).filter_by(blockchain_hash=tracked_hash).first()
+    assert transfer.recipient_transfer_account == existing_user.default_transfer_account
+    assert transfer.received_third_party_sync
+
 def test_force_third_party_transaction_sync():
     if will_func_test_blockchain():
         task_uuid = bt.force_third_party_transaction_sync()
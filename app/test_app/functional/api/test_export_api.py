@@ -1,4 +1,5 @@
 import pytest, json
+from server.utils.auth import get_complete_auth_token
 
 
 @pytest.mark.parametrize("email, status_code", [("test@acme.org", 201)])
@@ -14,3 +15,28 @@ def test_me_export_api(test_client, create_transfer_account_user, email, status_
 
     assert response.status_code == status_code
     assert response.json['file_url'] is not None
+
+
+@pytest.mark.parametrize("export_type, user_type, number_of_files", [
+    ('xlsx', 'all', 1),
+    ('csv', 'all', 2),
+    ('csv', 'beneficiary', 2),
+])
+def test_export_api(test_client, authed_sempo_admin_user, create_transfer_account_user, create_credit_transfer,
+                    export_type, user_type, number_of_files):
+    from server import red
+    from server.utils.executor import get_job_key
+
+    response = test_client.post('/api/v1/export/',
+                                headers=dict(Authorization=get_complete_auth_token(authed_sempo_admin_user),
+                                             Accept='application/json'),
+                                json=dict(export_type=export_type, user_type=user_type, include_transfers=True,
+                                          include_sent_and_received=True, include_custom_attributes=True),
+                                follow_redirects=True)
+    assert response.status_code == 200
+
+    status = json.loads(red.get(get_job_key(authed_sempo_admin_user.id, response.json['task_uuid'])))
+    assert status['message'] == 'Export file created.'
+    assert status['percent_complete'] == 100
+    # Test exports aren't uploaded, so there's a blank url for every file written
+    assert status['data']['file_urls'] == [''] * number_of_files
@@ -433,22 +433,29 @@ def test_clear_metrics_cache(test_client, complete_admin_auth_token, authed_semp
         )
     
     # Do a non-test clear metrics to flush the cache
-    clear_metrics()
+    version = clear_metrics().json['data']['cache_version']
 
-    # Create 4 fake metrics
-    red.set('2_metrics_fake_metric1', '123')
-    red.set('2_metrics_fake_metric2', '123')
-    red.set('2_metrics_fake_metric3', '123')
-    red.set('2_metrics_fake_metric4', '123')
+    # Create 4 fake metrics in the current version of the cache
+    for i in range(1, 5):
+        red.hset(f'2_metrics_v{version}_None', f'fake_metric{i}', '123')
 
     # Clear them for reals now
     response = clear_metrics()
 
-    # Make sure that 4 metrics are removed from the cache
-    assert response.json['data']['removed_entries'] == 44
-    
+    # Make sure that the cache moved on to a new version
+    assert response.json['data']['cache_version'] == version + 1
+
     # And check that they're well and truly gone from the cache!
-    assert not red.get('2_metrics_fake_metric1') 
-    assert not red.get('2_metrics_fake_metric2') 
-    assert not red.get('2_metrics_fake_metric3') 
-    assert not red.get('2_metrics_fake_metric4') 
+    for i in range(1, 5):
+        assert not red.hget(f'2_metrics_v{version + 1}_None', f'fake_metric{i}')
+
+    # The rebuild after clearing missed the cache, and counted it
+    response = test_client.get(
+        f'/api/v1/metrics/cache_stats/',
+        headers=dict(
+            Authorization=get_complete_auth_token(authed_sempo_admin_user),
+            Accept='application/json'
+        ),
+    )
+    assert response.status_code == 200
+    assert response.json['data']['cache_stats']['total_distributed_primary']['misses'] >= 1
@@ -15,6 +15,7 @@ def test_prep_search_api(test_client, complete_admin_auth_token, create_organisa
         CREATE INDEX trgm_public_serial_number ON "user" USING gist (_public_serial_number gist_trgm_ops);
         CREATE INDEX trgm_primary_blockchain_address ON "user" USING gist (primary_blockchain_address gist_trgm_ops);
         CREATE INDEX trgm_location ON "user" USING gist (_location gist_trgm_ops);
+        CREATE INDEX trgm_search_document ON "user" USING gin (search_document gin_trgm_ops);
     ''')
 
     # Adds users we're searching for
@@ -92,6 +92,10 @@ class MockBlockchainTasker(object):
     def make_token_transfer(*args, **kwargs):
         return MockBlockchainTasker._generic_task()
 
+    @staticmethod
+    def make_token_transfers(transfers, *args, **kwargs):
+        return [MockBlockchainTasker._generic_task() for _ in transfers]
+
     @staticmethod
     def make_approval(*args, **kwargs):
         return MockBlockchainTasker._generic_task()
@@ -1,7 +1,7 @@
 import pytest
 from uuid import uuid4
 from flask import g
-from server.utils.transfer_enums import TransferStatusEnum
+from server.utils.transfer_enums import TransferStatusEnum, BlockchainStatus
 
 
 from helpers.model_factories import TransferAccountFactory, CreditTransferFactory, TokenFactory, OrganisationFactory
@@ -180,3 +180,29 @@ def test_prior_task_requirements(test_client, init_database):
 
 
 
+
+    # The frontier moves forward as sends complete, and never back
+    assert ta1._last_completed_send_id == send5.id
+    ta1.record_completed_send(send1.id)
+    assert ta1._last_completed_send_id == send5.id
+
+    # Receives confirmed on chain drop out of the priors
+    send7 = CreditTransferFactory(
+        amount=1000,
+        sender_transfer_account=ta1,
+        recipient_transfer_account=ta2,
+        require_sufficient_balance=False
+    )
+    receive3 = CreditTransferFactory(
+        amount=1000,
+        sender_transfer_account=ta3,
+        recipient_transfer_account=ta1,
+        require_sufficient_balance=False
+    )
+    receive3.transfer_status = TransferStatusEnum.COMPLETE
+    send6.transfer_status = TransferStatusEnum.COMPLETE
+
+    assert send7._get_required_prior_tasks() == {send6, receive3}
+
+    receive3.blockchain_status = BlockchainStatus.SUCCESS
+    assert send7._get_required_prior_tasks() == {send6}
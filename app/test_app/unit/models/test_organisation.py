@@ -1,3 +1,39 @@
+from flask import g
 
+from server import db
+from server.models.utils import has_many_orgs, org_filter_stats
 
 
+def test_org_topology_cache(test_client, init_database, create_organisation, external_reserve_token):
+    """
+    GIVEN the filter_by_org topology cache
+    WHEN organisations are queried repeatedly, and a new organisation is created
+    THEN check that organisations are only counted again after the topology changes
+    """
+    from server.models.organisation import Organisation
+
+    g.pop('has_many_orgs', None)
+    assert has_many_orgs() is True
+
+    queries_before = org_filter_stats['org_count_queries']
+    Organisation.query.all()
+    Organisation.query.all()
+    assert org_filter_stats['org_count_queries'] == queries_before
+
+    organisation = Organisation(name='Topology Org', token=external_reserve_token, country_code='AU')
+    db.session.add(organisation)
+    db.session.commit()
+
+    assert g.get('has_many_orgs') is None
+    assert has_many_orgs() is True
+    assert org_filter_stats['org_count_queries'] > queries_before
+
+    # Organisations counted between a new organisation being flushed and committed are counted again after commit
+    db.session.add(Organisation(name='Topology Org 2', token=external_reserve_token, country_code='AU'))
+    db.session.flush()
+    has_many_orgs()
+    queries_before = org_filter_stats['org_count_queries']
+    db.session.commit()
+    assert g.get('has_many_orgs') is None
+    has_many_orgs()
+    assert org_filter_stats['org_count_queries'] > queries_before
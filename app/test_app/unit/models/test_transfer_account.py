@@ -174,3 +174,78 @@ def test_total_received_amounts(new_credit_transfer):
     assert ta.total_received_incl_pending_wei == 10000000000000000000
     assert ta.total_received_complete_only_wei == 10000000000000000000
 
+
+def test_reconcile_transfer_account_ledgers(new_credit_transfer):
+    """
+    GIVEN a Transfer Account whose running totals have drifted from its credit transfers
+    WHEN the ledgers are reconciled
+    THEN check the drift is reported, and corrected when fix is set
+    """
+    from server.utils.transfer_account import reconcile_transfer_account_ledgers
+
+    sta = new_credit_transfer.sender_transfer_account
+    assert sta.id not in [d['transfer_account_id'] for d in reconcile_transfer_account_ledgers()]
+
+    sta._total_sent_pending_wei = 0
+    drift = [d for d in reconcile_transfer_account_ledgers(fix=True) if d['transfer_account_id'] == sta.id]
+    assert len(drift) == 1
+    assert drift[0]['expected']['sent_pending_wei'] == 10000000000000000000
+
+    assert sta.total_sent_incl_pending_wei == 10000000000000000000
+    assert sta.id not in [d['transfer_account_id'] for d in reconcile_transfer_account_ledgers()]
+
+
+def test_deferred_ledger_writes(test_client, init_database):
+    """
+    GIVEN Transfer Accounts already in the database
+    WHEN transfers between them are completed inside (nested) deferred_ledger_writes blocks
+    THEN check their balances are kept up to date in memory, and only written to the database when the block exits
+    """
+    from server.utils.transfer_account import deferred_ledger_writes, reconcile_transfer_account_ledgers
+    from server.utils.transfer_enums import TransferStatusEnum, TransferTypeEnum, TransferSubTypeEnum
+    from helpers.model_factories import TransferAccountFactory, CreditTransferFactory, TokenFactory, \
+        OrganisationFactory
+
+    token = TokenFactory(name='DeferBucks', symbol='DB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    sender = TransferAccountFactory(token=token, organisation=organisation)
+    recipient = TransferAccountFactory(token=token, organisation=organisation)
+    sender.set_balance_offset(1000)
+    sender.update_balance()
+    init_database.session.commit()
+
+    def stored_total_sent(account):
+        return init_database.session.execute(
+            'SELECT coalesce(_total_sent_complete_wei, 0) FROM transfer_account WHERE id = :id', {'id': account.id}
+        ).scalar()
+
+    transfers = []
+    with deferred_ledger_writes():
+        # A nested block leaves its writes to the outer one, rather than writing or dropping them when it exits
+        with deferred_ledger_writes():
+            for amount in [100, 200, 300]:
+                transfer = CreditTransferFactory(
+                    amount=amount,
+                    sender_transfer_account=sender,
+                    recipient_transfer_account=recipient,
+                    transfer_type=TransferTypeEnum.PAYMENT,
+                    transfer_subtype=TransferSubTypeEnum.STANDARD,
+                    require_sufficient_balance=False
+                )
+                transfer.transfer_status = TransferStatusEnum.COMPLETE
+                transfers.append(transfer)
+
+        assert sender.balance == 400
+        assert recipient.balance == 600
+        init_database.session.flush()
+        assert stored_total_sent(sender) == 0
+
+    assert stored_total_sent(sender) == 600 * int(1e16)
+    init_database.session.commit()
+
+    assert sender.balance == 400
+    assert recipient.balance == 600
+    assert sender._last_completed_send_id == max(t.id for t in transfers)
+    drifted_ids = [d['transfer_account_id'] for d in reconcile_transfer_account_ledgers()]
+    assert sender.id not in drifted_ids and recipient.id not in drifted_ids
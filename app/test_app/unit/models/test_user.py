@@ -156,3 +156,24 @@ def test_delete_user_and_transfer_account(create_transfer_account_user):
 
     with pytest.raises(ResourceAlreadyDeletedError):
         create_transfer_account_user.delete_user_and_transfer_account()
+
+
+def test_search_document(create_transfer_account_user_function):
+    """
+    GIVEN a User Model
+    WHEN the attributes search matches on are changed
+    THEN check that the search document is rebuilt from them when the user is flushed
+    """
+    from server import db
+    user = create_transfer_account_user_function
+    user.first_name = 'Searchy'
+    user.location = 'Wollongong'
+    db.session.flush()
+
+    assert 'Searchy' in user.search_document
+    assert 'Wollongong' in user.search_document
+    assert user.phone in user.search_document
+
+    user.location = None
+    db.session.flush()
+    assert 'Wollongong' not in user.search_document
@@ -69,3 +69,75 @@ def test_rate_limited_login(test_client, init_database):
             assert result[1] == {'message': 'Please try again in 59 minutes', 'status': 'fail'}
     current_app.config['IS_TEST'] = True
     flush_ratelimit_counter()
+
+def test_auth_context_cache(test_client, init_database, authed_sempo_admin_user):
+    """
+    GIVEN a user's cached auth context
+    WHEN the user's organisations change
+    THEN check that the context is rebuilt, and that pending last seen timestamps are written in one flush
+    """
+    from server.models.ip_address import IpAddress
+    from server.utils.auth_context import load_auth_context, store_auth_context, flush_last_seen, \
+        LAST_SEEN_PENDING_KEY, IP_LAST_SEEN_PENDING_KEY
+    from helpers.model_factories import OrganisationFactory
+
+    user = authed_sempo_admin_user
+    init_database.session.commit()
+    auth_token = user.encode_auth_token().decode()
+
+    context = load_auth_context(user, auth_token)
+    assert context['member_organisations'] == [org.id for org in user.organisations]
+    context['known_ips'].append('1.2.3.4')
+    store_auth_context(user.id, auth_token, context)
+    assert load_auth_context(user, auth_token)['known_ips'] == ['1.2.3.4']
+
+    organisation = OrganisationFactory(country_code='AU')
+    user.organisations.append(organisation)
+    init_database.session.commit()
+    context = load_auth_context(user, auth_token)
+    assert organisation.id in context['member_organisations']
+    assert context['known_ips'] == []
+    user.organisations.remove(organisation)
+    init_database.session.commit()
+
+    known_ip = IpAddress(ip='5.6.7.8')
+    known_ip.user = user
+    init_database.session.add(known_ip)
+    init_database.session.commit()
+
+    red.hset(LAST_SEEN_PENDING_KEY, user.id, 0)
+    red.hset(IP_LAST_SEEN_PENDING_KEY, f'{user.id}|5.6.7.8', 0)
+    # Seen by a request that never committed, so never saved
+    red.hset(IP_LAST_SEEN_PENDING_KEY, f'{user.id}|9.9.9.9', 0)
+    flush_last_seen.submit()
+    init_database.session.expire_all()
+    assert user._last_seen == datetime.datetime.utcfromtimestamp(0)
+    assert IpAddress.check_user_ips(user, '5.6.7.8').updated == datetime.datetime.utcfromtimestamp(0)
+    assert IpAddress.check_user_ips(user, '9.9.9.9') is None
+    assert not red.exists(LAST_SEEN_PENDING_KEY, IP_LAST_SEEN_PENDING_KEY)
+
+
+def test_saved_ip_cached_as_known(mocker, test_client, init_database, authed_sempo_admin_user):
+    """
+    GIVEN a user whose IP address is already saved
+    WHEN they make several requests from it
+    THEN check that the IP address is only looked up in the database once
+    """
+    from server.models.ip_address import IpAddress
+
+    user = authed_sempo_admin_user
+    address = IpAddress(ip='127.0.0.1')
+    address.user = user
+    init_database.session.add(address)
+    init_database.session.commit()
+
+    check_user_ips = mocker.spy(IpAddress, 'check_user_ips')
+    auth_token = get_complete_auth_token(user)
+    for _ in range(3):
+        response = test_client.get(
+            '/api/v1/organisation/',
+            headers=dict(Authorization=auth_token, Accept='application/json'),
+            environ_base={'REMOTE_ADDR': '127.0.0.1'}
+        )
+        assert response.status_code == 200
+    assert check_user_ips.call_count == 1
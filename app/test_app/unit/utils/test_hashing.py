@@ -0,0 +1,102 @@
+import json
+import os
+
+import pytest
+
+import config
+
+
+@pytest.fixture(scope='function')
+def hashing_pool(request, monkeypatch):
+    from server.utils import hashing
+
+    monkeypatch.setattr(config, 'HASHING_POOL_SIZE', 1)
+
+    def shutdown_pool():
+        executor = hashing._pool['executor']
+        if executor:
+            hashing._reset_pool(executor)
+            executor.shutdown(wait=True)
+    request.addfinalizer(shutdown_pool)
+
+
+def test_rehash_on_verify(test_client, init_database, create_transfer_account_user, monkeypatch, mocker):
+    """
+    GIVEN a PIN hashed with a lower work factor than the current policy's
+    WHEN the user enters their PIN
+    THEN check that the PIN is rehashed with the current work factor, and that wrong PINs are still rejected
+    """
+    from server.utils import hashing
+
+    user = create_transfer_account_user
+    policy = hashing.work_factor_policy
+    # Calibrate first, so the patched cost is put back to the calibrated one rather than to None
+    policy.rounds
+
+    with monkeypatch.context() as m:
+        m.setattr(policy, '_rounds', 4)
+        user.hash_pin('1234')
+    old_hash = user.pin_hash
+    assert hashing.needs_rehash(old_hash)
+
+    assert not user.verify_pin('0000')
+    assert user.pin_hash == old_hash
+    assert user.verify_pin('1234')
+    assert user.pin_hash != old_hash
+    assert not hashing.needs_rehash(user.pin_hash)
+
+    # Successful checks are remembered, failed ones aren't
+    run = mocker.spy(hashing, '_run')
+    assert user.verify_pin('1234')
+    assert not user.verify_pin('0000')
+    assert run.call_count == 1
+
+
+def test_hashing_pool(test_client, hashing_pool):
+    """
+    GIVEN a hashing process pool
+    WHEN secrets are hashed and checked
+    THEN check that they're hashed on this process's pool
+    """
+    from server.utils import hashing
+
+    hashed = hashing.hash_secret('hunter2')
+    assert hashing.check_secret('hunter2', hashed)
+    assert not hashing.check_secret('hunter3', hashed)
+
+    assert hashing._pool['pid'] == os.getpid()
+    assert hashing._pool['executor'] is not None
+
+
+def test_hashing_pool_busy(test_client, init_database, create_transfer_account_user, hashing_pool, monkeypatch):
+    """
+    GIVEN a hashing process pool with no free queue slots
+    WHEN a user logs in with their PIN
+    THEN check that the login is turned away with a 503 rather than hashed on the request thread,
+    and that it succeeds once the pool has room again
+    """
+    from server.utils import hashing
+
+    user = create_transfer_account_user
+    user.is_activated = True
+    user.hash_pin('1234')
+    monkeypatch.setattr(config, 'HASHING_QUEUE_TIMEOUT_SECONDS', 0)
+
+    _, slots = hashing._get_pool()
+    held = 0
+    while slots.acquire(blocking=False):
+        held += 1
+
+    def login():
+        return test_client.post('/api/v1/auth/request_api_token/',
+                                data=json.dumps(dict(phone=user.phone, pin='1234')),
+                                content_type='application/json', follow_redirects=True)
+
+    response = login()
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+    for _ in range(held):
+        slots.release()
+    response = login()
+    assert response.status_code == 200
@@ -0,0 +1,174 @@
+import datetime
+
+from flask import g
+from sqlalchemy import func
+
+from server.utils.transfer_enums import TransferStatusEnum, TransferTypeEnum, TransferSubTypeEnum
+
+from helpers.model_factories import TransferAccountFactory, CreditTransferFactory, TokenFactory, OrganisationFactory
+
+
+def test_partial_history_cache_picks_up_resolved_transfers(test_client, init_database):
+    """
+    GIVEN a cached metric over complete transfers
+    WHEN cached pending transfers are resolved, and new transfers are made
+    THEN check that the cached metric reflects them without clearing the cache
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.utils.metrics import metrics_cache
+
+    token = TokenFactory(name='CacheBucks', symbol='CB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    metrics_cache.clear_metrics_cache()
+    ta1 = TransferAccountFactory(token=token, organisation=organisation)
+    ta2 = TransferAccountFactory(token=token, organisation=organisation)
+
+    def make_transfer(amount):
+        return CreditTransferFactory(
+            amount=amount,
+            sender_transfer_account=ta1,
+            recipient_transfer_account=ta2,
+            transfer_type=TransferTypeEnum.PAYMENT,
+            transfer_subtype=TransferSubTypeEnum.STANDARD,
+            require_sufficient_balance=False
+        )
+
+    complete = make_transfer(100)
+    complete.transfer_status = TransferStatusEnum.COMPLETE
+    pending = make_transfer(10)
+    rejected_later = make_transfer(1)
+    init_database.session.commit()
+
+    query = init_database.session.query(func.sum(CreditTransfer.transfer_amount).label('total'))\
+        .filter(CreditTransfer.transfer_status == TransferStatusEnum.COMPLETE)
+
+    def cached_total():
+        return metrics_cache.execute_with_partial_history_cache(
+            'test_complete_volume', query, CreditTransfer, metrics_cache.SUM
+        )
+
+    def cached_state():
+        with metrics_cache.metrics_cache_batch() as batch:
+            return batch.get(None, 'test_complete_volume')
+
+    assert cached_total() == 100
+    state = cached_state()
+    assert state['result'] == 100
+    assert state['unsettled_ids'] == sorted([pending.id, rejected_later.id])
+
+    pending.transfer_status = TransferStatusEnum.COMPLETE
+    rejected_later.transfer_status = TransferStatusEnum.REJECTED
+    init_database.session.commit()
+    assert cached_total() == 110
+
+    # New transfers are picked up from the id watermark
+    new = make_transfer(1000)
+    new.transfer_status = TransferStatusEnum.COMPLETE
+    init_database.session.commit()
+    assert cached_total() == 1110
+
+    state = cached_state()
+    assert state['unsettled_ids'] == []
+    assert state['max_id'] == new.id
+
+
+def test_partial_history_cache_ages_out_unsettled_transfers(test_client, init_database):
+    """
+    GIVEN cached metrics over transfers which stay pending
+    WHEN they've been pending for longer than UNSETTLED_MAX_AGE_DAYS
+    THEN check that they're folded into the cache rather than being held back forever
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.utils.metrics import metrics_cache
+
+    token = TokenFactory(name='AgeBucks', symbol='AB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    metrics_cache.clear_metrics_cache()
+    ta1 = TransferAccountFactory(token=token, organisation=organisation)
+    ta2 = TransferAccountFactory(token=token, organisation=organisation)
+
+    def make_pending_transfer(amount, age_days=0):
+        transfer = CreditTransferFactory(
+            amount=amount,
+            sender_transfer_account=ta1,
+            recipient_transfer_account=ta2,
+            transfer_type=TransferTypeEnum.PAYMENT,
+            transfer_subtype=TransferSubTypeEnum.STANDARD,
+            require_sufficient_balance=False
+        )
+        transfer.created = datetime.datetime.utcnow() - datetime.timedelta(days=age_days)
+        return transfer
+
+    long_lived = make_pending_transfer(10, age_days=metrics_cache.UNSETTLED_MAX_AGE_DAYS + 1)
+    recent = make_pending_transfer(20)
+    init_database.session.commit()
+
+    query = init_database.session.query(func.sum(CreditTransfer.transfer_amount).label('total'))
+
+    def cached_total():
+        return metrics_cache.execute_with_partial_history_cache(
+            'test_pending_volume', query, CreditTransfer, metrics_cache.SUM
+        )
+
+    def cached_state():
+        with metrics_cache.metrics_cache_batch() as batch:
+            return batch.get(None, 'test_pending_volume')
+
+    # A transfer that's already been pending for too long is folded straight in
+    assert cached_total() == 30
+    state = cached_state()
+    assert state['result'] == 10
+    assert state['unsettled_ids'] == [recent.id]
+
+    # And one that's been held back is folded in once it's been pending for too long
+    recent.created = datetime.datetime.utcnow() - datetime.timedelta(days=metrics_cache.UNSETTLED_MAX_AGE_DAYS + 1)
+    init_database.session.commit()
+    assert cached_total() == 30
+    state = cached_state()
+    assert state['result'] == 30
+    assert state['unsettled_ids'] == []
+
+
+def test_metrics_cache_batching_and_versions(test_client, init_database):
+    """
+    GIVEN a batch of metrics cache reads and writes
+    WHEN it's flushed, and the cache is cleared afterwards
+    THEN check that writes are only sent on flush, and that clearing hides every entry without deleting keys
+    """
+    from server import red
+    from server.utils.metrics import metrics_cache
+
+    token = TokenFactory(name='BatchBucks', symbol='BB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    version = metrics_cache.clear_metrics_cache()
+    partition_key = f'{organisation.id}_metrics_v{version}_ungrouped'
+
+    big_result = [(i, 'group') for i in range(1000)]
+    with metrics_cache.metrics_cache_batch() as batch:
+        batch.prefetch('ungrouped', metrics_cache.FIRST_DAY_PARTITION)
+        assert batch.get('ungrouped', 'small') is None
+        batch.record('small', hit=False)
+        batch.set('ungrouped', 'small', {'result': 1})
+        batch.set('ungrouped', 'big', {'result': big_result})
+        # Nested batches share the outer one, so nothing is sent until it exits
+        with metrics_cache.metrics_cache_batch() as nested:
+            assert nested is batch
+            assert nested.get('ungrouped', 'small') == {'result': 1}
+        assert not red.exists(partition_key)
+
+    assert red.hget(partition_key, 'big')[:1] == b'z'
+    with metrics_cache.metrics_cache_batch() as batch:
+        assert batch.get('ungrouped', 'small') == {'result': 1}
+        assert batch.get('ungrouped', 'big') == {'result': big_result}
+        batch.record('small', hit=True)
+
+    assert metrics_cache.get_metrics_cache_stats()['small'] == {'hits': 1, 'misses': 1}
+
+    assert metrics_cache.clear_metrics_cache() == version + 1
+    with metrics_cache.metrics_cache_batch() as batch:
+        assert batch.get('ungrouped', 'small') is None
+    # The old version is left to expire
+    assert red.ttl(partition_key) > 0
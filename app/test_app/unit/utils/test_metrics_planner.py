@@ -0,0 +1,94 @@
+import datetime
+from flask import g
+from sqlalchemy import text
+
+from server.utils.transfer_enums import TransferStatusEnum, TransferTypeEnum, TransferSubTypeEnum, TransferModeEnum
+
+from helpers.model_factories import TransferAccountFactory, CreditTransferFactory, TokenFactory, OrganisationFactory
+
+
+def _sorted_timeseries(result):
+    # Neither the fused or the separate queries order their days, so compare timeseries day by day
+    if isinstance(result, dict) and 'timeseries' in result:
+        result['timeseries'] = {
+            group: sorted(days, key=lambda d: d['date']) for group, days in result['timeseries'].items()
+        }
+    return result
+
+
+def test_fused_metrics_queries(test_client, init_database):
+    """
+    GIVEN transfer and participant metrics which skip the cache
+    WHEN their queries are fused by the planner
+    THEN check that each metric gets the same result as it would from its own queries
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.models.user import User
+    from server.utils.metrics import metrics_const, planner
+    from server.utils.metrics.group import Groups
+    from server.utils.metrics.transfer_stats import TransferStats
+    from server.utils.metrics.participant_stats import ParticipantStats
+
+    token = TokenFactory(name='FusedBucks', symbol='FB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    ta1 = TransferAccountFactory(token=token, organisation=organisation)
+    ta2 = TransferAccountFactory(token=token, organisation=organisation)
+
+    for amount, transfer_type, transfer_subtype in [
+        (100, TransferTypeEnum.PAYMENT, TransferSubTypeEnum.STANDARD),
+        (20, TransferTypeEnum.PAYMENT, TransferSubTypeEnum.STANDARD),
+        (50, TransferTypeEnum.PAYMENT, TransferSubTypeEnum.DISBURSEMENT),
+        (5, TransferTypeEnum.PAYMENT, TransferSubTypeEnum.RECLAMATION),
+        (7, TransferTypeEnum.WITHDRAWAL, TransferSubTypeEnum.STANDARD),
+    ]:
+        transfer = CreditTransferFactory(
+            amount=amount,
+            sender_transfer_account=ta1,
+            recipient_transfer_account=ta2,
+            transfer_type=transfer_type,
+            transfer_subtype=transfer_subtype,
+            transfer_mode=TransferModeEnum.USSD,
+            require_sufficient_balance=False
+        )
+        transfer.transfer_status = TransferStatusEnum.COMPLETE
+    init_database.session.commit()
+
+    date_filter_attributes = {
+        CreditTransfer: CreditTransfer.created + text("interval '0 hours'"),
+        User: User.created + text("interval '0 hours'")
+    }
+    today = datetime.date.today()
+    query_kwargs = dict(
+        user_filters={},
+        date_filter_attributes=date_filter_attributes,
+        enable_caching=False,
+        start_date=(today - datetime.timedelta(days=5)).isoformat(),
+        end_date=today.isoformat(),
+    )
+    population = {metrics_const.UNGROUPED: [(2, datetime.datetime.combine(today, datetime.time()))]}
+
+    for group_by in [metrics_const.UNGROUPED, metrics_const.TRANSFER_MODE]:
+        group_strategy = Groups().GROUP_TYPES[group_by]
+        metrics = TransferStats(group_strategy, metrics_const.DAY, token, date_filter_attributes).metrics \
+            + ParticipantStats(group_strategy, metrics_const.DAY, date_filter_attributes).metrics
+
+        fused_queries = planner.plan_fused_queries([(m, False) for m in metrics], group_by=group_by, **query_kwargs)
+        # eg total_distributed, total_reclaimed and total_withdrawn are read in one statement
+        assert any(
+            {'total_distributed', 'total_reclaimed', 'total_withdrawn'} <= {m.metric.metric_name for m in fq.members}
+            for fq in fused_queries
+        )
+        fused_results = {}
+        for fused_query in fused_queries:
+            for metric, results in fused_query.execute().items():
+                fused_results.setdefault(metric, {}).update(results)
+
+        for metric in metrics:
+            def execute(**kwargs):
+                return _sorted_timeseries(metric.execute_query(
+                    population_query_result=population, group_by=group_by, **query_kwargs, **kwargs
+                ))
+
+            assert execute(fused_results=fused_results.get(metric)) == execute(), \
+                f'{metric.metric_name} grouped by {group_by}'
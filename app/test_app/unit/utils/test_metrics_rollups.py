@@ -0,0 +1,125 @@
+import datetime
+from flask import g
+from sqlalchemy import text
+
+from server.utils.transfer_enums import TransferStatusEnum, TransferTypeEnum, TransferSubTypeEnum, TransferModeEnum
+
+from helpers.model_factories import TransferAccountFactory, CreditTransferFactory, TokenFactory, OrganisationFactory
+
+
+def _sorted_timeseries(result):
+    # The raw queries don't order their days, so compare timeseries day by day
+    if isinstance(result, dict) and 'timeseries' in result:
+        result['timeseries'] = {
+            group: sorted(days, key=lambda d: d['date']) for group, days in result['timeseries'].items()
+        }
+    return result
+
+
+def test_metrics_rollups(test_client, init_database):
+    """
+    GIVEN an organisation with daily metrics rollups
+    WHEN transfers complete, move days, and metrics are read from the rollups instead of the raw queries
+    THEN check that the rollups are kept up to date, and give the same metrics as the raw queries
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.models.metrics_rollup import MetricsDailyRollup
+    from server.utils.metrics import metrics_const
+    from server.utils.metrics.group import Groups
+    from server.utils.metrics.rollups import rebuild_metrics_rollups, get_rollup_organisation
+    from server.utils.metrics.transfer_stats import TransferStats
+
+    token = TokenFactory(name='RollupBucks', symbol='RB')
+    organisation = OrganisationFactory(token=token, country_code='AU', timezone='Australia/Sydney')
+    g.active_organisation = organisation
+    ta1 = TransferAccountFactory(token=token, organisation=organisation)
+    ta2 = TransferAccountFactory(token=token, organisation=organisation)
+
+    def make_transfer(amount, transfer_subtype, transfer_mode=None, complete=True):
+        transfer = CreditTransferFactory(
+            amount=amount,
+            sender_transfer_account=ta1,
+            recipient_transfer_account=ta2,
+            transfer_type=TransferTypeEnum.PAYMENT,
+            transfer_subtype=transfer_subtype,
+            transfer_mode=transfer_mode,
+            require_sufficient_balance=False
+        )
+        if complete:
+            transfer.transfer_status = TransferStatusEnum.COMPLETE
+        return transfer
+
+    make_transfer(100, TransferSubTypeEnum.STANDARD, TransferModeEnum.USSD)
+    make_transfer(50, TransferSubTypeEnum.DISBURSEMENT)
+    pending = make_transfer(10, TransferSubTypeEnum.STANDARD, TransferModeEnum.USSD, complete=False)
+    init_database.session.commit()
+
+    rebuild_metrics_rollups(organisation)
+    init_database.session.commit()
+    assert organisation.metrics_rollup_offset_hours == 10
+
+    def ungrouped_standard_payments():
+        return MetricsDailyRollup.query.filter(
+            MetricsDailyRollup.organisation_id == organisation.id,
+            MetricsDailyRollup.dimension == metrics_const.UNGROUPED,
+            MetricsDailyRollup.transfer_subtype == TransferSubTypeEnum.STANDARD.value
+        ).all()
+
+    rows = ungrouped_standard_payments()
+    assert [(r.item_count, r.total_amount_wei) for r in rows] == [(1, 100 * int(1e16))]
+
+    # Completed transfers are added incrementally, and moved when their created date changes
+    pending.transfer_status = TransferStatusEnum.COMPLETE
+    init_database.session.commit()
+    init_database.session.expire_all()
+    rows = ungrouped_standard_payments()
+    assert [(r.item_count, r.total_amount_wei) for r in rows] == [(2, 110 * int(1e16))]
+
+    pending.created = pending.created - datetime.timedelta(days=3)
+    init_database.session.commit()
+    init_database.session.expire_all()
+    rows = sorted(ungrouped_standard_payments(), key=lambda r: r.day)
+    assert [(r.item_count, r.total_amount_wei) for r in rows] == [(1, 10 * int(1e16)), (1, 100 * int(1e16))]
+
+    time_offset = organisation.metrics_rollup_offset_hours
+    date_filter_attributes = {
+        CreditTransfer: CreditTransfer.created + text(f"interval '{time_offset} hours'")
+    }
+    today = (datetime.datetime.utcnow() + datetime.timedelta(hours=time_offset)).date()
+    start_date = (today - datetime.timedelta(days=5)).isoformat()
+    end_date = today.isoformat()
+    assert get_rollup_organisation(CreditTransfer, metrics_const.TRANSFER_MODE) == organisation
+    assert get_rollup_organisation(CreditTransfer, metrics_const.SENDER_LOCATION) is None
+    # Usages, account types and custom attributes can change after a transfer completes, so aren't rolled up
+    for group_by in [metrics_const.TRANSFER_USAGE, metrics_const.SENDER_ACCOUNT_TYPE, 'colour,sender']:
+        assert get_rollup_organisation(CreditTransfer, group_by) is None
+    # The organisation is only looked up once per request
+    assert g.rollup_organisations == {organisation.id: organisation}
+
+    population = {metrics_const.UNGROUPED: [(2, datetime.datetime.combine(today, datetime.time()))]}
+
+    for group_by in [metrics_const.UNGROUPED, metrics_const.TRANSFER_MODE, metrics_const.TRANSFER_TYPE]:
+        for timeseries_unit in [metrics_const.DAY, metrics_const.WEEK]:
+            group_strategy = Groups().GROUP_TYPES[group_by]
+            metrics = TransferStats(group_strategy, timeseries_unit, token, date_filter_attributes).metrics
+            for metric in metrics:
+                if not metric.rollup_value:
+                    continue
+
+                def execute():
+                    return _sorted_timeseries(metric.execute_query(
+                        user_filters={},
+                        date_filter_attributes=date_filter_attributes,
+                        enable_caching=False,
+                        population_query_result=population,
+                        start_date=start_date,
+                        end_date=end_date,
+                        group_by=group_by
+                    ))
+
+                from_rollups = execute()
+                organisation.metrics_rollup_offset_hours = None
+                from_raw_queries = execute()
+                organisation.metrics_rollup_offset_hours = time_offset
+
+                assert from_rollups == from_raw_queries, f'{metric.metric_name} grouped by {group_by}'
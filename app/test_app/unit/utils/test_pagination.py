@@ -0,0 +1,118 @@
+import datetime
+import pytest
+from flask import g
+
+from server.utils.transfer_enums import TransferTypeEnum, TransferSubTypeEnum
+
+from helpers.model_factories import TransferAccountFactory, CreditTransferFactory, TokenFactory, OrganisationFactory
+
+
+def test_keyset_pagination(test_client, init_database):
+    """
+    GIVEN transfers, some of which were created at the same time
+    WHEN they're paginated with keyset cursors
+    THEN check that every transfer is returned exactly once, in order, without counting them
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.models.utils import paginate_query
+    from server.exceptions import PaginationCursorError
+
+    token = TokenFactory(name='PageBucks', symbol='PB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    ta1 = TransferAccountFactory(token=token, organisation=organisation)
+    ta2 = TransferAccountFactory(token=token, organisation=organisation)
+
+    created = datetime.datetime(2020, 1, 1)
+    transfers = []
+    for i in range(5):
+        transfer = CreditTransferFactory(
+            amount=i + 1,
+            sender_transfer_account=ta1,
+            recipient_transfer_account=ta2,
+            transfer_type=TransferTypeEnum.PAYMENT,
+            transfer_subtype=TransferSubTypeEnum.STANDARD,
+            require_sufficient_balance=False
+        )
+        # Pairs of transfers share a created time, so the cursor has to break ties by id
+        transfer.created = created + datetime.timedelta(days=i // 2)
+        transfers.append(transfer)
+    init_database.session.commit()
+
+    query = CreditTransfer.query.filter(CreditTransfer.sender_transfer_account_id == ta1.id)
+    expected_ids = [t.id for t in sorted(transfers, key=lambda t: (t.created, t.id), reverse=True)]
+
+    def fetch(args):
+        with test_client.application.test_request_context(f'/?pagination=keyset&per_page=2{args}'):
+            return paginate_query(query, CreditTransfer.created)
+
+    fetched_ids = []
+    cursor = None
+    while True:
+        items, total_items, total_pages, cursor = fetch(f'&total=exact&last_fetched={cursor}' if cursor else '&total=none')
+        if not items:
+            break
+        assert len(items) <= 2
+        if fetched_ids:
+            assert total_items == 5 and total_pages == 3
+        else:
+            assert total_items is None and total_pages is None
+        fetched_ids.extend(item.id for item in items)
+
+    assert fetched_ids == expected_ids
+    assert cursor is None
+
+    # The estimate comes from the planner's statistics, so only check it's usable as a page count
+    _, total_items, total_pages, _ = fetch('')
+    assert total_items >= 0 and total_pages >= 1
+
+    with pytest.raises(PaginationCursorError):
+        fetch('&last_fetched=notacursor')
+
+
+@pytest.mark.parametrize("sort_desc", [True, False])
+def test_keyset_pagination_null_sort_values(test_client, init_database, sort_desc):
+    """
+    GIVEN transfers, some of which have no value for the sort attribute
+    WHEN they're paginated with keyset cursors in either direction
+    THEN check that the ones without a value come last, and that none are dropped
+    """
+    from server.models.credit_transfer import CreditTransfer
+    from server.models.utils import paginate_query
+
+    token = TokenFactory(name='NullBucks', symbol='NB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    ta1 = TransferAccountFactory(token=token, organisation=organisation)
+    ta2 = TransferAccountFactory(token=token, organisation=organisation)
+
+    transfers = []
+    for i in range(5):
+        transfer = CreditTransferFactory(
+            amount=i + 1,
+            sender_transfer_account=ta1,
+            recipient_transfer_account=ta2,
+            transfer_type=TransferTypeEnum.PAYMENT,
+            transfer_subtype=TransferSubTypeEnum.STANDARD,
+            require_sufficient_balance=False
+        )
+        transfer.resolved_date = datetime.datetime(2020, 1, 1 + i) if i % 2 else None
+        transfers.append(transfer)
+    init_database.session.commit()
+
+    query = CreditTransfer.query.filter(CreditTransfer.sender_transfer_account_id == ta1.id)
+    resolved = sorted([t for t in transfers if t.resolved_date], key=lambda t: (t.resolved_date, t.id), reverse=sort_desc)
+    unresolved = sorted([t for t in transfers if not t.resolved_date], key=lambda t: t.id, reverse=sort_desc)
+    expected_ids = [t.id for t in resolved + unresolved]
+
+    fetched_ids = []
+    cursor = None
+    while True:
+        args = f'/?pagination=keyset&per_page=2&total=none' + (f'&last_fetched={cursor}' if cursor else '')
+        with test_client.application.test_request_context(args):
+            items, _, _, cursor = paginate_query(query, CreditTransfer.resolved_date, sort_desc=sort_desc)
+        if not items:
+            break
+        fetched_ids.extend(item.id for item in items)
+
+    assert fetched_ids == expected_ids
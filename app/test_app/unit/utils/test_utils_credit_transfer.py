@@ -98,3 +98,41 @@ def test_check_recent_transaction_sync_status(new_credit_transfer):
     new_credit_transfer.received_third_party_sync = False
     db.session.commit()
     assert CreditTransferUtils._check_recent_transaction_sync_status(interval_time, time_to_error) == []
+
+
+def test_ingest_third_party_transfers(test_client, init_database, create_transfer_account_user):
+    """
+    GIVEN a batch of third party transfers, including a repeated hash and a transfer between strangers
+    WHEN the batch is ingested
+    THEN check one credit transfer is created per tracked hash, and untracked transfers are skipped
+    """
+    from flask import g
+    g.pending_transactions = []
+
+    transfer_account = create_transfer_account_user.default_transfer_account
+    token = transfer_account.token
+    received_before = transfer_account._total_received_complete_wei or 0
+    stranger_address = '0xA9450d3dB5A909b08197BC4a0665A4d632537777'
+    tracked_hash = '0x5555beef2322d396649ed2fa2b7e0a944474b65cfab2c4b1435c81bb16697ecb'
+
+    def transfer(sender, recipient, blockchain_hash):
+        return dict(sender_blockchain_address=sender, recipient_blockchain_address=recipient,
+                    blockchain_transaction_hash=blockchain_hash, transfer_amount=100, contract_address=token.address)
+
+    results = CreditTransferUtils.ingest_third_party_transfers([
+        transfer(stranger_address, transfer_account.blockchain_address, tracked_hash),
+        transfer(stranger_address, transfer_account.blockchain_address, tracked_hash),
+        transfer(stranger_address, '0xA9450d3dB5A909b08197BC4a0665A4d632536666', '0x6666'),
+    ])
+
+    assert results[0]['credit_transfer'] is not None
+    assert results[0]['credit_transfer'] is results[1]['credit_transfer']
+    assert results[0]['credit_transfer'].recipient_transfer_account == transfer_account
+    assert results[0]['credit_transfer'].sender_transfer_account.blockchain_address == stranger_address
+    assert results[2]['credit_transfer'] is None
+    assert results[2]['message'] == 'Only external users involved in this transfer'
+
+    # The batch's changes to the account's totals were written once the batch was done
+    init_database.session.refresh(transfer_account)
+    assert transfer_account._total_received_complete_wei == \
+        received_before + results[0]['credit_transfer']._transfer_amount_wei
@@ -93,6 +93,70 @@ def test_transfer_usages_for_user(authed_sempo_admin_user):
     assert isinstance(usages, list)
 
 
+def test_transfer_usage_ranking(mocker, test_client, init_database):
+    """
+    GIVEN prioritised, used and unused transfer usages
+    WHEN transfer_usages_for_user is called, before and after the usages change and the user completes a transfer
+    or edits a completed one
+    THEN check usages are ranked prioritised, then used, then everything else, and the ranking is only worked out
+    again when something it depends on changes
+    """
+    from flask import g
+    from server import db
+    from server.models.user import User
+    from server.models.transfer_usage import TransferUsage
+    from server.utils.transfer_enums import TransferTypeEnum, TransferSubTypeEnum, TransferStatusEnum
+    from helpers.model_factories import CreditTransferFactory
+
+    prioritised = TransferUsage.find_or_create('Ranking Prioritised', priority=1)
+    used = TransferUsage.find_or_create('Ranking Used')
+    unused = TransferUsage.find_or_create('Ranking Unused')
+    token = TokenFactory(name='RankBucks', symbol='RB')
+    organisation = OrganisationFactory(token=token, country_code='AU')
+    g.active_organisation = organisation
+    user = UserFactory(phone=fake.msisdn())
+    transfer = CreditTransferFactory(
+        amount=1,
+        sender_user=user,
+        sender_transfer_account=TransferAccountFactory(token=token, organisation=organisation),
+        recipient_transfer_account=TransferAccountFactory(token=token, organisation=organisation),
+        transfer_type=TransferTypeEnum.PAYMENT,
+        transfer_subtype=TransferSubTypeEnum.STANDARD,
+        require_sufficient_balance=False
+    )
+    db.session.commit()
+
+    get_most_relevant_transfer_usages = mocker.patch.object(
+        User, 'get_most_relevant_transfer_usages', return_value={'Ranking Used': 2}
+    )
+
+    def ranked_ids():
+        ids = [usage.id for usage in transfer_usages_for_user(user)]
+        return [ids.index(usage.id) for usage in [prioritised, used, unused]]
+
+    prioritised_rank, used_rank, unused_rank = ranked_ids()
+    assert prioritised_rank < used_rank < unused_rank
+    ranked_ids()
+    assert get_most_relevant_transfer_usages.call_count == 1
+
+    unused.priority = 2
+    db.session.commit()
+    prioritised_rank, used_rank, unused_rank = ranked_ids()
+    assert prioritised_rank < unused_rank < used_rank
+    assert get_most_relevant_transfer_usages.call_count == 2
+
+    transfer.transfer_status = TransferStatusEnum.COMPLETE
+    db.session.commit()
+    ranked_ids()
+    assert get_most_relevant_transfer_usages.call_count == 3
+
+    # Editing the usages of a completed transfer changes the ranking too
+    transfer.transfer_use = ['Ranking Unused']
+    db.session.commit()
+    ranked_ids()
+    assert get_most_relevant_transfer_usages.call_count == 4
+
+
 def test_admin_reset_user_pin(mocker, test_client, init_database, create_transfer_account_user, mock_sms_apis):
     user = create_transfer_account_user
     admin_reset_user_pin(user)
@@ -66,3 +66,33 @@ def test_custom_display_text(test_client, init_database, menu_name, language, ex
             assert expected in resulting_menu
         if unexpected is not None:
             assert unexpected not in resulting_menu
+
+
+def test_usage_menu_pages(test_client, init_database):
+    """
+    GIVEN more transfer usages than fit on one menu page
+    WHEN the usage menu and then each of its later pages are shown
+    THEN check every page is worked out when the menu is first shown, and later pages show what was worked out
+    """
+    from server.utils.ussd.ussd_state_machine import USSD_MAX_LENGTH
+
+    with db.session.no_autoflush:
+        session = UssdSessionFactory(state="directory_listing")
+        mapping = fake_transfer_mapping(30)
+        session.user = standard_user()
+        session.session_data = {'transfer_usage_mapping': mapping, 'usage_menu': 0}
+
+        menu = UssdMenu(name='directory_listing', display_key='ussd.sempo.directory_listing')
+        first_page = UssdProcessor.custom_display_text(menu, session)
+        usage_stack = session.get_data('usage_index_stack')
+        assert len(usage_stack) > 2
+        assert first_page.count('Food') == usage_stack[1]
+
+        other_menu = UssdMenu(name='directory_listing_other', display_key='ussd.sempo.directory_listing_other')
+        for page in range(1, len(usage_stack)):
+            session.set_data('usage_menu', page)
+            page_text = UssdProcessor.custom_display_text(other_menu, session)
+            end_of_page = usage_stack[page + 1] if page + 1 < len(usage_stack) else len(mapping)
+            assert page_text.count('Food') == end_of_page - usage_stack[page]
+            assert len(page_text) <= USSD_MAX_LENGTH
+            assert session.get_data('usage_index_stack') == usage_stack
@@ -116,3 +116,44 @@ def test_send_directory_listing_none(mocker, test_client, init_database, dl_proc
 
     dl_processor.send_directory_listing()
     dl_processor.send_sms.assert_called_with('no_directory_listing_found_message')
+
+
+def test_completed_receive_count(test_client, init_database, dl_processor):
+    """
+    GIVEN a business and a customer
+    WHEN transfers to the business complete, stop being complete, or complete as part of a bulk job
+    THEN check the business's completed receive count, which the directory listing ranks by, keeps up
+    """
+    from server.utils.transfer_account import deferred_ledger_writes
+    from server.utils.transfer_enums import TransferStatusEnum
+
+    token = Token.query.filter_by(symbol="SM1").first()
+    business = UserFactory(phone=phone(), business_usage_id=dl_processor.selected_business_category.id,
+                           is_market_enabled=True)
+    create_transfer_account_for_user(business, token, 200)
+    customer = UserFactory(phone=phone())
+    create_transfer_account_for_user(customer, token, 200)
+    init_database.session.commit()
+    assert business.completed_receive_count == 0
+
+    def pay_business(**kwargs):
+        return make_payment_transfer(10, token=token, send_user=customer, receive_user=business,
+                                     is_ghost_transfer=False, require_sender_approved=False,
+                                     require_recipient_approved=False, **kwargs)
+
+    transfer = pay_business()
+    pay_business(automatically_resolve_complete=False)
+    init_database.session.commit()
+    assert business.completed_receive_count == 1
+
+    transfer.transfer_status = TransferStatusEnum.REJECTED
+    init_database.session.commit()
+    assert business.completed_receive_count == 0
+
+    with deferred_ledger_writes():
+        pay_business()
+        pay_business()
+    init_database.session.commit()
+    init_database.session.refresh(business)
+    assert business.completed_receive_count == 2
+    assert dl_processor.get_directory_listing_users()[0].id == business.id
@@ -57,4 +57,70 @@ def test_create_or_update_session(test_client, init_database):
     session = sessions.first()
     assert session.state == "bat"
     assert session.user_input == ""
-    assert session.ussd_menu_id == 5
\ No newline at end of file
+    assert session.ussd_menu_id == 5
+
+def test_ussd_menu_registry(test_client, init_database):
+    from server.models.ussd import UssdMenuRegistry, RegisteredUssdMenu
+
+    parent = UssdMenu(name='registry_parent', display_key='ussd.sempo.registry_parent')
+    db.session.add(parent)
+    db.session.commit()
+    child = UssdMenu(name='registry_child', display_key='ussd.sempo.registry_child', parent_id=parent.id)
+    db.session.add(child)
+    db.session.commit()
+
+    menu = UssdMenu.find_by_name('registry_child')
+    assert isinstance(menu, RegisteredUssdMenu)
+    assert menu.id == child.id
+    assert menu.parent().name == 'registry_parent'
+    # Nothing's changed, so the same registry is used
+    assert UssdMenu.find_by_name('registry_parent') is UssdMenuRegistry.current().by_id[parent.id]
+
+    child.display_key = 'ussd.sempo.registry_child_changed'
+    db.session.commit()
+    assert UssdMenu.find_by_name('registry_child').display_key == 'ussd.sempo.registry_child_changed'
+
+
+def test_ussd_session_store(test_client, init_database):
+    from flask import g
+    from server import red
+    from server.utils.ussd.session_store import get_ussd_session, create_or_update_cached_session, \
+        save_ussd_session, flush_ussd_sessions, USSD_SESSION_PENDING_KEY
+    g.active_organisation = OrganisationFactory(country_code='AU')
+
+    user = UserFactory(phone="456")
+    menu = UssdMenu(name='store_start', display_key='ussd.sempo.store_start')
+    db.session.add(menu)
+    db.session.commit()
+
+    assert get_ussd_session("store1") is None
+    session = create_or_update_cached_session("store1", user, menu, "", "*123#")
+    session.set_data('foo', 'bar')
+    save_ussd_session(session)
+
+    # A later request reads the session back from redis
+    g.ussd_sessions = {}
+    session = get_ussd_session("store1")
+    assert session.state == 'store_start'
+    assert session.get_data('foo') == 'bar'
+    session = create_or_update_cached_session("store1", user, menu, "1", "*123#")
+    session.set_data('fizz', 'buzz')
+    save_ussd_session(session, is_ended=True)
+
+    flush_ussd_sessions.submit()
+    rows = UssdSession.query.filter_by(session_id="store1").all()
+    assert len(rows) == 1
+    assert rows[0].user_input == "1"
+    assert rows[0].ussd_menu_id == menu.id
+    assert rows[0].user_id == user.id
+    assert rows[0].session_data == {'foo': 'bar', 'fizz': 'buzz'}
+    assert not red.hexists(USSD_SESSION_PENDING_KEY, "store1")
+
+    # Flushing a session again updates its existing row
+    session.user_input = "2"
+    save_ussd_session(session, is_ended=True)
+    flush_ussd_sessions.submit()
+    db.session.expire_all()
+    rows = UssdSession.query.filter_by(session_id="store1").all()
+    assert len(rows) == 1
+    assert rows[0].user_input == "2"
@@ -0,0 +1,53 @@
+import pytest
+
+from server.utils.ussd.ussd_state_machine import UssdStateMachine, MENU_OPTION_CONDITIONS, compile_transitions
+
+
+def test_compiled_transitions(test_client):
+    """
+    GIVEN the USSD state machine's transition definitions
+    WHEN they're compiled into its transition table
+    THEN check every callback exists, and that transitions looked up by menu option are the ones that would be
+    found by trying each transition's conditions in order
+    """
+    transitions = UssdStateMachine.define_transitions()
+    table = compile_transitions(transitions)
+    assert set(table) == {t['source'] for t in transitions}
+
+    for state_transitions in table.values():
+        for transition in list(state_transitions.menu_options.values()) + list(state_transitions.transitions):
+            for name in transition.conditions + transition.after:
+                assert callable(getattr(UssdStateMachine, name))
+
+    for condition, option in MENU_OPTION_CONDITIONS.items():
+        assert getattr(UssdStateMachine, condition)(None, option)
+
+    def could_be_taken(definition, option):
+        # Menu option conditions only hold for their option, anything else might hold for any input
+        conditions = definition.get('conditions') or []
+        conditions = [conditions] if isinstance(conditions, str) else conditions
+        return all(MENU_OPTION_CONDITIONS.get(condition, option) == option for condition in conditions)
+
+    for source, state_transitions in table.items():
+        definitions = [t for t in transitions if t['source'] == source]
+        for option, transition in state_transitions.menu_options.items():
+            first_match = next(t for t in definitions if could_be_taken(t, option))
+            assert transition.dest == first_match['dest'], f'{source} {option}'
+
+
+@pytest.mark.parametrize("state, user_input, expected", [
+    ('start', '1', 'send_enter_recipient'),
+    ('start', '5', 'help'),
+    ('start', '7', 'exit_invalid_menu_option'),
+    ('exchange_token', '2', 'exchange_token_agent_number_entry'),
+    ('account_management', '', 'exit_invalid_menu_option'),
+])
+def test_feed_char(test_client, state, user_input, expected):
+    class Session(object):
+        pass
+
+    session = Session()
+    session.state = state
+    state_machine = UssdStateMachine(session, None)
+    state_machine.feed_char(user_input)
+    assert state_machine.state == expected
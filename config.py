@@ -151,10 +151,27 @@ SUPPORT_SIG_VALIDATION = config_parser['APP'].getboolean('SUPPORT_SIG_VALIDATION
 THIRD_PARTY_SYNC_EPOCH = config_parser['APP'].get('THIRD_PARTY_SYNC_EPOCH', 'latest')
 THIRD_PARTY_SYNC_CHECK_PERIOD_SECONDS = int(config_parser['APP'].get('THIRD_PARTY_SYNC_CHECK_PERIOD_SECONDS', '60'))
 
+# Largest page paginate_query returns when a page size is given, and the default page size of keyset pagination
+PAGINATION_MAX_PER_PAGE = int(config_parser['APP'].get('PAGINATION_MAX_PER_PAGE', 500))
+
+# How similar (by trigrams) a user's search document has to be to a search string for search to consider them.
+# Raising it prunes more users through the trigram index, at the cost of missing weaker matches
+SEARCH_SIMILARITY_THRESHOLD = float(config_parser['APP'].get('SEARCH_SIMILARITY_THRESHOLD', 0.001))
+
+# Bulk disbursements commit their transfers, and publish their blockchain tasks, this many recipients at a time
+DISBURSEMENT_BATCH_SIZE = int(config_parser['APP'].get('DISBURSEMENT_BATCH_SIZE', 500))
+
 SINGLE_USE_TOKEN_EXPIRATION      = 60 * 60 * 24 * 1
 AUTH_TOKEN_EXPIRATION = int(config_parser['APP'].getboolean('AUTH_TOKEN_EXPIRATION', 60 * 60 * 2))  # 2 Hours
 VERIFY_JWT_EXPIRY     = config_parser['APP'].getboolean('VERIFY_JWT_EXPIRY', True)
 PASSWORD_PEPPER       = secrets_parser['APP'].get('PASSWORD_PEPPER')
+# Password and PIN hashing, see server/utils/hashing.py. A pool size of 0 hashes on the request thread
+HASHING_POOL_SIZE = int(config_parser['APP'].get('HASHING_POOL_SIZE', 0 if IS_TEST else 2))
+HASHING_QUEUE_SIZE = int(config_parser['APP'].get('HASHING_QUEUE_SIZE', 16))
+HASHING_QUEUE_TIMEOUT_SECONDS = float(config_parser['APP'].get('HASHING_QUEUE_TIMEOUT_SECONDS', 2))
+BCRYPT_TARGET_SECONDS = float(config_parser['APP'].get('BCRYPT_TARGET_SECONDS', 0.25))
+BCRYPT_MIN_ROUNDS = int(config_parser['APP'].get('BCRYPT_MIN_ROUNDS', 12))
+BCRYPT_MAX_ROUNDS = int(config_parser['APP'].get('BCRYPT_MAX_ROUNDS', 14))
 SECRET_KEY            = secrets_parser['APP']['SECRET_KEY'] + DEPLOYMENT_NAME
 ECDSA_SECRET          = hashlib.sha256(secrets_parser['APP']['ECDSA_SECRET'].encode()).digest()[0:24]
 
@@ -314,10 +331,14 @@ try:
         configs['CHECK_TRANSACTION_RETRIES_TIME_LIMIT'] = sum(
             [configs['CHECK_TRANSACTION_BASE_TIME'] * 2 ** i for i in range(1, configs['CHECK_TRANSACTION_RETRIES'] + 1)]
         )
+        configs['RECEIPT_WATCHER'] = config_parser[chain].getboolean('receipt_watcher', False)
+        configs['RECEIPT_WATCHER_SCHEDULE'] = config_parser[chain].getfloat('receipt_watcher_schedule', 5)
 
         configs['INTERNAL_TO_TOKEN_RATIO'] = float(config_parser[chain].get('internal_to_token_ratio', 1))
         configs['FORCE_ETH_DISBURSEMENT_AMOUNT'] = float(config_parser[chain].get('force_eth_disbursement_amount', 0))
         configs['PENDING_TRANSACTION_EXPIRY_SECONDS'] = config_parser[chain].getint('transaction_expiry_seconds', 30)
+        configs['NONCE_SWEEP_SCHEDULE'] = config_parser[chain].getfloat('nonce_sweep_schedule', 30)
+        configs['NONCE_RESERVATION_SIZE'] = config_parser[chain].getint('nonce_reservation_size', 20)
 
         unchecksummed_withdraw_to_address     = config_parser[chain].get('withdraw_to_address')
         if unchecksummed_withdraw_to_address:
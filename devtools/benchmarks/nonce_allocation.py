@@ -0,0 +1,83 @@
+"""
+Measures nonce claims per second for a single hot signing wallet, comparing the allocator against
+the old behaviour of sweeping failed nonces and rescanning the wallet's transactions on every claim.
+
+A throwaway wallet is created with a backlog of pending transactions, and is deleted again at the end.
+Claims go through locked_claim_transaction_nonce, so this needs the eth worker database and redis to be up.
+
+Usage (from the eth_worker directory): python ../devtools/benchmarks/nonce_allocation.py [claims] [backlog]
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), 'eth_src')))
+
+import redis
+
+import config
+from sql_persistence import session
+from sql_persistence.interface import SQLPersistenceInterface
+from sql_persistence.models import BlockchainWallet, BlockchainTransaction
+
+FIRST_BLOCK_HASH = 'nonce-allocation-benchmark'
+
+
+def create_transactions(wallet, count, nonce_start=None):
+    transactions = []
+    for i in range(count):
+        t = BlockchainTransaction(first_block_hash=FIRST_BLOCK_HASH)
+        t.signing_wallet = wallet
+        if nonce_start is not None:
+            t.nonce = nonce_start + i
+            t.status = 'PENDING'
+        transactions.append(t)
+    session.add_all(transactions)
+    session.commit()
+    return transactions
+
+
+def time_claims(persistence, wallet, claims, rescan_each_claim):
+    transactions = create_transactions(wallet, claims)
+
+    start = time.time()
+    for t in transactions:
+        if rescan_each_claim:
+            # Roughly what every claim used to cost. The global expiry sweep is left out since it would
+            # touch other wallets' transactions, so this understates the old cost a little
+            persistence._unconsume_high_failed_nonces(wallet.id, 0)
+            wallet.next_nonce = None
+        persistence.locked_claim_transaction_nonce(0, wallet.id, t.id)
+    elapsed = time.time() - start
+
+    return claims / elapsed
+
+
+if __name__ == '__main__':
+    claims = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    backlog = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    persistence = SQLPersistenceInterface(
+        red=redis.Redis.from_url(config.REDIS_URL), session=session, first_block_hash=FIRST_BLOCK_HASH
+    )
+
+    wallet = BlockchainWallet()
+    session.add(wallet)
+    session.commit()
+
+    try:
+        create_transactions(wallet, backlog, nonce_start=0)
+
+        rescanned = time_claims(persistence, wallet, claims, rescan_each_claim=True)
+        allocated = time_claims(persistence, wallet, claims, rescan_each_claim=False)
+
+        print(f'{claims} claims on one wallet with {backlog} pending transactions')
+        print(f'Sweep and rescan per claim:  {rescanned:.1f} claims/s')
+        print(f'Allocator:                   {allocated:.1f} claims/s ({allocated / rescanned:.1f}x)')
+    finally:
+        session.rollback()
+        session.query(BlockchainTransaction).filter(BlockchainTransaction.signing_wallet_id == wallet.id).delete()
+        session.delete(wallet)
+        session.commit()
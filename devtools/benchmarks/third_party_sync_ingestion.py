@@ -0,0 +1,157 @@
+"""
+Compares third party sync ingestion throughput of the batch endpoint before and after ingest_third_party_transfers.
+The before path is a copy of the handler the batch endpoint used to call for each event inside its own savepoint
+(process_internal_credit_transfer), which looked every hash, token and address up one query at a time.
+
+Synthetic Transfer events are generated between existing user transfer accounts and random external addresses,
+so run this against a database with some users in it (eg one seeded with the mock data api).
+Everything happens inside a transaction that is rolled back at the end, so nothing is persisted.
+
+Usage (from the app directory): python ../devtools/benchmarks/third_party_sync_ingestion.py [number_of_events]
+"""
+import os
+import sys
+import time
+import secrets
+import random
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..')))
+
+from server import create_app, db
+from server.models.credit_transfer import CreditTransfer
+from server.models.token import Token
+from server.models.transfer_account import TransferAccount, TransferAccountType
+from server.schemas import credit_transfer_schema
+from server.utils.credit_transfer import ingest_third_party_transfers
+from server.utils.transfer_enums import TransferTypeEnum
+from server.utils.user import create_transfer_account_if_required
+
+BATCH_SIZE = 100
+
+
+def random_address():
+    return '0x' + secrets.token_hex(20)
+
+
+def make_events(token, transfer_accounts, number_of_events):
+    events = []
+    for _ in range(number_of_events):
+        sempo_address = random.choice(transfer_accounts).blockchain_address
+        external_address = random_address()
+        sender, recipient = random.sample([sempo_address, external_address], 2)
+        events.append({
+            'sender_blockchain_address': sender,
+            'recipient_blockchain_address': recipient,
+            'blockchain_transaction_hash': '0x' + secrets.token_hex(32),
+            'transfer_amount': random.randint(1, 100),
+            'contract_address': token.address
+        })
+    return events
+
+
+def process_internal_credit_transfer(post_data):
+    # The handler as it was before ingest_third_party_transfers, kept here as the baseline
+    transfer_amount = post_data.get('transfer_amount')
+    sender_blockchain_address = post_data.get('sender_blockchain_address')
+    recipient_blockchain_address = post_data.get('recipient_blockchain_address')
+    blockchain_transaction_hash = post_data.get('blockchain_transaction_hash')
+    contract_address = post_data.get('contract_address')
+
+    transfer = CreditTransfer.query.execution_options(show_all=True)\
+        .filter_by(blockchain_hash=blockchain_transaction_hash).first()
+    if transfer:
+        transfer.received_third_party_sync = True
+        return credit_transfer_schema.dump(transfer).data
+
+    token = Token.query.filter_by(address=contract_address).first()
+    maybe_sender_transfer_account = TransferAccount.query.execution_options(show_all=True)\
+        .filter_by(blockchain_address=sender_blockchain_address).first()
+    maybe_sender_user = maybe_sender_transfer_account.users[0] \
+        if maybe_sender_transfer_account and len(maybe_sender_transfer_account.users) == 1 else None
+    maybe_recipient_transfer_account = TransferAccount.query.execution_options(show_all=True)\
+        .filter_by(blockchain_address=recipient_blockchain_address).first()
+    maybe_recipient_user = maybe_recipient_transfer_account.users[0] \
+        if maybe_recipient_transfer_account and len(maybe_recipient_transfer_account.users) == 1 else None
+
+    def is_external(transfer_account):
+        return not transfer_account or transfer_account.account_type == TransferAccountType.EXTERNAL
+
+    if is_external(maybe_sender_transfer_account) and is_external(maybe_recipient_transfer_account):
+        return None
+
+    send_transfer_account = create_transfer_account_if_required(
+        sender_blockchain_address, token, TransferAccountType.EXTERNAL
+    )
+    receive_transfer_account = create_transfer_account_if_required(
+        recipient_blockchain_address, token, TransferAccountType.EXTERNAL
+    )
+    transfer = CreditTransfer(
+        transfer_amount,
+        token=token,
+        sender_transfer_account=send_transfer_account,
+        recipient_transfer_account=receive_transfer_account,
+        transfer_type=TransferTypeEnum.PAYMENT,
+        sender_user=maybe_sender_user,
+        recipient_user=maybe_recipient_user,
+        require_sufficient_balance=False,
+        received_third_party_sync=True
+    )
+    transfer.resolve_as_complete_with_existing_blockchain_transaction(blockchain_transaction_hash)
+    db.session.flush()
+    return credit_transfer_schema.dump(transfer).data
+
+
+def before_batch(events):
+    # What the batch endpoint used to do: each event in its own savepoint, through the old handler
+    for event in events:
+        savepoint = db.session.begin_nested()
+        process_internal_credit_transfer(event)
+        savepoint.commit()
+
+
+def after_batch(events):
+    savepoint = db.session.begin_nested()
+    ingest_third_party_transfers(events)
+    savepoint.commit()
+
+
+def time_ingestion(events, ingest_batch):
+    savepoint = db.session.begin_nested()
+    start = time.time()
+    for i in range(0, len(events), BATCH_SIZE):
+        ingest_batch(events[i:i + BATCH_SIZE])
+    elapsed = time.time() - start
+    savepoint.rollback()
+    return len(events) / elapsed
+
+
+if __name__ == '__main__':
+    number_of_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    app = create_app(skip_create_filters=True)
+    with app.test_request_context():
+        from flask import g
+        g.pending_transactions = []
+        g.show_all = True
+
+        token = Token.query.filter(Token.address != None).first()
+        transfer_accounts = TransferAccount.query.execution_options(show_all=True)\
+            .filter(TransferAccount.token == token)\
+            .filter(TransferAccount.account_type == TransferAccountType.USER)\
+            .limit(500).all()
+
+        if not token or not transfer_accounts:
+            sys.exit('Needs a token with some user transfer accounts to benchmark against')
+
+        events = make_events(token, transfer_accounts, number_of_events)
+
+        before = time_ingestion(events, before_batch)
+        after = time_ingestion(events, after_batch)
+
+        db.session.rollback()
+
+        print(f'{number_of_events} events against {len(transfer_accounts)} transfer accounts, '
+              f'in batches of {BATCH_SIZE}')
+        print(f'Before (per event handler):           {before:.1f} events/s')
+        print(f'After (ingest_third_party_transfers): {after:.1f} events/s ({after / before:.1f}x)')
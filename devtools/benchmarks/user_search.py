@@ -0,0 +1,84 @@
+"""
+Compares user search latency of ranking every user by the sum of their column similarities (what search used to do)
+against finding candidates through the trigram indexed search document and only ranking those.
+
+Synthetic users are inserted with SQL, their search documents built the same way the migration backfills them,
+and the table analyzed so the planner knows about them. Everything happens inside a transaction that is rolled
+back at the end, so nothing is persisted. Run it against a migrated database, so the trigram indexes exist.
+
+Usage (from the app directory): python ../devtools/benchmarks/user_search.py [number_of_users] [repeats]
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..')))
+
+import config
+from server import create_app, db
+
+SEARCH_STRINGS = ['fra', 'mic der', '902555', 'Halifax', '0x5a1c']
+TOP_K = 50
+
+RANK = '''
+    coalesce(similarity(first_name, :q), 0) * 1.5 + coalesce(similarity(last_name, :q), 0) * 1.5
+    + coalesce(similarity(_phone, :q), 0) * 2 + coalesce(similarity(_public_serial_number, :q), 0) * 2
+    + coalesce(similarity(_location, :q), 0) + coalesce(similarity(primary_blockchain_address, :q), 0) * 2
+'''
+
+FULL_SCAN_SEARCH = f'SELECT id FROM "user" WHERE ({RANK}) != 0 ORDER BY ({RANK}) DESC LIMIT {TOP_K}'
+
+DOCUMENT_SEARCH = f'SELECT id FROM "user" WHERE search_document % :q ORDER BY ({RANK}) DESC LIMIT {TOP_K}'
+
+
+def insert_users(number_of_users):
+    db.session.execute(f'''
+        INSERT INTO "user" (first_name, last_name, _phone, _location, primary_blockchain_address, created)
+        SELECT
+            initcap(substr(md5(i::text), 1, 3 + i % 6)),
+            initcap(substr(md5((i * 7)::text), 1, 4 + i % 7)),
+            '+1902' || lpad(i::text, 7, '0'),
+            (ARRAY['Halifax', 'Dartmouth', 'Burbank', 'California', 'Nairobi', 'Vanuatu'])[1 + i % 6],
+            '0x' || md5(i::text) || substr(md5((i + 1)::text), 1, 8),
+            now()
+        FROM generate_series(1, {number_of_users}) AS i
+    ''')
+    db.session.execute('''
+        UPDATE "user" SET search_document = concat_ws(
+            ' ', first_name, last_name, _phone, _public_serial_number, _location, primary_blockchain_address
+        )
+        WHERE search_document IS NULL
+    ''')
+    db.session.execute('ANALYZE "user"')
+
+
+def time_search(sql, search_string, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        db.session.execute(sql, {'q': search_string}).fetchall()
+    return (time.time() - start) / repeats
+
+
+if __name__ == '__main__':
+    number_of_users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    app = create_app()
+    with app.app_context():
+        transaction = db.session.begin_nested()
+        print(f'Inserting {number_of_users} users')
+        insert_users(number_of_users)
+        db.session.execute(
+            'SELECT set_config(\'pg_trgm.similarity_threshold\', :threshold, true)',
+            {'threshold': str(config.SEARCH_SIMILARITY_THRESHOLD)}
+        )
+
+        for search_string in SEARCH_STRINGS:
+            full_scan = time_search(FULL_SCAN_SEARCH, search_string, repeats)
+            document = time_search(DOCUMENT_SEARCH, search_string, repeats)
+            print(f'{search_string!r:>12}: full scan {full_scan * 1000:.1f}ms, '
+                  f'search document {document * 1000:.1f}ms ({full_scan / document:.1f}x)')
+
+        transaction.rollback()
+        db.session.rollback()
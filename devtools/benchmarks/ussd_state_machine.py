@@ -0,0 +1,87 @@
+"""
+Measures USSD state machine hops per second. A hop is what each USSD request does: make a state machine for the
+session and feed it the user's input. It compares building the transition table on every hop (what making a
+state machine used to involve, with pytransitions doing the building if it's installed) against looking transitions
+up in the table compiled when the module is imported.
+
+Only transitions without side effects are fed, so no database or worker is needed beyond what importing the app does.
+
+Usage (from the app directory): python ../devtools/benchmarks/ussd_state_machine.py [hops]
+"""
+import importlib.util
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '..')))
+
+from server import create_app
+from server.utils.ussd.ussd_state_machine import UssdStateMachine, compile_transitions
+
+HOPS = [
+    ('start', '1'),
+    ('start', '4'),
+    ('start', '8'),
+    ('account_management', '2'),
+    ('exchange_token', '2'),
+    ('my_business', '7'),
+]
+
+
+class Session(object):
+    def __init__(self, state):
+        self.state = state
+
+
+def precompiled_hop(state, user_input):
+    state_machine = UssdStateMachine(Session(state), None)
+    state_machine.feed_char(user_input)
+    return state_machine.state
+
+
+def recompiling_hop(state, user_input):
+    state_machine = UssdStateMachine(Session(state), None)
+    state_machine.transition_table = compile_transitions(UssdStateMachine.define_transitions())
+    state_machine.feed_char(user_input)
+    return state_machine.state
+
+
+def pytransitions_hop(state, user_input):
+    from transitions import Machine, State
+    state_machine = UssdStateMachine(Session(state), None)
+    states = [State(name=s, on_enter=list(UssdStateMachine.on_enter.get(s, ()))) for s in UssdStateMachine.states]
+    # feed_char is already defined on the model, so the event is triggered through the machine
+    machine = Machine(model=state_machine, states=states, initial=state, auto_transitions=False)
+    machine.add_transitions(UssdStateMachine.define_transitions())
+    machine.events['feed_char'].trigger(state_machine, user_input)
+    return state_machine.state
+
+
+def hops_per_second(hop, hops):
+    start = time.time()
+    for i in range(hops):
+        hop(*HOPS[i % len(HOPS)])
+    return hops / (time.time() - start)
+
+
+if __name__ == '__main__':
+    hops = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    app = create_app()
+    with app.app_context():
+        hop_types = [('precompiled', precompiled_hop), ('recompiling', recompiling_hop)]
+        if importlib.util.find_spec('transitions'):
+            hop_types.append(('pytransitions', pytransitions_hop))
+        else:
+            print('pytransitions is not installed, so skipping it')
+
+        for state, user_input in HOPS:
+            results = {precompiled_hop(state, user_input)} | {hop(state, user_input) for _, hop in hop_types}
+            assert len(results) == 1, f'Hops from {state} with {user_input!r} disagree: {results}'
+
+        precompiled = hops_per_second(precompiled_hop, hops)
+        print(f'{"precompiled":>14}: {precompiled:,.0f} hops/s')
+        for name, hop in hop_types[1:]:
+            rate = hops_per_second(hop, hops // 10)
+            print(f'{name:>14}: {rate:,.0f} hops/s (precompiled is {precompiled / rate:.1f}x faster)')
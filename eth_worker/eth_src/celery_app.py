@@ -68,9 +68,19 @@ app.conf.beat_schedule = {
     'third-party-transaction-sync': {
         'task': celery_utils.eth_endpoint('synchronize_third_party_transactions'),
         'schedule': chain_config['THIRD_PARTY_SYNC_SCHEDULE'],
+    },
+    'sweep-expired-nonces': {
+        'task': celery_utils.eth_endpoint('sweep_expired_nonces'),
+        'schedule': chain_config['NONCE_SWEEP_SCHEDULE'],
     }
 }
 
+if chain_config['RECEIPT_WATCHER']:
+    app.conf.beat_schedule['watch-pending-transactions'] = {
+        'task': celery_utils.eth_endpoint('watch_pending_transactions'),
+        'schedule': chain_config['RECEIPT_WATCHER_SCHEDULE'],
+    }
+
 w3 = Web3(HTTPProvider(chain_config['HTTP_PROVIDER']))
 
 if not w3.isConnected():
@@ -106,13 +116,15 @@ processor = TransactionProcessorClass(
     gas_price_wei=w3.toWei(chain_config['GAS_PRICE'], 'gwei'),
     gas_limit=chain_config['GAS_LIMIT'],
     w3=w3,
-    persistence=persistence_module
+    persistence=persistence_module,
+    nonce_reservation_size=chain_config['NONCE_RESERVATION_SIZE']
 )
 
 supervisor = TransactionSupervisor(
     red=red,
     persistence=persistence_module,
-    processor=processor
+    processor=processor,
+    use_receipt_watcher=chain_config['RECEIPT_WATCHER']
 )
 
 task_manager = TaskManager(persistence=persistence_module, transaction_supervisor=supervisor)
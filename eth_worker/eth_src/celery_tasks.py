@@ -93,9 +93,14 @@ def force_recall_webhook(self, transaction_hash):
 def synchronize_third_party_transactions(self):
     return blockchain_sync.synchronize_third_party_transactions()
 
+# Set retry attempts to zero since beat will sweep again shortly anyway
+@app.task(name=eth_endpoint('sweep_expired_nonces'), **no_retry_config)
+def sweep_expired_nonces(self):
+    return persistence_module.sweep_expired_nonces()
+
 @app.task(name=eth_endpoint('add_transaction_filter'), **low_priority_config)
-def add_transaction_filter(self, contract_address, contract_type, filter_parameters, filter_type, decimals = 18, block_epoch = None):
-    f = blockchain_sync.add_transaction_filter(contract_address, contract_type, filter_parameters, filter_type, decimals, block_epoch)
+def add_transaction_filter(self, contract_address, contract_type, filter_parameters, filter_type, decimals = 18, block_epoch = None, fetch_concurrency = None):
+    f = blockchain_sync.add_transaction_filter(contract_address, contract_type, filter_parameters, filter_type, decimals, block_epoch, fetch_concurrency)
     if f:
         return {
             "contract_address": f.contract_address,
@@ -104,6 +109,7 @@ def add_transaction_filter(self, contract_address, contract_type, filter_paramet
             "filter_type": f.filter_type,
             "max_block": f.max_block,
             "decimals": f.decimals,
+            "fetch_concurrency": f.fetch_concurrency,
         }
     else:
         return True
@@ -225,6 +231,12 @@ def _check_transaction_response(self, transaction_id):
     return supervisor.check_transaction_response(self, transaction_id)
 
 
+# Set retry attempts to zero since beat will watch again shortly anyway
+@app.task(name=eth_endpoint('watch_pending_transactions'), **no_retry_config)
+def watch_pending_transactions(self):
+    return supervisor.watch_pending_transactions()
+
+
 @app.task(name=eth_endpoint('attempt_transaction'), **base_task_config)
 def attempt_transaction(self, task_uuid):
     return supervisor.attempt_transaction(task_uuid)
@@ -1,7 +1,11 @@
 import json
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from uuid import uuid4
 import config
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from math import ceil
 from web3 import Web3
@@ -16,23 +20,47 @@ class BlockchainSyncer(object):
     def get_latest_block_number(self):
         return self.w3.eth.getBlock('latest').number
 
-    # Call app-level webhook with newfound transacitons
-    def call_webhook(self, transaction):
-        body = {
+    @staticmethod
+    def _webhook_body(transaction):
+        return {
             'sender_blockchain_address': transaction.sender_address,
             'recipient_blockchain_address': transaction.recipient_address,
             'blockchain_transaction_hash': transaction.hash,
             'transfer_amount': int(transaction.amount or 0),
             'contract_address': transaction.contract_address
         }
-        r = requests.post(config.APP_HOST + '/api/v1/credit_transfer/internal/',
-                            json=body,
-                            auth=HTTPBasicAuth(config.INTERNAL_AUTH_USERNAME,
-                                            config.INTERNAL_AUTH_PASSWORD),
-                            timeout=30
-                        )
+
+    # Call app-level webhook with newfound transacitons
+    def call_webhook(self, transaction):
+        r = self.webhook_session.post(config.APP_HOST + '/api/v1/credit_transfer/internal/',
+                                      json=self._webhook_body(transaction),
+                                      timeout=30
+                                      )
         return r
 
+    # Call app-level batch webhook with newfound transactions, WEBHOOK_BATCH_SIZE at a time
+    # Returns the hashes of the transactions the app synchronized successfully
+    def call_batch_webhook(self, transactions):
+        synchronized_hashes = set()
+        for i in range(0, len(transactions), sync_const.WEBHOOK_BATCH_SIZE):
+            batch = transactions[i:i + sync_const.WEBHOOK_BATCH_SIZE]
+            try:
+                r = self.webhook_session.post(config.APP_HOST + '/api/v1/credit_transfer/internal/batch/',
+                                              json={'transfers': [self._webhook_body(t) for t in batch]},
+                                              timeout=sync_const.WEBHOOK_BATCH_TIMEOUT
+                                              )
+            except requests.exceptions.RequestException as e:
+                # Leave the batch unsynchronized so it can be retried later
+                config.logg.error(f'Batch webhook failed for {len(batch)} transactions: {e}')
+                continue
+            if not r.ok:
+                config.logg.error(f'Batch webhook failed for {len(batch)} transactions with status {r.status_code}')
+                continue
+            for result in r.json()['data']['results']:
+                if result['ok']:
+                    synchronized_hashes.add(result['blockchain_transaction_hash'])
+        return synchronized_hashes
+
     # Get list of filters from redis. This is the starting point of the synchronization process
     def synchronize_third_party_transactions(self):
         filters = self.persistence.get_all_synchronization_filters()
@@ -40,6 +68,9 @@ class BlockchainSyncer(object):
         # the range we want into chunks. Once all the chunk-jobs are formed and loaded into redis,
         # then trigger process_all_chunks, which will consume those jobs from redis
         total_blocks_retrieved = 0
+
+        # Filters watching the same contract from the same block share a single log query per chunk
+        filter_groups = OrderedDict()
         for f in filters:
             # Skip getting data for filters whose status is DISABLED
             if f.status == sync_const.DISABLED:
@@ -50,59 +81,150 @@ class BlockchainSyncer(object):
                 latest_block = self.get_latest_block_number()
                 self.persistence.set_filter_max_block(f.id, latest_block)
                 continue
-            # Make sure a filter is only being executed once at a time
-            have_lock = False
-            lock = self.red.lock(f'third-party-sync-lock-{f.id}', timeout=sync_const.LOCK_TIMEOUT)
-            try:
-                have_lock = lock.acquire(blocking=False)
-                if not have_lock:
+            filter_groups.setdefault((f.contract_address, f.max_block), []).append(f)
+
+        for group in filter_groups.values():
+            total_blocks_retrieved += self.synchronize_filter_group(group)
+        return total_blocks_retrieved
+
+    # Synchronizes a group of filters that share a contract address and max block
+    def synchronize_filter_group(self, filters):
+        # Make sure a filter is only being executed once at a time
+        locks = []
+        try:
+            locked_filters = []
+            for f in filters:
+                lock = self.red.lock(f'third-party-sync-lock-{f.id}', timeout=sync_const.LOCK_TIMEOUT)
+                if lock.acquire(blocking=False):
+                    locks.append(lock)
+                    locked_filters.append(f)
+                else:
                     config.logg.info(f'Skipping execution of synchronizing filter {f.id}, as it is already running in another process')
-                    continue
+            if not locked_filters:
+                return 0
 
-                latest_block = self.get_latest_block_number()
-                # If there's no filter.max_block (which is the default for auto-generated filters)
-                # start tracking third party transactions by looking at the lastest_block
-                max_fetched_block = f.max_block or latest_block
-                number_of_blocks_to_get = (latest_block - max_fetched_block)
-                number_of_chunks = ceil(number_of_blocks_to_get/sync_const.BLOCKS_PER_REQUEST)
-
-                total_blocks_retrieved += number_of_blocks_to_get
-
-                for chunk in range(number_of_chunks):
-                    floor = max_fetched_block + (chunk * sync_const.BLOCKS_PER_REQUEST) + 1
-                    ceiling = max_fetched_block + ((chunk + 1) * sync_const.BLOCKS_PER_REQUEST)
-                    if ceiling > latest_block:
-                        ceiling = latest_block
-                    self.process_chunk(f, floor, ceiling)
+            latest_block = self.get_latest_block_number()
+            # If there's no filter.max_block (which is the default for auto-generated filters)
+            # start tracking third party transactions by looking at the lastest_block
+            max_fetched_block = locked_filters[0].max_block or latest_block
+            number_of_blocks_to_get = (latest_block - max_fetched_block)
+            number_of_chunks = ceil(number_of_blocks_to_get/sync_const.BLOCKS_PER_REQUEST)
+
+            chunks = []
+            for chunk in range(number_of_chunks):
+                floor = max_fetched_block + (chunk * sync_const.BLOCKS_PER_REQUEST) + 1
+                ceiling = max_fetched_block + ((chunk + 1) * sync_const.BLOCKS_PER_REQUEST)
+                if ceiling > latest_block:
+                    ceiling = latest_block
+                chunks.append((floor, ceiling))
+
+            for floor, ceiling, transaction_history in self.prefetch_chunks(locked_filters, chunks):
+                for f in locked_filters:
+                    if len(locked_filters) > 1:
+                        filter_history = [e for e in transaction_history if self.event_matches_filter(e, f)]
+                    else:
+                        filter_history = transaction_history
+                    self.process_chunk(f, floor, ceiling, transaction_history=filter_history)
+                    # Chunks are yielded strictly in order, so a crash can never checkpoint past an unprocessed range
                     self.persistence.set_filter_max_block(f.id, ceiling)
+                for lock in locks:
                     lock.reacquire()
 
-                if number_of_chunks == 0:
+            if number_of_chunks == 0:
+                for f in locked_filters:
                     self.persistence.set_filter_max_block(f.id, latest_block)
-            finally:
-                if have_lock:
-                    lock.release()
-        return total_blocks_retrieved
 
-    # Gets history for given range, and runs handle_event on all of them
+            return number_of_blocks_to_get * len(locked_filters)
+        finally:
+            for lock in locks:
+                lock.release()
+
+    @staticmethod
+    def parse_filter_parameters(filter_parameters):
+        if isinstance(filter_parameters, str):
+            return json.loads(filter_parameters)
+        return filter_parameters
+
+    # Addresses in event args are checksummed, but filter parameters may be in any case
+    @staticmethod
+    def _normalise_event_arg(value):
+        if isinstance(value, str) and Web3.isAddress(value):
+            return Web3.toChecksumAddress(value)
+        return value
+
+    # Checks whether an event from a combined log query belongs to the given filter
+    def event_matches_filter(self, event, filter):
+        parameters = self.parse_filter_parameters(filter.filter_parameters) or {}
+        for key, value in parameters.items():
+            allowed = value if isinstance(value, (list, tuple)) else [value]
+            allowed = [self._normalise_event_arg(a) for a in allowed]
+            if self._normalise_event_arg(event.args.get(key)) not in allowed:
+                return False
+        return True
+
+    # Fetches the logs for a block range. Safe to run off the main thread, since it doesn't touch the database
+    def fetch_chunk(self, filter, floor, ceiling):
+        return list(self.get_blockchain_transaction_history(
+            filter.contract_address,
+            floor,
+            ceiling,
+            self.parse_filter_parameters(filter.filter_parameters),
+            filter.id
+        ))
+
+    # Fetches the logs for a block range once for a group of filters on the same contract
+    # Multiple filters are fetched without argument filters, and their events are routed afterwards
+    def fetch_group_chunk(self, filters, floor, ceiling):
+        if len(filters) == 1:
+            return self.fetch_chunk(filters[0], floor, ceiling)
+        return list(self.get_blockchain_transaction_history(filters[0].contract_address, floor, ceiling))
+
+    # Yields (floor, ceiling, transaction_history) for each chunk in order, while a bounded pool of
+    # threads fetches the logs for the next chunks in the background
+    def prefetch_chunks(self, filters, chunks):
+        concurrency = max(max(f.fetch_concurrency or sync_const.DEFAULT_FETCH_CONCURRENCY for f in filters), 1)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            in_flight = deque()
+            remaining = iter(chunks)
+            for floor, ceiling in islice(remaining, concurrency):
+                in_flight.append((floor, ceiling, pool.submit(self.fetch_group_chunk, filters, floor, ceiling)))
+            while in_flight:
+                floor, ceiling, future = in_flight.popleft()
+                # Raises if the fetch failed, which stops the sync for these filters at the last processed chunk
+                transaction_history = future.result()
+                for next_floor, next_ceiling in islice(remaining, 1):
+                    in_flight.append(
+                        (next_floor, next_ceiling, pool.submit(self.fetch_group_chunk, filters, next_floor, next_ceiling))
+                    )
+                yield floor, ceiling, transaction_history
+
+    # Web3 contract objects are cached, since building one parses the whole ABI
+    def get_erc20_contract(self, contract_address):
+        checksum_address = Web3.toChecksumAddress(contract_address)
+        if checksum_address not in self.erc20_contracts:
+            self.erc20_contracts[checksum_address] = self.w3.eth.contract(
+                address = checksum_address,
+                abi = erc20_abi.abi
+            )
+        return self.erc20_contracts[checksum_address]
+
+    # Gets history for given range (unless it's already been fetched), and syncs all of them with the app
     # This is the second stage in the third party transaction processing pipeline!
-    def process_chunk(self, filter, floor, ceiling):
-        transaction_history = self.get_blockchain_transaction_history(
-                filter.contract_address,
-                floor,
-                ceiling,
-                filter.filter_parameters,
-                filter.id
+    def process_chunk(self, filter, floor, ceiling, transaction_history=None):
+        if transaction_history is None:
+            transaction_history = self.fetch_chunk(filter, floor, ceiling)
+        transaction_objects = [self.get_or_create_transaction_object(event, filter) for event in transaction_history]
+        if transaction_objects:
+            synchronized_hashes = self.call_batch_webhook(transaction_objects)
+            # Transactions which we fetched, but couldn't sync for whatever reason won't be marked as completed
+            # in order to be retryable later
+            self.persistence.mark_transactions_as_completed(
+                [t for t in transaction_objects if t.hash in synchronized_hashes]
             )
-        for event in transaction_history:
-            self.handle_event(event, filter)
         return 'Success'
 
-    # Processes newly found transaction event
-    # Creates database object for transaction
-    # Calls webhook
-    # Sets sync status (whether or not webhook was successful)
-    def handle_event(self, transaction, filter):
+    # Gets the database object for a newly found transaction event, creating it if required
+    def get_or_create_transaction_object(self, transaction, filter):
         transaction_object = self.persistence.get_transaction(hash=transaction.transactionHash.hex())
         # If transaction doesn't exist, make it. Even if it does exist, and it's synchronized via first-party sync
         # we still want to send it with third-party (here) as insurance that tx sync is running correctly.
@@ -117,6 +239,14 @@ class BlockchainSyncer(object):
                 sender_address = transaction.args['from'],
                 amount = float(transaction.args['value'])/(10**filter.decimals)*100 #To cents
             )
+        return transaction_object
+
+    # Processes a single newly found transaction event
+    # Creates database object for transaction
+    # Calls webhook
+    # Sets sync status (whether or not webhook was successful)
+    def handle_event(self, transaction, filter):
+        transaction_object = self.get_or_create_transaction_object(transaction, filter)
 
         webook_resp = self.call_webhook(transaction_object)
         # Transactions which we fetched, but couldn't sync for whatever reason won't be marked as completed
@@ -131,10 +261,7 @@ class BlockchainSyncer(object):
         # Creates DB objects for every block to monitor status
         config.logg.info(f'Fetching block range {start_block} to {end_block} for contract {contract_address}')
 
-        erc20_contract = self.w3.eth.contract(
-            address = Web3.toChecksumAddress(contract_address),
-            abi = erc20_abi.abi
-        )
+        erc20_contract = self.get_erc20_contract(contract_address)
         try:
             events = erc20_contract.events.Transfer.getLogs(
                 fromBlock = start_block,
@@ -148,7 +275,7 @@ class BlockchainSyncer(object):
             raise Exception(f'Failed fetching block range {start_block} to {end_block} for contract {contract_address}')
 
     # Adds transaction filter to database if it doesn't already exist
-    def add_transaction_filter(self, contract_address, contract_type, filter_parameters, filter_type, decimals = 18, block_epoch=None):
+    def add_transaction_filter(self, contract_address, contract_type, filter_parameters, filter_type, decimals = 18, block_epoch=None, fetch_concurrency=None):
         # See if there's already a filter with the same contract address AND type. If there is, do nothing
         # This lets you always add all filters at app-launch, without running an entire filter every time
         if not contract_address:
@@ -166,7 +293,8 @@ class BlockchainSyncer(object):
                 contract_type,
                 filter_parameters,
                 filter_type, decimals,
-                block_epoch=epoch
+                block_epoch=epoch,
+                fetch_concurrency=fetch_concurrency
             )
 
     def get_metrics(self):
@@ -199,3 +327,13 @@ class BlockchainSyncer(object):
         self.w3 = w3
         self.red = red
         self.persistence = persistence
+
+        self.erc20_contracts = {}
+
+        # Keep-alive session shared by all webhook calls, so we're not opening a new connection per transaction
+        self.webhook_session = requests.Session()
+        self.webhook_session.auth = HTTPBasicAuth(config.INTERNAL_AUTH_USERNAME, config.INTERNAL_AUTH_PASSWORD)
+        self.webhook_session.mount(
+            config.APP_HOST,
+            HTTPAdapter(pool_connections=1, pool_maxsize=sync_const.WEBHOOK_POOL_SIZE)
+        )
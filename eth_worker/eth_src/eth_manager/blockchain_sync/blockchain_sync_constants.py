@@ -1,4 +1,11 @@
 BLOCKS_PER_REQUEST = 1000
+# How many chunks' logs are fetched ahead of the chunk being processed, unless overridden on the filter
+DEFAULT_FETCH_CONCURRENCY = 4
+# How many transactions are sent to the app's batch webhook per request
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_BATCH_TIMEOUT = 120
+# Max number of keep-alive connections held open to the app for webhook calls
+WEBHOOK_POOL_SIZE = 4
 # How long a blockchain_sync lock can last.
 # The lock gets renewed with every synchronized chunk, so the lock will continue to 
 # function in long-running jobs
@@ -9,8 +9,14 @@ from exceptions import PreBlockchainError
 from eth_manager.contract_registry.contract_registry import ContractRegistry
 from celery_utils import eth_endpoint
 import celery_app 
+from web3 import HTTPProvider
+from web3.datastructures import AttributeDict
 from web3.exceptions import TransactionNotFound
 
+# Receipts requested per JSON-RPC batch by the receipt watcher
+RECEIPT_BATCH_SIZE = 100
+RECEIPT_BATCH_TIMEOUT = 30
+
 class EthTransactionProcessor(object):
     """
     Does the grunt work of trying to get a transaction onto an ethereum chain.
@@ -138,7 +144,12 @@ class EthTransactionProcessor(object):
             }
         )
 
-        self._send_signed_transaction(signed_transaction, transaction_id)
+        try:
+            self._send_signed_transaction(signed_transaction, transaction_id)
+        except PreBlockchainError:
+            # Reserved nonces may be out of step with the chain now, so don't keep handing them out
+            self.persistence.locked_release_reserved_nonces(signing_wallet_obj.id)
+            raise
 
 
         # If we've made it this far, the nonce will(?) be consumed
@@ -153,8 +164,26 @@ class EthTransactionProcessor(object):
         return transaction_id
 
     def _calculate_nonce(self, signing_wallet_obj, transaction_id):
+        reserved_nonce = self.persistence.claim_reserved_transaction_nonce(signing_wallet_obj.id, transaction_id)
+        if reserved_nonce is not None:
+            return reserved_nonce
+
         network_nonce = self.w3.eth.getTransactionCount(signing_wallet_obj.address, block_identifier='pending')
 
+        # During bursts (such as bulk disbursements) reserve a block of nonces on the wallet in one locked step,
+        # rather than taking the lock and calling the node for every transaction
+        reservation_size = min(
+            self.nonce_reservation_size,
+            self.persistence.count_transactions_awaiting_nonce(signing_wallet_obj.id)
+        )
+        if reservation_size > 1:
+            self.persistence.locked_reserve_transaction_nonces(
+                network_nonce, signing_wallet_obj.id, reservation_size
+            )
+            reserved_nonce = self.persistence.claim_reserved_transaction_nonce(signing_wallet_obj.id, transaction_id)
+            if reserved_nonce is not None:
+                return reserved_nonce
+
         return self.persistence.locked_claim_transaction_nonce(
             network_nonce, signing_wallet_obj.id, transaction_id
         )
@@ -246,6 +275,71 @@ class EthTransactionProcessor(object):
 
         return self._status_from_hash(transaction_hash)
 
+    def get_transaction_statuses(self, transactions) -> dict:
+        """
+        Gets the status of many transactions at once, fetching their receipts in JSON-RPC batch requests
+        rather than one call per transaction.
+
+        :param transactions: BlockchainTransaction objects to check
+        :return: dict of transaction id to status, in the same format as get_transaction_status
+        """
+        receipts = self._get_transaction_receipts([t.hash for t in transactions if t.hash])
+
+        statuses = {}
+        for transaction in transactions:
+            if transaction.hash:
+                statuses[transaction.id] = self._status_from_receipt(receipts.get(transaction.hash))
+            else:
+                statuses[transaction.id] = self._status_from_hash(None)
+
+        return statuses
+
+    def _get_transaction_receipts(self, transaction_hashes) -> dict:
+        endpoint_uri = getattr(self.w3.provider, 'endpoint_uri', None)
+
+        if not isinstance(self.w3.provider, HTTPProvider) or not endpoint_uri:
+            # Batching needs a plain HTTP provider, so fall back to one call per hash
+            receipts = {}
+            for transaction_hash in transaction_hashes:
+                try:
+                    receipts[transaction_hash] = self.w3.eth.getTransactionReceipt(transaction_hash)
+                except TransactionNotFound:
+                    receipts[transaction_hash] = None
+            return receipts
+
+        receipts = {}
+        for i in range(0, len(transaction_hashes), RECEIPT_BATCH_SIZE):
+            batch = transaction_hashes[i:i + RECEIPT_BATCH_SIZE]
+            payload = [
+                {'jsonrpc': '2.0', 'id': request_id, 'method': 'eth_getTransactionReceipt', 'params': [transaction_hash]}
+                for request_id, transaction_hash in enumerate(batch)
+            ]
+
+            response = requests.post(endpoint_uri, json=payload, timeout=RECEIPT_BATCH_TIMEOUT)
+            response.raise_for_status()
+
+            for item in response.json():
+                # Errored items are left out, so they're treated as still pending
+                if 'error' not in item:
+                    receipts[batch[item['id']]] = self._format_raw_receipt(item.get('result'))
+
+        return receipts
+
+    def _format_raw_receipt(self, raw_receipt):
+        if raw_receipt is None:
+            return None
+
+        def to_int(hex_value):
+            return int(hex_value, 16) if hex_value is not None else None
+
+        contract_address = raw_receipt.get('contractAddress')
+
+        return AttributeDict({
+            'blockNumber': to_int(raw_receipt.get('blockNumber')),
+            'status': to_int(raw_receipt.get('status')),
+            'contractAddress': self.w3.toChecksumAddress(contract_address) if contract_address else None
+        })
+
     def _status_from_hash(self, transaction_hash):
 
         print('watching txn: {} at {}'.format(transaction_hash, datetime.datetime.utcnow()))
@@ -261,6 +355,10 @@ class EthTransactionProcessor(object):
         except TransactionNotFound:
             tx_receipt = None
 
+        return self._status_from_receipt(tx_receipt)
+
+    def _status_from_receipt(self, tx_receipt):
+
         if tx_receipt is None:
             return {'status': 'PENDING'}
 
@@ -312,7 +410,8 @@ class EthTransactionProcessor(object):
             w3,
             gas_price_wei,
             gas_limit,
-            persistence
+            persistence,
+            nonce_reservation_size=1
     ):
 
         self.registry = ContractRegistry(w3)
@@ -323,6 +422,9 @@ class EthTransactionProcessor(object):
         self.persistence = persistence
         self.sigs = SigGenerators()
 
+        # Most nonces to reserve on a wallet at once when several transactions are waiting for one
+        self.nonce_reservation_size = nonce_reservation_size
+
 
 class SigGenerators(object):
 
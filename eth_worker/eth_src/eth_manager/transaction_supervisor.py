@@ -1,4 +1,5 @@
 import datetime
+from collections import Counter
 
 import celery_utils
 import celery_app 
@@ -13,6 +14,11 @@ from eth_manager.eth_transaction_processor import EthTransactionProcessor
 RETRY_TRANSACTION_BASE_TIME = 2
 CHECK_TRANSACTION_BASE_TIME = 2
 CHECK_TRANSACTION_RETRIES_TIME_LIMIT = 4
+# Most submitted transactions the receipt watcher checks per run
+RECEIPT_WATCHER_MAX_TRANSACTIONS = 2000
+# How long after being submitted a transaction that was failed for staying pending too long is still checked for
+# a receipt, in case it's mined late
+RECEIPT_WATCHER_TIMEOUT_RECHECK_SECONDS = 60 * 60
 
 class TransactionSupervisor(object):
     """
@@ -76,6 +82,67 @@ class TransactionSupervisor(object):
             print(e)
             celery_task.retry(countdown=transaction_response_countdown())
 
+    def watch_pending_transactions(self):
+        """
+        Receipt watcher mode. Rather than each transaction having its own check task retrying with backoff,
+        periodically fetch the receipts of every submitted transaction that's still pending in batches,
+        then save the results and start any posterior tasks in bulk.
+        Transactions that sweep_expired_nonces failed for staying pending too long are checked too, for up to
+        RECEIPT_WATCHER_TIMEOUT_RECHECK_SECONDS after they were submitted, so one that's mined late still succeeds.
+
+        :return: dict of the number of transactions checked for each resulting status
+        """
+        transactions = self.persistence.get_submitted_pending_transactions(limit=RECEIPT_WATCHER_MAX_TRANSACTIONS)
+        timed_out_transactions = []
+        if len(transactions) < RECEIPT_WATCHER_MAX_TRANSACTIONS:
+            timed_out_transactions = self.persistence.get_timed_out_submitted_transactions(
+                datetime.datetime.utcnow() - datetime.timedelta(seconds=RECEIPT_WATCHER_TIMEOUT_RECHECK_SECONDS),
+                limit=RECEIPT_WATCHER_MAX_TRANSACTIONS - len(transactions)
+            )
+        transactions = transactions + timed_out_transactions
+
+        if not transactions:
+            return {}
+
+        statuses = self.processor.get_transaction_statuses(transactions)
+
+        resolved = {
+            transaction_id: result for transaction_id, result in statuses.items()
+            if result.get('status') != 'PENDING'
+        }
+        # A timed out transaction that's been mined used its nonce after all, which stops the nonce sweep
+        # handing that nonce out again
+        for transaction in timed_out_transactions:
+            if transaction.id in resolved:
+                resolved[transaction.id] = dict(resolved[transaction.id], nonce_consumed=True)
+
+        self.persistence.update_transactions_data(resolved)
+
+        succeeded_tasks = []
+        failed_tasks = []
+        for transaction in transactions:
+            status = resolved.get(transaction.id, {}).get('status')
+            if transaction.task is None:
+                continue
+            if status == 'SUCCESS':
+                succeeded_tasks.append(transaction.task)
+            elif status == 'FAILED':
+                failed_tasks.append(transaction.task)
+
+        for dep_task in self.persistence.get_unstarted_posteriors_for_tasks([task.id for task in succeeded_tasks]):
+            print('Starting posterior task: {}'.format(dep_task.uuid))
+            self.queue_attempt_transaction(dep_task.uuid)
+
+        self.persistence.set_tasks_status_text(succeeded_tasks, 'SUCCESS')
+
+        for task in failed_tasks:
+            try:
+                self.new_transaction_attempt(task)
+            except TaskRetriesExceededError:
+                pass
+
+        return dict(Counter(result.get('status') for result in statuses.values()))
+
     def attempt_transaction(self, task_uuid):
 
         task = self.persistence.get_task_from_uuid(task_uuid)
@@ -168,9 +235,14 @@ class TransactionSupervisor(object):
         else:
             raise Exception(f"Task type {task.type} not recognised")
 
-        check_response_sig = self.sigs.check_transaction_response()
         error_callback_sig = self.sigs.handle_error(transaction_id)
 
+        if self.use_receipt_watcher:
+            # The outcome is picked up by watch_pending_transactions instead of a check task
+            return chain([txn_sig]).on_error(error_callback_sig)
+
+        check_response_sig = self.sigs.check_transaction_response()
+
         return chain([txn_sig, check_response_sig]).on_error(error_callback_sig)
 
     def _topup_if_required(self, wallet, posterior_task_uuid):
@@ -264,13 +336,15 @@ class TransactionSupervisor(object):
             red,
             persistence,
             processor: EthTransactionProcessor,
-            task_max_retries=3
+            task_max_retries=3,
+            use_receipt_watcher=False
     ):
 
         self.red = red
         self.persistence = persistence
         self.processor = processor
         self.task_max_retries = task_max_retries
+        self.use_receipt_watcher = use_receipt_watcher
         self.sigs = SigGenerators()
 
 class SigGenerators(object):
@@ -1,5 +1,5 @@
 import datetime
-from typing import Tuple
+from typing import Tuple, Optional
 from sqlalchemy import and_, or_
 from sqlalchemy.sql import func
 
@@ -12,13 +12,17 @@ from sql_persistence.models import (
     BlockchainTransaction,
     BlockchainTask,
     BlockchainWallet,
-    SynchronizationFilter
+    SynchronizationFilter,
+    task_dependencies
 )
 
 from exceptions import (
     WalletExistsError
 )
 
+# The error given to transactions that sweep_expired_nonces fails for staying pending too long
+TRANSACTION_TIMEOUT_ERROR = 'Timeout Error'
+
 class SQLPersistenceInterface(object):
 
     def _fail_expired_transactions(self):
@@ -30,7 +34,7 @@ class SQLPersistenceInterface(object):
          .filter(and_(BlockchainTransaction.status == 'PENDING',
                       BlockchainTransaction.updated < expire_time))
          .update({BlockchainTransaction.status: 'FAILED',
-                  BlockchainTransaction.error: 'Timeout Error'},
+                  BlockchainTransaction.error: TRANSACTION_TIMEOUT_ERROR},
                  synchronize_session=False))
 
     def _unconsume_high_failed_nonces(self, signing_wallet_id, stating_nonce):
@@ -59,16 +63,12 @@ class SQLPersistenceInterface(object):
          .update({BlockchainTransaction.nonce_consumed: False},
                  synchronize_session=False))
 
-    def _calculate_nonce(self, signing_wallet_obj, starting_nonce=0):
-
-        self._unconsume_high_failed_nonces(signing_wallet_obj.id, starting_nonce)
-        self._fail_expired_transactions()
-
-        # First find the highest *continuous* nonce that isn't either pending, or consumed
-        # (failed or succeeded on blockchain)
+        return nonce
 
-        likely_consumed_nonces = (
-            self.session.query(BlockchainTransaction)
+    def _held_nonces_query(self, signing_wallet_obj, starting_nonce):
+        # Nonces that are either pending, or consumed (failed or succeeded on blockchain)
+        return (
+            self.session.query(BlockchainTransaction.nonce)
                 .filter(BlockchainTransaction.signing_wallet == signing_wallet_obj)
                 .filter(BlockchainTransaction.ignore == False)
                 .filter(BlockchainTransaction.first_block_hash == self.first_block_hash)
@@ -79,18 +79,101 @@ class SQLPersistenceInterface(object):
                         BlockchainTransaction.nonce >= starting_nonce
                     )
                 )
-                .all())
+        )
+
+    def _seed_nonce_allocator(self, signing_wallet_obj, starting_nonce=0):
+        """
+        Initialises a wallet's nonce allocator from its transaction history. This is the only time
+        the allocator scans transactions, which happens on a wallet's first claim or when the chain changes.
+        """
+        held_nonces = {nonce for (nonce,) in self._held_nonces_query(signing_wallet_obj, starting_nonce)}
+
+        next_nonce = max(held_nonces, default=starting_nonce - 1) + 1
+
+        signing_wallet_obj.next_nonce = next_nonce
+        signing_wallet_obj.released_nonces = sorted(set(range(starting_nonce, next_nonce)) - held_nonces)
+        signing_wallet_obj.nonce_first_block_hash = self.first_block_hash
+        signing_wallet_obj.reserved_nonces = []
+        signing_wallet_obj.nonces_reserved_at = None
+
+    def _allocate_nonce(self, signing_wallet_obj, network_nonce=0):
+        """
+        Hands out the lowest available nonce at or above the network nonce, preferring released gaps.
+        Must be called while holding the wallet's lock.
+        """
+        if (signing_wallet_obj.next_nonce is None
+                or signing_wallet_obj.nonce_first_block_hash != self.first_block_hash):
+            self._seed_nonce_allocator(signing_wallet_obj, network_nonce)
+
+        # Anything below the network nonce has been used on chain, possibly from outside this worker
+        released_nonces = [n for n in signing_wallet_obj.released_nonces or [] if n >= network_nonce]
+
+        if released_nonces:
+            nonce = released_nonces.pop(0)
+        else:
+            nonce = max(signing_wallet_obj.next_nonce, network_nonce)
+            signing_wallet_obj.next_nonce = nonce + 1
+
+        # Reassign rather than mutate so that the JSON column is flagged as modified
+        signing_wallet_obj.released_nonces = released_nonces
+
+        return nonce
+
+    def _release_nonce_gaps(self, signing_wallet_obj):
+        """
+        Returns nonces of expired failures on a wallet to its allocator, so that they can be claimed again.
+        """
+        if (signing_wallet_obj.next_nonce is None
+                or signing_wallet_obj.nonce_first_block_hash != self.first_block_hash):
+            return []
+
+        floor_nonce = self._unconsume_high_failed_nonces(signing_wallet_obj.id, 0)
+
+        held_nonces = {nonce for (nonce,) in self._held_nonces_query(signing_wallet_obj, floor_nonce)}
+
+        failed_nonces = {
+            nonce for (nonce,) in self.session.query(BlockchainTransaction.nonce)
+                .filter(BlockchainTransaction.signing_wallet == signing_wallet_obj)
+                .filter(BlockchainTransaction.first_block_hash == self.first_block_hash)
+                .filter(BlockchainTransaction.status == 'FAILED')
+                .filter(BlockchainTransaction.nonce_consumed == False)
+                .filter(BlockchainTransaction.nonce >= floor_nonce)
+                .filter(BlockchainTransaction.nonce < signing_wallet_obj.next_nonce)
+        }
+
+        existing = set(signing_wallet_obj.released_nonces or [])
+        newly_released = failed_nonces - held_nonces - existing
+
+        signing_wallet_obj.released_nonces = sorted((existing | newly_released) - held_nonces)
+
+        return sorted(newly_released)
+
+    def sweep_expired_nonces(self):
+        """
+        Periodic maintenance for the nonce allocators, which used to happen on every nonce claim.
+        Fails transactions that have been pending for too long, and releases the nonces of expired
+        failures and expired reservations back to their wallet's allocator.
+
+        :return: a dict of wallet address to the nonces released for that wallet
+        """
+        self._fail_expired_transactions()
+        self.session.commit()
+
+        wallets = self.session.query(BlockchainWallet).filter(BlockchainWallet.next_nonce != None).all()
 
-        # Use a set to find continous nonces because txns in db may be out of order
-        nonce_set = set()
-        for txn in likely_consumed_nonces:
-            nonce_set.add(txn.nonce)
+        released = {}
+        for wallet in wallets:
+            with self.red.lock(wallet.address, timeout=600):
+                self.session.refresh(wallet, with_for_update=True)
+                newly_released = self._release_nonce_gaps(wallet)
+                if wallet.reserved_nonces and self._reservation_expired(wallet):
+                    newly_released = sorted(set(newly_released) | set(self._release_reserved_nonces(wallet)))
+                self.session.commit()
 
-        next_nonce = starting_nonce
-        while next_nonce in nonce_set:
-            next_nonce += 1
+            if newly_released:
+                released[wallet.address] = newly_released
 
-        return next_nonce
+        return released
 
     def locked_claim_transaction_nonce(
             self,
@@ -134,7 +217,7 @@ class SQLPersistenceInterface(object):
 
         if transaction.nonce is not None:
             return transaction.nonce
-        calculated_nonce = self._calculate_nonce(signing_wallet, network_nonce)
+        calculated_nonce = self._allocate_nonce(signing_wallet, network_nonce)
         transaction.signing_wallet = signing_wallet
         transaction.nonce = calculated_nonce
         transaction.status = 'PENDING'
@@ -144,6 +227,137 @@ class SQLPersistenceInterface(object):
 
         return calculated_nonce
 
+    def locked_reserve_transaction_nonces(
+            self,
+            network_nonce,
+            signing_wallet_id: int,
+            count: int
+    ):
+        """
+        Reserve a block of nonces on a wallet in a single locked step, so that transactions can claim them
+        using claim_reserved_transaction_nonce without taking the wallet's lock. Does nothing if the wallet
+        already has a current reservation. Reservations are kept on the wallet, so any nonces left unclaimed
+        (for instance because the worker holding them died) are released by sweep_expired_nonces.
+
+        :param network_nonce: the highest nonce that we know has been claimed on chain
+        :param signing_wallet_id: the wallet object that will be used to sign the transactions
+        :param count: how many nonces to reserve
+        """
+
+        signing_wallet = self.session.query(BlockchainWallet).get(signing_wallet_id)
+
+        lock = self.red.lock(signing_wallet.address, timeout=600)
+        self.session.commit()
+        with lock:
+            self.session.commit()
+            self.session.refresh(signing_wallet, with_for_update=True)
+
+            if signing_wallet.reserved_nonces and not self._reservation_expired(signing_wallet):
+                self.session.commit()
+                return
+
+            self._release_reserved_nonces(signing_wallet)
+            signing_wallet.reserved_nonces = [
+                self._allocate_nonce(signing_wallet, network_nonce) for _ in range(count)
+            ]
+            signing_wallet.nonces_reserved_at = datetime.datetime.utcnow()
+            self.session.commit()
+
+    def claim_reserved_transaction_nonce(self, signing_wallet_id: int, transaction_id: int) -> Optional[int]:
+        """
+        Assign the next nonce reserved on a wallet by locked_reserve_transaction_nonces to a transaction.
+        Only the wallet's row is locked, which is enough to stop two transactions claiming the same nonce.
+
+        :return: the transaction's nonce, which is its existing one if it had already claimed a nonce,
+        or None if the wallet has no current reservation
+        """
+        transaction = self.session.query(BlockchainTransaction).get(transaction_id)
+
+        if transaction.nonce is not None:
+            return transaction.nonce
+
+        signing_wallet = (
+            self.session.query(BlockchainWallet)
+                .with_for_update()
+                .populate_existing()
+                .filter(BlockchainWallet.id == signing_wallet_id)
+                .one()
+        )
+
+        if (not signing_wallet.reserved_nonces
+                or self._reservation_expired(signing_wallet)
+                or signing_wallet.nonce_first_block_hash != self.first_block_hash):
+            self.session.commit()
+            return None
+
+        reserved_nonces = list(signing_wallet.reserved_nonces)
+        nonce = reserved_nonces.pop(0)
+
+        # Reassign rather than mutate so that the JSON column is flagged as modified
+        signing_wallet.reserved_nonces = reserved_nonces
+        transaction.signing_wallet = signing_wallet
+        transaction.nonce = nonce
+        transaction.status = 'PENDING'
+        self.session.commit()
+
+        return nonce
+
+    def locked_release_reserved_nonces(self, signing_wallet_id: int):
+        """
+        Hand any nonces still reserved on a wallet back to its allocator, for instance after a transaction
+        failed before it reached the chain and so the rest of the burst is unlikely to get there either.
+        """
+        signing_wallet = self.session.query(BlockchainWallet).get(signing_wallet_id)
+
+        lock = self.red.lock(signing_wallet.address, timeout=600)
+        self.session.commit()
+        with lock:
+            self.session.commit()
+            self.session.refresh(signing_wallet, with_for_update=True)
+
+            self._release_reserved_nonces(signing_wallet)
+            self.session.commit()
+
+    def _reservation_expired(self, signing_wallet_obj):
+        return (
+            signing_wallet_obj.nonces_reserved_at is None
+            or signing_wallet_obj.nonces_reserved_at < datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=self.PENDING_TRANSACTION_EXPIRY_SECONDS
+            )
+        )
+
+    def _release_reserved_nonces(self, signing_wallet_obj):
+        """
+        Moves a wallet's unclaimed reserved nonces back to its released nonces.
+        Must be called while holding both the wallet's lock and its row lock.
+
+        :return: the nonces released
+        """
+        reserved_nonces = signing_wallet_obj.reserved_nonces or []
+
+        # The allocator may have been reseeded for a new chain since the nonces were reserved
+        if reserved_nonces and signing_wallet_obj.nonce_first_block_hash == self.first_block_hash:
+            signing_wallet_obj.released_nonces = sorted(
+                set(signing_wallet_obj.released_nonces or []) | set(reserved_nonces)
+            )
+        else:
+            reserved_nonces = []
+
+        signing_wallet_obj.reserved_nonces = []
+        signing_wallet_obj.nonces_reserved_at = None
+
+        return sorted(reserved_nonces)
+
+    def count_transactions_awaiting_nonce(self, signing_wallet_id: int) -> int:
+        return (
+            self.session.query(func.count(BlockchainTransaction.id))
+                .filter(BlockchainTransaction.signing_wallet_id == signing_wallet_id)
+                .filter(BlockchainTransaction.first_block_hash == self.first_block_hash)
+                .filter(BlockchainTransaction.status == 'PENDING')
+                .filter(BlockchainTransaction.nonce == None)
+                .scalar()
+        )
+
     def update_transaction_data(self, transaction_id, transaction_data):
         transaction = self.session.query(BlockchainTransaction).get(transaction_id)
 
@@ -152,6 +366,61 @@ class SQLPersistenceInterface(object):
                 setattr(transaction, attribute, transaction_data[attribute])
         self.session.commit()
 
+    def update_transactions_data(self, transaction_data_by_id):
+        """
+        Bulk version of update_transaction_data, committing once for all transactions
+
+        :param transaction_data_by_id: dict of transaction id to the data to update that transaction with
+        """
+        if not transaction_data_by_id:
+            return
+
+        transactions = (self.session.query(BlockchainTransaction)
+                        .filter(BlockchainTransaction.id.in_(transaction_data_by_id.keys()))
+                        .all())
+
+        for transaction in transactions:
+            transaction_data = transaction_data_by_id[transaction.id]
+            for attribute in transaction_data:
+                if transaction_data[attribute] != getattr(transaction, attribute):
+                    setattr(transaction, attribute, transaction_data[attribute])
+        self.session.commit()
+
+    def get_submitted_pending_transactions(self, limit=None):
+        """
+        Transactions that have been sent to the chain but whose outcome isn't known yet, oldest first
+        """
+        query = (self.session.query(BlockchainTransaction)
+                 .filter(BlockchainTransaction.status == 'PENDING')
+                 .filter(BlockchainTransaction.hash != None)
+                 .filter(BlockchainTransaction.first_block_hash == self.first_block_hash)
+                 .filter(BlockchainTransaction.is_third_party_transaction == False)
+                 .order_by(BlockchainTransaction.submitted_date.asc()))
+
+        if limit:
+            query = query.limit(limit)
+
+        return query.all()
+
+    def get_timed_out_submitted_transactions(self, submitted_after, limit=None):
+        """
+        Transactions that had been sent to the chain when they were failed for staying pending too long,
+        which may still be mined. Oldest first
+        """
+        query = (self.session.query(BlockchainTransaction)
+                 .filter(BlockchainTransaction.status == 'FAILED')
+                 .filter(BlockchainTransaction.error == TRANSACTION_TIMEOUT_ERROR)
+                 .filter(BlockchainTransaction.hash != None)
+                 .filter(BlockchainTransaction.submitted_date > submitted_after)
+                 .filter(BlockchainTransaction.first_block_hash == self.first_block_hash)
+                 .filter(BlockchainTransaction.is_third_party_transaction == False)
+                 .order_by(BlockchainTransaction.submitted_date.asc()))
+
+        if limit:
+            query = query.limit(limit)
+
+        return query.all()
+
     def create_blockchain_transaction(self, task_uuid):
 
         task = self.session.query(BlockchainTask).filter_by(uuid=task_uuid).first()
@@ -401,6 +670,25 @@ class SQLPersistenceInterface(object):
 
             return unstarted_posteriors
 
+    def get_unstarted_posteriors_for_tasks(self, task_ids):
+        """
+        Bulk version of get_unstarted_posteriors, returning each posterior once even if it follows several tasks
+        """
+        if not task_ids:
+            return []
+
+        return (self.session.query(BlockchainTask)
+                .join(task_dependencies, task_dependencies.c.posterior_task_id == BlockchainTask.id)
+                .filter(task_dependencies.c.prior_task_id.in_(task_ids))
+                .filter(BlockchainTask.status == 'UNSTARTED')
+                .distinct()
+                .all())
+
+    def set_tasks_status_text(self, tasks, text):
+        for task in tasks:
+            task.status_text = text
+        self.session.commit()
+
     def get_unsatisfied_prior_tasks(self, task_uuid):
 
         task = self.get_task_from_uuid(task_uuid=task_uuid)
@@ -489,6 +777,12 @@ class SQLPersistenceInterface(object):
         self.session.commit()
         return transaction
 
+    def mark_transactions_as_completed(self, transactions):
+        for transaction in transactions:
+            transaction.is_synchronized_with_app = True
+        self.session.commit()
+        return transactions
+
     def get_transaction_by_hash(self, hash):
         return self.session.query(BlockchainTransaction).filter(BlockchainTransaction.hash == hash).first()
 
@@ -577,8 +871,8 @@ class SQLPersistenceInterface(object):
             .all()
         return self.__aggregate_tuple_list__(failed_callbacks)
 
-    def add_transaction_filter(self, contract_address, contract_type, filter_parameters, filter_type, decimals, block_epoch):
-        filter = SynchronizationFilter(contract_address=contract_address, contract_type=contract_type, filter_parameters=filter_parameters, max_block=block_epoch, filter_type=filter_type, decimals=decimals)
+    def add_transaction_filter(self, contract_address, contract_type, filter_parameters, filter_type, decimals, block_epoch, fetch_concurrency=None):
+        filter = SynchronizationFilter(contract_address=contract_address, contract_type=contract_type, filter_parameters=filter_parameters, max_block=block_epoch, filter_type=filter_type, decimals=decimals, fetch_concurrency=fetch_concurrency)
         self.session.add(filter)
         self.session.commit()
         return filter
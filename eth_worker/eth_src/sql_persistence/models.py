@@ -5,7 +5,7 @@ from sqlalchemy.orm import sessionmaker, relationship, backref, object_session
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import Table, Column, Integer, String, DateTime, Boolean, ForeignKey, BigInteger, JSON, Numeric
 from sqlalchemy.orm import scoped_session
-from sqlalchemy import select, func, case, event
+from sqlalchemy import select, func, case, event, UniqueConstraint
 
 import requests
 import time
@@ -43,6 +43,20 @@ class BlockchainWallet(ModelBase):
     wei_topup_threshold   = Column(BigInteger())
     last_topup_task_uuid    = Column(String())
 
+    # Nonce allocator state, only ever modified while holding the wallet's redis lock.
+    # next_nonce is the lowest nonce never handed out, and released_nonces are gaps below it
+    # (from expired failures) that can be handed out again. Both are only valid for the chain
+    # identified by nonce_first_block_hash
+    next_nonce              = Column(BigInteger())
+    released_nonces         = Column(JSON, default=[])
+    nonce_first_block_hash  = Column(String())
+
+    # Nonces allocated as a block during a burst of transactions, which transactions claim one at a time while
+    # holding the wallet's row lock rather than its redis lock. Any left unclaimed once the block is older than
+    # the pending transaction expiry are released back to the allocator by the nonce sweep
+    reserved_nonces         = Column(JSON, default=[])
+    nonces_reserved_at      = Column(DateTime)
+
     tasks = relationship('BlockchainTask',
                          backref='signing_wallet',
                          lazy=True,
@@ -313,13 +327,18 @@ class BlockchainTransaction(ModelBase):
 
 class SynchronizationFilter(ModelBase):
     __tablename__ = 'synchronization_filter'
-    contract_address = Column(String, unique=True)
+    # Several filters can watch the same contract with different filter_parameters. Those sharing a max_block
+    # are combined into a single log query during synchronization
+    __table_args__ = (UniqueConstraint('contract_address', 'filter_parameters'),)
+    contract_address = Column(String)
     contract_type = Column(String)
     filter_parameters = Column(String)
     filter_type = Column(String) # TRANSFER, EXCHANGE
     status = Column(String) # ENABLED, DISABLED, SKIP
     max_block = Column(Integer)
     decimals = Column(Integer)
+    # How many block ranges to fetch in parallel when catching up. Falls back to DEFAULT_FETCH_CONCURRENCY if null
+    fetch_concurrency = Column(Integer)
 
 # When BlockchainTransaction is updated, let the api layer know about it
 @event.listens_for(BlockchainTransaction, 'after_update')
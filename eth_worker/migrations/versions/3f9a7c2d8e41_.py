@@ -0,0 +1,24 @@
+"""Add fetch_concurrency to synchronization_filter
+
+Revision ID: 3f9a7c2d8e41
+Revises: b930c0a15ab8
+Create Date: 2026-10-18 10:41:07.552013
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a7c2d8e41'
+down_revision = 'b930c0a15ab8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('synchronization_filter', sa.Column('fetch_concurrency', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('synchronization_filter', 'fetch_concurrency')
@@ -0,0 +1,26 @@
+"""Store nonce reservations on blockchain_wallet
+
+Revision ID: 5c8e2f1a9d34
+Revises: a41c6e9f2b57
+Create Date: 2026-10-19 09:14:52.660318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8e2f1a9d34'
+down_revision = 'a41c6e9f2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('blockchain_wallet', sa.Column('reserved_nonces', sa.JSON(), nullable=True))
+    op.add_column('blockchain_wallet', sa.Column('nonces_reserved_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('blockchain_wallet', 'nonces_reserved_at')
+    op.drop_column('blockchain_wallet', 'reserved_nonces')
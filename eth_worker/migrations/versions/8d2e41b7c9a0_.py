@@ -0,0 +1,29 @@
+"""Allow multiple synchronization filters per contract
+
+Revision ID: 8d2e41b7c9a0
+Revises: 3f9a7c2d8e41
+Create Date: 2026-10-18 11:20:33.918245
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e41b7c9a0'
+down_revision = '3f9a7c2d8e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('synchronization_filter_contract_address_key', 'synchronization_filter', type_='unique')
+    op.create_unique_constraint(
+        'synchronization_filter_contract_address_filter_parameters_key',
+        'synchronization_filter',
+        ['contract_address', 'filter_parameters']
+    )
+
+
+def downgrade():
+    op.drop_constraint('synchronization_filter_contract_address_filter_parameters_key', 'synchronization_filter', type_='unique')
+    op.create_unique_constraint('synchronization_filter_contract_address_key', 'synchronization_filter', ['contract_address'])
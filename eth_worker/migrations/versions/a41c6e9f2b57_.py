@@ -0,0 +1,29 @@
+"""Add nonce allocator state to blockchain_wallet
+
+Revision ID: a41c6e9f2b57
+Revises: 8d2e41b7c9a0
+Create Date: 2026-10-18 12:02:14.306127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c6e9f2b57'
+down_revision = '8d2e41b7c9a0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Allocators are seeded from blockchain_transaction on first claim, so no backfill is required
+    op.add_column('blockchain_wallet', sa.Column('next_nonce', sa.BigInteger(), nullable=True))
+    op.add_column('blockchain_wallet', sa.Column('released_nonces', sa.JSON(), nullable=True))
+    op.add_column('blockchain_wallet', sa.Column('nonce_first_block_hash', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('blockchain_wallet', 'nonce_first_block_hash')
+    op.drop_column('blockchain_wallet', 'released_nonces')
+    op.drop_column('blockchain_wallet', 'next_nonce')
@@ -25,6 +25,42 @@ def test_calculate_nonce(dummy_transaction, second_dummy_transaction, noncer, pr
     assert processor._calculate_nonce(wallet, second_dummy_transaction.id) == 3
 
 
+def test_calculate_nonce_with_reservation(
+        mocker, db_session, dummy_wallet, noncer, processor, persistence_module
+):
+    import datetime
+    from sql_persistence.models import BlockchainTransaction
+
+    mocker.patch.object(processor, 'nonce_reservation_size', 3)
+
+    transactions = []
+    for _ in range(3):
+        t = BlockchainTransaction(signing_wallet=dummy_wallet, first_block_hash=persistence_module.first_block_hash)
+        db_session.add(t)
+        transactions.append(t)
+    db_session.commit()
+
+    get_transaction_count = mocker.patch.object(
+        processor.w3.eth, 'getTransactionCount', wraps=processor.w3.eth.getTransactionCount
+    )
+
+    # All three are awaiting nonces, so the first claim reserves a block on the wallet and the second claims from it
+    assert processor._calculate_nonce(dummy_wallet, transactions[0].id) == 0
+    assert processor._calculate_nonce(dummy_wallet, transactions[1].id) == 1
+    assert get_transaction_count.call_count == 1
+    assert dummy_wallet.reserved_nonces == [2]
+
+    # A reservation left behind by a worker that died is released by the sweep once it expires
+    dummy_wallet.nonces_reserved_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    db_session.commit()
+
+    persistence_module.sweep_expired_nonces()
+    assert dummy_wallet.reserved_nonces == []
+    assert dummy_wallet.released_nonces == [2]
+
+    assert processor._calculate_nonce(dummy_wallet, transactions[2].id) == 2
+
+
 @pytest.mark.parametrize("unbuilt_transaction, gas_limit, gas_price, expected", [
     (MockUnbuiltTransaction(), None, 123456, {'gas': 100000, 'gasPrice': 123456, 'nonce': 0, 'chainId': 1}),
     (MockUnbuiltTransaction(), 654321, None, {'gas': 654321, 'gasPrice': 100, 'nonce': 0, 'chainId': 1}),
@@ -99,3 +135,43 @@ def test_compile_transaction_metadata(dummy_transaction, processor, unbuilt_tran
 #
 #     if status_code == 200:
 #         assert isinstance(response.json['data']['filters'], list)
+
+
+def test_get_transaction_statuses_batches_receipts(mocker, processor):
+    from web3 import HTTPProvider
+    from sql_persistence.models import BlockchainTransaction
+
+    mocker.patch.object(processor.w3, 'provider', HTTPProvider('http://localhost:8545'))
+
+    succeeded = BlockchainTransaction(hash='0xaaaa')
+    succeeded.id = 1
+    failed = BlockchainTransaction(hash='0xbbbb')
+    failed.id = 2
+    pending = BlockchainTransaction(hash='0xcccc')
+    pending.id = 3
+    unhashed = BlockchainTransaction()
+    unhashed.id = 4
+
+    class MockResponse(object):
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return [
+                {'id': 0, 'result': {'blockNumber': '0x10', 'status': '0x1', 'contractAddress': None}},
+                {'id': 1, 'result': {'blockNumber': '0x11', 'status': '0x0', 'contractAddress': None}},
+                {'id': 2, 'result': None},
+            ]
+
+    post = mocker.patch('requests.post', return_value=MockResponse())
+
+    statuses = processor.get_transaction_statuses([succeeded, failed, pending, unhashed])
+
+    # One request for all three hashes
+    assert post.call_count == 1
+    assert [r['params'] for r in post.call_args[1]['json']] == [['0xaaaa'], ['0xbbbb'], ['0xcccc']]
+
+    assert statuses[1]['status'] == 'SUCCESS' and statuses[1]['block'] == 16
+    assert statuses[2]['status'] == 'FAILED' and statuses[2]['block'] == 17
+    assert statuses[3] == {'status': 'PENDING'}
+    assert statuses[4]['status'] == 'FAILED'
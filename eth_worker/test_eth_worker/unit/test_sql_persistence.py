@@ -157,6 +157,9 @@ class TestInterface:
 
         transactions[0].status = 'FAILED'
 
+        # Failed nonces are only handed back to the allocator by the periodic sweep
+        assert persistence_module.sweep_expired_nonces() == {wallet.address: [starting_nonce]}
+
         trans, nonce = created_nonced_transaction()
         transactions.append(trans)
 
@@ -168,6 +171,61 @@ class TestInterface:
         # transactions.append(trans)
         # assert trans.nonce == starting_nonce + 1
 
+    def test_seed_nonce_allocator(self, db_session, persistence_module: SQLPersistenceInterface):
+        wallet = BlockchainWallet()
+        db_session.add(wallet)
+
+        # Transactions from before the allocator existed, with a gap at nonce 3
+        for nonce in [2, 4]:
+            t = BlockchainTransaction(first_block_hash=persistence_module.first_block_hash)
+            t.signing_wallet = wallet
+            t.nonce = nonce
+            t.status = 'PENDING'
+            db_session.add(t)
+        db_session.commit()
+
+        assert persistence_module._allocate_nonce(wallet, network_nonce=2) == 3
+        assert persistence_module._allocate_nonce(wallet, network_nonce=2) == 5
+        assert wallet.next_nonce == 6
+
+        # Released gaps below the network nonce have been used elsewhere and are dropped
+        wallet.released_nonces = [3]
+        assert persistence_module._allocate_nonce(wallet, network_nonce=7) == 7
+        assert wallet.released_nonces == []
+
+    def test_unordered_nonce_claims(self, db_session, persistence_module: SQLPersistenceInterface):
+        # Transfers of the same disbursement share a batch uuid, so the app sends them without prior tasks
+        # between them and the worker can process them in any order. They're all signed by the organisation's
+        # wallet, which hands out nonces, so they still get distinct nonces with no gaps
+        wallet = BlockchainWallet()
+        db_session.add(wallet)
+
+        transactions = []
+        for _ in range(6):
+            t = BlockchainTransaction(first_block_hash=persistence_module.first_block_hash)
+            t.signing_wallet = wallet
+            db_session.add(t)
+            transactions.append(t)
+        db_session.commit()
+
+        network_nonce = 4
+        persistence_module.locked_reserve_transaction_nonces(network_nonce, wallet.id, 3)
+
+        nonces = []
+        for t in reversed(transactions):
+            nonce = persistence_module.claim_reserved_transaction_nonce(wallet.id, t.id)
+            if nonce is None:
+                nonce = persistence_module.locked_claim_transaction_nonce(network_nonce, wallet.id, t.id)
+            nonces.append(nonce)
+
+        assert sorted(nonces) == list(range(network_nonce, network_nonce + 6))
+        assert [t.nonce for t in reversed(transactions)] == nonces
+
+        # A transaction that's retried keeps its nonce
+        assert persistence_module.locked_claim_transaction_nonce(
+            network_nonce, wallet.id, transactions[0].id
+        ) == transactions[0].nonce
+
     def test_update_transaction_data(self, db_session, persistence_module: SQLPersistenceInterface):
         transaction = BlockchainTransaction()
         db_session.add(transaction)
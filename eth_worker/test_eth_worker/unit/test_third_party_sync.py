@@ -1,4 +1,5 @@
 import pytest
+from web3 import Web3
 
 from sql_persistence.interface import SQLPersistenceInterface
 from sql_persistence.models import BlockchainTransaction
@@ -131,11 +132,48 @@ class TestModels:
         mocker.patch.object(blockchain_sync, 'get_latest_block_number', lambda: 12000)
 
         ranges = []
-        mocker.patch.object(blockchain_sync, 'process_chunk', lambda filter, floor, ceiling: ranges.append((filter.id, floor, ceiling)))
+        mocker.patch.object(blockchain_sync, 'fetch_chunk', lambda filter, floor, ceiling: [])
+        mocker.patch.object(blockchain_sync, 'process_chunk', lambda filter, floor, ceiling, transaction_history=None: ranges.append((filter.id, floor, ceiling)))
         blockchain_sync_constants.BLOCKS_PER_REQUEST=5000
         blockchain_sync.synchronize_third_party_transactions()
         assert ranges == [(1, 2, 5001), (1, 5002, 10001), (1, 10002, 12000), (2, 2, 5001), (2, 5002, 10001), (2, 10002, 12000)]
 
+    def test_synchronize_checkpoints_in_order(
+            self, mocker, blockchain_sync, processor, persistence_module: SQLPersistenceInterface
+    ):
+        tf = blockchain_sync.add_transaction_filter(
+            self.contract_address,
+            self.contract_type,
+            self.filter_parameters,
+            self.filter_type,
+            self.decimals,
+            self.block_epoch,
+            fetch_concurrency=3
+        )
+
+        mocker.patch.object(blockchain_sync, 'get_latest_block_number', lambda: 5000)
+
+        # Later chunks finish fetching before earlier ones, and the third chunk fails to fetch
+        import time
+        def slow_fetch(filter, floor, ceiling):
+            time.sleep(0.1 if floor == 2 else 0)
+            if floor == 2002:
+                raise Exception('Fetch failed')
+            return [(floor, ceiling)]
+        mocker.patch.object(blockchain_sync, 'fetch_chunk', slow_fetch)
+
+        processed = []
+        mocker.patch.object(blockchain_sync, 'process_chunk',
+                            lambda filter, floor, ceiling, transaction_history=None: processed.append(transaction_history))
+        blockchain_sync_constants.BLOCKS_PER_REQUEST=1000
+
+        with pytest.raises(Exception):
+            blockchain_sync.synchronize_third_party_transactions()
+
+        # Only the chunks before the failure are processed, in order, and the checkpoint stops before the failed range
+        assert processed == [[(2, 1001)], [(1002, 2001)]]
+        assert tf.max_block == 2001
+
     def test_skip(self, mocker, blockchain_sync, processor, persistence_module: SQLPersistenceInterface):
         # Create filters for this function to consume
         tf = blockchain_sync.add_transaction_filter(
@@ -361,3 +399,100 @@ class TestModels:
         blockchain_sync.force_recall_webhook('0x4444444444444444444444445')
 
         assert fail_tx.is_synchronized_with_app == True
+
+    def test_process_chunk_batches_webhook(self, mocker, blockchain_sync, processor, persistence_module: SQLPersistenceInterface):
+        class DummyFilter():
+            contract_address = '0x468F90c5a236130E5D51260A2A5Bfde834C694b6'
+            filter_parameters = None
+            id = 1
+            decimals = 18
+
+        events = [
+            self.Transaction(10, f'0x{i}{i}{i}{i}', self.contract_address, False, '0x2222', '0x3333', 10)
+            for i in range(1, 4)
+        ]
+        for e in events:
+            e.blockNumber = 10
+        mocker.patch.object(blockchain_sync, 'get_blockchain_transaction_history', lambda *args: iter(events))
+
+        posted_bodies = []
+        class RequestsResp():
+            ok = True
+            def json(self):
+                return {'data': {'results': [
+                    {'blockchain_transaction_hash': t['blockchain_transaction_hash'],
+                     'ok': t['blockchain_transaction_hash'] != '0x2222'}
+                    for t in posted_bodies[-1]['transfers']
+                ]}}
+        def mock_post(url, json, timeout):
+            posted_bodies.append(json)
+            return RequestsResp()
+        mocker.patch.object(blockchain_sync.webhook_session, 'post', mock_post)
+
+        mocker.patch.object(blockchain_sync_constants, 'WEBHOOK_BATCH_SIZE', 2)
+        blockchain_sync.process_chunk(DummyFilter(), 1, 20)
+
+        # Three transactions are sent in two requests, rather than one request each
+        assert [len(b['transfers']) for b in posted_bodies] == [2, 1]
+        for e in events:
+            tx = persistence_module.get_transaction(hash=e.transactionHash.hex())
+            assert tx.is_synchronized_with_app == (e.transactionHash.hex() != '0x2222')
+
+    def test_synchronize_combines_same_contract_filters(
+            self, mocker, blockchain_sync, processor, persistence_module: SQLPersistenceInterface
+    ):
+        # Two filters on the same contract and starting block, differing only in their parameters
+        to_filter = blockchain_sync.add_transaction_filter(
+            self.contract_address, self.contract_type, '{"to": "0x2222"}', self.filter_type, self.decimals, self.block_epoch
+        )
+        from_filter = blockchain_sync.add_transaction_filter(
+            self.contract_address, self.contract_type, '{"from": "0x2222"}', self.filter_type, self.decimals, self.block_epoch
+        )
+
+        mocker.patch.object(blockchain_sync, 'get_latest_block_number', lambda: 1000)
+
+        incoming = self.Transaction(10, '0xaaaa', self.contract_address, False, '0x2222', '0x3333', 10)
+        outgoing = self.Transaction(10, '0xbbbb', self.contract_address, False, '0x3333', '0x2222', 10)
+
+        log_queries = []
+        def get_history(contract_address, start_block, end_block='latest', argument_filters=None, filter_id=None):
+            log_queries.append((contract_address, start_block, end_block, argument_filters))
+            return iter([incoming, outgoing])
+        mocker.patch.object(blockchain_sync, 'get_blockchain_transaction_history', get_history)
+
+        processed = {}
+        mocker.patch.object(blockchain_sync, 'process_chunk',
+                            lambda filter, floor, ceiling, transaction_history=None:
+                            processed.setdefault(filter.id, []).extend(transaction_history))
+        mocker.patch.object(blockchain_sync_constants, 'BLOCKS_PER_REQUEST', 5000)
+
+        blockchain_sync.synchronize_third_party_transactions()
+
+        # One log query is shared by both filters, and each only receives its own events
+        assert log_queries == [(self.contract_address, 2, 1000, None)]
+        assert processed == {to_filter.id: [incoming], from_filter.id: [outgoing]}
+        assert to_filter.max_block == from_filter.max_block == 1000
+
+    def test_event_matches_filter_ignores_address_case(self, blockchain_sync):
+        recipient = Web3.toChecksumAddress('0xa9450d3db5a909b08197bc4a0665a4d632537777')
+        class DummyFilter():
+            filter_parameters = '{"to": "0xa9450d3db5a909b08197bc4a0665a4d632537777"}'
+
+        matching = self.Transaction(10, '0xaaaa', self.contract_address, False, recipient, '0x3333', 10)
+        other = self.Transaction(10, '0xbbbb', self.contract_address, False, '0x3333', recipient, 10)
+
+        assert blockchain_sync.event_matches_filter(matching, DummyFilter())
+        assert not blockchain_sync.event_matches_filter(other, DummyFilter())
+
+    def test_erc20_contract_is_cached(self, mocker, blockchain_sync):
+        contract_calls = []
+        def dummy_contract(*args, **kwargs):
+            contract_calls.append(kwargs['address'])
+            return object()
+        mocker.patch.object(blockchain_sync.w3.eth, 'contract', dummy_contract)
+
+        first = blockchain_sync.get_erc20_contract(self.contract_address)
+        second = blockchain_sync.get_erc20_contract(self.contract_address.lower())
+
+        assert first is second
+        assert len(contract_calls) == 1
@@ -0,0 +1,82 @@
+import datetime
+
+from sql_persistence.models import BlockchainTask, BlockchainTransaction
+
+from utils import str_uuid
+
+
+def test_watch_pending_transactions(mocker, db_session, supervisor, dummy_wallet, mock_queue_sig):
+    first_block_hash = supervisor.persistence.first_block_hash
+
+    def submitted_task(hash):
+        task = BlockchainTask(uuid=str_uuid(), signing_wallet=dummy_wallet)
+        transaction = BlockchainTransaction(signing_wallet=dummy_wallet, first_block_hash=first_block_hash, hash=hash)
+        transaction.task = task
+        db_session.add_all([task, transaction])
+        return task, transaction
+
+    succeeded_task, succeeded = submitted_task('0xaaaa')
+    pending_task, pending = submitted_task('0xbbbb')
+
+    posterior = BlockchainTask(uuid=str_uuid(), signing_wallet=dummy_wallet)
+    posterior.prior_tasks.append(succeeded_task)
+    db_session.add(posterior)
+    db_session.commit()
+
+    checked = []
+    def get_transaction_statuses(transactions):
+        checked.append([t.id for t in transactions])
+        return {
+            succeeded.id: {'status': 'SUCCESS', 'block': 10},
+            pending.id: {'status': 'PENDING'},
+        }
+    mocker.patch.object(supervisor.processor, 'get_transaction_statuses', get_transaction_statuses)
+
+    assert supervisor.watch_pending_transactions() == {'SUCCESS': 1, 'PENDING': 1}
+
+    # All pending transactions are checked in a single call
+    assert len(checked) == 1 and set(checked[0]) == {succeeded.id, pending.id}
+
+    assert succeeded.status == 'SUCCESS'
+    assert succeeded.block == 10
+    assert succeeded_task.status_text == 'SUCCESS'
+    assert pending.status == 'PENDING'
+
+    # Only the posterior of the successful task is started
+    assert len(mock_queue_sig) == 1
+    assert mock_queue_sig[0][0].kwargs['task_uuid'] == posterior.uuid
+
+
+def test_watch_pending_transactions_after_timeout(mocker, db_session, supervisor, dummy_wallet, mock_queue_sig):
+    task = BlockchainTask(uuid=str_uuid(), signing_wallet=dummy_wallet)
+    transaction = BlockchainTransaction(
+        signing_wallet=dummy_wallet,
+        first_block_hash=supervisor.persistence.first_block_hash,
+        hash='0xcccc',
+        submitted_date=datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+    )
+    transaction.task = task
+    posterior = BlockchainTask(uuid=str_uuid(), signing_wallet=dummy_wallet)
+    posterior.prior_tasks.append(task)
+    db_session.add_all([task, transaction, posterior])
+    db_session.commit()
+
+    # Still pending well past the expiry, so the sweep fails it
+    transaction.updated = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+    db_session.commit()
+    supervisor.persistence.sweep_expired_nonces()
+    db_session.refresh(transaction)
+    assert transaction.status == 'FAILED'
+
+    # But it's mined after all, and the watcher picks that up
+    mocker.patch.object(
+        supervisor.processor, 'get_transaction_statuses',
+        return_value={transaction.id: {'status': 'SUCCESS', 'block': 11}}
+    )
+    assert supervisor.watch_pending_transactions() == {'SUCCESS': 1}
+
+    assert transaction.status == 'SUCCESS'
+    assert transaction.nonce_consumed
+    assert task.status_text == 'SUCCESS'
+    assert len(mock_queue_sig) == 1
+    assert mock_queue_sig[0][0].kwargs['task_uuid'] == posterior.uuid